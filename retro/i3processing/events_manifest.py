@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position, range-builtin-not-iterating
+
+"""
+Manifest of the leaf directories (each containing an "events.npy" file) under a
+Retro events root directory, so that the number of events in each directory
+and the aggregate index of each directory's first event are known without
+walking the directory tree and loading every "events.npy" file.
+
+The manifest is stored as "events_manifest.json" in the events root directory;
+build or refresh it (e.g. after extracting more events) by running this
+script. `retro.init_obj.get_events` uses the manifest if present.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'EVENTS_MANIFEST_FNAME',
+    'EVENTS_MANIFEST_VERSION',
+    'iter_events_dirs',
+    'build_events_manifest',
+    'load_events_manifest',
+    'iter_leaf_dirs',
+    'get_agg_slice',
+    'range_to_slice_kw',
+    'iter_selected_leaf_dirs',
+    'test_get_agg_slice',
+    'parse_args',
+    'main',
+]
+
+__author__ = 'J.L. Lanfranchi'
+__license__ = '''Copyright 2019 Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+from os import remove, rename, walk
+from os.path import abspath, dirname, getmtime, isfile, join, relpath
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+import time
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro.utils.misc import expand, mkdir, nsort_key_func
+
+
+EVENTS_MANIFEST_FNAME = 'events_manifest.json'
+"""Name of the manifest file in an events root directory"""
+
+EVENTS_MANIFEST_VERSION = 1
+
+
+def iter_events_dirs(events_root):
+    """Walk `events_root` (following symlinks, in natural-sort order) and
+    yield each directory containing an "events.npy" file.
+
+    This defines the order of events in the aggregate of all events under
+    `events_root`.
+
+    Parameters
+    ----------
+    events_root : string
+
+    Yields
+    ------
+    dirpath : string
+
+    """
+    for dirpath, dirs, files in walk(expand(events_root), followlinks=True):
+        dirs.sort(key=nsort_key_func)
+        if 'events.npy' in files:
+            yield dirpath
+
+
+def _get_num_events(dirpath):
+    """Number of events in a leaf dir (reads only the .npy header)"""
+    return len(np.load(join(dirpath, 'events.npy'), mmap_mode='r'))
+
+
+def build_events_manifest(events_root, refresh=False):
+    """Build (or refresh) the manifest of an events root directory.
+
+    Parameters
+    ----------
+    events_root : string
+    refresh : bool, optional
+        If True and a manifest exists, leaf directories whose "events.npy"
+        has not been modified since the manifest was built are not reloaded;
+        the directory tree is always re-walked to find new or removed leaf
+        directories
+
+    Returns
+    -------
+    manifest : OrderedDict
+
+    """
+    t0 = time.time()
+    events_root = expand(events_root)
+    manifest_fpath = join(events_root, EVENTS_MANIFEST_FNAME)
+
+    previous = {}
+    if refresh and isfile(manifest_fpath):
+        for leaf in load_events_manifest(events_root)['leaf_dirs']:
+            previous[leaf['path']] = leaf
+
+    leaf_dirs = []
+    offset = 0
+    num_reused = 0
+    for dirpath in iter_events_dirs(events_root):
+        rel_path = relpath(dirpath, events_root)
+        mtime = getmtime(join(dirpath, 'events.npy'))
+        prev = previous.get(rel_path)
+        if prev is not None and prev['mtime'] == mtime:
+            num_events = prev['num_events']
+            num_reused += 1
+        else:
+            num_events = _get_num_events(dirpath)
+        leaf_dirs.append(
+            OrderedDict(
+                [
+                    ('path', rel_path),
+                    ('num_events', num_events),
+                    ('offset', offset),
+                    ('mtime', mtime),
+                ]
+            )
+        )
+        offset += num_events
+
+    manifest = OrderedDict(
+        [
+            ('version', EVENTS_MANIFEST_VERSION),
+            ('num_events', offset),
+            ('leaf_dirs', leaf_dirs),
+        ]
+    )
+
+    # Write atomically since running jobs may be reading the manifest
+    tmp_fpath = manifest_fpath + '.tmp'
+    with open(tmp_fpath, 'w') as fobj:
+        json.dump(manifest, fobj, indent=1)
+    try:
+        rename(tmp_fpath, manifest_fpath)
+    except Exception:
+        remove(tmp_fpath)
+        raise
+
+    print(
+        'Wrote manifest of {} events in {} leaf dirs ({} unchanged) to "{}" in {:.3f} s'
+        .format(offset, len(leaf_dirs), num_reused, manifest_fpath, time.time() - t0)
+    )
+    return manifest
+
+
+def load_events_manifest(events_root):
+    """Load the manifest of an events root directory.
+
+    Parameters
+    ----------
+    events_root : string
+
+    Returns
+    -------
+    manifest : OrderedDict or None
+        None if there is no manifest
+
+    """
+    manifest_fpath = join(expand(events_root), EVENTS_MANIFEST_FNAME)
+    if not isfile(manifest_fpath):
+        return None
+    with open(manifest_fpath, 'r') as fobj:
+        manifest = json.load(fobj, object_pairs_hook=OrderedDict)
+    if manifest.get('version') != EVENTS_MANIFEST_VERSION:
+        raise ValueError(
+            'Manifest "{}" has version {}, expected {}; rebuild it'.format(
+                manifest_fpath, manifest.get('version'), EVENTS_MANIFEST_VERSION
+            )
+        )
+    return manifest
+
+
+def iter_leaf_dirs(events_root):
+    """Iterate over the leaf directories of an events root directory and the
+    number of events in each, using the manifest if present and otherwise
+    walking the directory tree.
+
+    Parameters
+    ----------
+    events_root : string
+
+    Yields
+    ------
+    dirpath : string
+    num_events : int
+
+    """
+    events_root = expand(events_root)
+    manifest = load_events_manifest(events_root)
+    if manifest is None:
+        for dirpath in iter_events_dirs(events_root):
+            yield dirpath, _get_num_events(dirpath)
+    else:
+        for leaf in manifest['leaf_dirs']:
+            yield join(events_root, leaf['path']), leaf['num_events']
+
+
+def get_agg_slice(num_events, slice_kw, agg_offset, agg_start=0, agg_stop=None, agg_step=1):
+    """Find which events of a leaf directory are selected by slicing its
+    events with `slice_kw` and then slicing the aggregate of all directories'
+    (sliced) events with [agg_start:agg_stop:agg_step].
+
+    Parameters
+    ----------
+    num_events : int
+        Number of events in the directory
+    slice_kw : mapping
+        `start`, `stop`, and `step` for slicing the directory's events
+    agg_offset : int
+        Aggregate index of the first event (after slicing) of the directory
+    agg_start : int >= 0, optional
+    agg_stop : int or None, optional
+    agg_step : int >= 1, optional
+
+    Returns
+    -------
+    num_sliced : int
+        Number of events in the directory after slicing with `slice_kw`
+    file_slice_kw : dict or None
+        `start`, `stop`, and `step` selecting, from the directory's events, the
+        events to yield; None if there are none
+    agg_indices : range
+        Aggregate indices of the events to yield
+
+    """
+    sliced = range(num_events)[slice(slice_kw.get('start'), slice_kw.get('stop'),
+                                     slice_kw.get('step'))]
+    num_sliced = len(sliced)
+
+    # First aggregate index within this dir satisfying the aggregate slicing
+    low = max(agg_start, agg_offset)
+    first = agg_start + -(-(low - agg_start) // agg_step) * agg_step
+    high = agg_offset + num_sliced
+    if agg_stop is not None:
+        high = min(high, agg_stop)
+    agg_indices = range(first, max(first, high), agg_step)
+    if len(agg_indices) == 0:
+        return num_sliced, None, agg_indices
+
+    selected = sliced[first - agg_offset : high - agg_offset : agg_step]
+    return num_sliced, range_to_slice_kw(selected), agg_indices
+
+
+def range_to_slice_kw(indices):
+    """Convert a `range` of non-negative indices to `start`, `stop`, and
+    `step` arguments for `slice` that select the same elements.
+
+    Parameters
+    ----------
+    indices : range
+
+    Returns
+    -------
+    slice_kw : dict
+
+    """
+    return dict(
+        start=indices.start,
+        # A negative stop would be interpreted as counting from the end
+        stop=indices.stop if indices.stop >= 0 else None,
+        step=indices.step,
+    )
+
+
+def iter_selected_leaf_dirs(events_roots, slice_kw=None, agg_start=None, agg_stop=None,
+                            agg_step=None):
+    """Iterate over the leaf directories under `events_roots` that contain
+    events selected by slicing each directory's events with `slice_kw` and
+    then slicing the aggregate of all (sliced) events with
+    [agg_start:agg_stop:agg_step].
+
+    Parameters
+    ----------
+    events_roots : sequence of strings
+    slice_kw : mapping, optional
+    agg_start, agg_stop, agg_step : int or None, optional
+
+    Yields
+    ------
+    dirpath : string
+    num_events : int
+        Number of events in the directory (before slicing)
+    file_slice_kw : dict
+        `start`, `stop`, and `step` selecting the directory's selected events
+    agg_indices : range
+        Aggregate indices of the selected events
+
+    """
+    if slice_kw is None:
+        slice_kw = {}
+    agg_start = 0 if agg_start is None else agg_start
+    agg_step = 1 if agg_step is None else agg_step
+
+    # Aggregate index of the first (sliced) event in the current leaf dir
+    agg_offset = 0
+    for events_root in events_roots:
+        for dirpath, num_events in iter_leaf_dirs(events_root):
+            if agg_stop is not None and agg_offset >= agg_stop:
+                return
+            num_sliced, file_slice_kw, agg_indices = get_agg_slice(
+                num_events=num_events,
+                slice_kw=slice_kw,
+                agg_offset=agg_offset,
+                agg_start=agg_start,
+                agg_stop=agg_stop,
+                agg_step=agg_step,
+            )
+            agg_offset += num_sliced
+            if file_slice_kw is not None:
+                yield dirpath, num_events, file_slice_kw, agg_indices
+
+
+def test_get_agg_slice():
+    """Unit tests for functions `get_agg_slice`, `range_to_slice_kw`, and
+    `iter_selected_leaf_dirs`."""
+    rand = np.random.RandomState(seed=0)
+    tmpdir = mkdtemp(suffix='test_get_agg_slice')
+    try:
+        # Two events roots with leaf dirs of various sizes, including empty
+        events_roots = []
+        leaf_sizes = []
+        for root_idx, sizes in enumerate([[3, 0, 7, 1, 12], [5, 0, 0, 9]]):
+            events_root = join(tmpdir, 'root{}'.format(root_idx))
+            events_roots.append(events_root)
+            for leaf_idx, num_events in enumerate(sizes):
+                leaf_dir = join(events_root, 'leaf{}'.format(leaf_idx))
+                mkdir(leaf_dir)
+                np.save(join(leaf_dir, 'events.npy'), np.arange(num_events))
+                leaf_sizes.append((leaf_dir, num_events))
+
+        for use_manifest in [False, True]:
+            if use_manifest:
+                for events_root in events_roots:
+                    build_events_manifest(events_root)
+
+            for _ in range(2000):
+                slice_kw = dict(
+                    start=rand.choice([None, 0, 1, 2, 5, -1, -3]),
+                    stop=rand.choice([None, 0, 1, 4, 8, -1, -2]),
+                    step=rand.choice([None, 1, 2, 3, -1, -2]),
+                )
+                agg_start = rand.choice([None, 0, 1, 3, 10, 20])
+                agg_stop = rand.choice([None, 0, 2, 5, 11, 17, 30, 100])
+                agg_step = rand.choice([None, 1, 2, 3, 7])
+
+                # Aggregate of all (sliced) events as (dirpath, event index)
+                agg = []
+                for dirpath, num_events in leaf_sizes:
+                    agg.extend(
+                        (dirpath, idx)
+                        for idx in list(range(num_events))[
+                            slice(slice_kw['start'], slice_kw['stop'], slice_kw['step'])
+                        ]
+                    )
+                ref_indices = list(range(len(agg)))[
+                    slice(agg_start, agg_stop, agg_step)
+                ]
+                ref = [agg[i] for i in ref_indices]
+
+                test_indices = []
+                test = []
+                for dirpath, num_events, file_slice_kw, agg_indices in (
+                        iter_selected_leaf_dirs(
+                            events_roots,
+                            slice_kw=slice_kw,
+                            agg_start=agg_start,
+                            agg_stop=agg_stop,
+                            agg_step=agg_step,
+                        )
+                ):
+                    assert num_events == len(np.load(join(dirpath, 'events.npy')))
+                    selected = list(range(num_events))[slice(
+                        file_slice_kw['start'], file_slice_kw['stop'], file_slice_kw['step']
+                    )]
+                    assert len(selected) == len(agg_indices) > 0
+                    test.extend((dirpath, idx) for idx in selected)
+                    test_indices.extend(agg_indices)
+
+                assert test_indices == ref_indices, (
+                    slice_kw, agg_start, agg_stop, agg_step, test_indices, ref_indices
+                )
+                assert test == ref, (slice_kw, agg_start, agg_stop, agg_step, test, ref)
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+    print('<< PASS : test_get_agg_slice >>')
+
+
+def parse_args(description=__doc__):
+    """Parse command line arguments"""
+    parser = ArgumentParser(description=description)
+    parser.add_argument(
+        '--events-root', nargs='+', required=True,
+        help='''Retro events root directory(ies) in which to build manifests'''
+    )
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='''Only reload leaf directories whose "events.npy" changed since
+        the existing manifest was built'''
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Script interface to `build_events_manifest`"""
+    args = parse_args()
+    for events_root in args.events_root:
+        build_events_manifest(events_root, refresh=args.refresh)
+
+
+if __name__ == '__main__':
+    main()
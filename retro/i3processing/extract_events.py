@@ -33,6 +33,7 @@ __all__ = [
     "get_frame_item",
     "extract_reco",
     "extract_trigger_hierarchy",
+    "extract_flat_pulses",
     "extract_pulses",
     "extract_photons",
     "get_cascade_and_track_info",
@@ -52,7 +53,8 @@ try:
 except ImportError:
     from collections.abc import Iterable, Sequence
 from copy import deepcopy
-from os.path import abspath, basename, dirname, join
+from multiprocessing import Pool
+from os.path import abspath, basename, dirname, isfile, join
 import pickle
 import re
 import sys
@@ -68,6 +70,7 @@ if __name__ == "__main__" and __package__ is None:
         sys.path.append(RETRO_DIR)
 from retro import retro_types as rt
 from retro.i3processing.extract_common import dict2struct, set_explicit_dtype
+from retro.i3processing.flat_pulses import FlatPulsesBuffer
 from retro.utils.cascade_energy_conversion import em2hadr, hadr2em
 from retro.utils.misc import expand, get_file_md5, mkdir
 from retro.utils.geom import cart2sph_np, sph2cart_np
@@ -727,29 +730,9 @@ def extract_trigger_hierarchy(frame, path):
     return triggers
 
 
-def extract_pulses(frame, pulse_series_name):
-    """Extract a pulse series from an I3 frame.
-
-    Parameters
-    ----------
-    frame : icetray.I3Frame
-        Frame object from which to extract the pulses.
-
-    pulse_series_name : str
-        Name of the pulse series to retrieve. If it represents a mask, the mask
-        will be applied and appropriate pulses retrieved.
-
-    Returns
-    -------
-    pulses_list : list of ((string, dom, pmt), pulses) tuples
-        `sd_idx` is from get_sd_idx and each `pulses` object is a 1-D array of
-        dtype retro_types.PULSE_T with length the number of pulses recorded in
-        that DOM.
-
-    time_range : tuple of two floats or None
-        None is returned if the <pulses>TimeRange field is missing
-
-    """
+def _get_pulse_series(frame, pulse_series_name):
+    """Get a pulse series (applying it if it is a mask or union) and its time
+    range from an I3 frame; see `extract_pulses`"""
     from icecube import (  # pylint: disable=unused-import
         dataclasses,
         recclasses,
@@ -777,22 +760,149 @@ def extract_pulses(frame, pulse_series_name):
     if not isinstance(pulse_series, I3RecoPulseSeriesMap):
         raise TypeError(type(pulse_series))
 
-    pulses_list = []
+    return pulse_series, time_range
 
-    for (string, dom, pmt), pinfo in pulse_series:
-        pls = []
-        for pulse in pinfo:
-            pls.append((pulse.time, pulse.charge, pulse.width, pulse.flags))
-        pls = np.array(pls, dtype=rt.PULSE_T)
 
-        pulses_list.append(((string, dom, pmt), pls))
+def _flatten_series_map(series_map):
+    """Flatten an I3Map of OMKey to vectors of (e.g.) pulses or photons.
 
+    Returns
+    -------
+    dom_keys : list of (string, dom, pmt) tuples
+    dom_num_elements : list of int
+    elements : list
+        All DOMs' elements, concatenated
+
+    """
+    dom_keys = []
+    dom_num_elements = []
+    elements = []
+    for omkey, dom_elements in series_map:
+        if len(omkey) == 2:
+            string, dom = omkey
+            pmt = 0
+        else:
+            string, dom, pmt = omkey
+        dom_keys.append((string, dom, pmt))
+        dom_num_elements.append(len(dom_elements))
+        elements.extend(dom_elements)
+    return dom_keys, dom_num_elements, elements
+
+
+def extract_flat_pulses(frame, pulse_series_name, flat_pulses_buffer=None):
+    """Extract a pulse series from an I3 frame into a flat array (see
+    `retro.i3processing.flat_pulses`).
+
+    Pulses are counted first and then each field of all pulses is converted
+    to numpy at once, rather than creating an array per DOM.
+
+    Parameters
+    ----------
+    frame : icetray.I3Frame
+    pulse_series_name : str
+        See `extract_pulses`
+    flat_pulses_buffer : retro.i3processing.flat_pulses.FlatPulsesBuffer, optional
+        If specified, the event is added to (and its pulses written directly
+        into) this buffer
+
+    Returns
+    -------
+    flat_pulses : array of dtype retro_types.FLAT_PULSE_T
+        View into `flat_pulses_buffer` if specified
+    dom_num_pulses : list of int
+        Number of pulses in each DOM
+    time_range : tuple of two floats
+        (nan, nan) if the <pulses>TimeRange field is missing
+
+    """
+    flat_pulses, _, dom_num_pulses, time_range = _extract_flat_pulses(
+        frame=frame,
+        pulse_series_name=pulse_series_name,
+        flat_pulses_buffer=flat_pulses_buffer,
+    )
+    return flat_pulses, dom_num_pulses, time_range
+
+
+def _extract_flat_pulses(frame, pulse_series_name, flat_pulses_buffer):
+    """See `extract_flat_pulses`; additionally returns the list of DOMs'
+    (string, dom, pmt) keys"""
+    pulse_series, time_range = _get_pulse_series(frame, pulse_series_name)
+    dom_keys, dom_num_pulses, pulses = _flatten_series_map(pulse_series)
+    num_pulses = len(pulses)
+
+    if flat_pulses_buffer is None:
+        flat_pulses = np.empty(shape=num_pulses, dtype=rt.FLAT_PULSE_T)
+    else:
+        flat_pulses = flat_pulses_buffer.add_event(dom_num_pulses)
+
+    flat_pulses["key"] = np.repeat(
+        np.array(dom_keys, dtype=rt.OMKEY_T), np.array(dom_num_pulses, dtype=np.int64)
+    )
+    pulse_fields = flat_pulses["pulse"]
+    pulse_fields["time"] = np.fromiter(
+        (pulse.time for pulse in pulses), dtype=np.float64, count=num_pulses
+    )
+    pulse_fields["charge"] = np.fromiter(
+        (pulse.charge for pulse in pulses), dtype=np.float64, count=num_pulses
+    )
+    pulse_fields["width"] = np.fromiter(
+        (pulse.width for pulse in pulses), dtype=np.float64, count=num_pulses
+    )
+    pulse_fields["flags"] = np.fromiter(
+        (pulse.flags for pulse in pulses), dtype=np.int64, count=num_pulses
+    )
+
+    return flat_pulses, dom_keys, dom_num_pulses, time_range
+
+
+def _split_by_dom(flat, dom_keys, dom_num_elements):
+    """Split a flat array into a list of ((string, dom, pmt), array) tuples
+    (arrays are views into `flat`)"""
+    stops = np.cumsum(dom_num_elements, dtype=np.int64)
+    starts = stops - np.array(dom_num_elements, dtype=np.int64)
+    return [
+        (key, flat[start:stop]) for key, start, stop in zip(dom_keys, starts, stops)
+    ]
+
+
+def extract_pulses(frame, pulse_series_name):
+    """Extract a pulse series from an I3 frame.
+
+    Parameters
+    ----------
+    frame : icetray.I3Frame
+        Frame object from which to extract the pulses.
+
+    pulse_series_name : str
+        Name of the pulse series to retrieve. If it represents a mask, the mask
+        will be applied and appropriate pulses retrieved.
+
+    Returns
+    -------
+    pulses_list : list of ((string, dom, pmt), pulses) tuples
+        `sd_idx` is from get_sd_idx and each `pulses` object is a 1-D array of
+        dtype retro_types.PULSE_T with length the number of pulses recorded in
+        that DOM.
+
+    time_range : tuple of two floats or None
+        None is returned if the <pulses>TimeRange field is missing
+
+    """
+    flat_pulses, dom_keys, dom_num_pulses, time_range = _extract_flat_pulses(
+        frame=frame, pulse_series_name=pulse_series_name, flat_pulses_buffer=None
+    )
+    pulses_list = _split_by_dom(
+        flat=flat_pulses["pulse"], dom_keys=dom_keys, dom_num_elements=dom_num_pulses
+    )
     return pulses_list, time_range
 
 
 def extract_photons(frame, photon_key):
     """Extract a photon series from an I3 frame.
 
+    All photons of the frame are converted to a single array at once; the
+    per-DOM arrays returned are views into it.
+
     Parameters
     ----------
     frame : icetray.I3Frame
@@ -815,33 +925,33 @@ def extract_photons(frame, photon_key):
         simclasses,
     )
 
-    photon_series = frame[photon_key]
-    photons = []
-    for omkey, pinfos in photon_series:
-        if len(omkey) == 2:
-            string, dom = omkey
-            pmt = 0
-        else:
-            string, dom, pmt = omkey
+    dom_keys, dom_num_photons, pinfos = _flatten_series_map(frame[photon_key])
+    num_photons = len(pinfos)
 
-        phot = []  # Photon(*([] for _ in range(len(Photon._fields))))
-        for pinfo in pinfos:
-            phot.append(
-                (
-                    pinfo.time,
-                    pinfo.pos.x,
-                    pinfo.pos.y,
-                    pinfo.pos.z,
-                    np.cos(pinfo.dir.zenith),
-                    pinfo.dir.azimuth,
-                    pinfo.wavelength,
-                )
-            )
-        phot = np.array(phot, dtype=rt.PHOTON_T)
-
-        photons.append(((string, dom, pmt), phot))
+    phot = np.empty(shape=num_photons, dtype=rt.PHOTON_T)
+    phot["time"] = np.fromiter(
+        (pinfo.time for pinfo in pinfos), dtype=np.float64, count=num_photons
+    )
+    phot["x"] = np.fromiter(
+        (pinfo.pos.x for pinfo in pinfos), dtype=np.float64, count=num_photons
+    )
+    phot["y"] = np.fromiter(
+        (pinfo.pos.y for pinfo in pinfos), dtype=np.float64, count=num_photons
+    )
+    phot["z"] = np.fromiter(
+        (pinfo.pos.z for pinfo in pinfos), dtype=np.float64, count=num_photons
+    )
+    phot["coszen"] = np.cos(
+        np.fromiter((pinfo.dir.zenith for pinfo in pinfos), dtype=np.float64, count=num_photons)
+    )
+    phot["azimuth"] = np.fromiter(
+        (pinfo.dir.azimuth for pinfo in pinfos), dtype=np.float64, count=num_photons
+    )
+    phot["wavelength"] = np.fromiter(
+        (pinfo.wavelength for pinfo in pinfos), dtype=np.float64, count=num_photons
+    )
 
-    return photons
+    return _split_by_dom(flat=phot, dom_keys=dom_keys, dom_num_elements=dom_num_photons)
 
 
 def get_cascade_and_track_info(particles, mctree):
@@ -1586,6 +1696,10 @@ def _extract_events_from_single_file(
     fpath : str
         Path to I3 file
 
+    gcd_md5_hex : str, optional
+        MD5 sum of the (already extracted) GCD applying to events preceding
+        any GCD frames in the file(s)
+
     external_gcd : bool, optional
         If `True`, force loading a (single) GCD file to be found in the same
         directory as the data file(s) (e.g., use this option for actual data
@@ -1602,7 +1716,9 @@ def _extract_events_from_single_file(
         Names of photons series' to extract from each event
 
     pulses : None, str, or iterable of str
-        Names of pulse series' to extract from each event
+        Names of pulse series' to extract from each event; each is saved to
+        "pulses/<name>/" in the columnar format described in
+        `retro.i3processing.flat_pulses`
 
     recos : None, str, or iterable of str
         Names of reconstructions to extract from each event
@@ -1702,9 +1818,10 @@ def _extract_events_from_single_file(
     for name in photons:
         photons_d[name] = []
 
+    # Each pulse series' pulses for all events are written into one buffer
     pulses_d = OrderedDict()
     for name in pulses:
-        pulses_d[name] = []
+        pulses_d[name] = FlatPulsesBuffer()
         pulses_d[name + "TimeRange"] = []
 
     recos_d = OrderedDict()
@@ -1800,8 +1917,11 @@ def _extract_events_from_single_file(
             photons_d[photon_name].append(extract_photons(pframe, photon_name))
 
         for pulse_series_name in pulses:
-            pulses_list, time_range = extract_pulses(pframe, pulse_series_name)
-            pulses_d[pulse_series_name].append(pulses_list)
+            _, _, time_range = extract_flat_pulses(
+                frame=pframe,
+                pulse_series_name=pulse_series_name,
+                flat_pulses_buffer=pulses_d[pulse_series_name],
+            )
             pulses_d[pulse_series_name + "TimeRange"].append(time_range)
 
         for reco_name in recos:
@@ -1823,8 +1943,6 @@ def _extract_events_from_single_file(
     gcd_frames = OrderedDict([("g_frame", None), ("c_frame", None), ("d_frame", None)])
     gcd_changed = False
 
-    gcd_md5_hex = None
-
     while i3file_iterator.more():
         try:
             frame = None
@@ -1934,11 +2052,7 @@ def _extract_events_from_single_file(
         )
 
     for name in pulses:
-        pickle.dump(
-            pulses_d[name],
-            open(join(pulse_series_dir, name + ".pkl"), "wb"),
-            protocol=pickle.HIGHEST_PROTOCOL,
-        )
+        pulses_d[name].save(join(pulse_series_dir, name))
         tr_key = name + "TimeRange"
         np.save(
             join(pulse_series_dir, tr_key + ".npy"),
@@ -1995,8 +2109,10 @@ def extract_events(
     triggers=tuple(),
     truth=False,
     additional_keys=None,
+    procs=1,
+    resume_log=None,
 ):
-    """Extract event information from an i3 file.
+    """Extract event information from i3 files.
 
     Parameters
     ----------
@@ -2029,7 +2145,9 @@ def extract_events(
         Names of photons series' to extract from each event
 
     pulses : None, str, or iterable of str
-        Names of pulse series' to extract from each event
+        Names of pulse series' to extract from each event; each is saved to
+        "pulses/<name>/" in the columnar format described in
+        `retro.i3processing.flat_pulses`
 
     recos : None, str, or iterable of str
         Names of reconstructions to extract from each event
@@ -2043,36 +2161,25 @@ def extract_events(
 
     additional_keys : str, iterable thereof, or None
 
+    procs : int >= 1, optional
+        Number of worker processes, each extracting one i3 file at a time (so
+        memory use is bounded by that of `procs` files). An external `gcd` is
+        extracted once, up front; GCD frames embedded in i3 files are
+        extracted by only one worker even if several encounter the same GCD
+        concurrently (see `retro.i3processing.extract_gcd.extract_gcd_frames`).
+        With `procs` > 1, a failure to extract a file is reported (with its
+        traceback) and the remaining files are still extracted.
+
+    resume_log : str, optional
+        Path to a text file to which the path of each successfully extracted
+        i3 file is appended; i3 files already listed in it are skipped, so an
+        interrupted extraction resumes where it left off when re-run with the
+        same `resume_log`.
+
     Returns
     -------
-    list of OrderedDict, one per event
-        Each dict contains key "meta" with sub-dict containing file metadata.
-        Depending on which arguments are provided, OrderedDicts for each named
-        key passed will appear as a key within the OrderedDicts named "pulses",
-        "recos", "photons", and "truth". E.g.:
-
-        .. python ::
-
-            {
-                'i3_metadata': {...},
-                'events': [{...}, {...}, ...],
-                'truth': [{'pdg_encoding': ..., 'daughters': [{...}, ...]}],
-                'photons': {
-                    'photons': [[...], [...], ...],
-                    'other_photons': [[...], [...], ...]
-                },
-                'pulse_series': {
-                    'SRTOfflinePulses': [[...], [...], ...],
-                    'WaveDeformPulses': [[...], [...], ...]
-                },
-                'recos': {
-                    'PegLeg8D': [{...}, ...],
-                    'Retro8D': [{...}, ...]
-                },
-                'triggers': {
-                    'I3TriggerHierarchy': [{...}, ...],
-                }
-            }
+    failed_i3_files : list of str
+        Paths of i3 files that failed to be extracted
 
     """
     from retro.i3processing.extract_gcd import MD5_HEX_RE, extract_gcd_files
@@ -2080,6 +2187,28 @@ def extract_events(
     if isinstance(i3_files, string_types):
         i3_files = [i3_files]
 
+    # Remove duplicates and files already extracted
+    logged_i3_files = set()
+    if resume_log is not None:
+        resume_log = expand(resume_log)
+        if isfile(resume_log):
+            with open(resume_log, "r") as fobj:
+                logged_i3_files.update(line.strip() for line in fobj if line.strip())
+    todo_i3_files = []
+    num_skipped = 0
+    for i3_fpath in i3_files:
+        i3_fpath = abspath(expand(i3_fpath))
+        if i3_fpath in logged_i3_files:
+            num_skipped += 1
+        elif i3_fpath not in todo_i3_files:
+            todo_i3_files.append(i3_fpath)
+    if num_skipped:
+        print(
+            'Skipping {} i3 file(s) already extracted according to "{}"'.format(
+                num_skipped, resume_log
+            )
+        )
+
     if gcd is None:
         gcd_md5_hex = None
     elif isinstance(gcd, string_types):
@@ -2095,31 +2224,103 @@ def extract_events(
     else:
         raise TypeError("Cannot handle `gcd` arg of type {}".format(type(gcd)))
 
-    for i3_fpath in i3_files:
-        _extract_events_from_single_file(
-            i3_fpath=i3_fpath,
-            retro_gcd_dir=retro_gcd_dir,
-            gcd=gcd,
-            gcd_md5_hex=gcd_md5_hex,
-            outdir=outdir,
-            photons=photons,
-            pulses=pulses,
-            recos=recos,
-            triggers=triggers,
-            truth=truth,
-            additional_keys=additional_keys,
-        )
+    file_kwargs = dict(
+        retro_gcd_dir=retro_gcd_dir,
+        gcd=gcd,
+        gcd_md5_hex=gcd_md5_hex,
+        outdir=outdir,
+        photons=photons,
+        pulses=pulses,
+        recos=recos,
+        triggers=triggers,
+        truth=truth,
+        additional_keys=additional_keys,
+    )
+    tasks = [dict(file_kwargs, i3_fpath=i3_fpath) for i3_fpath in todo_i3_files]
+
+    procs = max(1, min(int(procs), len(tasks)))
+    if procs == 1:
+        # Exceptions propagate to the caller, as ever
+        results = (_extract_file_task(task, catch=False) for task in tasks)
+        pool = None
+    else:
+        # Workers are replaced after each file so memory held by one file's
+        # extraction is returned to the system before the next
+        pool = Pool(procs, maxtasksperchild=1)
+        results = pool.imap_unordered(_extract_file_task, tasks, chunksize=1)
+
+    t0 = time.time()
+    failed_i3_files = []
+    try:
+        for num_done, (i3_fpath, success, elapsed) in enumerate(results, 1):
+            if success:
+                if resume_log is not None:
+                    with open(resume_log, "a") as fobj:
+                        fobj.write(i3_fpath + "\n")
+            else:
+                failed_i3_files.append(i3_fpath)
+            print(
+                '[{}/{}] {} "{}" in {:.1f} s ({:.1f} s elapsed, {} failed)'.format(
+                    num_done,
+                    len(tasks),
+                    "extracted" if success else "FAILED to extract",
+                    i3_fpath,
+                    elapsed,
+                    time.time() - t0,
+                    len(failed_i3_files),
+                )
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for i3_fpath in failed_i3_files:
+        sys.stderr.write('Failed to extract "{}"\n'.format(i3_fpath))
+
+    return failed_i3_files
+
+
+def _extract_file_task(kwargs, catch=True):
+    """Extract events from one i3 file (as a process-pool task).
+
+    Parameters
+    ----------
+    kwargs : mapping
+        Keyword arguments to `_extract_events_from_single_file`
+    catch : bool, optional
+        Report exceptions (with full traceback, which is otherwise lost when
+        running in a worker process) instead of raising them
+
+    Returns
+    -------
+    i3_fpath : str
+    success : bool
+    elapsed : float
+        Seconds taken
+
+    """
+    t0 = time.time()
+    try:
+        _extract_events_from_single_file(**kwargs)
+    except Exception:
+        if not catch:
+            raise
+        sys.stderr.write('ERROR extracting "{}":\n'.format(kwargs["i3_fpath"]))
+        traceback.print_exc(file=sys.stderr)
+        return kwargs["i3_fpath"], False, time.time() - t0
+    return kwargs["i3_fpath"], True, time.time() - t0
 
 
 def wrapped_extract_events(*args, **kwargs):
     """`extract_events` function wrapped in a try/except that keeps full
     traceback information. Use if calling from multiprocessing module."""
     try:
-        extract_events(*args, **kwargs)
+        failed_i3_files = extract_events(*args, **kwargs)
     except Exception:
         traceback.print_exc(file=sys.stderr)
         return False
-    return True
+    return not failed_i3_files
 
 
 def main(description=__doc__):
@@ -2191,9 +2392,25 @@ def main(description=__doc__):
         nargs="+",
         help="""Additional keys to extract from event I3 frame""",
     )
+    parser.add_argument(
+        "--procs",
+        type=int,
+        default=1,
+        help="""Number of worker processes, each extracting one i3 file at a
+        time""",
+    )
+    parser.add_argument(
+        "--resume-log",
+        default=None,
+        help="""Text file to which the path of each successfully extracted i3
+        file is appended; i3 files listed in it are skipped, so re-running with
+        the same --resume-log resumes an interrupted extraction""",
+    )
     args = parser.parse_args()
     kwargs = vars(args)
-    extract_events(**kwargs)
+    failed_i3_files = extract_events(**kwargs)
+    if failed_i3_files:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -26,6 +26,7 @@ limitations under the License."""
 __all__ = [
     "GCD_README",
     "MD5_HEX_RE",
+    "GCD_LOCK_TIMEOUT",
     "extract_i3_geometry",
     "extract_i3_calibration",
     "extract_i3_detector_status",
@@ -44,13 +45,15 @@ except ImportError:
 import errno
 import io
 import json
+import os
 from os.path import abspath, dirname, isdir, isfile, join
 import pickle
 import re
-from shutil import copytree, rmtree
+from shutil import rmtree
 import socket
 import sys
 from tempfile import mkdtemp
+import time
 
 import numpy as np
 from six import string_types
@@ -93,6 +96,10 @@ GCD frames are output to an i3 file and hashed).
 
 MD5_HEX_RE = re.compile("^[0-9a-f]{32}$")
 
+GCD_LOCK_TIMEOUT = 600
+"""Seconds after which a GCD extraction lock file is assumed to have been left
+behind by a killed process"""
+
 
 def extract_i3_geometry(frame):
     """Extract I3Geometry object from frame.
@@ -443,7 +450,17 @@ def extract_gcd_frames(g_frame, c_frame, d_frame, retro_gcd_dir, metadata=None):
         sys.stderr.write("Already extracted GCD with md5sum {}\n".format(gcd_md5_hex))
         return gcd_md5_hex
 
-    tempdir_path = mkdtemp(suffix="." + gcd_md5_hex)
+    # Processes extracting events from files sharing a GCD concurrently (e.g.
+    # workers of `retro.i3processing.extract_events.extract_events`) extract
+    # it only once: one takes the lock and the others wait for its result
+    lock_fpath = this_gcd_dir_path + ".lock"
+    if not _acquire_gcd_lock(lock_fpath=lock_fpath, gcd_dir_path=this_gcd_dir_path):
+        sys.stderr.write("GCD with md5sum {} extracted by another process\n".format(gcd_md5_hex))
+        return gcd_md5_hex
+
+    # Extract to a temporary dir on the same filesystem and rename it into
+    # place, so the GCD dir appears (to other processes) only once complete
+    tempdir_path = mkdtemp(suffix="." + gcd_md5_hex, prefix=".tmp", dir=retro_gcd_dir)
     try:
         # Extract GCD info into Python/Numpy-readable things
         gcd_info = OrderedDict()
@@ -474,9 +491,9 @@ def extract_gcd_frames(g_frame, c_frame, d_frame, retro_gcd_dir, metadata=None):
                 json.dump(metadata, fhandle, sort_keys=False, indent=4)
 
         try:
-            copytree(tempdir_path, this_gcd_dir_path)
+            os.rename(tempdir_path, this_gcd_dir_path)
         except OSError as err:
-            if err.errno != errno.EEXIST:
+            if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
                 raise
 
     finally:
@@ -484,10 +501,50 @@ def extract_gcd_frames(g_frame, c_frame, d_frame, retro_gcd_dir, metadata=None):
             rmtree(tempdir_path)
         except Exception:
             pass
+        try:
+            os.remove(lock_fpath)
+        except OSError:
+            pass
 
     return gcd_md5_hex
 
 
+def _acquire_gcd_lock(lock_fpath, gcd_dir_path, timeout=GCD_LOCK_TIMEOUT):
+    """Create lock file `lock_fpath`, waiting for any other process holding it.
+
+    Returns
+    -------
+    acquired : bool
+        True if the lock was acquired (the caller must extract the GCD and
+        then remove the lock file); False if the GCD dir `gcd_dir_path` was
+        created (by another process) in the meantime
+
+    """
+    t0 = time.time()
+    while True:
+        try:
+            os.close(os.open(lock_fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        else:
+            if isdir(gcd_dir_path):
+                os.remove(lock_fpath)
+                return False
+            return True
+
+        if isdir(gcd_dir_path):
+            return False
+        if time.time() - t0 > timeout:
+            sys.stderr.write('Removing stale GCD lock file "{}"\n'.format(lock_fpath))
+            try:
+                os.remove(lock_fpath)
+            except OSError:
+                pass
+            t0 = time.time()
+        time.sleep(0.5)
+
+
 def extract_gcd_files(gcd_files, retro_gcd_dir, verbosity=0):
     """
     Parameters
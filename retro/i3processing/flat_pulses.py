@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position
+
+"""
+Columnar storage of pulse series for all events extracted from an i3 file.
+
+A pulse series named `name` is stored in directory ``<events dir>/pulses/<name>``
+as three memory-mappable .npy files:
+
+    pulses.npy : shape (n_pulses,) array of dtype `retro_types.FLAT_PULSE_T`
+        All pulses of all events, ordered by event and then by DOM (in the
+        order the DOMs appear in the frame's pulse series map)
+    dom_offsets.npy : shape (n_doms + 1,) uint64 array
+        Pulses of the i-th (event, DOM) pair are
+        ``pulses[dom_offsets[i]:dom_offsets[i+1]]``
+    event_offsets.npy : shape (n_events + 1,) uint64 array
+        (event, DOM) pairs of the j-th event are
+        ``event_offsets[j]:event_offsets[j+1]``, so its pulses are
+        ``pulses[dom_offsets[event_offsets[j]]:dom_offsets[event_offsets[j+1]]]``
+
+Reading an event's pulses therefore costs O(size of the event) and requires
+no deserialization, unlike the legacy "pulses/<name>.pkl" files (pickled
+per-event lists of ``((string, om, pmt), PULSE_T array)`` tuples).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'FLAT_PULSES_ARRAY_NAMES',
+    'pulses_list_to_flat',
+    'iter_dom_pulses',
+    'save_flat_pulses',
+    'FlatPulsesBuffer',
+    'is_flat_pulses',
+    'FlatPulses',
+    'load_pulses_lists',
+    'test_flat_pulses',
+]
+
+__author__ = 'J.L. Lanfranchi'
+__license__ = '''Copyright 2019 Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from os.path import abspath, dirname, isdir, isfile, join
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro import load_pickle
+from retro.retro_types import FLAT_PULSE_T, PULSE_T
+from retro.utils.misc import expand, mkdir
+
+
+FLAT_PULSES_ARRAY_NAMES = ('pulses', 'dom_offsets', 'event_offsets')
+"""Names of the .npy files (without extension) of a flat pulse series"""
+
+
+def pulses_list_to_flat(pulses_list):
+    """Convert an event's pulses from a list of ``((string, om, pmt),
+    PULSE_T array)`` tuples (as returned by
+    `retro.i3processing.extract_events.extract_pulses`) to a flat array.
+
+    Parameters
+    ----------
+    pulses_list : sequence of ((string, om, pmt), pulses) tuples
+
+    Returns
+    -------
+    flat_pulses : shape (n_pulses,) array of dtype FLAT_PULSE_T
+    dom_num_pulses : shape (n_doms,) uint64 array
+        Number of pulses in each DOM
+
+    """
+    dom_num_pulses = np.array([len(pls) for _, pls in pulses_list], dtype=np.uint64)
+    flat_pulses = np.empty(shape=int(np.sum(dom_num_pulses)), dtype=FLAT_PULSE_T)
+    offset = 0
+    for (string, om, pmt), pls in pulses_list:
+        num = len(pls)
+        dom_pulses = flat_pulses[offset : offset + num]
+        dom_pulses['key']['string'] = string
+        dom_pulses['key']['om'] = om
+        dom_pulses['key']['pmt'] = pmt
+        dom_pulses['pulse'] = pls
+        offset += num
+    return flat_pulses, dom_num_pulses
+
+
+def iter_dom_pulses(flat_pulses):
+    """Iterate over the DOMs in an event's flat pulses, where each DOM's
+    pulses are contiguous.
+
+    Parameters
+    ----------
+    flat_pulses : array of dtype FLAT_PULSE_T
+
+    Yields
+    ------
+    key : tuple (string, om, pmt)
+    pulses : array of dtype PULSE_T
+        View into `flat_pulses`
+
+    """
+    if len(flat_pulses) == 0:
+        return
+    keys = flat_pulses['key']
+    boundaries = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    stops = np.concatenate([boundaries, [len(flat_pulses)]])
+    for start, stop in zip(starts, stops):
+        key = keys[start]
+        yield (key['string'], key['om'], key['pmt']), flat_pulses['pulse'][start:stop]
+
+
+def save_flat_pulses(outdir, events_flat_pulses):
+    """Save flat pulses of a sequence of events.
+
+    Parameters
+    ----------
+    outdir : string
+        Directory in which to store the .npy files (created if it doesn't
+        exist), e.g. "<events dir>/pulses/<pulse series name>"
+    events_flat_pulses : sequence of (flat_pulses, dom_num_pulses) tuples
+        One per event, as returned by `pulses_list_to_flat`
+
+    """
+    outdir = expand(outdir)
+    mkdir(outdir)
+
+    event_num_doms = [len(dom_num_pulses) for _, dom_num_pulses in events_flat_pulses]
+    event_offsets = np.zeros(len(events_flat_pulses) + 1, dtype=np.uint64)
+    event_offsets[1:] = np.cumsum(event_num_doms)
+
+    dom_offsets = np.zeros(int(event_offsets[-1]) + 1, dtype=np.uint64)
+    if events_flat_pulses:
+        np.cumsum(
+            np.concatenate([dnp for _, dnp in events_flat_pulses]).astype(np.uint64),
+            out=dom_offsets[1:],
+        )
+        pulses = np.concatenate([fp for fp, _ in events_flat_pulses])
+    else:
+        pulses = np.empty(shape=0, dtype=FLAT_PULSE_T)
+
+    _save_flat_arrays(
+        outdir=outdir, pulses=pulses, dom_offsets=dom_offsets, event_offsets=event_offsets
+    )
+
+
+def _save_flat_arrays(outdir, pulses, dom_offsets, event_offsets):
+    np.save(join(outdir, 'pulses.npy'), pulses)
+    np.save(join(outdir, 'dom_offsets.npy'), dom_offsets)
+    np.save(join(outdir, 'event_offsets.npy'), event_offsets)
+
+
+class FlatPulsesBuffer(object):
+    """Flat pulse series of a sequence of events, built in place: each event's
+    pulses are written directly into a single (growing) FLAT_PULSE_T buffer,
+    so no per-event or per-DOM arrays are created and no concatenation is
+    needed to save them.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Initial number of pulses the buffer can hold; it grows geometrically
+        as needed
+
+    """
+    def __init__(self, capacity=2**16):
+        self.pulses = np.empty(shape=max(1, int(capacity)), dtype=FLAT_PULSE_T)
+        self.num_pulses = 0
+        self.dom_num_pulses = []
+        self.event_num_doms = []
+
+    def __len__(self):
+        return len(self.event_num_doms)
+
+    def add_event(self, dom_num_pulses):
+        """Append an event with `dom_num_pulses[i]` pulses in its i-th DOM.
+
+        Parameters
+        ----------
+        dom_num_pulses : sequence of int
+
+        Returns
+        -------
+        event_pulses : shape (sum(dom_num_pulses),) array of dtype FLAT_PULSE_T
+            Uninitialized view into the buffer, to be filled by the caller
+            before the next call to `add_event`
+
+        """
+        dom_num_pulses = np.asarray(dom_num_pulses, dtype=np.uint64)
+        num = int(np.sum(dom_num_pulses))
+        start = self.num_pulses
+        stop = start + num
+        if stop > len(self.pulses):
+            pulses = np.empty(shape=max(stop, 2 * len(self.pulses)), dtype=FLAT_PULSE_T)
+            pulses[:start] = self.pulses[:start]
+            self.pulses = pulses
+        self.num_pulses = stop
+        self.dom_num_pulses.append(dom_num_pulses)
+        self.event_num_doms.append(len(dom_num_pulses))
+        return self.pulses[start:stop]
+
+    def save(self, outdir):
+        """Save the pulses of all events added, as `save_flat_pulses` does"""
+        outdir = expand(outdir)
+        mkdir(outdir)
+
+        event_offsets = np.zeros(len(self.event_num_doms) + 1, dtype=np.uint64)
+        event_offsets[1:] = np.cumsum(self.event_num_doms)
+
+        dom_offsets = np.zeros(int(event_offsets[-1]) + 1, dtype=np.uint64)
+        if self.dom_num_pulses:
+            np.cumsum(np.concatenate(self.dom_num_pulses), out=dom_offsets[1:])
+
+        _save_flat_arrays(
+            outdir=outdir,
+            pulses=self.pulses[:self.num_pulses],
+            dom_offsets=dom_offsets,
+            event_offsets=event_offsets,
+        )
+
+
+def is_flat_pulses(path):
+    """Whether `path` is a directory containing a flat pulse series"""
+    path = expand(path)
+    return isdir(path) and all(
+        isfile(join(path, name + '.npy')) for name in FLAT_PULSES_ARRAY_NAMES
+    )
+
+
+class FlatPulses(object):
+    """Read-only access to a flat pulse series (see module docstring).
+
+    Parameters
+    ----------
+    path : string
+        Directory containing the .npy files
+    mmap : bool, optional
+        Memory map the pulses (offsets are always read into memory since they
+        are small)
+
+    """
+    def __init__(self, path, mmap=True):
+        self.path = expand(path)
+        self.pulses = np.load(join(self.path, 'pulses.npy'), mmap_mode='r' if mmap else None)
+        self.dom_offsets = np.load(join(self.path, 'dom_offsets.npy'))
+        self.event_offsets = np.load(join(self.path, 'event_offsets.npy'))
+        if self.pulses.dtype != FLAT_PULSE_T:
+            raise TypeError(
+                'pulses in "{}" have dtype {}, expected {}'.format(
+                    self.path, self.pulses.dtype, FLAT_PULSE_T
+                )
+            )
+        # Offsets of each event's first pulse
+        self.event_pulse_offsets = self.dom_offsets[self.event_offsets]
+
+    def __len__(self):
+        return len(self.event_offsets) - 1
+
+    def __getitem__(self, event_idx):
+        """Pulses of event `event_idx`, a (read-only, if memory mapped) view
+        of dtype FLAT_PULSE_T"""
+        num_events = len(self)
+        if event_idx < 0:
+            event_idx += num_events
+        if not 0 <= event_idx < num_events:
+            raise IndexError(
+                'event index {} out of range for {} events'.format(event_idx, num_events)
+            )
+        start = int(self.event_pulse_offsets[event_idx])
+        stop = int(self.event_pulse_offsets[event_idx + 1])
+        return self.pulses[start:stop]
+
+    def get_dom_offsets(self, event_idx):
+        """Offsets of each DOM's pulses within the pulses of event
+        `event_idx`, shape (n_doms + 1,)"""
+        start = int(self.event_offsets[event_idx])
+        stop = int(self.event_offsets[event_idx + 1])
+        dom_offsets = self.dom_offsets[start : stop + 1]
+        return dom_offsets - dom_offsets[0]
+
+    def get_pulses_list(self, event_idx):
+        """Pulses of event `event_idx` in the legacy format, a list of
+        ``((string, om, pmt), PULSE_T array)`` tuples (arrays are views)"""
+        event_pulses = self[event_idx]
+        dom_offsets = self.get_dom_offsets(event_idx)
+        pulses_list = []
+        for start, stop in zip(dom_offsets[:-1], dom_offsets[1:]):
+            key = event_pulses['key'][start]
+            pulses_list.append(
+                ((key['string'], key['om'], key['pmt']), event_pulses['pulse'][start:stop])
+            )
+        return pulses_list
+
+    def iter_events(self, event_indices):
+        """Iterate over the pulses of events `event_indices`"""
+        for event_idx in event_indices:
+            yield self[event_idx]
+
+
+class _PulsesListsView(object):
+    """Sequence of events' pulses in the legacy format, read on access from a
+    `FlatPulses`"""
+    def __init__(self, flat_pulses):
+        self.flat_pulses = flat_pulses
+
+    def __len__(self):
+        return len(self.flat_pulses)
+
+    def __getitem__(self, event_idx):
+        return self.flat_pulses.get_pulses_list(event_idx)
+
+    def __iter__(self):
+        for event_idx in range(len(self)):
+            yield self[event_idx]
+
+
+def load_pulses_lists(events_dirpath, name, mmap=True):
+    """Get the pulse series `name` of all events in an events directory in the
+    legacy format (a list of ``((string, om, pmt), PULSE_T array)`` tuples per
+    event), from the flat pulse series if it exists or else from the legacy
+    "pulses/<name>.pkl" file.
+
+    Parameters
+    ----------
+    events_dirpath : string
+        Directory containing "events.npy"
+    name : string
+        Pulse series name, e.g. "SRTTWOfflinePulsesDC"
+    mmap : bool, optional
+        Memory map flat pulses (see `FlatPulses`)
+
+    Returns
+    -------
+    pulses_lists : sequence
+        Events' pulses are read on access from flat pulses, while a legacy
+        .pkl file is loaded in its entirety
+
+    Raises
+    ------
+    IOError
+        If neither form of the pulse series is found
+
+    """
+    events_dirpath = expand(events_dirpath)
+    flat_dpath = join(events_dirpath, 'pulses', name)
+    if is_flat_pulses(flat_dpath):
+        return _PulsesListsView(FlatPulses(flat_dpath, mmap=mmap))
+    pkl_fpath = join(events_dirpath, 'pulses', name + '.pkl')
+    if not isfile(pkl_fpath):
+        raise IOError(
+            'Pulse series "{}" not found in "{}"'.format(name, events_dirpath)
+        )
+    return load_pickle(pkl_fpath)
+
+
+def _random_pulses_lists(rand, num_events, max_doms=6, max_pulses=5):
+    """Events' pulses in the legacy format, with random numbers of DOMs
+    (including none) and of pulses per DOM"""
+    pulses_lists = []
+    for _ in range(num_events):
+        num_doms = rand.randint(0, max_doms + 1)
+        sd_indices = np.sort(rand.choice(86 * 60, size=num_doms, replace=False))
+        pulses_list = []
+        for sd_idx in sd_indices:
+            pls = np.empty(shape=rand.randint(1, max_pulses + 1), dtype=PULSE_T)
+            pls['time'] = np.sort(rand.uniform(9000, 12000, size=len(pls)))
+            pls['charge'] = rand.uniform(0.2, 5, size=len(pls))
+            pls['width'] = rand.uniform(2, 10, size=len(pls))
+            pls['flags'] = rand.randint(0, 8, size=len(pls))
+            key = (int(sd_idx // 60) + 1, int(sd_idx % 60) + 1, 0)
+            pulses_list.append((key, pls))
+        pulses_lists.append(pulses_list)
+    return pulses_lists
+
+
+def _assert_pulses_lists_equal(test, ref):
+    """Assert that two events' pulses in the legacy format are equal"""
+    assert len(test) == len(ref), (len(test), len(ref))
+    for (test_key, test_pls), (ref_key, ref_pls) in zip(test, ref):
+        assert tuple(test_key) == tuple(ref_key), (test_key, ref_key)
+        assert np.array_equal(test_pls, ref_pls)
+
+
+def test_flat_pulses():
+    """Unit tests for functions `pulses_list_to_flat`, `save_flat_pulses`, and
+    `iter_dom_pulses` and classes `FlatPulsesBuffer` and `FlatPulses`."""
+    rand = np.random.RandomState(0)
+    tmpdir = mkdtemp(suffix='test_flat_pulses')
+    try:
+        for num_events in [0, 1, 2, 50]:
+            pulses_lists = _random_pulses_lists(rand, num_events)
+            if num_events >= 2:
+                pulses_lists[0] = []
+                pulses_lists[-1] = []
+
+            events_dirpath = join(tmpdir, str(num_events))
+            outdir = join(events_dirpath, 'pulses', 'SRTTWOfflinePulsesDC')
+            save_flat_pulses(outdir, [pulses_list_to_flat(pl) for pl in pulses_lists])
+            assert is_flat_pulses(outdir)
+
+            # Buffer must write identical files, also when it has to grow
+            for capacity in [1, 7, 2**16]:
+                buffer_outdir = join(tmpdir, 'buffer{}_{}'.format(num_events, capacity))
+                flat_buffer = FlatPulsesBuffer(capacity=capacity)
+                for pulses_list in pulses_lists:
+                    event_pulses = flat_buffer.add_event(
+                        [len(pls) for _, pls in pulses_list]
+                    )
+                    event_pulses[:] = pulses_list_to_flat(pulses_list)[0]
+                assert len(flat_buffer) == num_events
+                flat_buffer.save(buffer_outdir)
+                for name in FLAT_PULSES_ARRAY_NAMES:
+                    with open(join(outdir, name + '.npy'), 'rb') as fobj:
+                        ref_bytes = fobj.read()
+                    with open(join(buffer_outdir, name + '.npy'), 'rb') as fobj:
+                        assert fobj.read() == ref_bytes, (name, capacity)
+
+            for mmap in [True, False]:
+                flat_pulses = FlatPulses(outdir, mmap=mmap)
+                assert len(flat_pulses) == num_events
+                for event_idx, pulses_list in enumerate(pulses_lists):
+                    event_pulses = flat_pulses[event_idx]
+                    assert len(event_pulses) == sum(len(pls) for _, pls in pulses_list)
+                    _assert_pulses_lists_equal(list(iter_dom_pulses(event_pulses)), pulses_list)
+                    _assert_pulses_lists_equal(
+                        flat_pulses.get_pulses_list(event_idx), pulses_list
+                    )
+                    assert np.array_equal(
+                        np.diff(flat_pulses.get_dom_offsets(event_idx)),
+                        [len(pls) for _, pls in pulses_list],
+                    )
+                    if event_idx == num_events - 1:
+                        assert np.array_equal(flat_pulses[-1], event_pulses)
+                try:
+                    flat_pulses[num_events] # pylint: disable=pointless-statement
+                except IndexError:
+                    pass
+                else:
+                    raise AssertionError('expected IndexError')
+
+            pulses_lists_view = load_pulses_lists(events_dirpath, 'SRTTWOfflinePulsesDC')
+            assert len(pulses_lists_view) == num_events
+            for test, ref in zip(pulses_lists_view, pulses_lists):
+                _assert_pulses_lists_equal(test, ref)
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+    print('<< PASS : test_flat_pulses >>')
+
+
+if __name__ == '__main__':
+    test_flat_pulses()
@@ -36,6 +36,7 @@ __all__ = [
     "particle_from_reco",
     "populate_pframe",
     "retro_recos_to_i3files",
+    "populate_i3file",
     "main",
 ]
 
@@ -47,6 +48,7 @@ except ImportError:
     from collections import Sequence
 from copy import deepcopy
 from glob import glob
+from multiprocessing import Pool
 from os import remove, walk
 from os.path import (
     abspath,
@@ -60,6 +62,8 @@ from os.path import (
     splitext,
 )
 import sys
+import time
+import traceback
 
 import numpy as np
 from six import string_types
@@ -508,12 +512,15 @@ def populate_pframe(event_index, frame_buffer, recos_d, point_estimator):
 
 
 def retro_recos_to_i3files(
-    eventsdir, point_estimator, recos=None, i3dir=None, overwrite=False
+    eventsdir, point_estimator, recos=None, i3dir=None, overwrite=False, procs=1
 ):
     """Take retro recos found in .npy files / retro directory structure and
     corresponding i3 files and generate new i3 files like the original but
     populated with the retro reco information.
 
+    Each i3 file is streamed through frame by frame and reco .npy files are
+    memory mapped, so only the rows of events being written are read.
+
     Parameters
     ----------
     eventsdir : str
@@ -523,6 +530,15 @@ def retro_recos_to_i3files(
     i3dir : str, optional
         If None or not specified, defaults to `eventsdir`
     overwrite : bool
+    procs : int >= 1, optional
+        Number of worker processes, each populating one i3 file at a time.
+        With `procs` > 1, a failure to populate a file is reported (with its
+        traceback) and the remaining files are still populated.
+
+    Returns
+    -------
+    failed_i3filepaths : list of str
+        Output i3 files that failed to be written
 
     """
     eventsdir = abspath(expanduser(expandvars(eventsdir)))
@@ -553,13 +569,14 @@ def retro_recos_to_i3files(
 
     # -- Walk directories and match (events, recos) to i3 paths -- #
 
+    tasks = []
     for events_dirpath, dirs, filenames in walk(eventsdir):
         dirs.sort(key=nsort_key_func)
         if "events.npy" not in filenames:
             continue
 
         missing_recos = []
-        reco_filepaths = {}
+        reco_filepaths = OrderedDict()
         for reco in recos:
             reco_filepath = join(events_dirpath, "recos", "{}.npy".format(reco))
             if isfile(reco_filepath):
@@ -595,7 +612,6 @@ def retro_recos_to_i3files(
                     i3filepaths
                 )
             )
-        print("input_i3filepath:", input_i3filepath)
 
         suffix = "__" + "__".join(sorted(reco_filepaths.keys()))
         output_i3filepath = join(
@@ -613,131 +629,248 @@ def retro_recos_to_i3files(
                 )
             )
             continue
-        print("output_i3filepath:", output_i3filepath)
-
-        print("events_dirpath:", events_dirpath)
-        events = np.load(join(events_dirpath, "events.npy"))
-        recos_d = OrderedDict()
-        for reco, reco_filepath in reco_filepaths.items():
-            recos_d[reco] = np.load(reco_filepath)
-            if len(recos_d[reco]) != len(events):
-                raise ValueError(
-                    "{} has len {}, events has len {}".format(
-                        reco, len(recos_d[reco]), len(events)
+
+        tasks.append(
+            dict(
+                events_dirpath=events_dirpath,
+                reco_filepaths=reco_filepaths,
+                input_i3filepath=input_i3filepath,
+                output_i3filepath=output_i3filepath,
+                point_estimator=point_estimator,
+            )
+        )
+
+    procs = max(1, min(int(procs), len(tasks)))
+    if procs == 1:
+        results = (_populate_i3file_task(task, catch=False) for task in tasks)
+        pool = None
+    else:
+        pool = Pool(procs)
+        results = pool.imap_unordered(_populate_i3file_task, tasks, chunksize=1)
+
+    t0 = time.time()
+    failed_i3filepaths = []
+    try:
+        for num_done, (output_i3filepath, stats) in enumerate(results, 1):
+            if stats is None:
+                failed_i3filepaths.append(output_i3filepath)
+                print(
+                    '[{}/{}] FAILED to write "{}"'.format(
+                        num_done, len(tasks), output_i3filepath
                     )
                 )
-
-        # Collect frames into an event chain until we hit a physics frame, a
-        # second DAQ frame, or the end of the file.
-        #
-        # * If we have only a DAQ frame in the chain, create a new Physics
-        #   frame and populate the reco(s) to it.
-        #
-        # * If we have a Physics frame, populate the recos to that frame.
-        #
-        # * If we have no DAQ or Physics frames in the chain, we should be
-        #   done. Make sure we've accounted for all the recos in the npy files
-        #   and quit.
-        #
-        # When done with the chain, push all frames in the chain to the output file.
-        # physics frame, we have a new "event" to process; populate recos to
-        # that frame. Then, regardless of why we finished the event chain,
-        # write the frames in the chain out to the new i3 file.
-
-        input_i3file = I3File(input_i3filepath, "r")
-        output_i3file = I3File(output_i3filepath, "w")
-
-        frame_buffer = []
-        chain_has_daq_frame = False
-        chain_has_physics_frame = False
-        frame_counter = 0
-        event_index = -1
-
-        try:
-            while True:
-                if input_i3file.more():
-                    try:
-                        next_frame = input_i3file.pop_frame()
-                    except:
-                        sys.stderr.write(
-                            "Failed to pop frame #{}\n".format(frame_counter + 1)
-                        )
-                        raise
-                    frame_counter += 1
-                else:
-                    next_frame = None
-
-                # Current chain has ended and a new one will have to be started
-                # (or we're at the end of the file).
-
-                # Populate the reco to the current chain, push all of the
-                # current chain's frames to the output file, and start a new
-                # chain with the next frame (or quit if we're at the end of the
-                # file).
-                if (
-                    next_frame is None
-                    or next_frame.Stop == I3Frame.DAQ
-                    or (chain_has_physics_frame and next_frame.Stop == I3Frame.Physics)
-                ):
-                    if frame_buffer:
-                        # Events are identified as a chain with daq frame being
-                        # present with no physics frame, physics frame present
-                        # with no daq frame, or both being present (existence
-                        # of other frames is considered to be irrelevant)
-
-                        # TODO: oscNext v01.01 by L5, i3 file processing was
-                        # messed up, there were Q frames followed by I frames
-                        # and no associated P frame. Therefore we have to only
-                        # count chains with P frames in them as events, or else
-                        # the recos won't be put back in the right place /
-                        # indices run out.
-                        #if chain_has_daq_frame or chain_has_physics_frame:
-
-                        if chain_has_physics_frame:
-                            event_index += 1
-                            populate_pframe(
-                                event_index=event_index,
-                                frame_buffer=frame_buffer,
-                                recos_d=recos_d,
-                                point_estimator=point_estimator,
-                            )
-
-                        # Regardless if there was an event identified in the
-                        # chain, push all frames to the output file
-                        for frame in frame_buffer:
-                            output_i3file.push(frame)
-
-                    # No next frame indicates we hit the end of the file; quit
-                    if next_frame is None:
-                        break
-
-                    # Create a new chain, starting with the next frame
-                    frame_buffer = [next_frame]
-                    chain_has_daq_frame = next_frame.Stop == I3Frame.DAQ
-                    chain_has_physics_frame = next_frame.Stop == I3Frame.Physics
-
-                # Otherwise, we have just another frame in the current chain;
-                # append it and move on.
-                else:
-                    frame_buffer.append(next_frame)
-                    chain_has_daq_frame |= next_frame.Stop == I3Frame.DAQ
-                    chain_has_physics_frame |= next_frame.Stop == I3Frame.Physics
-
-        except:
-            output_i3file.close()
-            del output_i3file
-            remove(output_i3filepath)
-
-            sys.stderr.write(
-                'ERROR! file "{}", frame #{}\n'.format(
-                    input_i3filepath, frame_counter + 1
+                continue
+            num_events, num_frames, elapsed = stats
+            print(
+                '[{}/{}] wrote "{}": {} events, {} frames in {:.1f} s ({:.1f}'
+                " events/s; {:.1f} s elapsed)".format(
+                    num_done,
+                    len(tasks),
+                    output_i3filepath,
+                    num_events,
+                    num_frames,
+                    elapsed,
+                    num_events / elapsed if elapsed > 0 else np.inf,
+                    time.time() - t0,
                 )
             )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return failed_i3filepaths
+
+
+def _populate_i3file_task(kwargs, catch=True):
+    """Run `populate_i3file` (as a process-pool task).
+
+    Parameters
+    ----------
+    kwargs : mapping
+        Keyword arguments to `populate_i3file`
+    catch : bool, optional
+        Report exceptions (with full traceback, which is otherwise lost when
+        running in a worker process) instead of raising them
+
+    Returns
+    -------
+    output_i3filepath : str
+    stats : tuple (num_events, num_frames, elapsed) or None
+        None if an exception was caught
+
+    """
+    try:
+        stats = populate_i3file(**kwargs)
+    except Exception:
+        if not catch:
             raise
+        sys.stderr.write('ERROR writing "{}":\n'.format(kwargs["output_i3filepath"]))
+        traceback.print_exc(file=sys.stderr)
+        stats = None
+    return kwargs["output_i3filepath"], stats
 
-        else:
-            output_i3file.close()
-            del output_i3file
+
+def populate_i3file(
+    events_dirpath, reco_filepaths, input_i3filepath, output_i3filepath, point_estimator
+):
+    """Write a copy of an i3 file with Retro recos populated to its events'
+    physics frames.
+
+    Parameters
+    ----------
+    events_dirpath : str
+        Retro events leaf directory (containing "events.npy") extracted from
+        `input_i3filepath`
+    reco_filepaths : mapping
+        Keys are reco names and values are paths to their .npy files, which
+        are memory mapped (only the row of each event is read when it is
+        written)
+    input_i3filepath, output_i3filepath : str
+    point_estimator : str in {"mean", "median", "max"}
+
+    Returns
+    -------
+    num_events : int
+    num_frames : int
+    elapsed : float
+        Seconds taken
+
+    """
+    t0 = time.time()
+    num_events = len(np.load(join(events_dirpath, "events.npy"), mmap_mode="r"))
+    recos_d = OrderedDict()
+    for reco, reco_filepath in reco_filepaths.items():
+        recos_d[reco] = np.load(reco_filepath, mmap_mode="r")
+        if len(recos_d[reco]) != num_events:
+            raise ValueError(
+                "{} has len {}, events has len {}".format(
+                    reco, len(recos_d[reco]), num_events
+                )
+            )
+
+    # Collect frames into an event chain until we hit a physics frame, a
+    # second DAQ frame, or the end of the file.
+    #
+    # * If we have only a DAQ frame in the chain, create a new Physics
+    #   frame and populate the reco(s) to it.
+    #
+    # * If we have a Physics frame, populate the recos to that frame.
+    #
+    # * If we have no DAQ or Physics frames in the chain, we should be
+    #   done. Make sure we've accounted for all the recos in the npy files
+    #   and quit.
+    #
+    # When done with the chain, push all frames in the chain to the output file.
+    # physics frame, we have a new "event" to process; populate recos to
+    # that frame. Then, regardless of why we finished the event chain,
+    # write the frames in the chain out to the new i3 file.
+
+    input_i3file = I3File(input_i3filepath, "r")
+    output_i3file = I3File(output_i3filepath, "w")
+
+    frame_buffer = []
+    chain_has_daq_frame = False
+    chain_has_physics_frame = False
+    frame_counter = 0
+    event_index = -1
+
+    try:
+        while True:
+            if input_i3file.more():
+                try:
+                    next_frame = input_i3file.pop_frame()
+                except:
+                    sys.stderr.write(
+                        "Failed to pop frame #{}\n".format(frame_counter + 1)
+                    )
+                    raise
+                frame_counter += 1
+            else:
+                next_frame = None
+
+            # Current chain has ended and a new one will have to be started
+            # (or we're at the end of the file).
+
+            # Populate the reco to the current chain, push all of the
+            # current chain's frames to the output file, and start a new
+            # chain with the next frame (or quit if we're at the end of the
+            # file).
+            if (
+                next_frame is None
+                or next_frame.Stop == I3Frame.DAQ
+                or (chain_has_physics_frame and next_frame.Stop == I3Frame.Physics)
+            ):
+                if frame_buffer:
+                    # Events are identified as a chain with daq frame being
+                    # present with no physics frame, physics frame present
+                    # with no daq frame, or both being present (existence
+                    # of other frames is considered to be irrelevant)
+
+                    # TODO: oscNext v01.01 by L5, i3 file processing was
+                    # messed up, there were Q frames followed by I frames
+                    # and no associated P frame. Therefore we have to only
+                    # count chains with P frames in them as events, or else
+                    # the recos won't be put back in the right place /
+                    # indices run out.
+                    #if chain_has_daq_frame or chain_has_physics_frame:
+
+                    if chain_has_physics_frame:
+                        event_index += 1
+                        populate_pframe(
+                            event_index=event_index,
+                            frame_buffer=frame_buffer,
+                            recos_d=recos_d,
+                            point_estimator=point_estimator,
+                        )
+
+                    # Regardless if there was an event identified in the
+                    # chain, push all frames to the output file
+                    for frame in frame_buffer:
+                        output_i3file.push(frame)
+
+                # No next frame indicates we hit the end of the file; quit
+                if next_frame is None:
+                    break
+
+                # Create a new chain, starting with the next frame
+                frame_buffer = [next_frame]
+                chain_has_daq_frame = next_frame.Stop == I3Frame.DAQ
+                chain_has_physics_frame = next_frame.Stop == I3Frame.Physics
+
+            # Otherwise, we have just another frame in the current chain;
+            # append it and move on.
+            else:
+                frame_buffer.append(next_frame)
+                chain_has_daq_frame |= next_frame.Stop == I3Frame.DAQ
+                chain_has_physics_frame |= next_frame.Stop == I3Frame.Physics
+
+    except:
+        output_i3file.close()
+        del output_i3file
+        remove(output_i3filepath)
+
+        sys.stderr.write(
+            'ERROR! file "{}", frame #{}\n'.format(
+                input_i3filepath, frame_counter + 1
+            )
+        )
+        raise
+
+    else:
+        output_i3file.close()
+        del output_i3file
+
+    input_i3file.close()
+
+    if event_index + 1 != num_events:
+        print(
+            'WARNING: populated {} events to "{}" but "{}" has {} events'.format(
+                event_index + 1, output_i3filepath, events_dirpath, num_events
+            )
+        )
+
+    return event_index + 1, frame_counter, time.time() - t0
 
 
 def main(description=__doc__):
@@ -775,8 +908,17 @@ def main(description=__doc__):
         action="store_true",
         help="""Overwrite existing output file(s) if they exist""",
     )
+    parser.add_argument(
+        "--procs",
+        type=int,
+        default=1,
+        help="""Number of worker processes, each populating one i3 file at a
+        time""",
+    )
     kwargs = vars(parser.parse_args())
-    retro_recos_to_i3files(**kwargs)
+    failed_i3filepaths = retro_recos_to_i3files(**kwargs)
+    if failed_i3filepaths:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -39,6 +39,78 @@ from retro import __version__, init_obj
 from retro.reco import Reco
 
 
+class BatchedReco(icetray.I3Module):
+    """IceTray module that buffers physics frames and reconstructs each batch
+    of them concurrently in threads via `retro.reco.Reco.reco_frames`, sharing
+    the tables of a single `Reco` object. All frames (including any other
+    frames arriving while physics frames are buffered) are pushed in their
+    original order.
+
+    Parameters (IceTray)
+    --------------------
+    Reco : retro.reco.Reco
+    RecoKwargs : mapping
+        Keyword arguments to `Reco.__call__`, except `frame`
+    BatchSize : int >= 1
+        Number of physics frames to buffer
+    Threads : int >= 1
+        Number of threads reconstructing the frames of a batch
+
+    """
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter("Reco", "retro.reco.Reco object", None)
+        self.AddParameter("RecoKwargs", "Keyword arguments to Reco.__call__", {})
+        self.AddParameter("BatchSize", "Number of physics frames to buffer", 1)
+        self.AddParameter("Threads", "Number of reconstruction threads", 1)
+        self.AddOutBox("OutBox")
+        self.reco = None
+        self.reco_kwargs = None
+        self.batch_size = None
+        self.threads = None
+        self.frames = []
+        self.num_physics_frames = 0
+
+    def Configure(self):  # pylint: disable=invalid-name, missing-docstring
+        self.reco = self.GetParameter("Reco")
+        self.reco_kwargs = dict(self.GetParameter("RecoKwargs"))
+        self.batch_size = int(self.GetParameter("BatchSize"))
+        self.threads = int(self.GetParameter("Threads"))
+        if self.reco is None:
+            raise ValueError("Parameter `Reco` must be specified")
+        if self.batch_size < 1 or self.threads < 1:
+            raise ValueError("`BatchSize` and `Threads` must be >= 1")
+
+    def Process(self):  # pylint: disable=invalid-name, missing-docstring
+        frame = self.PopFrame()
+        self.frames.append(frame)
+        if frame.Stop == icetray.I3Frame.Physics:
+            self.num_physics_frames += 1
+            if self.num_physics_frames >= self.batch_size:
+                self._process_batch()
+
+    def Flush(self):  # pylint: disable=invalid-name, missing-docstring
+        self._process_batch()
+        icetray.I3Module.Flush(self)
+
+    def Finish(self):  # pylint: disable=invalid-name, missing-docstring
+        if self.frames:
+            raise RuntimeError(
+                "{} buffered frames were never pushed".format(len(self.frames))
+            )
+
+    def _process_batch(self):
+        physics_frames = [f for f in self.frames if f.Stop == icetray.I3Frame.Physics]
+        if physics_frames:
+            self.reco.reco_frames(
+                frames=physics_frames, threads=self.threads, **self.reco_kwargs
+            )
+        for frame in self.frames:
+            self.PushFrame(frame)
+        self.frames = []
+        self.num_physics_frames = 0
+
+
 def main():
     """Script to run Retro recos in icetray"""
     parser = ArgumentParser()
@@ -56,9 +128,24 @@ def main():
         help="""Output I3 file""",
     )
 
+    parser.add_argument(
+        "--batch-size", type=int,
+        default=1,
+        help="""Number of physics frames to buffer and reconstruct
+        concurrently""",
+    )
+
+    parser.add_argument(
+        "--threads", type=int,
+        default=1,
+        help="""Number of threads reconstructing each batch of frames""",
+    )
+
     split_kwargs = init_obj.parse_args(dom_tables=True, tdi_tables=True, parser=parser)
 
     other_kw = split_kwargs.pop("other_kw")
+    batch_size = other_kw.pop("batch_size")
+    threads = other_kw.pop("threads")
 
     # instantiate Retro reco object
     my_reco = Reco(**split_kwargs)
@@ -71,9 +158,7 @@ def main():
         FilenameList=other_kw["input_i3_file"],
     )
 
-    tray.Add(
-        _type=my_reco,
-        _name="retro",
+    reco_kwargs = dict(
         methods="crs_prefit",
         reco_pulse_series_name="SRTTWOfflinePulsesDC",
         hit_charge_quant=0.05,
@@ -85,6 +170,18 @@ def main():
         point_estimator="median",
     )
 
+    if batch_size > 1 or threads > 1:
+        tray.AddModule(
+            _type=BatchedReco,
+            _name="retro",
+            Reco=my_reco,
+            RecoKwargs=reco_kwargs,
+            BatchSize=max(batch_size, threads),
+            Threads=threads,
+        )
+    else:
+        tray.Add(_type=my_reco, _name="retro", **reco_kwargs)
+
     tray.AddModule(
         _type="I3Writer",
         _name="writer",
@@ -12,7 +12,15 @@ from __future__ import absolute_import, division, print_function
 __all__ = [
     'setup_dom_tables',
     'setup_discrete_hypo',
+    'TRIGGER_WINDOWS',
+    'get_trigger_time_window',
+    'test_get_trigger_time_window',
     'get_hits',
+    'test_get_hits',
+    'get_event',
+    'read_npy_slice',
+    'evaluate_prefilter',
+    'iter_prefetched',
     'parse_args',
 ]
 
@@ -39,14 +47,16 @@ except ImportError:
     from collections.abc import Iterable, Mapping
 from copy import deepcopy
 from operator import getitem
-from os import listdir, walk
+from os import listdir
 from os.path import abspath, dirname, isdir, isfile, join, splitext
 import sys
+import threading
 import time
 
 import numba
 import numpy as np
-from six import string_types
+from six import reraise, string_types
+from six.moves import queue
 
 if __name__ == '__main__' and __package__ is None:
     RETRO_DIR = dirname(dirname(abspath(__file__)))
@@ -58,13 +68,20 @@ from retro.hypo import discrete_cascade_kernels as dck
 from retro.hypo import discrete_muon_kernels as dmk
 from retro.i3info.angsens_model import load_angsens_model
 from retro.i3info.extract_gcd import extract_gcd
+from retro.i3processing.events_manifest import iter_selected_leaf_dirs, range_to_slice_kw
+from retro.i3processing.flat_pulses import FlatPulses, is_flat_pulses
 from retro.retro_types import (
-    HIT_T, SD_INDEXER_T, HITS_SUMMARY_T, TriggerConfigID, TriggerTypeID, TriggerSourceID
+    FLAT_PULSE_T, HIT_T, OMKEY_T, SD_INDEXER_T, HITS_SUMMARY_T, TriggerConfigID, TriggerTypeID,
+    TriggerSourceID
 )
 from retro.tables.retro_5d_tables import (
     NORM_VERSIONS, TABLE_KINDS, Retro5DTables
 )
-from retro.utils.misc import expand, nsort_key_func, quantize
+from retro.tables.prefetch import DFLT_PREFETCH_MARGIN, TablePrefetcher
+from retro.tables.table_cache import get_tables_cache_key
+from retro.tables.sparse_tdi import is_sparse_tdi, load_sparse_tdi
+from retro.tables.tdi_store import TDIStore, is_tdi_store
+from retro.utils.misc import expand, quantize
 
 
 QUANTIZE_VEC = numba.vectorize(cache=True, target="cpu")(quantize)
@@ -82,6 +99,11 @@ def setup_dom_tables(
     compute_t_indep_exp=True,
     no_noise=False,
     force_no_mmap=False,
+    coarse_dom_tables_fname_proto=None,
+    table_cache_dir=None,
+    prefetch=False,
+    prefetch_margin=DFLT_PREFETCH_MARGIN,
+    chunked_tables=False,
 ):
     """Instantiate and load single-DOM tables.
 
@@ -98,6 +120,33 @@ def setup_dom_tables(
     compute_t_indep_exp : bool, optional
     no_noise : bool, optional
     force_no_mmap : bool, optional
+    coarse_dom_tables_fname_proto : str, optional
+        If specified, additionally load coarsely-binned "ckv_uncompr" tables
+        (e.g. as produced by `retro.tables.coarsen_ckv_table`) and attach them
+        as `dom_tables.coarse_tables`. The coarse tables must be laid out
+        such that they map DOMs to table indices identically to the fine
+        tables.
+    table_cache_dir : str, optional
+        If specified, table norms and table metadata are cached in (and, on
+        subsequent invocations, loaded from) this directory; only applies to
+        "ckv_uncompr" and "ckv_templ_compr" tables. See
+        `retro.tables.table_cache`.
+    prefetch : bool, optional
+        If True and tables are memory mapped, attach a
+        `retro.tables.prefetch.TablePrefetcher` as `dom_tables.prefetcher`
+        (used by `retro.reco.Reco` to prefetch the table regions each event
+        will access).
+    prefetch_margin : float >= 0, optional
+        Distance (m) by which the bounding box of an event's hit DOMs is
+        enlarged to find the table regions to prefetch; see
+        `retro.tables.prefetch.DFLT_PREFETCH_MARGIN`
+    chunked_tables : bool, optional
+        Tables are in the chunked, compressed format (see
+        `retro.tables.chunked_tables`); not supported for stacked tables.
+        Tables stay compressed when loaded and each is decompressed
+        directly into the stacked array when the likelihood functions are
+        generated (template-compressed tables are decompressed at load), so
+        memory for the uncompressed tables is still required.
 
     Returns
     -------
@@ -107,13 +156,15 @@ def setup_dom_tables(
     print('Instantiating and loading DOM tables')
     t0 = time.time()
 
+    gcd_ = gcd
+
     dom_tables_fname_proto = expand(dom_tables_fname_proto)
 
     # TODO: set mmap based on memory?
     if force_no_mmap:
         mmap = False
     else:
-        mmap = 'uncompr' in dom_tables_kind
+        mmap = 'uncompr' in dom_tables_kind and not chunked_tables
 
     if dom_tables_kind in ['raw_templ_compr', 'ckv_templ_compr']:
         template_library = np.load(expand(template_library))
@@ -137,103 +188,158 @@ def setup_dom_tables(
         ckv_sigma_deg=ckv_sigma_deg,
         template_library=template_library,
         use_sd_indices=use_sd_indices,
+        table_cache_dir=table_cache_dir,
+        chunked=chunked_tables,
     )
 
-    if '{subdet' in dom_tables_fname_proto:
-        doms = const.ALL_DOMS
-        for subdet in ['ic', 'dc']:
-            if subdet == 'ic':
-                strings = const.IC_STRS
-            else:
-                strings = const.DC_STRS
+    tables_cache_key = None
+    loaded_from_cache = False
+    if table_cache_dir is not None and dom_tables.tbl_is_ckv and not chunked_tables:
+        tables_cache_key = get_tables_cache_key(
+            table_kind=dom_tables_kind,
+            tables_location=dom_tables_fname_proto,
+            norm_version=norm_version,
+            angsens_model=dom_tables.angsens_model,
+            sd_indices=dom_tables.use_sd_indices,
+            compute_t_indep_exp=compute_t_indep_exp,
+        )
+        loaded_from_cache = dom_tables.load_tables_from_cache(
+            cache_key=tables_cache_key, mmap=mmap
+        )
+        if loaded_from_cache:
+            print('  loaded tables via table cache "{}"'.format(table_cache_dir))
+
+    if not loaded_from_cache:
+        if '{subdet' in dom_tables_fname_proto:
+            doms = const.ALL_DOMS
+            for subdet in ['ic', 'dc']:
+                if subdet == 'ic':
+                    strings = const.IC_STRS
+                else:
+                    strings = const.DC_STRS
 
-            for dom in doms:
-                fpath = dom_tables_fname_proto.format(
-                    subdet=subdet, dom=dom, depth_idx=dom - 1
-                )
+                for dom in doms:
+                    fpath = dom_tables_fname_proto.format(
+                        subdet=subdet, dom=dom, depth_idx=dom - 1
+                    )
+
+                    shared_table_sd_indices = []
+                    for string in strings:
+                        sd_idx = const.get_sd_idx(string=string, om=dom, pmt=0)
+                        if sd_idx not in use_sd_indices:
+                            continue
+                        shared_table_sd_indices.append(sd_idx)
 
-                shared_table_sd_indices = []
-                for string in strings:
-                    sd_idx = const.get_sd_idx(string=string, om=dom, pmt=0)
-                    if sd_idx not in use_sd_indices:
+                    if not shared_table_sd_indices:
                         continue
-                    shared_table_sd_indices.append(sd_idx)
 
-                if not shared_table_sd_indices:
-                    continue
+                    dom_tables.load_table(
+                        fpath=fpath,
+                        sd_indices=shared_table_sd_indices,
+                        mmap=mmap,
+                    )
 
-                dom_tables.load_table(
-                    fpath=fpath,
-                    sd_indices=shared_table_sd_indices,
-                    mmap=mmap,
-                )
+        elif '{string}' in dom_tables_fname_proto:
+            raise NotImplementedError('dom_tables_fname_proto with {string} not'
+                                      ' implemented')
+
+        elif '{string_idx}' in dom_tables_fname_proto:
+            raise NotImplementedError('dom_tables_fname_proto with {string_idx}'
+                                      ' not implemented')
 
-    elif '{string}' in dom_tables_fname_proto:
-        raise NotImplementedError('dom_tables_fname_proto with {string} not'
-                                  ' implemented')
+        elif '{cluster_idx}' in dom_tables_fname_proto:
+            cluster_idx = -1
+            while True:
+                cluster_idx += 1
+                dpath = dom_tables_fname_proto.format(cluster_idx=cluster_idx)
+                if not isdir(dpath):
+                    print(
+                        'failed to find "{}" (this may inidicate that all existing '
+                        "tables are loaded)\n"
+                        .format(dpath)
+                    )
+                    break
 
-    elif '{string_idx}' in dom_tables_fname_proto:
-        raise NotImplementedError('dom_tables_fname_proto with {string_idx}'
-                                  ' not implemented')
+                # TODO: make the omkeys field generic to all tables & place
+                # loading & intersection ops within the `load_table` method.
+                omkeys = np.load(join(dpath, 'omkeys.npy'))
+                sd_indices = set(const.omkeys_to_sd_indices(omkeys))
+                shared_table_sd_indices = sd_indices.intersection(use_sd_indices)
 
-    elif '{cluster_idx}' in dom_tables_fname_proto:
-        cluster_idx = -1
-        while True:
-            cluster_idx += 1
-            dpath = dom_tables_fname_proto.format(cluster_idx=cluster_idx)
-            if not isdir(dpath):
-                print(
-                    'failed to find "{}" (this may inidicate that all existing '
-                    "tables are loaded)\n"
-                    .format(dpath)
+                dom_tables.load_table(
+                    fpath=dpath,
+                    sd_indices=shared_table_sd_indices,
+                    mmap=mmap,
                 )
-                break
-
-            # TODO: make the omkeys field generic to all tables & place
-            # loading & intersection ops within the `load_table` method.
-            omkeys = np.load(join(dpath, 'omkeys.npy'))
-            sd_indices = set(const.omkeys_to_sd_indices(omkeys))
-            shared_table_sd_indices = sd_indices.intersection(use_sd_indices)
 
-            dom_tables.load_table(
-                fpath=dpath,
-                sd_indices=shared_table_sd_indices,
-                mmap=mmap,
+        else:
+            if chunked_tables:
+                raise NotImplementedError('Chunked stacked tables not supported')
+            stacked_tables_fpath = expand(join(
+                dom_tables_fname_proto,
+                'stacked_{}.npy'.format(dom_tables.table_name)
+            ))
+            stacked_tables_meta_fpath = expand(join(
+                dom_tables_fname_proto,
+                'stacked_{}_meta.pkl'.format(dom_tables.table_name)
+            ))
+            stacked_t_indep_tables_fpath = expand(join(
+                dom_tables_fname_proto,
+                'stacked_{}.npy'.format(dom_tables.t_indep_table_name)
+            ))
+            dom_tables.load_stacked_tables(
+                stacked_tables_meta_fpath=stacked_tables_meta_fpath,
+                stacked_tables_fpath=stacked_tables_fpath,
+                stacked_t_indep_tables_fpath=stacked_t_indep_tables_fpath,
+                mmap_t_indep=mmap,
             )
 
-    else:
-        stacked_tables_fpath = expand(join(
-            dom_tables_fname_proto,
-            'stacked_{}.npy'.format(dom_tables.table_name)
-        ))
-        stacked_tables_meta_fpath = expand(join(
-            dom_tables_fname_proto,
-            'stacked_{}_meta.pkl'.format(dom_tables.table_name)
-        ))
-        stacked_t_indep_tables_fpath = expand(join(
-            dom_tables_fname_proto,
-            'stacked_{}.npy'.format(dom_tables.t_indep_table_name)
-        ))
-        dom_tables.load_stacked_tables(
-            stacked_tables_meta_fpath=stacked_tables_meta_fpath,
-            stacked_tables_fpath=stacked_tables_fpath,
-            stacked_t_indep_tables_fpath=stacked_t_indep_tables_fpath,
-            mmap_t_indep=mmap,
-        )
-
-    for table in dom_tables.tables:
-        assert np.all(np.isfinite(table['weight'])), 'table not finite!'
-        assert np.all(table['weight'] >= 0), 'table is negative!'
-        assert np.min(table['index']) >= 0, 'table has negative index'
-        if dom_tables.template_library is not None:
-            assert np.max(table['index']) < dom_tables.template_library.shape[0], \
-                    'table too large index'
+        if tables_cache_key is not None:
+            dom_tables.store_tables_in_cache(cache_key=tables_cache_key)
+
+    if dom_tables.tbl_is_templ_compr:
+        for table in dom_tables.tables:
+            assert np.all(np.isfinite(table['weight'])), 'table not finite!'
+            assert np.all(table['weight'] >= 0), 'table is negative!'
+            assert np.min(table['index']) >= 0, 'table has negative index'
+            if dom_tables.template_library is not None:
+                assert np.max(table['index']) < dom_tables.template_library.shape[0], \
+                        'table too large index'
     if dom_tables.template_library is not None:
         assert np.all(np.isfinite(dom_tables.template_library)), 'templates not finite!'
         assert np.all(dom_tables.template_library >= 0), 'templates have negative values!'
 
+    if prefetch and mmap:
+        dom_tables.prefetcher = TablePrefetcher(dom_tables, margin=prefetch_margin)
+
     print('  -> {:.3f} s\n'.format(time.time() - t0))
 
+    if coarse_dom_tables_fname_proto is not None:
+        print('Loading coarse DOM tables')
+        coarse_tables = setup_dom_tables(
+            dom_tables_kind='ckv_uncompr',
+            dom_tables_fname_proto=coarse_dom_tables_fname_proto,
+            gcd=gcd_,
+            norm_version=norm_version,
+            use_sd_indices=use_sd_indices,
+            num_phi_samples=num_phi_samples,
+            ckv_sigma_deg=ckv_sigma_deg,
+            compute_t_indep_exp=compute_t_indep_exp,
+            no_noise=no_noise,
+            force_no_mmap=force_no_mmap,
+            table_cache_dir=table_cache_dir,
+            prefetch=prefetch,
+            prefetch_margin=prefetch_margin,
+        )
+        if not np.array_equal(
+            coarse_tables.sd_idx_table_indexer, dom_tables.sd_idx_table_indexer
+        ):
+            raise ValueError(
+                'Coarse tables must map DOMs to table indices identically to'
+                ' the fine tables'
+            )
+        dom_tables.coarse_tables = coarse_tables
+
     return dom_tables
 
 
@@ -243,8 +349,11 @@ def setup_tdi_tables(tdi=None, mmap=False):
     Parameters
     ----------
     tdi : sequence of strings, optional
-        Path to TDI tables' `ckv_tdi_table.npy` files, or paths to
-        directories containing those files; one entry per TDI table
+        Paths to TDI stores (containing quantity "ckv_tdi_table"), to sparse
+        TDI tables (see `retro.tables.sparse_tdi`), to TDI tables'
+        `ckv_tdi_table.npy` files, or to directories containing those files;
+        one entry per TDI table. A sparse TDI table is returned as the tuple
+        of its arrays.
 
     mmap : bool
 
@@ -265,6 +374,23 @@ def setup_tdi_tables(tdi=None, mmap=False):
         if tdi_ is None:
             continue
         tdi_ = expand(tdi_)
+        if is_tdi_store(tdi_):
+            print('Loading and instantiating TDI table from store "{}"'.format(tdi_))
+            store = TDIStore(tdi_, mmap=mmap)
+            meta = OrderedDict(store.meta)
+            meta['bin_edges'] = store.bin_edges
+            tdi_table = store.get_array('ckv_tdi_table')
+            tdi_metas.append(meta)
+            tdi_tables.append(tdi_table)
+            continue
+
+        if is_sparse_tdi(tdi_):
+            print('Loading sparse TDI table from "{}"'.format(tdi_))
+            tdi_table, meta = load_sparse_tdi(tdi_, mmap=mmap)
+            tdi_metas.append(meta)
+            tdi_tables.append(tdi_table)
+            continue
+
         if isdir(tdi_):
             tdi_ = join(tdi_, 'ckv_tdi_table.npy')
 
@@ -363,6 +489,9 @@ def get_events(
     hits=None,
     hit_charge_quant=None,
     min_hit_charge=None,
+    prefilter=None,
+    event_selector=None,
+    prefetch_depth=None,
 ):
     """Iterate through a Retro events directory, getting events in a
     the form of a nested OrderedDict, with leaf nodes numpy structured arrays.
@@ -374,7 +503,11 @@ def get_events(
     ----------
     events_root : string or iterable thereof
         Path(s) to Retro events directory(ies) (each such directory corresponds
-        to a single i3 file and contains an "events.npy" file).
+        to a single i3 file and contains an "events.npy" file). If a root
+        directory has a manifest (see
+        `retro.i3processing.events_manifest`), its leaf directories are found
+        from the manifest instead of by walking the tree; either way, only leaf
+        directories with events selected by the slicing below are read.
 
     start, stop, step : optional
         Arguments passed to ``slice`` for only retrieving select events from
@@ -397,7 +530,11 @@ def get_events(
 
     pulses : sequences of strings, optional
         Pulse series names to extract. Default is to not extract any pulse
-        series.
+        series. Pulses stored in the columnar format (see
+        `retro.i3processing.flat_pulses`) are yielded as arrays of dtype
+        FLAT_PULSE_T (views into memory-mapped files, so only each yielded
+        event's pulses are read); legacy pickled pulses are yielded as lists
+        of ((string, om, pmt), PULSE_T array) tuples.
 
     recos : sequence of strings, optional
         Reconstruction names to extract. Default is to not extract any
@@ -422,6 +559,30 @@ def get_events(
 
     min_hit_charge : scalar, required if `hits` specified
 
+    prefilter : string, optional
+        Expression evaluated vectorized over each leaf directory's selected
+        event headers (and, if referenced, reco arrays and pulse counts); see
+        `evaluate_prefilter`. Events for which it is False are neither built
+        nor yielded (so, unlike with the per-event `filter` of
+        `retro.reco.Reco`, no "skipped" fit status is recorded for them);
+        aggregate indices of yielded events are unchanged. Flat pulses are
+        read only for passing events; other per-event files are read over the
+        span from the first to the last passing event in each directory.
+
+    event_selector : callable, optional
+        Called as ``event_selector(dirpath, event_indices, headers)`` for each
+        leaf directory with the indices (within the directory) and headers of
+        its selected events; must return a bool array of the same length.
+        Events for which it is False are treated as if they failed
+        `prefilter` (and both must pass if both are specified).
+
+    prefetch_depth : None or int >= 0, optional
+        If > 0, events (including their hits) are prepared by a background
+        thread up to this many events ahead of the consumer, so reading and
+        preparing events overlaps with whatever the consumer does with them.
+        Order (and therefore `event.meta`) is unchanged. None or 0 disables
+        prefetching.
+
     Yields
     ------
     event : nested OrderedDict
@@ -430,6 +591,32 @@ def get_events(
         "events_root", "num_events", and "event_idx".
 
     """
+    if prefetch_depth:
+        kwargs = dict(
+            events_root=events_root,
+            gcd_dir=gcd_dir,
+            start=start,
+            stop=stop,
+            step=step,
+            agg_start=agg_start,
+            agg_stop=agg_stop,
+            agg_step=agg_step,
+            truth=truth,
+            photons=photons,
+            pulses=pulses,
+            recos=recos,
+            triggers=triggers,
+            angsens_model=angsens_model,
+            hits=hits,
+            hit_charge_quant=hit_charge_quant,
+            min_hit_charge=min_hit_charge,
+            prefilter=prefilter,
+            event_selector=event_selector,
+        )
+        for event in iter_prefetched(get_events(**kwargs), depth=prefetch_depth):
+            yield event
+        return
+
     if isinstance(events_root, string_types):
         events_roots = [expand(events_root)]
     else:
@@ -496,201 +683,305 @@ def get_events(
                 "`min_hit_charge` must be specified if `hits` is specified"
             )
 
-    agg_event_idx = -1
-    for events_root in events_roots:
-        for dirpath, dirs, files in walk(events_root, followlinks=True):
-            dirs.sort(key=nsort_key_func)
-
-            if "events.npy" not in files:
-                continue
-
-            file_iterator_tree = OrderedDict()
-
-            num_events, event_indices, headers = iterate_file(
-                join(dirpath, 'events.npy'), **slice_kw
+    # Only read events (and only from leaf dirs) that will be yielded
+    for dirpath, num_events_in_dir, dir_slice_kw, agg_indices in iter_selected_leaf_dirs(
+            events_roots=events_roots,
+            slice_kw=slice_kw,
+            agg_start=agg_start,
+            agg_stop=agg_stop,
+            agg_step=agg_step,
+    ):
+        file_iterator_tree = OrderedDict()
+
+        num_events, event_indices, headers = read_npy_slice(
+            join(dirpath, 'events.npy'), **dir_slice_kw
+        )
+        if num_events != num_events_in_dir:
+            raise ValueError(
+                '"{}" has {} events but the events manifest says {}; rebuild'
+                ' the manifest'.format(dirpath, num_events, num_events_in_dir)
             )
 
-            meta = OrderedDict(
-                [
-                    ("events_root", dirpath),
-                    ("num_events", num_events),
-                    ("event_idx", None),
-                    ("agg_event_idx", None),
-                ]
+        # Positions (relative to the slice read below) of events to yield;
+        # None means all of them
+        keep = None
+        passed = None
+        if prefilter is not None:
+            passed = evaluate_prefilter(
+                prefilter=prefilter, dirpath=dirpath, headers=headers, slice_kw=dir_slice_kw
+            )
+        if event_selector is not None:
+            selected = np.asarray(
+                event_selector(dirpath, event_indices, headers), dtype=bool
             )
+            passed = selected if passed is None else passed & selected
+        if passed is not None:
+            passing = np.flatnonzero(passed)
+            if len(passing) == 0:
+                continue
+            # Only read the span from the first to the last passing event, and
+            # only build events that pass from it
+            first, last = passing[0], passing[-1] + 1
+            keep = passing - first
+            dir_slice_kw = range_to_slice_kw(event_indices[first:last])
+            event_indices = _take(event_indices[first:last], keep)
+            agg_indices = _take(agg_indices[first:last], keep)
+            headers = headers[passing]
+
+        meta = OrderedDict(
+            [
+                ("events_root", dirpath),
+                ("num_events", num_events),
+                ("event_idx", None),
+                ("agg_event_idx", None),
+            ]
+        )
 
-            event_indices_iter = iter(event_indices)
-            file_iterator_tree['header'] = iter(headers)
+        event_indices_iter = iter(event_indices)
+        agg_indices_iter = iter(agg_indices)
+        file_iterator_tree['header'] = iter(headers)
 
-            # -- Translate args with defaults / find dynamically-specified things -- #
+        # -- Translate args with defaults / find dynamically-specified things -- #
 
-            if truth is None:
-                truth_ = isfile(join(dirpath, 'truth.npy'))
-            else:
-                truth_ = truth
+        if truth is None:
+            truth_ = isfile(join(dirpath, 'truth.npy'))
+        else:
+            truth_ = truth
 
-            if photons is None:
-                dpath = join(dirpath, 'photons')
-                if isdir(dpath):
-                    photons_ = [splitext(d)[0] for d in listdir(dpath)]
-                else:
-                    photons_ = False
-            elif isinstance(photons, string_types):
-                photons_ = [photons]
+        if photons is None:
+            dpath = join(dirpath, 'photons')
+            if isdir(dpath):
+                photons_ = [splitext(d)[0] for d in listdir(dpath)]
             else:
-                photons_ = photons
+                photons_ = False
+        elif isinstance(photons, string_types):
+            photons_ = [photons]
+        else:
+            photons_ = photons
 
-            if pulses is None:
-                dpath = join(dirpath, 'pulses')
-                if isdir(dpath):
-                    pulses_ = [splitext(d)[0] for d in listdir(dpath) if 'TimeRange' not in d]
-                else:
-                    pulses_ = False
-            elif isinstance(pulses, string_types):
-                pulses_ = [pulses]
+        if pulses is None:
+            dpath = join(dirpath, 'pulses')
+            if isdir(dpath):
+                pulses_ = [splitext(d)[0] for d in listdir(dpath) if 'TimeRange' not in d]
             else:
-                pulses_ = list(pulses)
-
-            if recos is None:
-                dpath = join(dirpath, 'recos')
-                if isdir(dpath):
-                    # TODO: make check a regex including colons, etc. so we don't
-                    # accidentally exclude a valid reco that starts with "slc"
-                    recos_ = []
-                    for fname in listdir(dpath):
-                        if fname[:3] in ("slc", "evt"):
-                            continue
-                        fbase = splitext(fname)[0]
-                        if fbase.endswith(".llhp"):
-                            continue
-                        recos_.append(fbase)
-                else:
-                    recos_ = False
-            elif isinstance(recos, string_types):
-                recos_ = [recos]
+                pulses_ = False
+        elif isinstance(pulses, string_types):
+            pulses_ = [pulses]
+        else:
+            pulses_ = list(pulses)
+
+        if recos is None:
+            dpath = join(dirpath, 'recos')
+            if isdir(dpath):
+                # TODO: make check a regex including colons, etc. so we don't
+                # accidentally exclude a valid reco that starts with "slc"
+                recos_ = []
+                for fname in listdir(dpath):
+                    if fname[:3] in ("slc", "evt"):
+                        continue
+                    fbase = splitext(fname)[0]
+                    if fbase.endswith(".llhp"):
+                        continue
+                    recos_.append(fbase)
             else:
-                recos_ = list(recos)
+                recos_ = False
+        elif isinstance(recos, string_types):
+            recos_ = [recos]
+        else:
+            recos_ = list(recos)
 
-            if triggers is None:
-                dpath = join(dirpath, 'triggers')
-                if isdir(dpath):
-                    triggers_ = [splitext(d)[0] for d in listdir(dpath)]
-                else:
-                    triggers_ = False
-            elif isinstance(triggers, string_types):
-                triggers_ = [triggers]
+        if triggers is None:
+            dpath = join(dirpath, 'triggers')
+            if isdir(dpath):
+                triggers_ = [splitext(d)[0] for d in listdir(dpath)]
             else:
-                triggers_ = list(triggers)
-
-            # Note that `hits_` must be defined after `pulses_` and `photons_`
-            # since `hits_` is one of these
-            if hits is None:
-                if pulses_ is not None and len(pulses_) == 1:
-                    hits_ = ['pulses', pulses_[0]]
-                elif photons_ is not None and len(photons_) == 1:
-                    hits_ = ['photons', photons_[0]]
-            elif isinstance(hits, string_types):
-                hits_ = hits.split('/')
-            else:
-                raise TypeError("{}".format(type(hits)))
+                triggers_ = False
+        elif isinstance(triggers, string_types):
+            triggers_ = [triggers]
+        else:
+            triggers_ = list(triggers)
+
+        # Note that `hits_` must be defined after `pulses_` and `photons_`
+        # since `hits_` is one of these
+        if hits is None:
+            if pulses_ is not None and len(pulses_) == 1:
+                hits_ = ['pulses', pulses_[0]]
+            elif photons_ is not None and len(photons_) == 1:
+                hits_ = ['photons', photons_[0]]
+        elif isinstance(hits, string_types):
+            hits_ = hits.split('/')
+        else:
+            raise TypeError("{}".format(type(hits)))
 
-            # -- Populate the file iterator tree -- #
+        # -- Populate the file iterator tree -- #
 
-            if truth_:
-                num_truths, _, truths = iterate_file(
-                    fpath=join(dirpath, 'truth.npy'), **slice_kw
+        if truth_:
+            num_truths, _, truths = read_npy_slice(
+                fpath=join(dirpath, 'truth.npy'), **dir_slice_kw
+            )
+            assert num_truths == num_events
+            file_iterator_tree['truth'] = iter(_take(truths, keep))
+
+        if photons_:
+            photons_ = sorted(photons_)
+            file_iterator_tree['photons'] = iterators = OrderedDict()
+            for photon_series in photons_:
+                num_phs, _, photon_serieses = iterate_file(
+                    fpath=join(dirpath, 'photons', photon_series + '.pkl'), **dir_slice_kw
                 )
-                assert num_truths == num_events
-                file_iterator_tree['truth'] = iter(truths)
-
-            if photons_:
-                photons_ = sorted(photons_)
-                file_iterator_tree['photons'] = iterators = OrderedDict()
-                for photon_series in photons_:
-                    num_phs, _, photon_serieses = iterate_file(
-                        fpath=join(dirpath, 'photons', photon_series + '.pkl'), **slice_kw
-                    )
-                    assert num_phs == num_events
-                    iterators[photon_series] = iter(photon_serieses)
-
-            if pulses_:
-                file_iterator_tree['pulses'] = iterators = OrderedDict()
-                for pulse_series in sorted(pulses_):
+                assert num_phs == num_events
+                iterators[photon_series] = iter(_take(photon_serieses, keep))
+
+        if pulses_:
+            file_iterator_tree['pulses'] = iterators = OrderedDict()
+            for pulse_series in sorted(set(pulses_)):
+                flat_pulses_dpath = join(dirpath, 'pulses', pulse_series)
+                if is_flat_pulses(flat_pulses_dpath):
+                    # Only the requested events' slices are ever read
+                    flat_pulses = FlatPulses(flat_pulses_dpath, mmap=True)
+                    assert len(flat_pulses) == num_events
+                    iterators[pulse_series] = flat_pulses.iter_events(event_indices)
+                else:
                     num_ps, _, pulse_serieses = iterate_file(
-                        fpath=join(dirpath, 'pulses', pulse_series + '.pkl'), **slice_kw
+                        fpath=join(dirpath, 'pulses', pulse_series + '.pkl'), **dir_slice_kw
                     )
                     assert num_ps == num_events
-                    iterators[pulse_series] = iter(pulse_serieses)
-
-                    num_tr, _, time_ranges = iterate_file(
-                        fpath=join(
-                            dirpath,
-                            'pulses',
-                            pulse_series + 'TimeRange' + '.npy'
-                        ),
-                        **slice_kw
-                    )
-                    assert num_tr == num_events
-                    iterators[pulse_series + 'TimeRange'] = iter(time_ranges)
-
-            if recos_:
-                file_iterator_tree['recos'] = iterators = OrderedDict()
-                for reco in sorted(recos_):
-                    num_recoses, _, recoses = iterate_file(
-                        fpath=join(dirpath, 'recos', reco + '.npy'), **slice_kw
-                    )
-                    assert num_recoses == num_events
-                    iterators[reco] = iter(recoses)
-
-            if triggers_:
-                file_iterator_tree['triggers'] = iterators = OrderedDict()
-                for trigger_hier in sorted(triggers_):
-                    num_th, _, trigger_hiers = iterate_file(
-                        fpath=join(dirpath, 'triggers', trigger_hier + '.pkl'), **slice_kw
-                    )
-                    assert num_th == num_events
-                    iterators[trigger_hier] = iter(trigger_hiers)
+                    iterators[pulse_series] = iter(_take(pulse_serieses, keep))
+
+                num_tr, _, time_ranges = read_npy_slice(
+                    fpath=join(
+                        dirpath,
+                        'pulses',
+                        pulse_series + 'TimeRange' + '.npy'
+                    ),
+                    **dir_slice_kw
+                )
+                assert num_tr == num_events
+                iterators[pulse_series + 'TimeRange'] = iter(_take(time_ranges, keep))
+
+        if recos_:
+            file_iterator_tree['recos'] = iterators = OrderedDict()
+            for reco in sorted(recos_):
+                num_recoses, _, recoses = read_npy_slice(
+                    fpath=join(dirpath, 'recos', reco + '.npy'), **dir_slice_kw
+                )
+                assert num_recoses == num_events
+                iterators[reco] = iter(_take(recoses, keep))
+
+        if triggers_:
+            file_iterator_tree['triggers'] = iterators = OrderedDict()
+            for trigger_hier in sorted(triggers_):
+                num_th, _, trigger_hiers = iterate_file(
+                    fpath=join(dirpath, 'triggers', trigger_hier + '.pkl'), **dir_slice_kw
+                )
+                assert num_th == num_events
+                iterators[trigger_hier] = iter(_take(trigger_hiers, keep))
 
-            if hits_ is not None and hits_[0] == 'photons':
-                angsens_model, _ = load_angsens_model(angsens_model)
-            else:
-                angsens_model = None
+        if hits_ is not None and hits_[0] == 'photons':
+            angsens_model, _ = load_angsens_model(angsens_model)
+        else:
+            angsens_model = None
 
-            while True:
-                try:
-                    event = extract_next_event(file_iterator_tree)
-                except StopIteration:
-                    break
+        while True:
+            try:
+                event = extract_next_event(file_iterator_tree)
+            except StopIteration:
+                break
 
-                if hits_ is not None:
-                    hits_array, hits_indexer, hits_summary = get_hits(
-                        event=event,
-                        path=hits_,
-                        hit_charge_quant=hit_charge_quant,
-                        min_hit_charge=min_hit_charge,
-                        angsens_model=angsens_model,
-                    )
-                    event['hits'] = hits_array
-                    event['hits_indexer'] = hits_indexer
-                    event['hits_summary'] = hits_summary
+            event_idx = next(event_indices_iter)
+            agg_event_idx = next(agg_indices_iter)
+
+            if hits_ is not None:
+                hits_array, hits_indexer, hits_summary = get_hits(
+                    event=event,
+                    path=hits_,
+                    hit_charge_quant=hit_charge_quant,
+                    min_hit_charge=min_hit_charge,
+                    angsens_model=angsens_model,
+                )
+                event['hits'] = hits_array
+                event['hits_indexer'] = hits_indexer
+                event['hits_summary'] = hits_summary
 
-                agg_event_idx += 1
+            event.meta = deepcopy(meta)
+            event.meta["event_idx"] = event_idx
+            event.meta["agg_event_idx"] = agg_event_idx
 
-                event.meta = deepcopy(meta)
-                event.meta["event_idx"] = next(event_indices_iter)
-                event.meta["agg_event_idx"] = agg_event_idx
+            yield event
+
+        for key in list(file_iterator_tree.keys()):
+            del file_iterator_tree[key]
+        del file_iterator_tree
 
-                if agg_stop is not None and agg_event_idx >= agg_stop:
-                    return
 
-                if agg_event_idx < agg_start or (agg_event_idx - agg_start) % agg_step != 0:
-                    continue
+def iter_prefetched(iterable, depth):
+    """Iterate over `iterable`, which is consumed by a background thread up to
+    `depth` items ahead of the caller.
 
-                yield event
+    Items are yielded in the same order as produced by `iterable`. Any
+    exception (including e.g. KeyboardInterrupt) raised by `iterable` is
+    re-raised to the caller once the items before it have been yielded. If the
+    caller stops iterating early, the background thread stops after at most
+    one more item.
+
+    Parameters
+    ----------
+    iterable : iterable
+    depth : int >= 1
+        Maximum number of items held ready for the caller
+
+    Yields
+    ------
+    item
 
-            for key in list(file_iterator_tree.keys()):
-                del file_iterator_tree[key]
-            del file_iterator_tree
+    """
+    depth = int(depth)
+    if depth < 1:
+        raise ValueError("`depth` must be >= 1; got {}".format(depth))
+
+    items = queue.Queue(maxsize=depth)
+    stop_event = threading.Event()
+    sentinel = object()
+
+    def put(item):
+        """Put `item` in `items` unless the caller stops iterating first;
+        returns whether `item` was put"""
+        while not stop_event.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        """Fill `items` from `iterable`; the last item put is always `sentinel`
+        or (`sentinel`, exception info), so the caller never blocks forever"""
+        end = sentinel
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException: # pylint: disable=broad-except
+            end = (sentinel, sys.exc_info())
+        finally:
+            put(end)
+
+    thread = threading.Thread(target=produce, name="iter_prefetched")
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is sentinel:
+                break
+            if isinstance(item, tuple) and len(item) == 2 and item[0] is sentinel:
+                reraise(*item[1])
+            yield item
+    finally:
+        stop_event.set()
+        thread.join()
 
 
 def iterate_file(fpath, start=None, stop=None, step=None, mmap_mode=None):
@@ -741,6 +1032,200 @@ def iterate_file(fpath, start=None, stop=None, step=None, mmap_mode=None):
     return num_events_in_file, indices, sliced_events
 
 
+def read_npy_slice(fpath, start=None, stop=None, step=None):
+    """Read only the elements of a one-dimensional array in a numpy .npy file
+    selected by slicing it (via a memory map, closed when no longer
+    referenced), so cost scales with the size of the slice rather than the
+    size of the file.
+
+    Arrays that cannot be memory mapped (e.g. of Python objects) are read
+    entirely via `iterate_file`.
+
+    Parameters
+    ----------
+    fpath : string
+    start, stop, step : optional
+
+    Returns
+    -------
+    num_elements_in_file : int
+    indices : range
+    sliced : numpy.ndarray
+        In-memory copy of the selected elements
+
+    """
+    try:
+        array = np.load(fpath, mmap_mode='r')
+    except ValueError:
+        return iterate_file(fpath, start=start, stop=stop, step=step)
+    slicer = slice(start, stop, step)
+    indices = range(len(array))[slicer]  # pylint: disable=range-builtin-not-iterating
+    return len(array), indices, np.array(array[slicer])
+
+
+def _take(seq, positions):
+    """Select `positions` from an array or sequence (all if `positions` is
+    None)"""
+    if positions is None:
+        return seq
+    if isinstance(seq, np.ndarray):
+        return seq[positions]
+    return [seq[pos] for pos in positions]
+
+
+class _LazyDirArrays(dict):
+    """Mapping whose values are computed (once) on first access via
+    `getter(key)`"""
+    def __init__(self, getter):
+        super(_LazyDirArrays, self).__init__()
+        self.getter = getter
+
+    def __missing__(self, key):
+        value = self[key] = self.getter(key)
+        return value
+
+
+def evaluate_prefilter(prefilter, dirpath, headers, slice_kw):
+    """Evaluate a vectorized filter expression over all selected events of an
+    events leaf directory at once.
+
+    The expression is evaluated with the following names defined, each with
+    one element per selected event:
+
+        header : structured array
+            Event headers (from "events.npy")
+        recos : mapping
+            `recos[name]` is reco "recos/<name>.npy"
+        num_pulses, num_doms : mapping
+            `num_pulses[name]` and `num_doms[name]` are the number of pulses
+            and hit DOMs in each event of (columnar) pulse series `name`
+
+    as well as `np` (numpy). Only files referenced by the expression are read,
+    and only their selected elements. As element-wise operations are applied
+    to arrays, use ``&``, ``|``, and ``~`` (with parentheses) rather than
+    ``and``, ``or``, and ``not``, e.g.::
+
+        prefilter='header["L5_oscNext_bool"] & (num_pulses["SRTTWOfflinePulsesDC"] >= 8)'
+
+    Parameters
+    ----------
+    prefilter : string
+    dirpath : string
+        Events leaf directory
+    headers : structured numpy.ndarray
+        Headers of the selected events
+    slice_kw : mapping
+        `start`, `stop`, and `step` selecting the events from the directory
+
+    Returns
+    -------
+    passed : shape (len(headers),) bool array
+
+    """
+    slicer = slice(slice_kw.get('start'), slice_kw.get('stop'), slice_kw.get('step'))
+
+    def get_reco(name):
+        return read_npy_slice(join(dirpath, 'recos', name + '.npy'), **slice_kw)[2]
+
+    def get_flat_pulses(name):
+        dpath = join(dirpath, 'pulses', name)
+        if not is_flat_pulses(dpath):
+            raise ValueError(
+                'Pulse series "{}" is not in the columnar format required by'
+                ' `prefilter`'.format(dpath)
+            )
+        return FlatPulses(dpath, mmap=True)
+
+    def get_num_pulses(name):
+        return np.diff(get_flat_pulses(name).event_pulse_offsets)[slicer]
+
+    def get_num_doms(name):
+        return np.diff(get_flat_pulses(name).event_offsets)[slicer]
+
+    namespace = dict(
+        header=headers,
+        recos=_LazyDirArrays(get_reco),
+        num_pulses=_LazyDirArrays(get_num_pulses),
+        num_doms=_LazyDirArrays(get_num_doms),
+    )
+    passed = eval(prefilter, {'np': np}, namespace)  # pylint: disable=eval-used
+    return np.broadcast_to(np.asarray(passed, dtype=bool), (len(headers),))
+
+
+def get_event(events_root, agg_idx=None, event_idx=None, **kwargs):
+    """Get a single, fully populated event by index without iterating through
+    the events that precede it.
+
+    With a manifest (see `retro.i3processing.events_manifest`) for
+    `events_root`, only the leaf directory containing the event is opened; in
+    it, .npy files are memory mapped and columnar pulse series are sliced, so
+    only the event's elements are read (legacy pickled series, e.g. trigger
+    hierarchies and photons, are still read whole).
+
+    Parameters
+    ----------
+    events_root : string
+        Events root directory if `agg_idx` is specified, or a single leaf
+        directory (containing "events.npy") if `event_idx` is specified
+    agg_idx : int >= 0, optional
+        Index of the event in the aggregate of all events under
+        `events_root` (after slicing each leaf directory's events with
+        `start`, `stop`, and `step` from `kwargs`, if specified)
+    event_idx : int >= 0, optional
+        Index of the event within the leaf directory `events_root`; the
+        event's meta["agg_event_idx"] is set to None
+    **kwargs
+        Passed to `get_events` (excluding aggregate slicing arguments, and
+        excluding per-file slicing arguments if `event_idx` is specified)
+
+    Returns
+    -------
+    event : OrderedDict
+
+    Raises
+    ------
+    IndexError
+        If there is no such event
+
+    """
+    if (agg_idx is None) == (event_idx is None):
+        raise ValueError("Specify exactly one of `agg_idx` or `event_idx`")
+    for key in ('agg_start', 'agg_stop', 'agg_step', 'prefetch_depth'):
+        kwargs.pop(key, None)
+
+    if agg_idx is not None:
+        agg_idx = int(agg_idx)
+        if agg_idx < 0:
+            raise IndexError("`agg_idx` must be >= 0; got {}".format(agg_idx))
+        kwargs.update(agg_start=agg_idx, agg_stop=agg_idx + 1)
+    else:
+        event_idx = int(event_idx)
+        if event_idx < 0:
+            raise IndexError("`event_idx` must be >= 0; got {}".format(event_idx))
+        if not isfile(join(expand(events_root), 'events.npy')):
+            raise ValueError(
+                '`events_root` "{}" must be a leaf directory if `event_idx` is'
+                " specified".format(events_root)
+            )
+        for key in ('start', 'stop', 'step'):
+            if kwargs.pop(key, None) is not None:
+                raise ValueError("Cannot specify `{}` with `event_idx`".format(key))
+        kwargs.update(start=event_idx, stop=event_idx + 1, agg_start=0, agg_stop=1)
+
+    for event in get_events(events_root=events_root, **kwargs):
+        if event_idx is not None:
+            event.meta["agg_event_idx"] = None
+        return event
+
+    raise IndexError(
+        'No event with {} {} in "{}"'.format(
+            "agg_idx" if agg_idx is not None else "event_idx",
+            agg_idx if agg_idx is not None else event_idx,
+            events_root,
+        )
+    )
+
+
 def get_path(event, path):
     """Extract an item at `path` from an event which is usable as a nested
     Python mapping (i.e., using `getitem` for each level in `path`).
@@ -775,6 +1260,121 @@ def get_path(event, path):
     return node
 
 
+# (source, type, config_id or None for any) of in-ice triggers and the times
+# (ns) relative to each that define the readout window. Values can be
+# extracted by running
+# $I3_SRC/trigger-sim/resources/scripts/print_trigger_configuration.py -g GCDFILE
+# TODO: rework to _only_ use TriggerConfigID?
+TRIGGER_WINDOWS = (
+    (
+        (TriggerSourceID.IN_ICE, TriggerTypeID.SIMPLE_MULTIPLICITY, TriggerConfigID.SMT8_IN_ICE),
+        (-4e3, 5e3 + 6e3),
+    ),
+    (
+        (TriggerSourceID.IN_ICE, TriggerTypeID.SIMPLE_MULTIPLICITY, TriggerConfigID.SMT3_DeepCore),
+        (-4e3, 2.5e3 + 6e3),
+    ),
+    ((TriggerSourceID.IN_ICE, TriggerTypeID.VOLUME, None), (-4e3, 1e3 + 6e3)),
+    ((TriggerSourceID.IN_ICE, TriggerTypeID.STRING, None), (-4e3, 1.5e3 + 6e3)),
+)
+
+
+def get_trigger_time_window(trigger_hierarchy):
+    """Compute the in-ice readout time window from a trigger hierarchy.
+
+    GLOBAL triggers (of any TriggerTypeID) do not expand the window.
+
+    Parameters
+    ----------
+    trigger_hierarchy : array of dtype TRIGGER_T (or the old TRIGGER_T, with
+        trigger key fields at the same level as the trigger's)
+
+    Returns
+    -------
+    time_window_start, time_window_stop : float
+        inf and -inf, respectively, if there are no in-ice triggers
+
+    Raises
+    ------
+    NotImplementedError
+        If a non-GLOBAL trigger is not in `TRIGGER_WINDOWS`
+
+    """
+    trigger_hierarchy = np.asarray(trigger_hierarchy)
+    if trigger_hierarchy.size == 0:
+        return np.inf, -np.inf
+
+    if 'key' in trigger_hierarchy.dtype.names:  # New (more correct) TRIGGER_T struct
+        trigger_keys = trigger_hierarchy['key']
+    else:  # old TRIGGER_T had triggerkey fields at same level as trigger
+        trigger_keys = trigger_hierarchy
+    sources = trigger_keys['source']
+    tr_types = trigger_keys['type']
+    config_ids = trigger_keys['config_id']
+
+    left_dts = np.full(shape=sources.shape, fill_value=np.nan)
+    right_dts = np.full(shape=sources.shape, fill_value=np.nan)
+    for (source, tr_type, config_id), (left_dt, right_dt) in reversed(TRIGGER_WINDOWS):
+        mask = (sources == source) & (tr_types == tr_type)
+        if config_id is not None:
+            mask &= config_ids == config_id
+        left_dts[mask] = left_dt
+        right_dts[mask] = right_dt
+
+    in_ice = sources != TriggerSourceID.GLOBAL
+    unhandled = np.flatnonzero(in_ice & np.isnan(left_dts))
+    if unhandled.size > 0:
+        idx = unhandled[0]
+        raise NotImplementedError(
+            'Trigger TypeID {}, SourceID {}, config_id {} not'
+            ' implemented'
+            .format(TriggerTypeID(tr_types[idx]).name, # pylint: disable=no-member
+                    TriggerSourceID(sources[idx]).name, # pylint: disable=no-member
+                    config_ids[idx])
+        )
+    if not np.any(in_ice):
+        return np.inf, -np.inf
+
+    tr_times = trigger_hierarchy['time'][in_ice].astype(np.float64)
+    time_window_start = np.min(tr_times + left_dts[in_ice])
+    time_window_stop = np.max(tr_times + right_dts[in_ice])
+    return time_window_start, time_window_stop
+
+
+def _flatten_series(series):
+    """Keys and values of all hits in a pulse or photon series, with each
+    DOM's hits contiguous.
+
+    Parameters
+    ----------
+    series : array of dtype FLAT_PULSE_T or sequence of ((string, om, pmt), array) tuples
+
+    Returns
+    -------
+    keys : array of dtype OMKEY_T
+    values : array of dtype PULSE_T, PHOTON_T, etc.
+
+    """
+    if isinstance(series, np.ndarray) and series.dtype == FLAT_PULSE_T:
+        return series['key'], series['pulse']
+
+    dom_keys = []
+    dom_values = []
+    for key, dom_values_ in series:
+        dom_keys.append(tuple(key))
+        dom_values.append(dom_values_)
+    if not dom_values:
+        return (
+            np.empty(shape=0, dtype=OMKEY_T),
+            np.empty(shape=0, dtype=FLAT_PULSE_T['pulse']),
+        )
+    keys = np.repeat(
+        np.array(dom_keys, dtype=OMKEY_T),
+        [len(vals) for vals in dom_values],
+    )
+    return keys, np.concatenate(dom_values)
+
+
 def get_hits(event, path, hit_charge_quant, min_hit_charge, angsens_model=None):
     """From an event, take either pulses or photons (optionally applying
     weights to the latter for angular sensitivity) and create the three
@@ -786,6 +1386,9 @@ def get_hits(event, path, hit_charge_quant, min_hit_charge, angsens_model=None):
     event : mapping
 
     path : string
+        Path within `event` to a photon series or to a pulse series; the
+        latter may be an array of dtype FLAT_PULSE_T (with each DOM's pulses
+        contiguous) or a sequence of ((string, om, pmt), PULSE_T array) tuples
 
     hit_charge_quant : scalar >= 0
         quantize charge in steps of this size; 0 disables quantization
@@ -824,104 +1427,50 @@ def get_hits(event, path, hit_charge_quant, min_hit_charge, angsens_model=None):
                                 .format(type(angsens_model)))
 
     else:
-        trigger_hierarchy = event['triggers']['I3TriggerHierarchy']
-        time_window_start = np.inf
-        time_window_stop = -np.inf
-        for trigger in trigger_hierarchy:
-            if 'key' in trigger.dtype.names:  # New (more correct) TRIGGER_T struct
-                trigger_key = trigger['key']
-                source = trigger_key['source']
-                tr_type = trigger_key['type']
-                config_id = trigger_key['config_id']
-            else:  # old TRIGGER_T had triggerkey fields at same level as trigger
-                source = trigger['source']
-                tr_type = trigger['type']
-                config_id = trigger['config_id']
-
-            # Do not expand the in-ice window based on GLOBAL triggers (of
-            # any TriggerTypeID)
-            if source == TriggerSourceID.GLOBAL:
-                continue
-
-            tr_time = trigger['time']
-
-            # TODO: rework to _only_ use TriggerConfigID?
-            # Below values can be extracted by running
-            # $I3_SRC/trigger-sim/resources/scripts/print_trigger_configuration.py -g GCDFILE
-            trigger_handled = False
-            if tr_type == TriggerTypeID.SIMPLE_MULTIPLICITY:
-                if source == TriggerSourceID.IN_ICE:
-                    if config_id == TriggerConfigID.SMT8_IN_ICE:
-                        trigger_handled = True
-                        left_dt = -4e3
-                        right_dt = 5e3 + 6e3
-                    elif config_id == TriggerConfigID.SMT3_DeepCore:
-                        trigger_handled = True
-                        left_dt = -4e3
-                        right_dt = 2.5e3 + 6e3
-            elif tr_type == TriggerTypeID.VOLUME:
-                if source == TriggerSourceID.IN_ICE:
-                    trigger_handled = True
-                    left_dt = -4e3
-                    right_dt = 1e3 + 6e3
-            elif tr_type == TriggerTypeID.STRING:
-                if source == TriggerSourceID.IN_ICE:
-                    trigger_handled = True
-                    left_dt = -4e3
-                    right_dt = 1.5e3 + 6e3
-
-            if not trigger_handled:
-                raise NotImplementedError(
-                    'Trigger TypeID {}, SourceID {}, config_id {} not'
-                    ' implemented'
-                    .format(TriggerTypeID(tr_type).name, # pylint: disable=no-member
-                            TriggerSourceID(source).name, # pylint: disable=no-member
-                            config_id)
-                )
-
-            time_window_start = min(time_window_start, tr_time + left_dt)
-            time_window_stop = max(time_window_stop, tr_time + right_dt)
-
-    hits = []
-    hits_indexer = []
-    offset = 0
-
-    for (string, dom, pmt), hits_ in series:
-        # -- Filter the pulses -- #
-        if hit_charge_quant > 0:
-            hits_["charge"] = QUANTIZE_VEC(hits_["charge"], hit_charge_quant)
-        if min_hit_charge > 0:
-            hits_ = hits_[hits_["charge"] >= min_hit_charge]
-
-        num = len(hits_)
-        if num == 0:
-            continue
-
-        sd_idx = const.get_sd_idx(string=string, om=dom, pmt=pmt)
-        sd_hits = np.empty(shape=num, dtype=HIT_T)
-        sd_hits['time'] = hits_['time']
-        if not photons:
-            sd_hits['charge'] = hits_['charge']
-        elif angsens_model:
-            sd_hits['charge'] = angsens_poly(hits_['coszen'])
-        else:
-            sd_hits['charge'] = 1
+        time_window_start, time_window_stop = get_trigger_time_window(
+            event['triggers']['I3TriggerHierarchy']
+        )
 
-        hits.append(sd_hits)
-        hits_indexer.append((sd_idx, offset, num))
-        offset += num
+    keys, values = _flatten_series(series)
 
-    if len(hits) == 0:
+    # -- Filter the pulses -- #
+    pulse_charges = None
+    if hit_charge_quant > 0:
+        pulse_charges = QUANTIZE_VEC(values["charge"], hit_charge_quant).astype(
+            values.dtype["charge"]
+        )
+    if min_hit_charge > 0:
+        if pulse_charges is None:
+            pulse_charges = values["charge"]
+        mask = pulse_charges >= min_hit_charge
+        keys = keys[mask]
+        values = values[mask]
+        pulse_charges = pulse_charges[mask]
+
+    num_hits = len(values)
+    if num_hits == 0:
         hits = np.empty(shape=0, dtype=HIT_T)
         hits_indexer = np.empty(shape=0, dtype=SD_INDEXER_T)
         hits_summary = np.empty(shape=0, dtype=HITS_SUMMARY_T)
         return hits, hits_indexer, hits_summary
 
-    hits = np.concatenate(hits) #, dtype=HIT_T)
-    if hits.dtype != HIT_T:
-        raise TypeError('got dtype {}'.format(hits.dtype))
+    hits = np.empty(shape=num_hits, dtype=HIT_T)
+    hits['time'] = values['time']
+    if not photons:
+        hits['charge'] = values['charge'] if pulse_charges is None else pulse_charges
+    elif angsens_model:
+        hits['charge'] = angsens_poly(values['coszen'])
+    else:
+        hits['charge'] = 1
 
-    hits_indexer = np.array(hits_indexer, dtype=SD_INDEXER_T)
+    # Each DOM's hits are contiguous, so DOMs start wherever the key changes
+    dom_starts = np.flatnonzero(
+        np.concatenate([[True], keys[1:] != keys[:-1]])
+    )
+    hits_indexer = np.empty(shape=len(dom_starts), dtype=SD_INDEXER_T)
+    hits_indexer['sd_idx'] = const.omkeys_to_sd_indices(keys[dom_starts])
+    hits_indexer['offset'] = dom_starts
+    hits_indexer['num'] = np.diff(np.append(dom_starts, num_hits))
 
     hit_times = hits['time']
     hit_charges = hits['charge']
@@ -931,7 +1480,6 @@ def get_hits(event, path, hit_charge_quant, min_hit_charge, angsens_model=None):
     latest_hit_time = hit_times.max()
     average_hit_time = np.sum(hit_times * hit_charges) / total_charge
 
-    num_hits = len(hits)
     num_doms_hit = len(hits_indexer)
 
     hits_summary = np.array(
@@ -951,6 +1499,210 @@ def get_hits(event, path, hit_charge_quant, min_hit_charge, angsens_model=None):
     return hits, hits_indexer, hits_summary
 
 
+def _reference_trigger_time_window(trigger_hierarchy):
+    """Compute the in-ice readout time window one trigger at a time"""
+    time_window_start = np.inf
+    time_window_stop = -np.inf
+    for trigger in trigger_hierarchy:
+        trigger_key = trigger['key'] if 'key' in trigger.dtype.names else trigger
+        source = trigger_key['source']
+        tr_type = trigger_key['type']
+        config_id = trigger_key['config_id']
+        if source == TriggerSourceID.GLOBAL:
+            continue
+        if source != TriggerSourceID.IN_ICE:
+            raise NotImplementedError()
+        if tr_type == TriggerTypeID.SIMPLE_MULTIPLICITY:
+            if config_id == TriggerConfigID.SMT8_IN_ICE:
+                left_dt, right_dt = -4e3, 5e3 + 6e3
+            elif config_id == TriggerConfigID.SMT3_DeepCore:
+                left_dt, right_dt = -4e3, 2.5e3 + 6e3
+            else:
+                raise NotImplementedError()
+        elif tr_type == TriggerTypeID.VOLUME:
+            left_dt, right_dt = -4e3, 1e3 + 6e3
+        elif tr_type == TriggerTypeID.STRING:
+            left_dt, right_dt = -4e3, 1.5e3 + 6e3
+        else:
+            raise NotImplementedError()
+        time_window_start = min(time_window_start, trigger['time'] + left_dt)
+        time_window_stop = max(time_window_stop, trigger['time'] + right_dt)
+    return time_window_start, time_window_stop
+
+
+def _random_trigger_hierarchy(rand, num_triggers, old_dtype=False):
+    """Trigger hierarchy of handled in-ice and of GLOBAL triggers"""
+    from retro.retro_types import TRIGGER_T
+    keys = [
+        (TriggerSourceID.IN_ICE, TriggerTypeID.SIMPLE_MULTIPLICITY,
+         TriggerConfigID.SMT8_IN_ICE),
+        (TriggerSourceID.IN_ICE, TriggerTypeID.SIMPLE_MULTIPLICITY,
+         TriggerConfigID.SMT3_DeepCore),
+        (TriggerSourceID.IN_ICE, TriggerTypeID.VOLUME, TriggerConfigID.Cylinder),
+        (TriggerSourceID.IN_ICE, TriggerTypeID.STRING, TriggerConfigID.Cluster),
+        (TriggerSourceID.GLOBAL, TriggerTypeID.MERGED, TriggerConfigID.NONE),
+        (TriggerSourceID.GLOBAL, TriggerTypeID.THROUGHPUT, TriggerConfigID.NONE),
+    ]
+    if old_dtype:
+        dtype = np.dtype(
+            [(name, TRIGGER_T[name]) for name in TRIGGER_T.names if name != 'key']
+            + [(name, TRIGGER_T['key'][name]) for name in TRIGGER_T['key'].names]
+        )
+    else:
+        dtype = TRIGGER_T
+    trigger_hierarchy = np.zeros(shape=num_triggers, dtype=dtype)
+    trigger_hierarchy['time'] = rand.uniform(9000, 12000, size=num_triggers)
+    trigger_keys = trigger_hierarchy if old_dtype else trigger_hierarchy['key']
+    for trigger_idx, key_idx in enumerate(rand.randint(0, len(keys), size=num_triggers)):
+        source, tr_type, config_id = keys[key_idx]
+        trigger_keys['source'][trigger_idx] = source
+        trigger_keys['type'][trigger_idx] = tr_type
+        trigger_keys['config_id'][trigger_idx] = config_id
+    return trigger_hierarchy
+
+
+def test_get_trigger_time_window():
+    """Unit tests for function `get_trigger_time_window`."""
+    rand = np.random.RandomState(0)
+    for old_dtype in [False, True]:
+        for num_triggers in [0, 1, 2, 3, 10] * 20:
+            trigger_hierarchy = _random_trigger_hierarchy(rand, num_triggers, old_dtype)
+            ref = _reference_trigger_time_window(trigger_hierarchy)
+            test = get_trigger_time_window(trigger_hierarchy)
+            assert test == ref, (test, ref, trigger_hierarchy)
+
+        # Unhandled in-ice trigger
+        trigger_hierarchy = _random_trigger_hierarchy(rand, 5, old_dtype)
+        trigger_keys = trigger_hierarchy if old_dtype else trigger_hierarchy['key']
+        trigger_keys[3]['source'] = TriggerSourceID.IN_ICE
+        trigger_keys[3]['type'] = TriggerTypeID.SIMPLE_MULTIPLICITY
+        trigger_keys[3]['config_id'] = TriggerConfigID.SMT6_ICE_TOP
+        try:
+            get_trigger_time_window(trigger_hierarchy)
+        except NotImplementedError:
+            pass
+        else:
+            raise AssertionError('expected NotImplementedError')
+
+    print('<< PASS : test_get_trigger_time_window >>')
+
+
+def _reference_get_hits(series, photons, hit_charge_quant, min_hit_charge,
+                        angsens_poly=None):
+    """Create hits, hits indexer, and hits summary (sans time window) one DOM
+    at a time"""
+    hits = []
+    hits_indexer = []
+    offset = 0
+    for (string, om, pmt), hits_ in series:
+        if hit_charge_quant > 0:
+            hits_ = hits_.copy()
+            hits_['charge'] = [quantize(c, hit_charge_quant) for c in hits_['charge']]
+        if min_hit_charge > 0:
+            hits_ = hits_[hits_['charge'] >= min_hit_charge]
+        num = len(hits_)
+        if num == 0:
+            continue
+        sd_hits = np.empty(shape=num, dtype=HIT_T)
+        sd_hits['time'] = hits_['time']
+        if not photons:
+            sd_hits['charge'] = hits_['charge']
+        elif angsens_poly is not None:
+            sd_hits['charge'] = angsens_poly(hits_['coszen'])
+        else:
+            sd_hits['charge'] = 1
+        hits.append(sd_hits)
+        hits_indexer.append((const.get_sd_idx(string=string, om=om, pmt=pmt), offset, num))
+        offset += num
+
+    if not hits:
+        return np.empty(shape=0, dtype=HIT_T), np.empty(shape=0, dtype=SD_INDEXER_T), None
+    hits = np.concatenate(hits)
+    total_charge = np.sum(hits['charge'])
+    summary = (
+        hits['time'].min(),
+        hits['time'].max(),
+        np.sum(hits['time'] * hits['charge']) / total_charge,
+        total_charge,
+        len(hits),
+        len(hits_indexer),
+    )
+    return hits, np.array(hits_indexer, dtype=SD_INDEXER_T), summary
+
+
+def test_get_hits():
+    """Unit tests for function `get_hits`."""
+    from retro.i3processing.flat_pulses import pulses_list_to_flat
+    from retro.retro_types import PHOTON_T, PULSE_T
+
+    rand = np.random.RandomState(0)
+    angsens_poly = np.polynomial.Polynomial([0.3, 0.4, 0.2])
+    for _ in range(100):
+        num_doms = rand.randint(0, 8)
+        sd_indices = np.sort(rand.choice(const.NUM_DOMS_TOT, size=num_doms, replace=False))
+        pulses_list = []
+        photons_list = []
+        for sd_idx in sd_indices:
+            key = (int(sd_idx % const.NUM_STRINGS) + 1, int(sd_idx // const.NUM_STRINGS) + 1, 0)
+            pulses = np.zeros(shape=rand.randint(1, 6), dtype=PULSE_T)
+            pulses['time'] = np.sort(rand.uniform(9000, 12000, size=len(pulses)))
+            pulses['charge'] = rand.exponential(size=len(pulses))
+            pulses_list.append((key, pulses))
+            photons = np.zeros(shape=rand.randint(1, 6), dtype=PHOTON_T)
+            photons['time'] = rand.uniform(0, 2000, size=len(photons))
+            photons['coszen'] = rand.uniform(-1, 1, size=len(photons))
+            photons_list.append((key, photons))
+
+        event = dict(
+            pulses=dict(
+                legacy=pulses_list,
+                flat=pulses_list_to_flat(pulses_list)[0],
+            ),
+            photons=dict(photons=photons_list),
+            triggers=dict(
+                I3TriggerHierarchy=_random_trigger_hierarchy(rand, rand.randint(1, 4))
+            ),
+        )
+        time_window = _reference_trigger_time_window(event['triggers']['I3TriggerHierarchy'])
+
+        tests = []
+        for hit_charge_quant, min_hit_charge in [(0, 0), (0.05, 0), (0, 0.41), (0.05, 0.41)]:
+            for name in ['legacy', 'flat']:
+                tests.append((('pulses', name), pulses_list, hit_charge_quant, min_hit_charge,
+                              None, time_window))
+        for poly in [None, angsens_poly]:
+            tests.append((('photons', 'photons'), photons_list, 0, 0, poly, (0., 0.)))
+
+        for path, series, hit_charge_quant, min_hit_charge, poly, time_window in tests:
+            hits, hits_indexer, hits_summary = get_hits(
+                event=event,
+                path=path,
+                hit_charge_quant=hit_charge_quant,
+                min_hit_charge=min_hit_charge,
+                angsens_model=poly,
+            )
+            ref_hits, ref_hits_indexer, ref_summary = _reference_get_hits(
+                series=series,
+                photons=path[0] == 'photons',
+                hit_charge_quant=hit_charge_quant,
+                min_hit_charge=min_hit_charge,
+                angsens_poly=poly,
+            )
+            assert hits.dtype == HIT_T and hits_indexer.dtype == SD_INDEXER_T
+            assert np.array_equal(hits, ref_hits), (path, hits, ref_hits)
+            assert np.array_equal(hits_indexer, ref_hits_indexer), path
+            if ref_summary is None:
+                assert hits_summary.dtype == HITS_SUMMARY_T and len(hits_summary) == 0
+            else:
+                assert hits_summary.dtype == HITS_SUMMARY_T
+                assert np.all(
+                    np.array(ref_summary + tuple(time_window), dtype=HITS_SUMMARY_T)
+                    == hits_summary
+                ), (hits_summary, ref_summary, time_window)
+
+    print('<< PASS : test_get_hits >>')
+
+
 def extract_next_event(file_iterator_tree, event=None):
     """Recursively extract events from file iterators, where the structure of
     the iterator tree is reflected in the produced event.
@@ -1109,6 +1861,38 @@ def parse_args(
             help='''Specify to NOT memory map the tables. If not specified, a
             sensible default is chosen for the type of tables being used.'''
         )
+        group.add_argument(
+            '--coarse-dom-tables-fname-proto', default=None,
+            help='''Optionally load coarsely-binned ckv_uncompr tables (see
+            retro/tables/coarsen_ckv_table.py) in addition to the tables
+            specified by --dom-tables-fname-proto; reco recipes that support
+            it use these in the early phase of the minimization. Same
+            brace-enclosed fields as --dom-tables-fname-proto.'''
+        )
+        group.add_argument(
+            '--table-cache-dir', default=None,
+            help='''Directory in which to cache table norms and metadata for
+            fast subsequent loading of the same (ckv) tables'''
+        )
+        group.add_argument(
+            '--prefetch', action='store_true',
+            help='''Prefetch the regions of memory-mapped tables each event
+            will access (in a background thread) once its hits are loaded'''
+        )
+        group.add_argument(
+            '--prefetch-margin', type=float, default=DFLT_PREFETCH_MARGIN,
+            help='''With --prefetch, prefetch the table regions accessed by
+            sources within this distance (m) of the bounding box of an event's
+            hit DOMs'''
+        )
+        group.add_argument(
+            '--chunked-tables', action='store_true',
+            help='''Tables are in the chunked, compressed format written by
+            retro/tables/chunked_tables.py. Tables are decompressed when
+            the likelihood functions are generated (at load for
+            template-compressed tables), so memory for the uncompressed
+            tables is still required'''
+        )
 
     if tdi_tables:
         group = parser.add_argument_group(
@@ -1117,8 +1901,8 @@ def parse_args(
         group.add_argument(
             '--tdi',
             action='append',
-            help='''Path to TDI table's `ckv_tdi_table.npy` file or path
-            to directory containing that file; repeat --tdi to specify multiple
+            help='''Path to TDI store, to TDI table's `ckv_tdi_table.npy`
+            file, or to directory containing that file; repeat --tdi to specify multiple
             TDI tables (making sure more finely-binned tables are specified
             BEFORE more coarsely-binned tables)'''
         )
@@ -1214,6 +1998,20 @@ def parse_args(
             '--triggers', nargs='+',
             help='''Name(s) of reconstruction(s) to extract.''',
         )
+        group.add_argument(
+            '--prefilter', default=None,
+            help='''Expression evaluated vectorized over each events file's
+            headers (`header`), recos (`recos[name]`), and pulse counts
+            (`num_pulses[name]`, `num_doms[name]`); only events for which it
+            is True are read and reconstructed. Combine conditions with & and
+            |, e.g. --prefilter='header["L5_oscNext_bool"] &
+            (num_pulses["SRTTWOfflinePulsesDC"] >= 8)' ''',
+        )
+        group.add_argument(
+            '--prefetch-depth', type=int, default=0,
+            help='''Prepare up to this many events ahead of their
+            reconstruction in a background thread; 0 disables prefetching''',
+        )
         group.add_argument(
             '--hits', default=None,
             help='''Path to item to use as "hits", e.g.
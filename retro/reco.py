@@ -13,7 +13,9 @@ __all__ = [
     "CRS_STOP_FLAGS",
     "REPORT_AFTER",
     "CART_DIMS",
+    "COARSE_CRS_THRESH_FACTOR",
     "Reco",
+    "get_event_dom_and_hit_info",
     "get_multinest_meta",
     "main",
 ]
@@ -36,10 +38,13 @@ limitations under the License."""
 
 from argparse import ArgumentParser
 from collections import OrderedDict
+from copy import copy
+from multiprocessing.pool import ThreadPool
 from os.path import abspath, dirname, isdir, isfile, join
 from shutil import rmtree
 import sys
 from tempfile import mkdtemp
+import threading
 import time
 import traceback
 
@@ -66,6 +71,7 @@ from retro.priors import (
 )
 from retro.retro_types import EVT_DOM_INFO_T, EVT_HIT_INFO_T, FitStatus
 from retro.tables.pexp_5d import generate_pexp_and_llh_functions
+from retro.tables.prefetch import get_hit_doms_extent
 from retro.utils.geom import (
     rotate_points,
     add_vectors,
@@ -110,6 +116,10 @@ REPORT_AFTER = 100
 
 CART_DIMS = ("x", "y", "z", "time")
 
+COARSE_CRS_THRESH_FACTOR = 4.
+"""Recipes supporting coarse tables run CRS on those until the stopping
+criteria are within this factor of being met (see `Reco.run_crs`)"""
+
 EMILY_CRS_SETTINGS = dict(
     n_live=250,
     max_iter=100000,
@@ -163,20 +173,68 @@ class StandaloneEvents(object):
         # do initialization here so any new recos are automatically detected
         events = init_obj.get_events(**self.events_kw)
         for event in events:
-            event.meta["prefix"] = join(
-                event.meta["events_root"],
-                "recos",
-                "evt{}.".format(event.meta["event_idx"]),
-            )
-            self.event_counter += 1
-            print(
-                'Reconstructing event #{} (index {} in dir "{}")'.format(
-                    self.event_counter,
-                    event.meta["event_idx"],
-                    event.meta["events_root"],
+            yield self._prepare_event(event)
+
+    def get_events_to_redo(self, methods):
+        """Iterator over only those events (of the events selected by
+        `events_kw`) that have not been reconstructed successfully with all of
+        `methods`, i.e. that for any method have `fit_status` other than
+        `FitStatus.OK` (including `FitStatus.NotSet`).
+
+        Each leaf directory's fit statuses (and, if `events_kw` specifies a
+        `prefilter`, the quantities it references) are read first, then only
+        the events that need redoing (and pass the prefilter) are built, in a
+        single pass over the directory (see `event_selector` in
+        `retro.init_obj.get_events`).
+
+        Parameters
+        ----------
+        methods : string or iterable thereof
+
+        Yields
+        ------
+        event : OrderedDict
+            As yielded by `events`
+
+        """
+        if isinstance(methods, string_types):
+            methods = [methods]
+
+        def needs_redo(dirpath, event_indices, headers):  # pylint: disable=unused-argument
+            """Whether each of the events `event_indices` needs redoing"""
+            to_redo = np.zeros(shape=len(event_indices), dtype=bool)
+            event_indices = np.asarray(event_indices, dtype=int)
+            for method in methods:
+                fit_status_fpath = join(
+                    dirpath, "recos", "retro_{}__fit_status.npy".format(method)
                 )
+                if not isfile(fit_status_fpath):
+                    to_redo[:] = True
+                    break
+                fit_status = np.load(fit_status_fpath, mmap_mode="r")
+                to_redo |= fit_status[event_indices] != FitStatus.OK
+            return to_redo
+
+        events = init_obj.get_events(event_selector=needs_redo, **self.events_kw)
+        for event in events:
+            yield self._prepare_event(event)
+
+    def _prepare_event(self, event):
+        """Add "prefix" to `event.meta` and report progress"""
+        event.meta["prefix"] = join(
+            event.meta["events_root"],
+            "recos",
+            "evt{}.".format(event.meta["event_idx"]),
+        )
+        self.event_counter += 1
+        print(
+            'Reconstructing event #{} (index {} in dir "{}")'.format(
+                self.event_counter,
+                event.meta["event_idx"],
+                event.meta["events_root"],
             )
-            yield event
+        )
+        return event
 
 
 class Reco(object):
@@ -217,6 +275,14 @@ class Reco(object):
             tdi_tables=self.tdi_tables,
             tdi_metas=self.tdi_metas,
         )
+        self.coarse_pexp, self.coarse_get_llh = None, None
+        if self.dom_tables.coarse_tables is not None:
+            self.coarse_pexp, self.coarse_get_llh, _ = generate_pexp_and_llh_functions(
+                dom_tables=self.dom_tables.coarse_tables,
+                tdi_tables=self.tdi_tables,
+                tdi_metas=self.tdi_metas,
+            )
+        self.use_coarse_tables = False
         self.event = None
         self.hypo_handler = None
         self.prior = None
@@ -224,6 +290,30 @@ class Reco(object):
         self.loglike = None
         self.n_params = None
         self.n_opt_params = None
+        self._thread_pool = None
+        self._thread_pool_size = None
+        self._thread_local = threading.local()
+
+    def _get_thread_workspace(self):
+        """Get the calling thread's workspace: a shallow copy of this object
+        sharing its tables and (`nogil`) likelihood functions but with its own
+        per-event state (`event`, `hypo_handler`, `prior`, `loglike`, etc.),
+        so that events can be reconstructed concurrently in threads"""
+        workspace = getattr(self._thread_local, "workspace", None)
+        if workspace is None:
+            workspace = copy(self)
+            workspace.use_coarse_tables = False
+            workspace.event = None
+            workspace.hypo_handler = None
+            workspace.prior = None
+            workspace.priors_used = None
+            workspace.loglike = None
+            workspace.n_params = None
+            workspace.n_opt_params = None
+            workspace._thread_pool = None
+            workspace._thread_pool_size = None
+            self._thread_local.workspace = workspace
+        return workspace
 
     def __call__(
         self,
@@ -278,19 +368,114 @@ class Reco(object):
            tray.AddModule("I3Writer", ...)
 
         """
-        from icecube.icetray import I3Int
+        event = self._frame_to_event(
+            frame=frame,
+            reco_pulse_series_name=reco_pulse_series_name,
+            hit_charge_quant=hit_charge_quant,
+            min_hit_charge=min_hit_charge,
+            seeding_recos=seeding_recos,
+            triggers=triggers,
+            additional_keys=additional_keys,
+        )
+        fit_statuses = self._reco_frame_event(event=event, methods=methods, filter=filter)
+        self._populate_frame(
+            frame=frame,
+            event=event,
+            fit_statuses=fit_statuses,
+            point_estimator=point_estimator,
+        )
+
+    def reco_frames(
+        self,
+        frames,
+        threads,
+        methods,
+        reco_pulse_series_name,
+        hit_charge_quant,
+        min_hit_charge,
+        seeding_recos,
+        triggers,
+        additional_keys,
+        filter,
+        point_estimator,
+    ):
+        """Run Retro reconstructions on several frames concurrently, as
+        `__call__` does for a single frame.
+
+        Events are extracted from and results are populated to `frames` in
+        the calling thread, while the reconstructions themselves run in a pool
+        of `threads` threads, each with its own workspace (see
+        `_get_thread_workspace`); tables are shared, and the likelihood
+        functions release the GIL (`nogil=True` in `DFLT_NUMBA_JIT_KWARGS`).
+
+        Parameters
+        ----------
+        frames : sequence of icecube.icetray.I3Frame
+            Physics frames
+        threads : int >= 1
+        methods, reco_pulse_series_name, hit_charge_quant, min_hit_charge,
+        seeding_recos, triggers, additional_keys, filter, point_estimator
+            See `__call__`
+
+        """
+        events = [
+            self._frame_to_event(
+                frame=frame,
+                reco_pulse_series_name=reco_pulse_series_name,
+                hit_charge_quant=hit_charge_quant,
+                min_hit_charge=min_hit_charge,
+                seeding_recos=seeding_recos,
+                triggers=triggers,
+                additional_keys=additional_keys,
+            )
+            for frame in frames
+        ]
+
+        def reco_event(event):
+            workspace = self._get_thread_workspace()
+            return workspace._reco_frame_event(  # pylint: disable=protected-access
+                event=event, methods=methods, filter=filter
+            )
+
+        threads = max(1, min(int(threads), len(events)))
+        if threads == 1:
+            all_fit_statuses = [reco_event(event) for event in events]
+        else:
+            if self._thread_pool is None or self._thread_pool_size != threads:
+                if self._thread_pool is not None:
+                    self._thread_pool.close()
+                self._thread_pool = ThreadPool(threads)
+                self._thread_pool_size = threads
+            all_fit_statuses = self._thread_pool.map(reco_event, events, chunksize=1)
+
+        for frame, event, fit_statuses in zip(frames, events, all_fit_statuses):
+            self._populate_frame(
+                frame=frame,
+                event=event,
+                fit_statuses=fit_statuses,
+                point_estimator=point_estimator,
+            )
+
+    def _frame_to_event(
+        self,
+        frame,
+        reco_pulse_series_name,
+        hit_charge_quant,
+        min_hit_charge,
+        seeding_recos,
+        triggers,
+        additional_keys,
+    ):
+        """Extract an event (as yielded by `retro.init_obj.get_events`) from
+        an I3 frame; see `__call__` for parameters"""
         from retro.i3processing.extract_events import (
             I3EVENTHEADER_SPECS,
             extract_metadata_from_frame,
-            extract_photons,
             extract_pulses,
             extract_reco,
             extract_trigger_hierarchy,
             get_frame_item,
         )
-        from retro.i3processing.retro_recos_to_i3files import (
-            make_i3_particles, extract_all_reco_info, setitem_pframe
-        )
 
         event = OrderedDict()
 
@@ -361,6 +546,17 @@ class Reco(object):
         #    overwrite=True,
         #)
 
+        return event
+
+    def _reco_frame_event(self, event, methods, filter):
+        """Run reconstructions on an event extracted from an I3 frame.
+
+        Returns
+        -------
+        fit_statuses : OrderedDict
+            Keys are methods and values are their `FitStatus`es
+
+        """
         if isinstance(methods, string_types):
             methods = [methods]
 
@@ -375,10 +571,12 @@ class Reco(object):
         if len(set(methods)) != len(methods):
             raise ValueError("Same reco specified multiple times")
 
+        self._prefetch_tables(event)
+
+        fit_statuses = OrderedDict()
         for method in methods:
-            reco_name = "retro_" + method
             try:
-                fit_status = self._reco_event(
+                fit_statuses[method] = self._reco_event(
                     event,
                     method=method,
                     save_llhp=False,
@@ -386,7 +584,43 @@ class Reco(object):
                     save_estimate=False,
                 )
             except MissingOrInvalidPrefitError:
-                fit_status = FitStatus.MissingSeed
+                fit_statuses[method] = FitStatus.MissingSeed
+        return fit_statuses
+
+    def _prefetch_tables(self, event):
+        """Start reading in (in the background) the regions of memory-mapped
+        tables that reconstructing `event` will access, if table prefetching
+        is enabled (see `retro.init_obj.setup_dom_tables`). Call once per
+        event, before running any reconstruction methods on it.
+        """
+        prefetchers = [
+            dom_tables.prefetcher
+            for dom_tables in (self.dom_tables, self.dom_tables.coarse_tables)
+            if dom_tables is not None and dom_tables.prefetcher is not None
+        ]
+        if not prefetchers or len(event["hits"]) == 0:
+            return
+        try:
+            event_dom_info, _ = get_event_dom_and_hit_info(
+                event=event, dom_tables=self.dom_tables
+            )
+        except AssertionError:
+            # Let the reconstruction itself report events it cannot handle
+            return
+        extent = get_hit_doms_extent(event_dom_info)
+        for prefetcher in prefetchers:
+            prefetcher.prefetch(event_dom_info=event_dom_info, extent=extent)
+
+    def _populate_frame(self, frame, event, fit_statuses, point_estimator):
+        """Populate reconstruction results (from `_reco_frame_event`) to the
+        I3 frame the event was extracted from"""
+        from icecube.icetray import I3Int
+        from retro.i3processing.retro_recos_to_i3files import (
+            make_i3_particles, extract_all_reco_info, setitem_pframe
+        )
+
+        for method, fit_status in fit_statuses.items():
+            reco_name = "retro_" + method
 
             # Do not populate recos that were not performed
             if fit_status == FitStatus.NotSet:
@@ -582,6 +816,7 @@ class Reco(object):
                 stdthresh=dict(x=5, y=5, z=5, time=15),
                 use_sobol=True,
                 seed=0,
+                coarse_thresh_factor=COARSE_CRS_THRESH_FACTOR,
             )
 
             llhp = self.make_llhp(
@@ -684,6 +919,7 @@ class Reco(object):
                 stdthresh=dict(x=5, y=5, z=4, time=20),
                 use_sobol=True,
                 seed=0,
+                coarse_thresh_factor=COARSE_CRS_THRESH_FACTOR,
             )
 
             llhp = self.make_llhp(
@@ -1069,6 +1305,8 @@ class Reco(object):
         if len(set(methods)) != len(methods):
             raise ValueError("Same reco specified multiple times")
 
+        self._prefetch_tables(event)
+
         for method in methods:
             reco_name = "retro_" + method
 
@@ -1271,13 +1509,9 @@ class Reco(object):
         n_opt_params = self.hypo_handler.n_opt_params
         fixed_params = self.hypo_handler.fixed_params
         event = self.event
-        hits = event["hits"]
-        hits_indexer = event["hits_indexer"]
         hypo_handler = self.hypo_handler
         pegleg_muon_dt = hypo_handler.pegleg_kernel_kwargs.get("dt")
         pegleg_muon_const_e_loss = True
-        dom_info = self.dom_tables.dom_info
-        sd_idx_table_indexer = self.dom_tables.sd_idx_table_indexer
         if "truth" in event:
             truth = event["truth"]
             truth_info = OrderedDict(
@@ -1306,86 +1540,10 @@ class Reco(object):
         else:
             truth_info = None
 
-        num_operational_doms = np.sum(dom_info["operational"])
-
-        # Array containing only DOMs operational during the event & info
-        # relevant to the hits these DOMs got (if any)
-        event_dom_info = np.zeros(shape=num_operational_doms, dtype=EVT_DOM_INFO_T)
-
-        # Array containing all relevant hit info for the event, including a
-        # pointer back to the index of the DOM in the `event_dom_info` array
-        event_hit_info = np.zeros(shape=hits.size, dtype=EVT_HIT_INFO_T)
-
-        # Copy 'time' and 'charge' over directly; add 'event_dom_idx' below
-        event_hit_info[["time", "charge"]] = hits[["time", "charge"]]
-
-        # Must be a list, not tuple:
-        copy_fields = [
-            "sd_idx",
-            "x",
-            "y",
-            "z",
-            "quantum_efficiency",
-            "noise_rate_per_ns",
-        ]
-
-        print("all noise rate %.5f" % np.nansum(dom_info["noise_rate_per_ns"]))
-        print(
-            "DOMs with zero or NaN noise %i"
-            % np.count_nonzero(
-                np.isnan(dom_info["noise_rate_per_ns"])
-                | (dom_info["noise_rate_per_ns"] == 0)
-            )
+        event_dom_info, event_hit_info = get_event_dom_and_hit_info(
+            event=event, dom_tables=self.dom_tables, verbose=True
         )
 
-        # Fill `event_{hit,dom}_info` arrays only for operational DOMs
-        for dom_idx, this_dom_info in enumerate(dom_info[dom_info["operational"]]):
-            this_event_dom_info = event_dom_info[dom_idx : dom_idx + 1]
-            this_event_dom_info[copy_fields] = this_dom_info[copy_fields]
-            sd_idx = this_dom_info["sd_idx"]
-            this_event_dom_info["table_idx"] = sd_idx_table_indexer[sd_idx]
-
-            # Copy any hit info from `hits_indexer` and total charge from
-            # `hits` into `event_hit_info` and `event_dom_info` arrays
-            this_hits_indexer = hits_indexer[hits_indexer["sd_idx"] == sd_idx]
-            if len(this_hits_indexer) == 0:
-                this_event_dom_info["hits_start_idx"] = 0
-                this_event_dom_info["hits_stop_idx"] = 0
-                this_event_dom_info["total_observed_charge"] = 0
-                continue
-
-            start = this_hits_indexer[0]["offset"]
-            stop = start + this_hits_indexer[0]["num"]
-            event_hit_info[start:stop]["event_dom_idx"] = dom_idx
-            this_event_dom_info["hits_start_idx"] = start
-            this_event_dom_info["hits_stop_idx"] = stop
-            this_event_dom_info["total_observed_charge"] = np.sum(
-                hits[start:stop]["charge"]
-            )
-
-        print("this evt. noise rate %.5f" % np.sum(event_dom_info["noise_rate_per_ns"]))
-        print(
-            "DOMs with zero noise: %i"
-            % np.sum(event_dom_info["noise_rate_per_ns"] == 0)
-        )
-        # settings those to minimum noise
-        noise = event_dom_info["noise_rate_per_ns"]
-        mask = noise < 1e-7
-        noise[mask] = 1e-7
-        print("this evt. noise rate %.5f" % np.sum(event_dom_info["noise_rate_per_ns"]))
-        print(
-            "DOMs with zero noise: %i"
-            % np.sum(event_dom_info["noise_rate_per_ns"] == 0)
-        )
-        print("min noise: ", np.min(noise))
-        print("mean noise: ", np.mean(noise))
-
-        assert np.sum(event_dom_info["quantum_efficiency"] <= 0) == 0, "negative QE"
-        assert np.sum(event_dom_info["total_observed_charge"]) > 0, "no charge"
-        assert np.isfinite(
-            np.sum(event_dom_info["total_observed_charge"])
-        ), "non-finite charge"
-
         def loglike(cube, ndim=None, nparams=None):  # pylint: disable=unused-argument
             """Get log likelihood values.
 
@@ -1417,7 +1575,12 @@ class Reco(object):
             pegleg_sources = hypo_handler.get_pegleg_sources(hypo)
             scaling_sources = hypo_handler.get_scaling_sources(hypo)
 
-            get_llh_retval = self.get_llh(
+            if self.use_coarse_tables:
+                get_llh = self.coarse_get_llh
+            else:
+                get_llh = self.get_llh
+
+            get_llh_retval = get_llh(
                 generic_sources=generic_sources,
                 pegleg_sources=pegleg_sources,
                 scaling_sources=scaling_sources,
@@ -1428,11 +1591,17 @@ class Reco(object):
 
             llh, pegleg_idx, scalefactor = get_llh_retval[:3]
             llh += LLH_FUDGE_SUMMAND
-            aux_values.append(get_llh_retval[3:])
 
             assert np.isfinite(llh), "LLH not finite: {}".format(llh)
             # assert llh <= 0, "LLH positive: {}".format(llh)
 
+            # LLH values from coarse tables only guide the minimizer; do not
+            # record them, as they would bias the estimate
+            if self.use_coarse_tables:
+                return llh
+
+            aux_values.append(get_llh_retval[3:])
+
             additional_results = []
 
             if self.hypo_handler.pegleg_kernel:
@@ -1803,6 +1972,7 @@ class Reco(object):
         stdthresh,
         use_sobol,
         seed,
+        coarse_thresh_factor=None,
     ):
         """
         At the moment Cartesian (standard) parameters and spherical parameters
@@ -1835,6 +2005,13 @@ class Reco(object):
             so far)
         seed : int
             Random seed
+        coarse_thresh_factor : float > 1, optional
+            If specified and coarse DOM tables are loaded, first minimize using
+            the coarse tables until `min_llh_std` and `stdthresh` (each
+            multiplied by `coarse_thresh_factor`) are met, then continue from
+            the best `n_live` points found so far using the fine tables until
+            the actual thresholds are met. If not specified or no coarse tables
+            are loaded, only the fine tables are used.
 
         Returns
         -------
@@ -1962,12 +2139,51 @@ class Reco(object):
 
             initial_points = np.vstack(initial_points)
 
+            coarse_iterations = 0
+            if coarse_thresh_factor is not None and self.coarse_get_llh is not None:
+                coarse_points = []
+                coarse_fvals = []
+
+                def coarse_func(x):
+                    fval = func(x)
+                    coarse_points.append(np.copy(x))
+                    coarse_fvals.append(fval)
+                    return fval
+
+                self.use_coarse_tables = True
+                try:
+                    coarse_fit = spherical_opt(
+                        func=coarse_func,
+                        method="CRS2",
+                        initial_points=initial_points,
+                        spherical_indices=spherical_pairs,
+                        max_iter=max_iter,
+                        max_noimprovement=max_noimprovement,
+                        fstdthresh=min_llh_std * coarse_thresh_factor,
+                        cstdthresh=[
+                            thresh * coarse_thresh_factor if thresh > 0 else thresh
+                            for thresh in cstdthresh
+                        ],
+                        meta=True,
+                        rand=rand,
+                    )
+                finally:
+                    self.use_coarse_tables = False
+
+                coarse_iterations = int(coarse_fit["nit"])
+                run_info["coarse_iterations"] = coarse_iterations
+                run_info["coarse_stopping_flag"] = int(coarse_fit["stopping_flag"])
+
+                # Seed the fine-table phase with the best points found
+                best_indices = np.argsort(coarse_fvals)[:n_live]
+                initial_points = np.vstack([coarse_points[i] for i in best_indices])
+
             fit = spherical_opt(
                 func=func,
                 method="CRS2",
                 initial_points=initial_points,
                 spherical_indices=spherical_pairs,
-                max_iter=max_iter,
+                max_iter=max(1, max_iter - coarse_iterations),
                 max_noimprovement=max_noimprovement,
                 fstdthresh=min_llh_std,
                 cstdthresh=cstdthresh,
@@ -2007,7 +2223,7 @@ class Reco(object):
             fit_meta["fit_status"] = np.int8(
                 FitStatus.OK if fit["success"] else FitStatus.FailedToConverge
             )
-            fit_meta["iterations"] = np.int32(fit["nit"])
+            fit_meta["iterations"] = np.int32(coarse_iterations + fit["nit"])
             fit_meta["stopping_flag"] = np.int8(fit["stopping_flag"])
             fit_meta["llh_std"] = np.float32(fit["meta"]["fstd"])
             fit_meta["no_improvement_counter"] = np.int32(fit["meta"]["no_improvement_counter"])
@@ -2514,6 +2730,119 @@ class Reco(object):
         return run_info, fit_meta
 
 
+def get_event_dom_and_hit_info(event, dom_tables, verbose=False):
+    """Create the `event_dom_info` and `event_hit_info` arrays that the
+    likelihood functions take for an event.
+
+    `event_dom_info` contains all DOMs operational during the event (whether
+    or not they were hit); noise rates below 1e-7 per ns are raised to that
+    value.
+
+    Parameters
+    ----------
+    event : mapping
+        Must contain "hits" and "hits_indexer"
+    dom_tables : Retro5DTables
+    verbose : bool, optional
+        Print noise-rate statistics
+
+    Returns
+    -------
+    event_dom_info : shape (n_operational_doms,) array of dtype EVT_DOM_INFO_T
+    event_hit_info : shape (n_hits,) array of dtype EVT_HIT_INFO_T
+
+    """
+    hits = event["hits"]
+    hits_indexer = event["hits_indexer"]
+    dom_info = dom_tables.dom_info
+    sd_idx_table_indexer = dom_tables.sd_idx_table_indexer
+
+    num_operational_doms = np.sum(dom_info["operational"])
+
+    # Array containing only DOMs operational during the event & info
+    # relevant to the hits these DOMs got (if any)
+    event_dom_info = np.zeros(shape=num_operational_doms, dtype=EVT_DOM_INFO_T)
+
+    # Array containing all relevant hit info for the event, including a
+    # pointer back to the index of the DOM in the `event_dom_info` array
+    event_hit_info = np.zeros(shape=hits.size, dtype=EVT_HIT_INFO_T)
+
+    # Copy 'time' and 'charge' over directly; add 'event_dom_idx' below
+    event_hit_info[["time", "charge"]] = hits[["time", "charge"]]
+
+    # Must be a list, not tuple:
+    copy_fields = [
+        "sd_idx",
+        "x",
+        "y",
+        "z",
+        "quantum_efficiency",
+        "noise_rate_per_ns",
+    ]
+
+    if verbose:
+        print("all noise rate %.5f" % np.nansum(dom_info["noise_rate_per_ns"]))
+        print(
+            "DOMs with zero or NaN noise %i"
+            % np.count_nonzero(
+                np.isnan(dom_info["noise_rate_per_ns"])
+                | (dom_info["noise_rate_per_ns"] == 0)
+            )
+        )
+
+    # Fill `event_{hit,dom}_info` arrays only for operational DOMs
+    for dom_idx, this_dom_info in enumerate(dom_info[dom_info["operational"]]):
+        this_event_dom_info = event_dom_info[dom_idx : dom_idx + 1]
+        this_event_dom_info[copy_fields] = this_dom_info[copy_fields]
+        sd_idx = this_dom_info["sd_idx"]
+        this_event_dom_info["table_idx"] = sd_idx_table_indexer[sd_idx]
+
+        # Copy any hit info from `hits_indexer` and total charge from
+        # `hits` into `event_hit_info` and `event_dom_info` arrays
+        this_hits_indexer = hits_indexer[hits_indexer["sd_idx"] == sd_idx]
+        if len(this_hits_indexer) == 0:
+            this_event_dom_info["hits_start_idx"] = 0
+            this_event_dom_info["hits_stop_idx"] = 0
+            this_event_dom_info["total_observed_charge"] = 0
+            continue
+
+        start = this_hits_indexer[0]["offset"]
+        stop = start + this_hits_indexer[0]["num"]
+        event_hit_info[start:stop]["event_dom_idx"] = dom_idx
+        this_event_dom_info["hits_start_idx"] = start
+        this_event_dom_info["hits_stop_idx"] = stop
+        this_event_dom_info["total_observed_charge"] = np.sum(
+            hits[start:stop]["charge"]
+        )
+
+    if verbose:
+        print("this evt. noise rate %.5f" % np.sum(event_dom_info["noise_rate_per_ns"]))
+        print(
+            "DOMs with zero noise: %i"
+            % np.sum(event_dom_info["noise_rate_per_ns"] == 0)
+        )
+    # settings those to minimum noise
+    noise = event_dom_info["noise_rate_per_ns"]
+    mask = noise < 1e-7
+    noise[mask] = 1e-7
+    if verbose:
+        print("this evt. noise rate %.5f" % np.sum(event_dom_info["noise_rate_per_ns"]))
+        print(
+            "DOMs with zero noise: %i"
+            % np.sum(event_dom_info["noise_rate_per_ns"] == 0)
+        )
+        print("min noise: ", np.min(noise))
+        print("mean noise: ", np.mean(noise))
+
+    assert np.sum(event_dom_info["quantum_efficiency"] <= 0) == 0, "negative QE"
+    assert np.sum(event_dom_info["total_observed_charge"]) > 0, "no charge"
+    assert np.isfinite(
+        np.sum(event_dom_info["total_observed_charge"])
+    ), "non-finite charge"
+
+    return event_dom_info, event_hit_info
+
+
 def get_multinest_meta(outputfiles_basename):
     """Get metadata from files that MultiNest writes to disk.
 
@@ -2599,7 +2928,8 @@ def main(description=__doc__):
         passed through `eval` and must produce a scalar value interpretable via
         `bool(eval(filter))`. Current event is accessible via the name `event`
         and numpy is named `np`. E.g.,
-        --filter='event["header"]["L5_oscNext_bool"] and len(event["hits"]) >= 8'"""
+        --filter='event["header"]["L5_oscNext_bool"] and len(event["hits"]) >= 8'.
+        See also --prefilter, which selects events before they are read."""
     )
 
     split_kwargs = init_obj.parse_args(
@@ -2611,7 +2941,12 @@ def main(description=__doc__):
     my_reco = Reco(**split_kwargs)
     start_time = time.time()
     my_events = StandaloneEvents(events_kw)
-    for event in my_events.events:
+    if other_kw["redo_failed"] and not other_kw["redo_all"]:
+        # Visit only events not yet successfully reconstructed
+        events = my_events.get_events_to_redo(other_kw["methods"])
+    else:
+        events = my_events.events
+    for event in events:
         my_reco.run(event, **other_kw)
 
     print("Total run time is {:.3f} s".format(time.time() - start_time))
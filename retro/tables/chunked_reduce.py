@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position
+
+"""
+Chunked reductions of (memory-mapped) tables.
+
+A table is processed in blocks of its leading axes (those not acted upon by
+any step) or, if a step acts on the first axis, in blocks along the first axis
+no step acts upon, so peak memory is set by the block size rather than the
+table size.
+Each output "product" is defined by a chain of steps (e.g., sum over the time
+axis, then fold deltaphidir into absdeltaphidir) and is written block by block
+to a memory-mapped .npy file. Any number of products are produced in a single
+pass over the input table, and intermediate results common to several products
+(i.e., the same step objects at the start of their chains) are computed only
+once per block.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'DFLT_CHUNK_NBYTES',
+    'Product',
+    'SumAxis',
+    'AxisLinearMap',
+    'iter_lead_blocks',
+    'reduce_table',
+    'test_reduce_table',
+    'save_binning',
+    'parse_args',
+    'main',
+]
+
+__author__ = 'J.L. Lanfranchi'
+__license__ = '''Copyright 2019 Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from argparse import ArgumentParser
+from collections import OrderedDict, namedtuple
+from os import remove
+from os.path import abspath, basename, dirname, isfile, join
+import sys
+import time
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro.utils.misc import expand, mkdir
+
+
+DFLT_CHUNK_NBYTES = 2**28
+"""Default (approximate) size of input blocks"""
+
+Product = namedtuple('Product', ['steps', 'fpath', 'dtype']) # pylint: disable=invalid-name
+"""Output of `reduce_table`: chain of `steps` applied to the input table, to
+be written to .npy file `fpath` (or kept in memory if `fpath` is None) with
+`dtype` (input table's dtype if None)"""
+
+
+class SumAxis(object):
+    """Sum over an axis, accumulating in double precision.
+
+    Parameters
+    ----------
+    axis : int
+
+    """
+    def __init__(self, axis):
+        self.axis = axis
+
+    @property
+    def axes(self):
+        """Axes acted upon"""
+        return (self.axis,)
+
+    def output_shape(self, shape):
+        """Shape of output given input `shape`"""
+        return tuple(n for i, n in enumerate(shape) if i != self.axis)
+
+    def __call__(self, block):
+        return block.sum(axis=self.axis, dtype=np.float64)
+
+
+class AxisLinearMap(object):
+    """Apply a linear map along an axis, e.g. to rebin that axis:
+    ``out[..., i, ...] = sum_j matrix[i, j] * in[..., j, ...]``
+
+    Parameters
+    ----------
+    axis : int
+    matrix : shape (n_out, n_in) array
+
+    """
+    def __init__(self, axis, matrix):
+        self.axis = axis
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    @property
+    def axes(self):
+        """Axes acted upon"""
+        return (self.axis,)
+
+    def output_shape(self, shape):
+        """Shape of output given input `shape`"""
+        if shape[self.axis] != self.matrix.shape[1]:
+            raise ValueError(
+                'Axis {} has length {} but map takes {} inputs'.format(
+                    self.axis, shape[self.axis], self.matrix.shape[1]
+                )
+            )
+        shape = list(shape)
+        shape[self.axis] = self.matrix.shape[0]
+        return tuple(shape)
+
+    def __call__(self, block):
+        out = np.tensordot(self.matrix, block, axes=([1], [self.axis]))
+        return np.moveaxis(out, 0, self.axis)
+
+
+def iter_lead_blocks(shape, num_lead_axes, itemsize, chunk_nbytes=DFLT_CHUNK_NBYTES):
+    """Iterate over blocks of the leading axes of an array.
+
+    Blocks are ranges of the first axis, each approximately `chunk_nbytes` in
+    size; if a single index of the first axis exceeds `chunk_nbytes`, that
+    index is split into blocks along the next leading axis, and so forth.
+
+    Parameters
+    ----------
+    shape : sequence of int
+    num_lead_axes : int >= 1
+    itemsize : int
+    chunk_nbytes : int, optional
+
+    Yields
+    ------
+    slices : tuple of `num_lead_axes` slices
+
+    """
+    def _iter(axis, outer_slices):
+        inner_nbytes = itemsize * int(np.prod(shape[axis + 1:]))
+        length = shape[axis]
+        if inner_nbytes * length <= chunk_nbytes or axis == num_lead_axes - 1:
+            step = max(1, chunk_nbytes // max(1, inner_nbytes))
+            for start in range(0, length, step):
+                yield outer_slices + (slice(start, min(start + step, length)),)
+        else:
+            for idx in range(length):
+                for slices in _iter(axis + 1, outer_slices + (slice(idx, idx + 1),)):
+                    yield slices
+
+    for slices in _iter(0, ()):
+        yield slices
+
+
+def _iter_axis_blocks(shape, block_axis, out_block_axes, itemsize,
+                      chunk_nbytes=DFLT_CHUNK_NBYTES):
+    """Iterate over blocks of an array along a single (not necessarily
+    leading) axis, each approximately `chunk_nbytes` in size.
+
+    Yields
+    ------
+    in_slices : tuple of slices
+    out_slices : dict
+        Slices into each product's output, keyed as `out_block_axes`
+
+    """
+    length = shape[block_axis]
+    inner_nbytes = itemsize * int(np.prod(shape)) // max(1, length)
+    step = max(1, chunk_nbytes // max(1, inner_nbytes))
+    for start in range(0, length, step):
+        slc = slice(start, min(start + step, length))
+        in_slices = (slice(None),) * block_axis + (slc,)
+        out_slices = dict(
+            (name, (slice(None),) * axis + (slc,))
+            for name, axis in out_block_axes.items()
+        )
+        yield in_slices, out_slices
+
+
+def reduce_table(table, products, chunk_nbytes=DFLT_CHUNK_NBYTES):
+    """Compute reductions of `table` in one blockwise pass over it.
+
+    Parameters
+    ----------
+    table : numpy.ndarray
+        E.g. a read-only memory-mapped table (or a view into one)
+    products : mapping
+        Keys are product names and values are `Product`s. The table is
+        processed in blocks along the leading axes no step acts upon or, if
+        some step acts on the first axis, along the first axis no step acts
+        upon (or in a single block if steps act on every axis)
+    chunk_nbytes : int, optional
+        Approximate size of blocks of `table` read at a time
+
+    Returns
+    -------
+    outputs : OrderedDict
+        Keys are product names and values are the resulting (possibly
+        memory-mapped) arrays
+
+    """
+    t0 = time.time()
+
+    # The leading axes not acted upon by any step are never touched by
+    # removing or rebinning later axes, so they are the same in all products
+    # Steps' axes refer to their input, i.e. the table after earlier steps in
+    # the chain removed axes; map them back to axes of `table`
+    touched_axes = set()
+    remaining_axes = OrderedDict()
+    for name, product in products.items():
+        shape = table.shape
+        orig_axes = list(range(table.ndim))
+        for step in product.steps:
+            out_shape = step.output_shape(shape)
+            touched_axes.update(orig_axes[axis] for axis in step.axes)
+            if len(out_shape) < len(shape):
+                orig_axes = [a for i, a in enumerate(orig_axes) if i not in step.axes]
+            shape = out_shape
+        remaining_axes[name] = orig_axes
+
+    free_axes = [axis for axis in range(table.ndim) if axis not in touched_axes]
+    num_lead_axes = 0
+    while num_lead_axes in free_axes:
+        num_lead_axes += 1
+
+    block_axis = None
+    if num_lead_axes < 1 and free_axes:
+        block_axis = free_axes[0]
+
+    outputs = OrderedDict()
+    # Position of `block_axis` in each product's output
+    out_block_axes = OrderedDict()
+    for name, product in products.items():
+        shape = table.shape
+        for step in product.steps:
+            shape = step.output_shape(shape)
+        if block_axis is not None:
+            out_block_axes[name] = remaining_axes[name].index(block_axis)
+        dtype = table.dtype if product.dtype is None else np.dtype(product.dtype)
+        if product.fpath is None:
+            outputs[name] = np.empty(shape=shape, dtype=dtype)
+        else:
+            fpath = expand(product.fpath)
+            mkdir(dirname(fpath))
+            outputs[name] = np.lib.format.open_memmap(
+                fpath, mode='w+', dtype=dtype, shape=shape
+            )
+
+    if num_lead_axes >= 1:
+        blocks = (
+            (lead_slices, dict((name, lead_slices) for name in products))
+            for lead_slices in iter_lead_blocks(
+                shape=table.shape,
+                num_lead_axes=num_lead_axes,
+                itemsize=table.dtype.itemsize,
+                chunk_nbytes=chunk_nbytes,
+            )
+        )
+    elif block_axis is not None:
+        blocks = _iter_axis_blocks(
+            shape=table.shape,
+            block_axis=block_axis,
+            out_block_axes=out_block_axes,
+            itemsize=table.dtype.itemsize,
+            chunk_nbytes=chunk_nbytes,
+        )
+    else:
+        blocks = [((), dict((name, ()) for name in products))]
+
+    for in_slices, out_slices in blocks:
+        block = np.asarray(table[in_slices])
+
+        # Intermediate results keyed by the chain of steps producing them
+        results = {(): block}
+        for name, product in products.items():
+            chain = ()
+            value = block
+            for step in product.steps:
+                chain += (id(step),)
+                if chain not in results:
+                    results[chain] = step(value)
+                value = results[chain]
+            outputs[name][out_slices[name]] = value
+
+        del block, results
+
+    for output in outputs.values():
+        if isinstance(output, np.memmap):
+            output.flush()
+
+    print('Computed {} from table of shape {} in {:.3f} s'.format(
+        ', '.join(products.keys()), table.shape, time.time() - t0))
+
+    return outputs
+
+
+def test_reduce_table():
+    """Unit tests for `reduce_table`, comparing chained and multi-product
+    reductions (including over the first axis) with plain numpy."""
+    rand = np.random.RandomState(0)
+    table = rand.uniform(size=(6, 5, 4, 3))
+    idx0 = [4, 0, 0, 2]
+    idx1 = [3, 1]
+    take0 = np.eye(table.shape[0])[idx0]
+    take1 = np.eye(table.shape[1])[idx1]
+    shared_sum0 = SumAxis(0)
+
+    # Keys are product names, values are (steps, numpy reference)
+    cases = OrderedDict([
+        ('sum0', ([SumAxis(0)], table.sum(axis=0))),
+        ('sum3', ([SumAxis(3)], table.sum(axis=3))),
+        ('sum0_sum1', ([shared_sum0, SumAxis(1)], table.sum(axis=(0, 2)))),
+        ('sum0_sum0', ([shared_sum0, SumAxis(0)], table.sum(axis=(0, 1)))),
+        ('sum1_sum0', ([SumAxis(1), SumAxis(0)], table.sum(axis=(0, 1)))),
+        ('sum2_sum0', ([SumAxis(2), SumAxis(0)], table.sum(axis=(0, 2)))),
+        ('sum1_sum1', ([SumAxis(1), SumAxis(1)], table.sum(axis=(1, 2)))),
+        ('sum_all', (
+            [SumAxis(0), SumAxis(0), SumAxis(0), SumAxis(0)], table.sum()
+        )),
+        ('take0', ([AxisLinearMap(0, take0)], table.take(idx0, axis=0))),
+        ('take0_sum1', (
+            [AxisLinearMap(0, take0), SumAxis(1)], table.take(idx0, axis=0).sum(axis=1)
+        )),
+        ('sum0_take0', (
+            [shared_sum0, AxisLinearMap(0, take1)], table.sum(axis=0).take(idx1, axis=0)
+        )),
+        ('sum2_take1', (
+            [SumAxis(2), AxisLinearMap(1, take1)], table.sum(axis=2).take(idx1, axis=1)
+        )),
+    ])
+
+    for chunk_nbytes in [1, 8 * 4 * 3 * 2, 2**20]:
+        # Each product on its own
+        for name, (steps, ref) in cases.items():
+            out = reduce_table(
+                table=table,
+                products={name: Product(steps=steps, fpath=None, dtype=None)},
+                chunk_nbytes=chunk_nbytes,
+            )[name]
+            assert out.shape == ref.shape, (name, out.shape, ref.shape)
+            assert np.allclose(out, ref, rtol=1e-12, atol=0), name
+
+        # All products in one pass (block axis must suit all of them)
+        outs = reduce_table(
+            table=table,
+            products=OrderedDict(
+                (name, Product(steps=steps, fpath=None, dtype=None))
+                for name, (steps, _) in cases.items()
+            ),
+            chunk_nbytes=chunk_nbytes,
+        )
+        for name, (_, ref) in cases.items():
+            assert np.allclose(outs[name], ref, rtol=1e-12, atol=0), name
+
+    vector = rand.uniform(size=10)
+    out = reduce_table(
+        table=vector, products={'sum': Product(steps=[SumAxis(0)], fpath=None, dtype=None)}
+    )['sum']
+    assert np.isclose(out, vector.sum(), rtol=1e-12, atol=0)
+
+    print('<< PASS : test_reduce_table >>')
+
+
+def save_binning(output_dir, binning, removed_dims=()):
+    """Save structured binning array to "binning.npy" and (the legacy way of
+    storing bin edges) each dimension's bin edges to "<dim>_bin_edges.npy",
+    removing bin edges files for `removed_dims` if they exist.
+
+    Parameters
+    ----------
+    output_dir : string
+    binning : structured numpy.ndarray
+    removed_dims : sequence of strings, optional
+
+    """
+    np.save(join(output_dir, 'binning.npy'), binning)
+
+    for d_name in binning.dtype.names:
+        bin_edges_fpath = join(output_dir, '{}_bin_edges.npy'.format(d_name))
+        np.save(bin_edges_fpath, binning[d_name])
+
+    for d_name in removed_dims:
+        bin_edges_fpath = join(output_dir, '{}_bin_edges.npy'.format(d_name))
+        if isfile(bin_edges_fpath):
+            remove(bin_edges_fpath)
+
+
+def parse_args(description=__doc__):
+    """Parse command line arguments"""
+    parser = ArgumentParser(description=description)
+    parser.add_argument(
+        '--input-file', required=True,
+        help='''Input table (.npy file, with "binning.npy" in the same
+        directory)'''
+    )
+    parser.add_argument(
+        '--outdir', required=True,
+        help='''Each product is written to a subdirectory (named for the
+        product) of this directory'''
+    )
+    parser.add_argument(
+        '--product', action='append', required=True,
+        help='''Product to compute, formatted as NAME=STEP[,STEP...] where each
+        STEP is "sum:DIM" (sum over dimension DIM) or "absdeltaphidir" (fold
+        deltaphidir into abs(deltaphidir)); e.g. "t_indep=sum:t" or
+        "t_indep_abs=sum:t,absdeltaphidir". Repeat --product to compute
+        several products in the same pass over the table.'''
+    )
+    parser.add_argument(
+        '--chunk-nbytes', type=int, default=DFLT_CHUNK_NBYTES,
+        help='''Approximate size of blocks of the input table processed at a
+        time'''
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Script interface to `reduce_table` for tables with "binning.npy"
+    files"""
+    from retro.tables.phidir_to_absphidir import get_absdeltaphidir_binning
+    from retro.tables.remove_dimension import get_removed_dim_binning
+
+    args = parse_args()
+    input_file = expand(args.input_file)
+    input_dir = dirname(input_file)
+    outdir = expand(args.outdir)
+
+    table = np.load(input_file, mmap_mode='r')
+    input_binning = np.load(join(input_dir, 'binning.npy'))
+
+    # Steps with identical specs at the start of chains are shared, so their
+    # results are computed only once per block
+    steps_cache = {}
+    products = OrderedDict()
+    product_binnings = OrderedDict()
+    for spec in args.product:
+        name, steps_spec = spec.split('=')
+        name = name.strip()
+        binning = input_binning
+        removed_dims = []
+        steps = []
+        prefix = ()
+        for step_spec in steps_spec.split(','):
+            step_spec = step_spec.strip()
+            prefix += (step_spec,)
+            if step_spec.startswith('sum:'):
+                dim_name = step_spec[len('sum:'):]
+                binning, dim_num = get_removed_dim_binning(binning, dim_name)
+                removed_dims.append(dim_name)
+                step = steps_cache.setdefault(prefix, SumAxis(dim_num))
+            elif step_spec == 'absdeltaphidir':
+                binning, dim_num, matrix = get_absdeltaphidir_binning(binning)
+                step = steps_cache.setdefault(prefix, AxisLinearMap(dim_num, matrix))
+            else:
+                raise ValueError('Unrecognized step "{}"'.format(step_spec))
+            steps.append(step)
+
+        output_dir = join(outdir, name)
+        if abspath(output_dir) == abspath(input_dir):
+            raise ValueError('Will not allow output dir to be same as input dir')
+        products[name] = Product(
+            steps=steps,
+            fpath=join(output_dir, basename(input_file)),
+            dtype=None,
+        )
+        product_binnings[name] = (output_dir, binning, removed_dims)
+
+    reduce_table(table=table, products=products, chunk_nbytes=args.chunk_nbytes)
+
+    for output_dir, binning, removed_dims in product_binnings.values():
+        save_binning(output_dir=output_dir, binning=binning, removed_dims=removed_dims)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position
+
+"""
+Chunked, compressed container for (raw or Cherenkov) tables.
+
+The large arrays of a table (see `CHUNKED_KEYS`) are split into fixed-size
+chunks along their first two dimensions (r and costheta), each chunk is
+compressed independently with `zlib` or `lzma` from the standard library, and
+the chunks are concatenated into a single file alongside an index of chunk
+offsets. All other table items are stored as ordinary .npy files, so a chunked
+table is a directory laid out like the Retro .npy-files-in-a-directory tables
+except that, for each chunked array `<key>`, there are three files:
+
+    <key>.chunks            Concatenated compressed chunks
+    <key>.chunks.json       dtype, shape, chunk shape, and codec
+    <key>.chunks_index.npy  (offset, num_bytes) of each chunk in <key>.chunks
+
+`ChunkedArrayReader` decompresses chunks on demand (optionally caching them in
+a `ChunkCache` with a byte budget) for random access, while
+`load_chunked_table` is a table loader for `Retro5DTables`. Note that the
+Numba likelihood kernels index tables directly, so tables must be fully
+decompressed before they are used for reconstruction; with ``lazy=True``,
+`load_chunked_table` returns readers instead, which
+`retro.tables.pexp_5d.generate_pexp_and_llh_functions` decompresses (chunk by
+chunk, directly into the stacked array of all tables) only once the likelihood
+functions are generated.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'CHUNKED_TABLES_FORMAT_VERSION',
+    'CHUNKED_KEYS',
+    'CODECS',
+    'write_chunked_array',
+    'ChunkCache',
+    'ChunkedArrayReader',
+    'convert_to_chunked_table',
+    'load_chunked_table',
+    'parse_args',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+from numbers import Integral
+from os import listdir
+from os.path import abspath, dirname, isdir, isfile, join
+import sys
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro.tables.retro_5d_tables import TABLE_KINDS
+from retro.utils.misc import expand, mkdir
+
+
+CHUNKED_TABLES_FORMAT_VERSION = 1
+
+CHUNKED_KEYS = [
+    'table',
+    't_indep_table',
+    'ckv_table',
+    'ckv_template_map',
+    't_indep_ckv_table',
+]
+"""Table items stored as chunked arrays; all others are stored as .npy files"""
+
+CODECS = OrderedDict([
+    ('zlib', (
+        lambda data, level: zlib.compress(data, 6 if level is None else level),
+        zlib.decompress,
+    )),
+])
+"""Compression codecs: name -> (compress(data, level), decompress(data))"""
+if lzma is not None:
+    CODECS['lzma'] = (
+        lambda data, level: lzma.compress(data, preset=6 if level is None else level),
+        lzma.decompress,
+    )
+
+CHUNKS_SUFFIX = '.chunks'
+HEADER_SUFFIX = '.chunks.json'
+INDEX_SUFFIX = '.chunks_index.npy'
+
+
+def _dtype_to_json(dtype):
+    return np.lib.format.dtype_to_descr(np.dtype(dtype))
+
+
+def _dtype_from_json(descr):
+    if isinstance(descr, list):
+        return np.dtype([tuple(field) for field in descr])
+    return np.dtype(descr)
+
+
+def write_chunked_array(array, fpath_base, chunk_shape, codec='zlib', level=None):
+    """Write an array as compressed chunks.
+
+    Parameters
+    ----------
+    array : ndarray with ndim >= 2
+    fpath_base : string
+        Files are written to `fpath_base` + ".chunks", ".chunks.json", and
+        ".chunks_index.npy"
+    chunk_shape : 2-tuple of ints
+        Chunk size along the first two dimensions (the last chunk along each
+        dimension may be smaller)
+    codec : string, one of `CODECS`
+    level : int, optional
+        Compression level (codec default if not specified)
+
+    """
+    if codec not in CODECS:
+        raise ValueError('`codec` must be one of {}; got "{}"'.format(list(CODECS), codec))
+    if array.ndim < 2:
+        raise ValueError('Can only chunk arrays with 2 or more dimensions')
+    compress, _ = CODECS[codec]
+    chunk_shape = tuple(int(c) for c in chunk_shape)
+    num_chunks = tuple(-(-n // c) for n, c in zip(array.shape[:2], chunk_shape))
+
+    index = np.empty(shape=num_chunks + (2,), dtype=np.uint64)
+    offset = 0
+    with open(fpath_base + CHUNKS_SUFFIX, 'wb') as fobj:
+        for i in range(num_chunks[0]):
+            for j in range(num_chunks[1]):
+                chunk = np.ascontiguousarray(
+                    array[i*chunk_shape[0]:(i + 1)*chunk_shape[0],
+                          j*chunk_shape[1]:(j + 1)*chunk_shape[1]]
+                )
+                data = compress(chunk.tobytes(), level)
+                fobj.write(data)
+                index[i, j] = (offset, len(data))
+                offset += len(data)
+
+    np.save(fpath_base + INDEX_SUFFIX, index)
+    header = OrderedDict([
+        ('format_version', CHUNKED_TABLES_FORMAT_VERSION),
+        ('dtype', _dtype_to_json(array.dtype)),
+        ('shape', list(array.shape)),
+        ('chunk_shape', list(chunk_shape)),
+        ('codec', codec),
+    ])
+    with open(fpath_base + HEADER_SUFFIX, 'w') as fobj:
+        json.dump(header, fobj, indent=2)
+
+
+class ChunkCache(object):
+    """Thread-safe least-recently-used cache of decompressed chunks, limited
+    by the total number of bytes held.
+
+    Parameters
+    ----------
+    max_bytes : int >= 0
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get chunk stored under `key`, or None if not cached"""
+        with self._lock:
+            chunk = self._chunks.pop(key, None)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self._chunks[key] = chunk
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        """Cache `chunk` under `key`, evicting least-recently-used chunks as
+        necessary to stay within `max_bytes`"""
+        if chunk.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                self.num_bytes -= old.nbytes
+            while self._chunks and self.num_bytes + chunk.nbytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+            self._chunks[key] = chunk
+            self.num_bytes += chunk.nbytes
+
+    def clear(self):
+        """Remove all chunks from the cache"""
+        with self._lock:
+            self._chunks.clear()
+            self.num_bytes = 0
+
+
+class ChunkedArrayReader(object):
+    """Random-access reader for an array written by `write_chunked_array`.
+
+    Index with integers and/or (unit-step) slices along the first two
+    dimensions; any further indices are applied to the result. Only the
+    chunks covering the requested region are read and decompressed.
+
+    Parameters
+    ----------
+    fpath_base : string
+    cache : ChunkCache, optional
+        Cache shared across readers; decompressed chunks are not retained if
+        not specified
+
+    """
+    def __init__(self, fpath_base, cache=None):
+        self.fpath_base = expand(fpath_base)
+        with open(self.fpath_base + HEADER_SUFFIX, 'r') as fobj:
+            header = json.load(fobj)
+        if header['format_version'] != CHUNKED_TABLES_FORMAT_VERSION:
+            raise ValueError(
+                'Unsupported chunked table format version {}'
+                .format(header['format_version'])
+            )
+        if header['codec'] not in CODECS:
+            raise ValueError('Codec "{}" is not available'.format(header['codec']))
+        self.dtype = _dtype_from_json(header['dtype'])
+        self.shape = tuple(header['shape'])
+        self.chunk_shape = tuple(header['chunk_shape'])
+        self.codec = header['codec']
+        self.index = np.load(self.fpath_base + INDEX_SUFFIX)
+        self.cache = cache
+        self._decompress = CODECS[self.codec][1]
+        # Opened on first read, so unread readers hold no file handles
+        self._fobj = None
+        self._lock = threading.Lock()
+
+    @property
+    def ndim(self):
+        """Number of dimensions"""
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        """Size of the (decompressed) array"""
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def close(self):
+        """Close the underlying file (it is reopened if read again)"""
+        with self._lock:
+            if self._fobj is not None:
+                self._fobj.close()
+                self._fobj = None
+
+    def _chunk_shape(self, i, j):
+        return (
+            min(self.chunk_shape[0], self.shape[0] - i*self.chunk_shape[0]),
+            min(self.chunk_shape[1], self.shape[1] - j*self.chunk_shape[1]),
+        ) + self.shape[2:]
+
+    def read_chunk(self, i, j):
+        """Read and decompress chunk (`i`, `j`), using the cache if present.
+
+        Returns
+        -------
+        chunk : ndarray (read-only)
+
+        """
+        key = (self.fpath_base, i, j)
+        if self.cache is not None:
+            chunk = self.cache.get(key)
+            if chunk is not None:
+                return chunk
+
+        offset, num_bytes = self.index[i, j]
+        with self._lock:
+            if self._fobj is None:
+                self._fobj = open(self.fpath_base + CHUNKS_SUFFIX, 'rb')
+            self._fobj.seek(int(offset))
+            data = self._fobj.read(int(num_bytes))
+        chunk = np.frombuffer(self._decompress(data), dtype=self.dtype)
+        chunk = chunk.reshape(self._chunk_shape(i, j))
+
+        if self.cache is not None:
+            self.cache.put(key, chunk)
+        return chunk
+
+    def read_block(self, r_start, r_stop, ct_start, ct_stop, out=None):
+        """Read the contiguous block ``[r_start:r_stop, ct_start:ct_stop]``.
+
+        Parameters
+        ----------
+        r_start, r_stop, ct_start, ct_stop : int
+        out : ndarray, optional
+            Array of appropriate shape and dtype to fill
+
+        Returns
+        -------
+        block : ndarray
+
+        """
+        shape = (r_stop - r_start, ct_stop - ct_start) + self.shape[2:]
+        if out is None:
+            out = np.empty(shape=shape, dtype=self.dtype)
+        else:
+            assert out.shape == shape and out.dtype == self.dtype
+
+        rc, cc = self.chunk_shape
+        for i in range(r_start // rc, -(-r_stop // rc)):
+            for j in range(ct_start // cc, -(-ct_stop // cc)):
+                chunk = self.read_chunk(i, j)
+                r0, c0 = i*rc, j*cc
+                r_lo, r_hi = max(r_start, r0), min(r_stop, r0 + chunk.shape[0])
+                c_lo, c_hi = max(ct_start, c0), min(ct_stop, c0 + chunk.shape[1])
+                out[r_lo - r_start:r_hi - r_start, c_lo - ct_start:c_hi - ct_start] = (
+                    chunk[r_lo - r0:r_hi - r0, c_lo - c0:c_hi - c0]
+                )
+        return out
+
+    def to_array(self, out=None):
+        """Decompress the entire array (into `out`, if specified)"""
+        return self.read_block(0, self.shape[0], 0, self.shape[1], out=out)
+
+    def __array__(self, dtype=None):
+        array = self.to_array()
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * max(0, 2 - len(key))
+        r_key, ct_key, rest = key[0], key[1], key[2:]
+
+        indices = []
+        for dim_key, dim_len in zip((r_key, ct_key), self.shape[:2]):
+            if isinstance(dim_key, Integral):
+                idx = range(dim_len)[dim_key]
+                indices.append((idx, idx + 1, 0))
+            elif isinstance(dim_key, slice):
+                start, stop, step = dim_key.indices(dim_len)
+                if step != 1:
+                    raise IndexError('Only unit-step slices are supported')
+                indices.append((start, max(start, stop), slice(None)))
+            else:
+                raise IndexError('Unsupported index {!r}'.format(dim_key))
+
+        (r_start, r_stop, r_sel), (ct_start, ct_stop, ct_sel) = indices
+        block = self.read_block(r_start, r_stop, ct_start, ct_stop)
+        return block[(r_sel, ct_sel) + rest]
+
+
+def convert_to_chunked_table(
+    table,
+    outdir,
+    table_kind,
+    r_chunk=1,
+    costheta_chunk=None,
+    codec='zlib',
+    level=None,
+):
+    """Convert a table to the chunked format.
+
+    Parameters
+    ----------
+    table : string
+        Path to the source table (any format the loader for `table_kind` can
+        read, e.g. a CLSim .fits[.zst] file or a directory of .npy files)
+    outdir : string
+    table_kind : string, one of `TABLE_KINDS`
+        Note that template-compressed tables' template maps are chunked but
+        the template library (stored separately) is unaffected
+    r_chunk : int >= 1, optional
+        Number of r-bins per chunk
+    costheta_chunk : int >= 1, optional
+        Number of costheta-bins per chunk; defaults to all
+    codec : string, one of `CODECS`
+    level : int, optional
+
+    """
+    if table_kind in ('raw_uncompr', 'raw_templ_compr'):
+        from retro.tables.clsim_tables import load_clsim_table_minimal as loader
+    elif table_kind == 'ckv_uncompr':
+        from retro.tables.ckv_tables import load_ckv_table as loader
+    elif table_kind == 'ckv_templ_compr':
+        from retro.tables.template_compr_ckv_tables import (
+            load_template_compr_ckv_table as loader
+        )
+    else:
+        raise ValueError('`table_kind` must be one of {}'.format(TABLE_KINDS))
+
+    table_path = expand(table)
+    outdir = expand(outdir)
+    if outdir == table_path:
+        raise ValueError('Will not allow output dir to be same as input dir')
+
+    src = loader(fpath=table_path, mmap=True)
+    mkdir(outdir)
+    for key, val in src.items():
+        if key in CHUNKED_KEYS:
+            chunk_shape = (r_chunk, costheta_chunk or val.shape[1])
+            write_chunked_array(
+                val, join(outdir, key), chunk_shape=chunk_shape, codec=codec, level=level
+            )
+            in_bytes = val.nbytes
+            out_bytes = np.sum(np.load(join(outdir, key + INDEX_SUFFIX))[..., 1])
+            print('{}: {} -> {} bytes ({:.1f}%)'.format(
+                key, in_bytes, out_bytes, 100 * out_bytes / max(in_bytes, 1)
+            ))
+        else:
+            np.save(join(outdir, key + '.npy'), val)
+
+
+def load_chunked_table(fpath, mmap=False, cache=None, lazy=False):
+    """Load a table stored in the chunked format; compatible with the loader
+    functions used by `Retro5DTables`.
+
+    Parameters
+    ----------
+    fpath : string
+        Path to the chunked table's directory
+    mmap : bool, optional
+        Memory map the (un-chunked) .npy files
+    cache : ChunkCache, optional
+    lazy : bool, optional
+        Return a `ChunkedArrayReader` for each chunked array, deferring
+        decompression to its first use, instead of decompressing it now
+
+    Returns
+    -------
+    table : OrderedDict
+
+    """
+    indir = expand(fpath)
+    if not isdir(indir):
+        raise ValueError('Chunked table directory "{}" does not exist'.format(indir))
+    mmap_mode = 'r' if mmap else None
+
+    table = OrderedDict()
+    for fname in sorted(listdir(indir)):
+        abs_fpath = join(indir, fname)
+        if not isfile(abs_fpath):
+            continue
+        if fname.endswith(HEADER_SUFFIX):
+            key = fname[:-len(HEADER_SUFFIX)]
+            reader = ChunkedArrayReader(join(indir, key), cache=cache)
+            if lazy:
+                table[key] = reader
+                continue
+            try:
+                table[key] = reader.to_array()
+            finally:
+                reader.close()
+        elif fname.endswith('.npy') and not fname.endswith(INDEX_SUFFIX):
+            table[fname[:-len('.npy')]] = np.load(abs_fpath, mmap_mode=mmap_mode)
+
+    return table
+
+
+def parse_args(description=__doc__):
+    """Parse command line arguments"""
+    parser = ArgumentParser(description=description)
+    parser.add_argument(
+        '--table', required=True,
+        help='''Path to table to convert'''
+    )
+    parser.add_argument(
+        '--outdir', required=True,
+        help='''Directory in which to store the chunked table'''
+    )
+    parser.add_argument(
+        '--table-kind', required=True, choices=TABLE_KINDS,
+    )
+    parser.add_argument(
+        '--r-chunk', type=int, default=1,
+        help='''Number of r-bins per chunk'''
+    )
+    parser.add_argument(
+        '--costheta-chunk', type=int, default=None,
+        help='''Number of costheta-bins per chunk; defaults to all'''
+    )
+    parser.add_argument(
+        '--codec', choices=list(CODECS), default='zlib',
+    )
+    parser.add_argument(
+        '--level', type=int, default=None,
+        help='''Compression level; codec's default if not specified'''
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    convert_to_chunked_table(**vars(parse_args()))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position
+
+"""
+Derive a coarsely-binned Cherenkov table from an existing (finely-binned)
+Cherenkov table by merging integer numbers of adjacent bins in each dimension.
+
+Counts in merged bins are summed; since the table norm (see
+`retro.tables.retro_5d_tables.get_table_norm`) is computed from the bin edges
+stored alongside the table, the resulting survival probabilities are the
+(bin-volume-weighted) averages over the merged fine bins.
+
+Output table will be in .npy-files-in-a-directory format for easy memory
+mapping and can be loaded as a "ckv_uncompr" table.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'COARSEN_DIMS',
+    'coarsen_bin_edges',
+    'block_sum',
+    'coarsen_ckv_table',
+    'parse_args',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+import sys
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro.tables.ckv_tables import load_ckv_table
+from retro.tables.template_compr_ckv_tables import load_template_compr_ckv_table
+from retro.utils.misc import expand, mkdir
+
+
+COARSEN_DIMS = ['r', 'costheta', 't', 'costhetadir', 'deltaphidir']
+"""Dimensions of a ckv table, in the order they appear in the table"""
+
+
+def coarsen_bin_edges(bin_edges, factor):
+    """Merge every `factor` adjacent bins.
+
+    Parameters
+    ----------
+    bin_edges : 1D array
+    factor : int >= 1
+        Must evenly divide the number of bins
+
+    Returns
+    -------
+    coarse_bin_edges : 1D array
+
+    """
+    num_bins = len(bin_edges) - 1
+    if factor < 1 or num_bins % factor != 0:
+        raise ValueError(
+            'factor {} does not evenly divide {} bins'.format(factor, num_bins)
+        )
+    return np.asarray(bin_edges)[::factor].copy()
+
+
+def block_sum(array, factors, dtype=np.float64):
+    """Sum non-overlapping blocks of `array`, with block size along each axis
+    given by `factors`.
+
+    Parameters
+    ----------
+    array : ndarray
+    factors : sequence of int, one per dimension of `array`
+        Each must evenly divide the length of the corresponding axis
+    dtype : numpy dtype, optional
+        Accumulator dtype
+
+    Returns
+    -------
+    summed : ndarray of dtype `dtype`
+
+    """
+    assert len(factors) == array.ndim
+    split_shape = []
+    for axis_len, factor in zip(array.shape, factors):
+        if axis_len % factor != 0:
+            raise ValueError(
+                'factor {} does not evenly divide axis of length {}'
+                .format(factor, axis_len)
+            )
+        split_shape.extend([axis_len // factor, factor])
+    sum_axes = tuple(range(1, 2*array.ndim, 2))
+    return np.asarray(array).reshape(split_shape).sum(axis=sum_axes, dtype=dtype)
+
+
+def coarsen_ckv_table(
+    table,
+    outdir,
+    r_factor=1,
+    costheta_factor=1,
+    t_factor=1,
+    costhetadir_factor=1,
+    deltaphidir_factor=1,
+    template_library=None,
+    mmap_src=True,
+):
+    """Generate a coarsely-binned ckv table from a finely-binned ckv table.
+
+    Parameters
+    ----------
+    table : string
+        Path to ckv table directory (either uncompressed or, if
+        `template_library` is specified, template-compressed)
+
+    outdir : string
+        Directory in which to write the coarse table's .npy files; must differ
+        from the source table directory
+
+    r_factor, costheta_factor, t_factor, costhetadir_factor, deltaphidir_factor : int >= 1
+        Number of adjacent bins to merge in each dimension; each must evenly
+        divide the number of bins in the corresponding dimension
+
+    template_library : string, optional
+        Path to the template library .npy file; required iff `table` is
+        template-compressed. Templates are expanded before rebinning, so the
+        output is always an uncompressed ckv table.
+
+    mmap_src : bool, optional
+        Whether to memory map the source table. Default is True.
+
+    Returns
+    -------
+    coarse_table : dict
+        Keys are those written to `outdir`
+
+    """
+    table_dir = expand(table)
+    outdir = expand(outdir)
+    if outdir == table_dir:
+        raise ValueError('Will not allow output dir to be same as input dir')
+
+    factors = dict(
+        r=r_factor,
+        costheta=costheta_factor,
+        t=t_factor,
+        costhetadir=costhetadir_factor,
+        deltaphidir=deltaphidir_factor,
+    )
+
+    if template_library is None:
+        table = load_ckv_table(fpath=table_dir, mmap=mmap_src)
+        fine_table = table['ckv_table']
+    else:
+        template_library = np.load(expand(template_library))
+        table = load_template_compr_ckv_table(fpath=table_dir, mmap=mmap_src)
+        fine_table = table['ckv_template_map']
+
+    coarse_table = dict()
+    for key in ['n_photons', 'group_refractive_index', 'phase_refractive_index',
+                't_is_residual_time']:
+        coarse_table[key] = table[key]
+    for dim in COARSEN_DIMS:
+        key = '{}_bin_edges'.format(dim)
+        coarse_table[key] = coarsen_bin_edges(table[key], factors[dim])
+
+    n_fine_r = len(table['r_bin_edges']) - 1
+    n_coarse_r = n_fine_r // r_factor
+    dir_factors = (costhetadir_factor, deltaphidir_factor)
+    coarse_shape = tuple(
+        len(coarse_table['{}_bin_edges'.format(dim)]) - 1 for dim in COARSEN_DIMS
+    )
+
+    # Work on one coarse r-bin at a time to bound memory usage when the source
+    # table is memory mapped
+    ckv_table = np.empty(shape=coarse_shape, dtype=np.float32)
+    for coarse_r_idx in range(n_coarse_r):
+        fine_slice = fine_table[coarse_r_idx*r_factor:(coarse_r_idx + 1)*r_factor]
+        if template_library is not None:
+            fine_slice = (
+                fine_slice['weight'][..., np.newaxis, np.newaxis]
+                * template_library[fine_slice['index']]
+            )
+        ckv_table[coarse_r_idx] = block_sum(
+            fine_slice,
+            factors=(r_factor, costheta_factor, t_factor) + dir_factors,
+        )[0]
+    coarse_table['ckv_table'] = ckv_table
+
+    if 't_indep_ckv_table' in table:
+        coarse_table['t_indep_ckv_table'] = block_sum(
+            table['t_indep_ckv_table'],
+            factors=(r_factor, costheta_factor) + dir_factors,
+        ).astype(np.float32)
+
+    mkdir(outdir)
+    for key, val in coarse_table.items():
+        np.save(join(outdir, key + '.npy'), val)
+
+    print(
+        'Coarsened table {} -> {} (factors {})'.format(
+            fine_table.shape[:3] + template_library.shape[1:]
+            if template_library is not None else fine_table.shape,
+            coarse_shape,
+            ', '.join('{}={}'.format(d, factors[d]) for d in COARSEN_DIMS),
+        )
+    )
+
+    return coarse_table
+
+
+def parse_args(description=__doc__):
+    """Parse command line arguments"""
+    parser = ArgumentParser(description=description)
+    parser.add_argument(
+        '--table', required=True,
+        help='''Path to (finely-binned) ckv table directory'''
+    )
+    parser.add_argument(
+        '--outdir', required=True,
+        help='''Directory in which to store the coarsely-binned table'''
+    )
+    for dim in COARSEN_DIMS:
+        parser.add_argument(
+            '--{}-factor'.format(dim), type=int, default=1,
+            help='''Merge this many adjacent {} bins'''.format(dim)
+        )
+    parser.add_argument(
+        '--template-library', default=None,
+        help='''Template library; required if --table is template-compressed'''
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    coarse_table = coarsen_ckv_table(**vars(parse_args())) # pylint: disable=invalid-name
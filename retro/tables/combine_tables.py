@@ -12,7 +12,10 @@ __all__ = [
     'SUM_KEYS',
     'NO_VALIDATE_KEYS',
     'NO_WRITE_KEYS',
+    'DFLT_CHUNK_NBYTES',
+    'PROGRESS_DIRNAME',
     'combine_tables',
+    'test_combine_tables',
     'main',
 ]
 
@@ -35,8 +38,13 @@ from argparse import ArgumentParser
 from collections import OrderedDict
 from copy import deepcopy
 from glob import glob
-from os.path import abspath, basename, dirname, isfile, join, splitext
+import json
+from multiprocessing import Pool
+from os import remove, rename
+from os.path import abspath, basename, dirname, isdir, isfile, join, splitext
+from shutil import rmtree
 import sys
+from tempfile import mkdtemp
 from time import time
 
 import numpy as np
@@ -94,39 +102,19 @@ NO_WRITE_KEYS = (
     'template_chi2s',
 )
 
+DFLT_CHUNK_NBYTES = 2**27
+"""Default size of chunks summed at a time for out-of-core combining"""
 
-def combine_tables(table_fpaths, outdir=None, overwrite=False):
-    """Combine multiple tables together into a single table.
-
-    All tables specified must have the same binnings defined. Tables should
-    also be produced using different random seeds (if all else besides
-    n_photons is equal); if corresponding metadata files can be found in the
-    same directories as the CLSim tables, this will be enforced prior to
-    loading and combining the actual tables together.
-
-    Parameters
-    ----------
-    table_fpaths : string or iterable thereof
-        Each string is glob-expanded
+PROGRESS_DIRNAME = '.combine_progress'
+"""Sub-directory of the output directory recording out-of-core progress"""
 
-    outdir : string, optional
-        Directory to which to save the combined table; if not specified, the
-        resulting table will be returned but not saved to disk.
+PROGRESS_STATE_FNAME = 'state.json'
 
-    overwrite : bool
-        Overwrite an existing table. If a table is found at the output path and
-        `overwrite` is False, the function simply returns without raising an
-        exception.
+INCOMPLETE_SUFFIX = '.incomplete'
 
-    Returns
-    -------
-    combined_table
-
-    """
-    t_start = time()
-
-    # Get all input table filepaths, including glob expansion
 
+def _expand_table_fpaths(table_fpaths):
+    """Glob-expand and naturally sort table paths"""
     orig_table_fpaths = deepcopy(table_fpaths)
     if isinstance(table_fpaths, string_types):
         table_fpaths = [table_fpaths]
@@ -139,22 +127,22 @@ def combine_tables(table_fpaths, outdir=None, overwrite=False):
         raise ValueError(
             "Found no tables given `table_fpaths` = {}".format(orig_table_fpaths)
         )
+    return table_fpaths
 
-    wstderr(
-        'Found {} tables to combine:\n  {}\n'.format(
-            len(table_fpaths), '\n  '.join(table_fpaths)
-        )
-    )
 
-    # Create the output directory
+def _load_and_validate_tables(table_fpaths):
+    """Load tables (memory mapped where possible) one at a time, checking that
+    all are compatible and yielding each.
 
-    if outdir is not None:
-        outdir = expand(outdir)
-        mkdir(outdir)
+    Yields
+    ------
+    fpath : string
+    table : OrderedDict
+    table_keys : set
+        Keys of the first table
 
-    # Combine the tables
-
-    combined_table = None
+    """
+    first_table = None
     table_keys = None
     for fpath in table_fpaths:
         table = load_clsim_table_minimal(fpath, mmap=True)
@@ -166,32 +154,10 @@ def combine_tables(table_fpaths, outdir=None, overwrite=False):
         if 'source_tables' not in table:
             table['source_tables'] = np.array([base], dtype=np.string0)
 
-        if combined_table is None:
-            combined_table = table
+        if first_table is None:
+            first_table = table
             table_keys = set(table.keys())
-
-            # Formulate output file paths and check if they exist (do on first
-            # table to avoid finding out we are going to overwrite a file
-            # before loading all the source tables)
-            if outdir is not None:
-                output_fpaths = OrderedDict(
-                    (
-                        (k, join(outdir, k + '.npy'))
-                        for k in sorted(table_keys.difference(NO_WRITE_KEYS))
-                    )
-                )
-                if not overwrite:
-                    for fp in output_fpaths.values():
-                        if isfile(fp):
-                            raise IOError(
-                                'File at {} already exists, NOT overwriting'.format(fp)
-                            )
-                wstderr(
-                    'Output files will be written to:\n  {}\n'.format(
-                        '\n  '.join(output_fpaths.values())
-                    )
-                )
-
+            yield fpath, table, table_keys
             continue
 
         # Make sure keys are the same
@@ -217,9 +183,340 @@ def combine_tables(table_fpaths, outdir=None, overwrite=False):
         # Validate keys that should be equal
 
         for key in sorted(table_keys.difference(NO_VALIDATE_KEYS)):
-            if not np.array_equal(table[key], combined_table[key]):
+            if not np.array_equal(table[key], first_table[key]):
                 raise ValueError('Unequal "{}" in file {}'.format(key, fpath))
 
+        yield fpath, table, table_keys
+
+
+def _get_output_fpaths(outdir, table_keys, overwrite):
+    """Formulate output file paths and check if they exist"""
+    output_fpaths = OrderedDict(
+        (
+            (k, join(outdir, k + '.npy'))
+            for k in sorted(table_keys.difference(NO_WRITE_KEYS))
+        )
+    )
+    if not overwrite:
+        for fp in output_fpaths.values():
+            if isfile(fp):
+                raise IOError(
+                    'File at {} already exists, NOT overwriting'.format(fp)
+                )
+    wstderr(
+        'Output files will be written to:\n  {}\n'.format(
+            '\n  '.join(output_fpaths.values())
+        )
+    )
+    return output_fpaths
+
+
+def _write_outputs(combined_table, output_fpaths, keys):
+    """Save values from `combined_table` to .npy files"""
+    wstderr('Writing files:\n')
+    len_longest_fpath = np.max([len(p) for p in output_fpaths.values()])
+    for key in keys:
+        fpath = output_fpaths[key]
+        wstderr('  {} ...'.format(fpath.ljust(len_longest_fpath)))
+        t0 = time()
+        np.save(fpath, combined_table[key])
+        wstderr(' ({:12.3f} s)\n'.format(time() - t0))
+
+
+_SOURCE_ARRAYS = {}
+
+
+def _init_worker():
+    """Pool initializer: each worker keeps its own memory maps of the source
+    arrays"""
+    global _SOURCE_ARRAYS # pylint: disable=global-statement
+    _SOURCE_ARRAYS = {}
+
+
+def _get_source_array(fpath, key):
+    """Memory map (flattened) array `key` of the .npy-directory table `fpath`,
+    reusing existing memory maps"""
+    array = _SOURCE_ARRAYS.get((fpath, key), None)
+    if array is None:
+        array = np.load(join(fpath, key + '.npy'), mmap_mode='r').reshape(-1)
+        _SOURCE_ARRAYS[(fpath, key)] = array
+    return array
+
+
+def _chunk_marker_fpath(progress_dir, key, chunk_idx):
+    return join(progress_dir, '{}_{:d}.done'.format(key, chunk_idx))
+
+
+def _combine_chunk(task):
+    """Sum one chunk of one array over all source tables, write it to the
+    (memory-mapped) output, and mark the chunk as done.
+
+    Parameters
+    ----------
+    task : tuple
+        (key, chunk_idx, start, stop, table_fpaths, out_fpath, progress_dir),
+        where `start` and `stop` index the flattened array
+
+    Returns
+    -------
+    key : string
+    chunk_idx : int
+
+    """
+    key, chunk_idx, start, stop, table_fpaths, out_fpath, progress_dir = task
+
+    # Accumulate in the dtype of the first table, as in-memory combining does
+    chunk = np.array(_get_source_array(table_fpaths[0], key)[start:stop])
+    for fpath in table_fpaths[1:]:
+        chunk += _get_source_array(fpath, key)[start:stop]
+
+    out = np.load(out_fpath, mmap_mode='r+').reshape(-1)
+    out[start:stop] = chunk
+    out.flush()
+    del out
+
+    with open(_chunk_marker_fpath(progress_dir, key, chunk_idx), 'w'):
+        pass
+
+    return key, chunk_idx
+
+
+def _combine_tables_out_of_core(table_fpaths, outdir, overwrite, procs, chunk_nbytes):
+    """Sum large arrays of npy-directory tables chunk by chunk into
+    memory-mapped outputs; see `combine_tables`"""
+    progress_dir = join(outdir, PROGRESS_DIRNAME)
+    state_fpath = join(progress_dir, PROGRESS_STATE_FNAME)
+
+    # Validate all tables, sum small arrays in memory, and find the large
+    # arrays that are to be summed chunk by chunk
+
+    combined_table = None
+    chunked_keys = []
+    source_tables = []
+    for fpath, table, table_keys in _load_and_validate_tables(table_fpaths):
+        source_tables.append(table['source_tables'])
+        if combined_table is None:
+            combined_table = table
+            for key in SUM_KEYS:
+                if key not in table:
+                    continue
+                if isinstance(table[key], np.memmap):
+                    chunked_keys.append(key)
+                else:
+                    table[key] = np.array(table[key])
+            continue
+
+        for key in SUM_KEYS:
+            if key not in table:
+                continue
+            if key in chunked_keys:
+                if table[key].shape != combined_table[key].shape:
+                    raise ValueError('Shape of "{}" differs in file {}'.format(key, fpath))
+            else:
+                combined_table[key] += table[key]
+        del table
+
+    combined_table['source_tables'] = np.sort(np.concatenate(source_tables))
+
+    state = OrderedDict([
+        ('table_fpaths', table_fpaths),
+        ('chunk_nbytes', chunk_nbytes),
+        ('arrays', OrderedDict(
+            (key, OrderedDict([
+                ('shape', list(combined_table[key].shape)),
+                ('dtype', combined_table[key].dtype.str),
+            ]))
+            for key in chunked_keys
+        )),
+    ])
+
+    resume = False
+    if isfile(state_fpath):
+        with open(state_fpath, 'r') as fobj:
+            prev_state = json.load(fobj, object_pairs_hook=OrderedDict)
+        if prev_state == json.loads(json.dumps(state), object_pairs_hook=OrderedDict):
+            resume = True
+        elif overwrite:
+            rmtree(progress_dir)
+        else:
+            raise ValueError(
+                'Found an interrupted combine of different tables (or with'
+                ' different settings) in "{}"; use `overwrite` to discard it'
+                .format(outdir)
+            )
+
+    output_fpaths = _get_output_fpaths(
+        outdir=outdir,
+        table_keys=set(combined_table.keys()),
+        overwrite=overwrite or resume,
+    )
+
+    # Set up memory-mapped outputs and the list of chunks left to do
+
+    mkdir(progress_dir)
+    tasks = []
+    for key in chunked_keys:
+        shape = combined_table[key].shape
+        dtype = combined_table[key].dtype
+        out_fpath = output_fpaths[key] + INCOMPLETE_SUFFIX
+        if not (resume and isfile(out_fpath)):
+            np.lib.format.open_memmap(out_fpath, mode='w+', dtype=dtype, shape=shape)
+            for marker in glob(join(progress_dir, '{}_*.done'.format(key))):
+                remove(marker)
+        size = int(np.prod(shape))
+        chunk_size = max(1, chunk_nbytes // dtype.itemsize)
+        for chunk_idx, start in enumerate(range(0, size, chunk_size)):
+            if isfile(_chunk_marker_fpath(progress_dir, key, chunk_idx)):
+                continue
+            tasks.append(
+                (key, chunk_idx, start, min(start + chunk_size, size), table_fpaths,
+                 out_fpath, progress_dir)
+            )
+
+    if not resume:
+        with open(state_fpath, 'w') as fobj:
+            json.dump(state, fobj, indent=2)
+    else:
+        wstderr('Resuming interrupted combine: {} chunks left to do\n'.format(len(tasks)))
+
+    # Sum the chunks
+
+    t0 = time()
+    num_tasks = len(tasks)
+    procs = max(1, min(procs, num_tasks))
+    if procs == 1:
+        results = (_combine_chunk(task) for task in tasks)
+        pool = None
+    else:
+        pool = Pool(procs, initializer=_init_worker)
+        results = pool.imap_unordered(_combine_chunk, tasks)
+    try:
+        for task_num, _ in enumerate(results):
+            wstderr(
+                '\r  combined {}/{} chunks ({:.1f} s)'.format(
+                    task_num + 1, num_tasks, time() - t0
+                )
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _SOURCE_ARRAYS.clear()
+    if num_tasks:
+        wstderr('\n')
+
+    # Write small outputs and move completed memory-mapped outputs into place
+
+    _write_outputs(
+        combined_table=combined_table,
+        output_fpaths=output_fpaths,
+        keys=[k for k in output_fpaths if k not in chunked_keys],
+    )
+    for key in chunked_keys:
+        rename(output_fpaths[key] + INCOMPLETE_SUFFIX, output_fpaths[key])
+        combined_table[key] = np.load(output_fpaths[key], mmap_mode='r')
+    rmtree(progress_dir)
+
+    return combined_table
+
+
+def combine_tables(table_fpaths, outdir=None, overwrite=False, procs=1,
+                   chunk_nbytes=DFLT_CHUNK_NBYTES):
+    """Combine multiple tables together into a single table.
+
+    All tables specified must have the same binnings defined. Tables should
+    also be produced using different random seeds (if all else besides
+    n_photons is equal); if corresponding metadata files can be found in the
+    same directories as the CLSim tables, this will be enforced prior to
+    loading and combining the actual tables together.
+
+    If `outdir` is specified and all tables are .npy-files-in-a-directory
+    tables, the combine is performed out of core: large arrays are memory
+    mapped and summed chunk by chunk (in parallel if `procs` > 1) directly into
+    memory-mapped output files, so memory use is independent of the size of
+    the tables. Completed chunks are recorded in the output directory, and an
+    interrupted combine is resumed by calling this function again with the
+    same arguments. Other tables (e.g. .fits files) are loaded and summed in
+    memory.
+
+    Parameters
+    ----------
+    table_fpaths : string or iterable thereof
+        Each string is glob-expanded
+
+    outdir : string, optional
+        Directory to which to save the combined table; if not specified, the
+        resulting table will be returned but not saved to disk.
+
+    overwrite : bool
+        Overwrite an existing table. If a table is found at the output path and
+        `overwrite` is False, the function simply returns without raising an
+        exception.
+
+    procs : int >= 1, optional
+        Number of processes to use for out-of-core combining
+
+    chunk_nbytes : int > 0, optional
+        Size of chunks for out-of-core combining
+
+    Returns
+    -------
+    combined_table
+
+    """
+    t_start = time()
+
+    # Get all input table filepaths, including glob expansion
+
+    table_fpaths = _expand_table_fpaths(table_fpaths)
+
+    wstderr(
+        'Found {} tables to combine:\n  {}\n'.format(
+            len(table_fpaths), '\n  '.join(table_fpaths)
+        )
+    )
+
+    # Create the output directory
+
+    if outdir is not None:
+        outdir = expand(outdir)
+        mkdir(outdir)
+
+    if outdir is not None and all(isdir(fpath) for fpath in table_fpaths):
+        combined_table = _combine_tables_out_of_core(
+            table_fpaths=table_fpaths,
+            outdir=outdir,
+            overwrite=overwrite,
+            procs=procs,
+            chunk_nbytes=chunk_nbytes,
+        )
+        wstderr(
+            'Total time to combine tables: {} s\n'.format(np.round(time() - t_start, 3))
+        )
+        return combined_table
+
+    # Combine the tables in memory
+
+    combined_table = None
+    for fpath, table, table_keys in _load_and_validate_tables(table_fpaths):
+        if combined_table is None:
+            combined_table = table
+
+            # Sum into copies (tables are loaded read-only memory mapped)
+            for key in SUM_KEYS:
+                if key in combined_table:
+                    combined_table[key] = np.array(combined_table[key])
+
+            # Formulate output file paths and check if they exist (do on first
+            # table to avoid finding out we are going to overwrite a file
+            # before loading all the source tables)
+            if outdir is not None:
+                output_fpaths = _get_output_fpaths(
+                    outdir=outdir, table_keys=table_keys, overwrite=overwrite
+                )
+
+            continue
+
         # Add values from keys that should be summed
 
         for key in SUM_KEYS:
@@ -240,15 +537,11 @@ def combine_tables(table_fpaths, outdir=None, overwrite=False):
     # Save the data to npy files on disk (in a sub-directory for all of this
     # table's files)
     if outdir is not None:
-        wstderr('Writing files:\n')
-
-        len_longest_fpath = np.max([len(p) for p in output_fpaths.values()])
-        for key in sorted(table_keys.difference(NO_WRITE_KEYS)):
-            fpath = output_fpaths[key]
-            wstderr('  {} ...'.format(fpath.ljust(len_longest_fpath)))
-            t0 = time()
-            np.save(fpath, combined_table[key])
-            wstderr(' ({:12.3f} s)\n'.format(time() - t0))
+        _write_outputs(
+            combined_table=combined_table,
+            output_fpaths=output_fpaths,
+            keys=sorted(table_keys.difference(NO_WRITE_KEYS)),
+        )
 
     wstderr(
         'Total time to combine tables: {} s\n'.format(np.round(time() - t_start, 3))
@@ -257,6 +550,110 @@ def combine_tables(table_fpaths, outdir=None, overwrite=False):
     return combined_table
 
 
+class _Interrupt(Exception):
+    """Raised to simulate an interrupted combine"""
+
+
+def test_combine_tables():
+    """Unit tests for function `combine_tables`: out-of-core combining of
+    npy-directory tables, including resuming an interrupted combine, gives the
+    same result as combining in memory."""
+    global _combine_chunk # pylint: disable=global-statement
+
+    rand = np.random.RandomState(0)
+    # "table" must be large enough (>= 10 MiB) to be memory mapped when loaded
+    # and hence combined chunk by chunk
+    table_shape = (64, 64, 48, 14)
+    chunk_nbytes = 2**21
+    num_chunks = int(np.ceil(np.prod(table_shape) * 4 / chunk_nbytes))
+    num_interrupt = 2
+
+    tmpdir = mkdtemp(suffix='test_combine_tables')
+    orig_combine_chunk = _combine_chunk
+    try:
+        table_fpaths = []
+        for table_num in range(3):
+            fpath = join(tmpdir, 'table_{}'.format(table_num))
+            mkdir(fpath)
+            np.save(join(fpath, 'table.npy'),
+                    rand.uniform(size=table_shape).astype(np.float32))
+            np.save(join(fpath, 't_indep_table.npy'),
+                    rand.uniform(size=table_shape[:2]).astype(np.float32))
+            np.save(join(fpath, 'n_photons.npy'), np.uint64(rand.randint(1, 1000)))
+            np.save(join(fpath, 'r_bin_edges.npy'), np.linspace(0, 100, table_shape[0] + 1))
+            table_fpaths.append(fpath)
+
+        ref_table = combine_tables(table_fpaths=table_fpaths)
+
+        num_calls = [0]
+
+        def interrupted_combine_chunk(task):
+            """Combine `num_interrupt` chunks, then fail"""
+            if num_calls[0] == num_interrupt:
+                raise _Interrupt()
+            num_calls[0] += 1
+            return orig_combine_chunk(task)
+
+        def counting_combine_chunk(task):
+            """Count chunks combined"""
+            num_calls[0] += 1
+            return orig_combine_chunk(task)
+
+        outdir = join(tmpdir, 'combined')
+        _combine_chunk = interrupted_combine_chunk
+        try:
+            combine_tables(table_fpaths=table_fpaths, outdir=outdir,
+                           chunk_nbytes=chunk_nbytes)
+        except _Interrupt:
+            pass
+        else:
+            raise AssertionError('combine was not interrupted')
+        progress_dir = join(outdir, PROGRESS_DIRNAME)
+        assert len(glob(join(progress_dir, 'table_*.done'))) == num_interrupt
+        assert isfile(join(outdir, 'table.npy' + INCOMPLETE_SUFFIX))
+        assert not isfile(join(outdir, 'table.npy'))
+
+        # Different tables must not resume the interrupted combine
+        try:
+            combine_tables(table_fpaths=table_fpaths[:2], outdir=outdir,
+                           chunk_nbytes=chunk_nbytes)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('combined different tables into interrupted combine')
+
+        num_calls[0] = 0
+        _combine_chunk = counting_combine_chunk
+        combined_table = combine_tables(table_fpaths=table_fpaths, outdir=outdir,
+                                        chunk_nbytes=chunk_nbytes)
+        assert num_calls[0] == num_chunks - num_interrupt, (num_calls[0], num_chunks)
+        assert not isdir(progress_dir)
+        assert not glob(join(outdir, '*' + INCOMPLETE_SUFFIX))
+
+        loaded_table = load_clsim_table_minimal(outdir)
+        for key in ref_table:
+            if key in NO_WRITE_KEYS:
+                continue
+            assert np.array_equal(combined_table[key], ref_table[key]), key
+            assert np.array_equal(loaded_table[key], ref_table[key]), key
+
+        # Parallel out-of-core combine from scratch
+        _combine_chunk = orig_combine_chunk
+        combined_table = combine_tables(table_fpaths=table_fpaths, outdir=outdir,
+                                        overwrite=True, procs=3,
+                                        chunk_nbytes=chunk_nbytes)
+        for key in ref_table:
+            if key not in NO_WRITE_KEYS:
+                assert np.array_equal(combined_table[key], ref_table[key]), key
+        del combined_table, loaded_table
+
+    finally:
+        _combine_chunk = orig_combine_chunk
+        rmtree(tmpdir, ignore_errors=True)
+
+    print('<< PASS : test_combine_tables >>')
+
+
 def main(description=__doc__):
     """Script interface to `combine_tables`, parsing command line args
     and passing to that function.
@@ -277,6 +674,15 @@ def main(description=__doc__):
         '--overwrite', action='store_true',
         help='''Overwrite existing table key(s) if they exist in output directory.'''
     )
+    parser.add_argument(
+        '--procs', type=int, default=1,
+        help='''Number of processes to use for out-of-core combining (of
+        .npy-directory tables)'''
+    )
+    parser.add_argument(
+        '--chunk-nbytes', type=int, default=DFLT_CHUNK_NBYTES,
+        help='''Size of chunks, in bytes, for out-of-core combining'''
+    )
     args = parser.parse_args()
     combine_tables(**vars(args))
 
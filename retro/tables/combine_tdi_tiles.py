@@ -3,7 +3,9 @@
 # pylint: disable=wrong-import-position, too-many-instance-attributes, too-many-locals
 
 """
-Combine single-DOM time-independent Cartesian table tiles to create a TDI table.
+Combine single-DOM time-independent Cartesian table tiles to create a TDI table,
+which is written (as quantity "tdi_table") to a TDI store; see
+`retro.tables.tdi_store`.
 """
 
 from __future__ import absolute_import, division, print_function
@@ -32,8 +34,8 @@ limitations under the License.'''
 from argparse import ArgumentParser
 from collections import OrderedDict
 from glob import glob
+from os import rename
 from os.path import abspath, dirname, isdir, isfile, join
-import pickle
 import sys
 
 import numpy as np
@@ -46,6 +48,7 @@ if __name__ == '__main__' and __package__ is None:
 from retro import load_pickle
 from retro.i3info.angsens_model import load_angsens_model
 from retro.i3info.extract_gcd import extract_gcd
+from retro.tables.tdi_store import create_tdi_store, is_tdi_store
 from retro.utils.misc import expand, mkdir, wstderr, wstdout
 
 
@@ -72,16 +75,24 @@ def combine_tdi_tiles(
     gcd,
     bin_edges_file,
     tile_spec_file,
+    store_tile_shape=None,
 ):
     """Combine individual time-independent tiles (one produced per DOM) into a single
     TDI table.
 
+    The table is accumulated directly in a memory-mapped TDI store (so it
+    need not fit in memory), in directory
+    `dest_dir`/tdi_table_<table_hash>_tilt_<on|off>_anisotropy_<on|off>.
+
     Parameters
     ----------
     source_dir : str
     dest_dir : str
     bin_edges_file : str
     tile_spec_file : str
+    store_tile_shape : sequence of 3 ints, optional
+        Number of (x, y, z) bins per tile of the TDI store; default is a
+        single tile spanning the entire volume
 
     """
     source_dir = expand(source_dir)
@@ -125,7 +136,32 @@ def combine_tdi_tiles(
     with open(tile_spec_file, 'r') as f:
         tile_specs = [l.strip() for l in f.readlines()]
 
-    table = np.zeros(shape=(n_x, n_y, n_z, n_ctdir, n_phidir), dtype=np.float32)
+    # Table hash is known up front, but tilt and anisotropy settings must be
+    # read from the tiles to determine the output directory name; so
+    # accumulate into a store in a temporary directory and rename it when done
+    tmp_outdir = join(dest_dir, 'tdi_table_{}.incomplete'.format(table_hash))
+    if is_tdi_store(tmp_outdir):
+        raise ValueError(
+            'Incomplete TDI store exists at "{}"; remove it and try again'
+            .format(tmp_outdir)
+        )
+    if store_tile_shape is None:
+        store_tile_shape = (n_x, n_y, n_z)
+    store = create_tdi_store(
+        store_dir=tmp_outdir,
+        bin_edges=OrderedDict([
+            ('x', x_edges),
+            ('y', y_edges),
+            ('z', z_edges),
+            ('costhetadir', ctdir_edges),
+            ('phidir', phidir_edges),
+        ]),
+        tile_shape=store_tile_shape,
+        quantities=['tdi_table'],
+        dtype=np.float32,
+        meta=OrderedDict([('table_hash', table_hash)]),
+    )
+    table = store.get_array('tdi_table')
 
     # Slice all table dimensions to exclude {under,over}flow bins
     central_slice = (slice(1, -1),)*5
@@ -301,15 +337,21 @@ def combine_tdi_tiles(
 
     metadata = OrderedDict()
     metadata['table_hash'] = table_hash
-    metadata['disable_tilt'] = disable_tilt
-    metadata['disable_anisotropy'] = disable_anisotropy
-    metadata['gcd'] = gcd
+    metadata['disable_tilt'] = bool(disable_tilt)
+    metadata['disable_anisotropy'] = bool(disable_anisotropy)
+    metadata['source_gcd_i3_md5'] = gcd['source_gcd_i3_md5']
     metadata['angsens_model'] = angsens_model
     metadata['ice_model'] = ice_model
-    metadata['n_phase'] = n_phase
-    metadata['n_group'] = n_group
+    metadata['n_phase'] = float(n_phase)
+    metadata['n_group'] = float(n_group)
     metadata['tiles_info'] = tiles_info
 
+    table.flush()
+    del table
+    store.update_meta(metadata)
+    for tile_idx in np.ndindex(*store.tile_grid_shape):
+        store.mark_tile_written(tile_idx)
+
     outdir = join(
         dest_dir,
         'tdi_table_{}_tilt_{}_anisotropy_{}'.format(
@@ -318,44 +360,10 @@ def combine_tdi_tiles(
             'off' if disable_anisotropy else 'on',
         )
     )
-    mkdir(outdir)
-
-    name = 'tdi_table.npy'
-    outfpath = join(outdir, name)
-    wstdout('saving table to "{}"\n'.format(outfpath))
-    np.save(outfpath, table)
-
-    #outfpath = join(outdir, 'tdi_bin_edges.json')
-    #wstdout('saving bin edges to "{}"\n'.format(outfpath))
-    #json.dump(
-    #    bin_edges,
-    #    file(outfpath, 'w'),
-    #    sort_keys=False,
-    #    indent=2,
-    #)
-    outfpath = join(outdir, 'tdi_bin_edges.pkl')
-    wstdout('saving bin edges to "{}"\n'.format(outfpath))
-    pickle.dump(
-        bin_edges,
-        open(outfpath, 'wb'),
-        protocol=pickle.HIGHEST_PROTOCOL,
-    )
-
-    #outfpath = join(outdir, 'tdi_metadata.json')
-    #wstdout('saving metadata to "{}"\n'.format(outfpath))
-    #json.dump(
-    #    metadata,
-    #    file(outfpath, 'w'),
-    #    sort_keys=False,
-    #    indent=2,
-    #)
-    outfpath = join(outdir, 'tdi_metadata.pkl')
-    wstdout('saving metadata to "{}"\n'.format(outfpath))
-    pickle.dump(
-        metadata,
-        open(outfpath, 'wb'),
-        protocol=pickle.HIGHEST_PROTOCOL,
-    )
+    if isdir(outdir):
+        raise ValueError('Destination exists: "{}"'.format(outdir))
+    rename(tmp_outdir, outdir)
+    wstdout('saved TDI store to "{}"\n'.format(outdir))
 
 
 def parse_args(description=__doc__):
@@ -385,6 +393,11 @@ def parse_args(description=__doc__):
     parser.add_argument(
         '--tile-spec-file', required=True,
     )
+    parser.add_argument(
+        '--store-tile-shape', nargs=3, type=int, default=None,
+        help='''Number of (x, y, z) bins per tile of the output TDI store;
+        default is a single tile'''
+    )
     return parser.parse_args()
 
 
@@ -62,6 +62,7 @@ def generate_ckv_table(
     outdir=None,
     mmap_src=True,
     mmap_dst=False,
+    cone_cache_dir=None,
 ):
     """
     Parameters
@@ -104,6 +105,11 @@ def generate_ckv_table(
     mmap_dst : bool, optional
         Whether to memory map the destination `ckv_table`.
 
+    cone_cache_dir : string, optional
+        Directory in which to cache the Cherenkov-cone operator, which depends
+        only on `beta`, `oversample`, `num_cone_samples`, and the directional
+        binning, for reuse when converting other tables
+
     """
     input_filename = None
     if isinstance(table, string_types):
@@ -166,6 +172,7 @@ def generate_ckv_table(
             cos_ckv=cos_ckv,
             num_cone_samples=num_cone_samples,
             oversample=oversample,
+            cache_dir=cone_cache_dir,
             costhetadir_min=costhetadir_bin_edges.min(),
             costhetadir_max=costhetadir_bin_edges.max(),
             phidir_min=deltaphidir_bin_edges.min(),
@@ -208,6 +215,11 @@ def parse_args(description=__doc__):
         help='''Directory in which to store the resulting table
         directory(ies).'''
     )
+    parser.add_argument(
+        '--cone-cache-dir', default=None,
+        help='''Directory in which to cache the Cherenkov-cone operator for
+        reuse by subsequent invocations with the same parameters'''
+    )
     return parser.parse_args()
 
 
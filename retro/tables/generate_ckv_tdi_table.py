@@ -30,6 +30,7 @@ See the License for the specific language governing permissions and
 limitations under the License.'''
 
 from argparse import ArgumentParser
+from collections import OrderedDict
 from os import remove
 from os.path import abspath, dirname, isdir, isfile, join
 import pickle
@@ -42,6 +43,7 @@ if __name__ == '__main__' and __package__ is None:
     RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
     if RETRO_DIR not in sys.path:
         sys.path.append(RETRO_DIR)
+from retro.tables.tdi_store import TDIStore, is_tdi_store
 from retro.utils.ckv import convolve_table
 from retro.utils.misc import expand, mkdir
 
@@ -59,13 +61,16 @@ def generate_ckv_tdi_table(
     outdir=None,
     mmap_src=True,
     mmap_dst=False,
+    cone_cache_dir=None,
 ):
     """
     Parameters
     ----------
     tdi_table : string or mapping
-        If string, path to TDI table file (or directory containing a
-        `tdi_table.npy' file).
+        If string, path to a TDI store (as written by `combine_tdi_tiles`), a
+        TDI table file, or a directory containing a `tdi_table.npy' file. If a
+        TDI store is specified and `outdir` is None, the result is added to
+        the store as quantity "ckv_tdi_table".
 
     beta : float in [0, 1]
         Beta factor, i.e. velocity of the charged particle divided by the speed
@@ -102,12 +107,21 @@ def generate_ckv_tdi_table(
     mmap_dst : bool, optional
         Whether to memory map the destination `ckv_tdi_table.npy` file.
 
+    cone_cache_dir : string, optional
+        Directory in which to cache the Cherenkov-cone operator, which depends
+        only on `beta`, `oversample`, `num_cone_samples`, and the directional
+        binning, for reuse when converting other tables
+
     """
     input_filename = None
     input_dirname = None
+    store = None
     if isinstance(tdi_table, string_types):
         tdi_table = expand(tdi_table)
-        if isdir(tdi_table):
+        if is_tdi_store(tdi_table):
+            store = TDIStore(tdi_table, mmap=mmap_src)
+            input_filename = join(tdi_table, store.header['quantities']['tdi_table']['fname'])
+        elif isdir(tdi_table):
             input_filename = join(tdi_table, 'tdi_table.npy')
         elif isfile(tdi_table):
             input_filename = tdi_table
@@ -131,14 +145,21 @@ def generate_ckv_tdi_table(
         )
 
     if n_phase is None:
-        meta = pickle.load(file(join(input_dirname, 'tdi_metadata.pkl'), 'rb'))
-        n_phase = meta['n_phase']
+        if store is not None:
+            n_phase = store.meta['n_phase']
+        else:
+            meta = pickle.load(file(join(input_dirname, 'tdi_metadata.pkl'), 'rb'))
+            n_phase = meta['n_phase']
 
     if outdir is None:
         outdir = input_dirname
+    else:
+        store = None
     mkdir(outdir)
 
-    if input_filename is not None:
+    if store is not None:
+        tdi_table = store.get_array('tdi_table')
+    elif input_filename is not None:
         tdi_table = np.load(
             input_filename,
             mmap_mode='r' if mmap_src else None,
@@ -158,7 +179,13 @@ def generate_ckv_tdi_table(
             .format(ckv_tdi_table_fpath)
         )
 
-    if mmap_dst:
+    if store is not None:
+        # Convolve directly into a memory-mapped quantity of the store
+        dst_store = TDIStore(store.store_dir, mmap=True, writable=True)
+        if 'ckv_tdi_table' not in dst_store.quantities:
+            dst_store.add_quantity('ckv_tdi_table')
+        ckv_tdi_table = dst_store.get_array('ckv_tdi_table')
+    elif mmap_dst:
         # Allocate memory-mapped file
         ckv_tdi_table = np.lib.format.open_memmap(
             filename=ckv_tdi_table_fpath,
@@ -176,6 +203,7 @@ def generate_ckv_tdi_table(
             cos_ckv=cos_ckv,
             num_cone_samples=num_cone_samples,
             oversample=oversample,
+            cache_dir=cone_cache_dir,
             costhetadir_min=-1,
             costhetadir_max=+1,
             phidir_min=-np.pi,
@@ -183,11 +211,18 @@ def generate_ckv_tdi_table(
         )
     except:
         del ckv_tdi_table
-        if mmap_dst:
+        if mmap_dst and store is None:
             remove(ckv_tdi_table_fpath)
         raise
 
-    if not mmap_dst:
+    if store is not None:
+        ckv_tdi_table.flush()
+        dst_store.update_meta(OrderedDict([
+            ('ckv_beta', beta),
+            ('ckv_oversample', oversample),
+            ('ckv_num_cone_samples', num_cone_samples),
+        ]))
+    elif not mmap_dst:
         np.save(ckv_tdi_table_fpath, ckv_tdi_table)
 
     return ckv_tdi_table
@@ -198,8 +233,8 @@ def parse_args(description=__doc__):
     parser = ArgumentParser(description=description)
     parser.add_argument(
         '--tdi-table', required=True,
-        help='''Path to TDI table or path to directory containing the file
-        `tdi_table.npy`'''
+        help='''Path to TDI store, TDI table, or path to directory
+        containing the file `tdi_table.npy`'''
     )
     parser.add_argument(
         '--beta', type=float, default=1.0,
@@ -219,6 +254,11 @@ def parse_args(description=__doc__):
         help='''Directory in which to store the resulting table; if not
         specified, output table will be stored alongside the input table'''
     )
+    parser.add_argument(
+        '--cone-cache-dir', default=None,
+        help='''Directory in which to cache the Cherenkov-cone operator for
+        reuse by subsequent invocations with the same parameters'''
+    )
     return parser.parse_args()
 
 
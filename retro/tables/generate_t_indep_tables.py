@@ -20,7 +20,6 @@ from os.path import abspath, basename, dirname, isdir, isfile, join
 import sys
 import time
 
-import numpy as np
 from six import string_types
 
 if __name__ == '__main__' and __package__ is None:
@@ -30,6 +29,7 @@ if __name__ == '__main__' and __package__ is None:
 import retro
 from retro.tables.clsim_tables import load_clsim_table_minimal
 from retro.tables.ckv_tables import load_ckv_table
+from retro.tables.chunked_reduce import DFLT_CHUNK_NBYTES, Product, SumAxis, reduce_table
 from retro.utils.misc import expand, mkdir
 
 
@@ -37,7 +37,8 @@ def generate_time_indep_tables(
         table,
         kind,
         outdir=None,
-        overwrite=False
+        overwrite=False,
+        chunk_nbytes=DFLT_CHUNK_NBYTES,
     ):
     """Generate and save to disk time independent table(s) from the original
     CLSim table and/or a Cherenkov table.
@@ -48,6 +49,9 @@ def generate_time_indep_tables(
     kind : string in {"ckv", "clsim"} or iterable of one or more
     outdir : string, optional
     overwrite : bool, optional
+    chunk_nbytes : int, optional
+        Approximate size of blocks of the input table processed at a time; see
+        `retro.tables.chunked_reduce.reduce_table`
 
     Returns
     -------
@@ -122,19 +126,24 @@ def generate_time_indep_tables(
         if retro.DEBUG:
             print('loaded clsim table in {:.3f} s'.format(t1 - t0))
 
-        t_indep_table = clsim_table['table'][1:-1, 1:-1, 1:-1, 1:-1, 1:-1].sum(axis=2)
+        # Sum over t-axis (excluding under/overflow bins) block by block
+        # into memory-mapped output file
+        reduce_table(
+            table=clsim_table['table'][1:-1, 1:-1, 1:-1, 1:-1, 1:-1],
+            products={
+                't_indep_table': Product(
+                    steps=[SumAxis(2)], fpath=t_indep_table_fpath, dtype=None
+                ),
+            },
+            chunk_nbytes=chunk_nbytes,
+        )
 
         t2 = time.time()
         if retro.DEBUG:
-            print('summed over t-axis in {:.3f} s'.format(t2 - t1))
+            print('summed over t-axis and saved t_indep_table.npy to disk in'
+                  ' {:.3f} s'.format(t2 - t1))
 
-        np.save(t_indep_table_fpath, t_indep_table)
-
-        t3 = time.time()
-        if retro.DEBUG:
-            print('saved t_indep_table.npy to disk in {:.3f} s'.format(t3 - t2))
-
-        del clsim_table, t_indep_table
+        del clsim_table
 
     if 'ckv' in kinds and (overwrite or not t_indep_ckv_table_exists):
         if ckv_table_path is None:
@@ -152,19 +161,22 @@ def generate_time_indep_tables(
         if retro.DEBUG:
             print('loaded ckv table in {:.3f} s'.format(t1 - t0))
 
-        t_indep_ckv_table = ckv_table['ckv_table'].sum(axis=2)
+        reduce_table(
+            table=ckv_table['ckv_table'],
+            products={
+                't_indep_ckv_table': Product(
+                    steps=[SumAxis(2)], fpath=t_indep_ckv_table_fpath, dtype=None
+                ),
+            },
+            chunk_nbytes=chunk_nbytes,
+        )
 
         t2 = time.time()
         if retro.DEBUG:
-            print('summed over t-axis in {:.3f} s'.format(t2 - t1))
-
-        np.save(t_indep_ckv_table_fpath, t_indep_ckv_table)
-
-        t3 = time.time()
-        if retro.DEBUG:
-            print('saved t_indep_table.npy to disk in {:.3f} s'.format(t3 - t2))
+            print('summed over t-axis and saved t_indep_ckv_table.npy to disk'
+                  ' in {:.3f} s'.format(t2 - t1))
 
-        del ckv_table, t_indep_ckv_table
+        del ckv_table
 
 
 def parse_args(description=__doc__):
@@ -188,6 +200,11 @@ def parse_args(description=__doc__):
         '--overwrite', action='store_true',
         help='''Overwrite any existing time-independent tables.'''
     )
+    parser.add_argument(
+        '--chunk-nbytes', type=int, default=DFLT_CHUNK_NBYTES,
+        help='''Approximate size of blocks of the input table processed at a
+        time'''
+    )
     parser.add_argument(
         '-v', action='store_true'
     )
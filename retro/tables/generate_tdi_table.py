@@ -34,7 +34,15 @@ any of the voxel(s) of this table.
 from __future__ import absolute_import, division, print_function
 
 __all__ = [
+    'TDI_PARTIAL_KEYS',
     'generate_tdi_table_meta',
+    'generate_tdi_store_meta',
+    'compute_tdi_partials',
+    'reduce_tdi_partials',
+    'save_tdi_partials',
+    'load_tdi_partials',
+    'update_tdi_layer_partials',
+    'test_update_tdi_layer_partials',
     'generate_tdi_table',
     'parse_args'
 ]
@@ -57,12 +65,16 @@ limitations under the License.'''
 from argparse import ArgumentParser
 from collections import OrderedDict
 from copy import deepcopy
-from os.path import abspath, dirname, isdir, isfile, join
+from glob import glob
+from multiprocessing import Pool
+from os import remove
+from os.path import abspath, basename, dirname, isdir, isfile, join
+from shutil import rmtree
 import sys
+from tempfile import mkdtemp
 import time
 
 import numpy as np
-from astropy.io import fits
 
 if __name__ == '__main__' and __package__ is None:
     PARENT_DIR = dirname(dirname(abspath(__file__)))
@@ -72,16 +84,40 @@ from retro.const import (
     DC_DOM_QUANT_EFF, IC_DOM_QUANT_EFF, POL_TABLE_RMAX, POL_TABLE_RPWR,
     POL_TABLE_NRBINS, POL_TABLE_NTHETABINS, POL_TABLE_NTBINS
 )
+from retro.i3info.extract_gcd import extract_gcd
 from retro.tables.generate_binmap import generate_binmap
-from retro.tables.shift_and_bin import shift_and_bin
+from retro.tables.shift_and_bin import shift_and_bin, shift_and_bin_parallel
 from retro.tables.dom_time_polar_tables import load_t_r_theta_table
-from retro.tables.tdi_cart_tables import TDI_TABLE_FNAME_PROTO
+from retro.tables.table_cache import hash_items
+from retro.tables.tdi_cart_tables import (
+    TDI_QUANTITIES, TDI_STORE_DIRNAME_PROTO, TDI_TABLE_FNAME_PROTO
+)
+from retro.tables.tdi_store import create_tdi_store
 from retro.utils.geom import generate_geom_meta
 from retro.utils.misc import (
-    generate_anisotropy_str, hash_obj, hrlist2list, list2hrlist
+    expand, generate_anisotropy_str, hash_obj, hrlist2list, list2hrlist, mkdir
 )
 
 
+TDI_PARTIAL_KEYS = [
+    'binned_spv',
+    'binned_px_spv',
+    'binned_py_spv',
+    'binned_pz_spv',
+    'binned_log_one_minus_sp',
+    'binned_num_sp_one',
+]
+"""Accumulators that can be computed independently for disjoint sets of
+(subdet, depth) layers and then summed (or, to remove a layer's contribution,
+subtracted). The product over layers of one minus survival probability is
+kept as the sum of the logs of its nonzero factors
+(`binned_log_one_minus_sp`) plus the number of factors that are exactly zero
+(`binned_num_sp_one`), so that it too becomes a sum."""
+
+_LAYER_KW = None
+"""Set in pool workers by `_init_worker`"""
+
+
 def generate_tdi_table_meta(
         binmap_hash, geom_hash, dom_tables_hash, times_str, x_min, x_max,
         y_min, y_max, z_min, z_max, binwidth, anisotropy, ic_dom_quant_eff,
@@ -166,6 +202,537 @@ def generate_tdi_table_meta(
     return metadata
 
 
+def generate_tdi_store_meta(tdi_meta, volume_x_lims, volume_y_lims, volume_z_lims):
+    """Generate metadata for the TDI store containing the tile described by
+    `tdi_meta`.
+
+    All tiles generated with the same parameters (other than their limits)
+    and with the same limits of the full volume go into the same store.
+
+    Parameters
+    ----------
+    tdi_meta : mapping
+        As returned by `generate_tdi_table_meta` for the tile
+    volume_x_lims, volume_y_lims, volume_z_lims : 2-tuples of floats
+
+    Returns
+    -------
+    store_meta : OrderedDict
+        Contains "store_hash", "volume_lims", and the items of
+        `tdi_meta['kwargs']` that are common to all tiles
+
+    """
+    store_meta = OrderedDict()
+    for key, val in tdi_meta['kwargs'].items():
+        if key[0] in 'xyz' and key[1:] in ('_min', '_max'):
+            continue
+        store_meta[key] = val
+    store_meta['volume_lims'] = [
+        [float(l) for l in lims] for lims in (volume_x_lims, volume_y_lims, volume_z_lims)
+    ]
+    store_meta['store_hash'] = hash_items(
+        [(key, str(val)) for key, val in store_meta.items()]
+    )[:16]
+    return store_meta
+
+
+def _accumulate_layer(layer, accumulators, layer_kw):
+    """Load the (t, r, theta) table for one (subdet, depth) layer of DOMs,
+    marginalize out time, and shift-and-bin it into `accumulators` (modified
+    in place)"""
+    subdet, rel_idx, depth_idx = layer
+    print('    Subdetector: %s, depth_idx: %d' % (subdet, depth_idx))
+    dom_coords = layer_kw['subdet_doms'][subdet][:, rel_idx, :]
+    dom_coords = dom_coords[layer_kw['subdet_dom_masks'][subdet][:, rel_idx]]
+    if len(dom_coords) == 0:
+        print('    No operational DOMs\n')
+        return
+    times = layer_kw['times']
+
+    t0 = time.time()
+    table_fname = (
+        'retro_nevts1000'
+        '_{subdet:s}'
+        '_DOM{depth_idx:d}'
+        '_r_cz_t_angles'
+        '.fits'.format(
+            subdet=subdet.upper(), depth_idx=depth_idx
+        )
+    )
+    # TODO: validate that bin edges match spec we're using
+    photon_info, _ = load_t_r_theta_table(
+        fpath=join(layer_kw['tables_dir'], table_fname),
+        depth_idx=depth_idx,
+        scale=layer_kw['quant_effs'][subdet],
+        exponent=layer_kw['exponents'][subdet]
+    )
+    t1 = time.time()
+    print('    Time to load Retro DOM table: {} s'
+          .format(np.round(t1 - t0, 3)))
+
+    sp = photon_info.survival_prob[depth_idx].astype(np.float64)
+    plength = photon_info.length[depth_idx].astype(np.float64)
+    ptheta = photon_info.theta[depth_idx].astype(np.float64)
+    pdeltaphi = photon_info.deltaphi[depth_idx].astype(np.float64)
+
+    plength *= np.cos(pdeltaphi)
+    pz = plength * np.cos(ptheta)
+    prho = plength * np.sin(ptheta)
+
+    # Marginalize out time, computing the probability of a photon
+    # starting at any one time being detected at any other time
+    t_indep_sp = 1 - np.prod(1 - sp[times], axis=0)
+
+    mask = t_indep_sp != 0
+    scale = 1 / sp.sum(axis=0)[mask]
+
+    t_indep_pz = np.zeros_like(t_indep_sp)
+    t_indep_prho = np.zeros_like(t_indep_sp)
+
+    t_indep_pz[mask] = (
+        (pz[times] * sp[times]).sum(axis=0)[mask] * scale
+    )
+    t_indep_prho[mask] = (
+        (prho[times] * sp[times]).sum(axis=0)[mask] * scale
+    )
+
+    t2 = time.time()
+    print("    Time to reduce Retro DOM table's time dimension: {} s"
+          .format(np.round(t2 - t1, 3)))
+
+    x_lims, y_lims, z_lims = layer_kw['x_lims'], layer_kw['y_lims'], layer_kw['z_lims']
+    threads = layer_kw.get('threads', 1)
+    if threads == 1:
+        shift_and_bin_func = shift_and_bin
+        extra_kw = {}
+    else:
+        shift_and_bin_func = shift_and_bin_parallel
+        extra_kw = dict(num_threads=threads)
+    shift_and_bin_func(
+        ind_arrays=layer_kw['ind_arrays'],
+        vol_arrays=layer_kw['vol_arrays'],
+        dom_coords=dom_coords,
+        survival_prob=t_indep_sp,
+        prho=t_indep_prho,
+        pz=t_indep_pz,
+        nr=layer_kw['n_rbins'],
+        ntheta=layer_kw['n_costhetabins'],
+        r_max=layer_kw['r_max'],
+        binned_spv=accumulators['binned_spv'],
+        binned_px_spv=accumulators['binned_px_spv'],
+        binned_py_spv=accumulators['binned_py_spv'],
+        binned_pz_spv=accumulators['binned_pz_spv'],
+        binned_one_minus_sp=accumulators['binned_one_minus_sp'],
+        x_min=x_lims[0],
+        y_min=y_lims[0],
+        z_min=z_lims[0],
+        x_max=x_lims[1],
+        y_max=y_lims[1],
+        z_max=z_lims[1],
+        binwidth=layer_kw['binwidth'],
+        oversample=layer_kw['oversample'],
+        anisotropy=None,
+        **extra_kw
+    )
+    print('    %d surv probs are exactly 1'
+          % np.sum(accumulators['binned_one_minus_sp'] == 0))
+    t3 = time.time()
+    print('    Time to shift and bin: {} s'
+          .format(np.round(t3 - t2, 3)))
+    print('')
+
+
+def _layer_name(layer):
+    """Name identifying a layer independently of the selected depths"""
+    return '{}_{:d}'.format(layer[0], layer[2])
+
+
+def _layer_signature(layer, layer_kw):
+    """Hash of everything a layer's contribution depends on, including the
+    settings common to all layers (`layer_kw['common_signature']`), so that
+    partials stored by runs with different common settings never collide"""
+    subdet, rel_idx, _ = layer
+    dom_coords = layer_kw['subdet_doms'][subdet][:, rel_idx, :]
+    dom_coords = dom_coords[layer_kw['subdet_dom_masks'][subdet][:, rel_idx]]
+    return hash_items([
+        ('common', layer_kw.get('common_signature', None)),
+        ('layer', _layer_name(layer)),
+        ('dom_coords', np.round(dom_coords, 2)),
+        ('quant_eff', layer_kw['quant_effs'][subdet]),
+        ('exponent', layer_kw['exponents'][subdet]),
+    ])
+
+
+def _layer_partials_fpath(layer_partials_dir, signature):
+    return join(layer_partials_dir, 'layer_{}.npz'.format(signature))
+
+
+def _compute_layers_partials(layers, layer_kw=None):
+    """Compute partial accumulators (see `TDI_PARTIAL_KEYS`) for `layers`.
+    If `layer_kw` is None, uses that set by `_init_worker`. If
+    `layer_kw['layer_partials_dir']` is not None, each layer's partials are
+    also saved there."""
+    if layer_kw is None:
+        layer_kw = _LAYER_KW
+    layer_partials_dir = layer_kw.get('layer_partials_dir', None)
+
+    # Accumulators start as 1D to speed indexing operations
+    num_bins = int(np.prod(layer_kw['xyz_shape']))
+    partials = OrderedDict(
+        (key, np.zeros(num_bins, dtype=np.float64)) for key in TDI_PARTIAL_KEYS
+    )
+    for layer in layers:
+        accumulators = OrderedDict([
+            ('binned_spv', np.zeros(num_bins, dtype=np.float64)),
+            ('binned_px_spv', np.zeros(num_bins, dtype=np.float64)),
+            ('binned_py_spv', np.zeros(num_bins, dtype=np.float64)),
+            ('binned_pz_spv', np.zeros(num_bins, dtype=np.float64)),
+            ('binned_one_minus_sp', np.ones(num_bins, dtype=np.float64)),
+        ])
+        _accumulate_layer(layer=layer, accumulators=accumulators, layer_kw=layer_kw)
+
+        one_minus_sp = accumulators.pop('binned_one_minus_sp')
+        sp_is_one = one_minus_sp == 0
+        accumulators['binned_log_one_minus_sp'] = np.log(np.where(sp_is_one, 1, one_minus_sp))
+        accumulators['binned_num_sp_one'] = sp_is_one.astype(np.float64)
+
+        if layer_partials_dir is not None:
+            np.savez(
+                _layer_partials_fpath(layer_partials_dir, _layer_signature(layer, layer_kw)),
+                **accumulators
+            )
+        for key in TDI_PARTIAL_KEYS:
+            partials[key] += accumulators[key]
+
+    partials['layers'] = list(layers)
+    return partials
+
+
+def _init_worker(layer_kw):
+    """Pool initializer, so that large inputs are sent to each worker once"""
+    global _LAYER_KW # pylint: disable=global-statement
+    _LAYER_KW = layer_kw
+
+
+def reduce_tdi_partials(partials):
+    """Combine partial accumulators computed for disjoint sets of layers.
+
+    Parameters
+    ----------
+    partials : sequence of mappings
+        Each containing `TDI_PARTIAL_KEYS` and "layers"
+
+    Returns
+    -------
+    reduced : OrderedDict
+
+    """
+    partials = list(partials)
+    reduced = OrderedDict()
+    for key in TDI_PARTIAL_KEYS:
+        reduced[key] = np.sum([p[key] for p in partials], axis=0)
+    reduced['layers'] = []
+    for partial in partials:
+        overlap = set(reduced['layers']).intersection(partial['layers'])
+        if overlap:
+            raise ValueError('Layers {} included more than once'.format(sorted(overlap)))
+        reduced['layers'].extend(partial['layers'])
+    return reduced
+
+
+def compute_tdi_partials(layers, layer_kw, procs=1):
+    """Compute accumulators for `layers`, splitting the layers among `procs`
+    worker processes (each with its own partial accumulators), and reduce.
+
+    Parameters
+    ----------
+    layers : sequence of (subdet, rel_idx, depth_idx) tuples
+    layer_kw : mapping
+    procs : int >= 1, optional
+
+    Returns
+    -------
+    partials : OrderedDict
+        Keys are `TDI_PARTIAL_KEYS` and "layers"
+
+    """
+    procs = max(1, min(procs, len(layers)))
+    if procs == 1:
+        return _compute_layers_partials(layers=layers, layer_kw=layer_kw)
+
+    pool = Pool(procs, initializer=_init_worker, initargs=(layer_kw,))
+    try:
+        partials = pool.map(
+            _compute_layers_partials,
+            [layers[worker_idx::procs] for worker_idx in range(procs)],
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+    return reduce_tdi_partials(partials)
+
+
+def _partials_fpath(partials_dir, fbasename, job_idx, num_jobs):
+    return join(
+        partials_dir,
+        '{}_partial_{:d}of{:d}.npz'.format(fbasename, job_idx, num_jobs)
+    )
+
+
+def save_tdi_partials(partials, partials_dir, fbasename, job_idx, num_jobs):
+    """Save one job's partial accumulators to disk.
+
+    Returns
+    -------
+    fpath : string
+
+    """
+    mkdir(partials_dir)
+    fpath = _partials_fpath(partials_dir, fbasename, job_idx, num_jobs)
+    layers = partials['layers']
+    np.savez(
+        fpath,
+        layer_subdets=np.array([l[0] for l in layers], dtype='U2'),
+        layer_rel_indices=np.array([l[1] for l in layers], dtype=int),
+        layer_depth_indices=np.array([l[2] for l in layers], dtype=int),
+        **{key: partials[key] for key in TDI_PARTIAL_KEYS}
+    )
+    return fpath
+
+
+def load_tdi_partials(partials_dir, fbasename, num_jobs):
+    """Load and reduce the partial accumulators saved by all `num_jobs` jobs.
+
+    Returns
+    -------
+    partials : OrderedDict
+        See `reduce_tdi_partials`
+
+    """
+    def _load(job_idx):
+        fpath = _partials_fpath(partials_dir, fbasename, job_idx, num_jobs)
+        if not isfile(fpath):
+            raise IOError('Missing partial accumulators file "{}"'.format(fpath))
+        with np.load(fpath) as npz:
+            partial = OrderedDict((key, npz[key]) for key in TDI_PARTIAL_KEYS)
+            partial['layers'] = [
+                (str(s), int(r), int(d)) for s, r, d in zip(
+                    npz['layer_subdets'],
+                    npz['layer_rel_indices'],
+                    npz['layer_depth_indices']
+                )
+            ]
+        return partial
+
+    return reduce_tdi_partials(_load(job_idx) for job_idx in range(num_jobs))
+
+
+def update_tdi_layer_partials(layers, layer_kw, layer_partials_dir, common_signature,
+                              procs=1):
+    """Get accumulators for `layers`, reusing those stored in
+    `layer_partials_dir` by a previous run with the same common settings.
+
+    Layers whose DOMs (positions and operational status, e.g. after a GCD
+    change) or other settings differ from the stored ones have their stored
+    contributions subtracted and are recomputed; all other layers are taken
+    from the stored total as-is. The total and all recomputed layers'
+    partials are (re)written to `layer_partials_dir`, and the stored partials
+    of layers that were removed are deleted.
+
+    Parameters
+    ----------
+    layers : sequence of (subdet, rel_idx, depth_idx) tuples
+    layer_kw : mapping
+    layer_partials_dir : string
+    common_signature : string
+        Hash of settings common to all layers (binning, times, etc.)
+    procs : int >= 1, optional
+
+    Returns
+    -------
+    partials : OrderedDict
+        Keys are `TDI_PARTIAL_KEYS` and "layers"
+
+    """
+    mkdir(layer_partials_dir)
+    total_fpath = join(layer_partials_dir, 'total_{}.npz'.format(common_signature))
+    layer_kw = dict(layer_kw)
+    layer_kw['layer_partials_dir'] = layer_partials_dir
+    layer_kw['common_signature'] = common_signature
+    signatures = OrderedDict(
+        (_layer_name(layer), _layer_signature(layer, layer_kw)) for layer in layers
+    )
+
+    old_signatures = OrderedDict()
+    if isfile(total_fpath):
+        with np.load(total_fpath) as npz:
+            partials = OrderedDict((key, npz[key]) for key in TDI_PARTIAL_KEYS)
+            old_signatures = OrderedDict(
+                (str(n), str(s)) for n, s in zip(npz['layer_names'], npz['layer_signatures'])
+            )
+
+    to_remove = [
+        sig for name, sig in old_signatures.items() if signatures.get(name) != sig
+    ]
+    to_add = [
+        layer for layer in layers
+        if old_signatures.get(_layer_name(layer)) != signatures[_layer_name(layer)]
+    ]
+    print('Reusing {} stored layers, removing {}, (re)computing {}'.format(
+        len(old_signatures) - len(to_remove), len(to_remove), len(to_add)
+    ))
+    print('')
+
+    if not old_signatures:
+        partials = None
+    for signature in to_remove:
+        with np.load(_layer_partials_fpath(layer_partials_dir, signature)) as npz:
+            for key in TDI_PARTIAL_KEYS:
+                partials[key] -= npz[key]
+
+    if to_add:
+        added = compute_tdi_partials(layers=to_add, layer_kw=layer_kw, procs=procs)
+        if partials is None:
+            partials = added
+        else:
+            for key in TDI_PARTIAL_KEYS:
+                partials[key] += added[key]
+
+    # Clean up round-off in the count of exactly-zero factors
+    partials['binned_num_sp_one'] = np.round(partials['binned_num_sp_one'])
+
+    np.savez(
+        total_fpath,
+        layer_names=np.array(list(signatures.keys()), dtype='U8'),
+        layer_signatures=np.array(list(signatures.values()), dtype='U64'),
+        **{key: partials[key] for key in TDI_PARTIAL_KEYS}
+    )
+
+    # Only now that the total no longer refers to them
+    for signature in to_remove:
+        fpath = _layer_partials_fpath(layer_partials_dir, signature)
+        if isfile(fpath):
+            remove(fpath)
+
+    partials['layers'] = list(layers)
+    return partials
+
+
+def _synthetic_accumulate_layer(layer, accumulators, layer_kw):
+    """Stand-in for `_accumulate_layer` (which needs Retro DOM tables) that
+    adds a pseudo-random contribution for each operational DOM, determined by
+    the DOM's position and the layer's quantum efficiency"""
+    subdet, rel_idx, _ = layer
+    dom_coords = layer_kw['subdet_doms'][subdet][:, rel_idx, :]
+    dom_coords = dom_coords[layer_kw['subdet_dom_masks'][subdet][:, rel_idx]]
+    num_bins = len(accumulators['binned_spv'])
+    for coord in dom_coords:
+        rand = np.random.RandomState(int(np.sum(np.abs(coord) * [1, 100, 10000])))
+        bins = rand.choice(num_bins, size=num_bins // 2, replace=False)
+        sp = layer_kw['quant_effs'][subdet] * rand.uniform(size=len(bins))
+        sp[rand.uniform(size=len(bins)) < 0.1] = 1
+        accumulators['binned_spv'][bins] += sp
+        accumulators['binned_px_spv'][bins] += sp * coord[0]
+        accumulators['binned_py_spv'][bins] += sp * coord[1]
+        accumulators['binned_pz_spv'][bins] += sp * coord[2]
+        accumulators['binned_one_minus_sp'][bins] *= 1 - sp
+
+
+def test_update_tdi_layer_partials():
+    """Unit tests for function `update_tdi_layer_partials`: incremental
+    updates after changes to DOMs' operational status and other per-layer
+    settings match computing all layers from scratch, and stored partials of
+    changed layers are replaced rather than accumulated."""
+    global _accumulate_layer # pylint: disable=global-statement
+
+    rand = np.random.RandomState(0)
+    subdet_doms = dict(
+        ic=rand.randint(-500, 500, size=(5, 4, 3)).astype(np.float64),
+        dc=rand.randint(-500, 500, size=(3, 4, 3)).astype(np.float64),
+    )
+    layer_kw = dict(
+        subdet_doms=subdet_doms,
+        subdet_dom_masks=dict(
+            (subdet, np.ones(doms.shape[:2], dtype=bool)) for subdet, doms in subdet_doms.items()
+        ),
+        xyz_shape=(4, 5, 3),
+        quant_effs=dict(ic=0.25, dc=0.35),
+        exponents=dict(ic=1, dc=1),
+    )
+    all_layers = [
+        (subdet, rel_idx, depth_idx)
+        for subdet in sorted(subdet_doms.keys())
+        for rel_idx, depth_idx in enumerate([10, 20, 30, 40])
+    ]
+
+    num_calls = [0]
+    orig_accumulate_layer = _accumulate_layer
+
+    def counting_accumulate_layer(layer, accumulators, layer_kw):
+        """Count layers computed"""
+        num_calls[0] += 1
+        _synthetic_accumulate_layer(layer, accumulators, layer_kw)
+
+    def _check(layers, expected_num_calls, procs=1):
+        """Update stored partials and compare with computing from scratch"""
+        num_calls[0] = 0
+        partials = update_tdi_layer_partials(
+            layers=layers,
+            layer_kw=layer_kw,
+            layer_partials_dir=tmpdir,
+            common_signature='common',
+            procs=procs,
+        )
+        if procs == 1:
+            assert num_calls[0] == expected_num_calls, (num_calls[0], expected_num_calls)
+        ref = compute_tdi_partials(layers=layers, layer_kw=layer_kw)
+        assert partials['layers'] == ref['layers']
+        for key in TDI_PARTIAL_KEYS:
+            assert np.allclose(partials[key], ref[key], rtol=1e-10, atol=1e-10), key
+        assert np.array_equal(partials['binned_num_sp_one'], ref['binned_num_sp_one'])
+
+        # Only the current layers' partials remain
+        expected_fnames = set(
+            basename(_layer_partials_fpath(tmpdir, _layer_signature(
+                layer, dict(layer_kw, common_signature='common')
+            )))
+            for layer in layers
+        )
+        fnames = set(basename(f) for f in glob(join(tmpdir, 'layer_*.npz')))
+        assert fnames == expected_fnames, (sorted(fnames), sorted(expected_fnames))
+
+    tmpdir = mkdtemp(suffix='test_update_tdi_layer_partials')
+    try:
+        _accumulate_layer = counting_accumulate_layer
+        _check(all_layers, expected_num_calls=len(all_layers))
+        _check(all_layers, expected_num_calls=0)
+
+        # DOMs go out of service: some in one layer, all in another
+        layer_kw['subdet_dom_masks']['ic'][[0, 3], 1] = False
+        layer_kw['subdet_dom_masks']['dc'][:, 2] = False
+        _check(all_layers, expected_num_calls=2)
+
+        # Per-subdetector setting changes
+        layer_kw['quant_effs'] = dict(ic=0.25, dc=0.3)
+        _check(all_layers, expected_num_calls=4)
+
+        # DOMs come back into service; compute with multiple processes
+        layer_kw['subdet_dom_masks']['ic'][:, 1] = True
+        layer_kw['subdet_dom_masks']['dc'][:, 2] = True
+        _check(all_layers, expected_num_calls=2, procs=2)
+
+        # Layers removed and then added back
+        _check(all_layers[1:-2], expected_num_calls=0)
+        _check(all_layers, expected_num_calls=3)
+
+    finally:
+        _accumulate_layer = orig_accumulate_layer
+        rmtree(tmpdir, ignore_errors=True)
+
+    print('<< PASS : test_update_tdi_layer_partials >>')
+
+
 def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
                        x_lims, y_lims, z_lims,
                        binwidth, oversample, antialias, anisotropy,
@@ -175,7 +742,19 @@ def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
                        depths=slice(None),
                        times=slice(None),
                        recompute_binmap=False,
-                       recompute_table=False):
+                       recompute_table=False,
+                       procs=1,
+                       threads=1,
+                       num_jobs=1,
+                       job_idx=None,
+                       partials_dir=None,
+                       merge_partials=False,
+                       gcd=None,
+                       layer_partials_dir=None,
+                       volume_x_lims=None,
+                       volume_y_lims=None,
+                       volume_z_lims=None,
+                       store_dir=None):
     """Create a time- and DOM-independent Cartesian (x,y,z)-binned Retro
     table (if it doesn't already exist or if the user requests that it be
     re-computed) and save the table to disk.
@@ -217,6 +796,55 @@ def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
         Force recomputation of table files even if the already exist; existing
         files will be overwritten
 
+    procs : int >= 1
+        Number of worker processes among which to split the (subdet, depth)
+        layers of DOMs; each accumulates its layers separately and the
+        results are summed
+
+    threads : int, optional
+        Number of threads among which to split the DOMs of each layer when
+        shifting and binning (see `shift_and_bin_parallel`); 1 uses the serial
+        `shift_and_bin` and values <= 0 use all cores. Total number of threads
+        is `procs` * `threads`.
+
+    num_jobs : int >= 1
+        Split the work among this many (e.g., cluster) jobs. Each job (see
+        `job_idx`) saves its partial accumulators to `partials_dir` and
+        returns None; then run once more with `merge_partials` to produce the
+        table.
+
+    job_idx : int in [0, num_jobs), optional
+        Required if `num_jobs` > 1 and not `merge_partials`
+
+    partials_dir : string, optional
+        Required if `num_jobs` > 1
+
+    merge_partials : bool
+        Combine the partial accumulators from all `num_jobs` jobs instead of
+        computing anything
+
+    gcd : string, optional
+        If specified, take DOM positions from this GCD file (instead of
+        `geom_fpath`) and exclude DOMs that have zero or non-finite RDE (i.e.,
+        are not operational)
+
+    layer_partials_dir : string, optional
+        Store each (subdet, depth) layer's partial accumulators (and their
+        total) here, and reuse them in subsequent runs such that only layers
+        whose DOMs changed (e.g. between GCDs) are recomputed; see
+        `update_tdi_layer_partials`. Cannot be combined with `num_jobs` > 1.
+
+    volume_x_lims, volume_y_lims, volume_z_lims : 2-tuples of floats, optional
+        Limits of the full volume of the TDI store into which the table
+        (spanning `x_lims`, `y_lims`, and `z_lims`) is written as one tile;
+        the full volume must be divisible into tiles of this table's size.
+        Defaults are `x_lims`, `y_lims`, and `z_lims`, i.e., a single-tile
+        store.
+
+    store_dir : string, optional
+        TDI store directory; default is a directory named according to
+        `TDI_STORE_DIRNAME_PROTO` within `tables_dir`
+
     Returns
     -------
     tdi_data : OrderedDict
@@ -232,11 +860,23 @@ def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
             'vol_arrays'
             'tdi_meta' : OrderedDict
                 Return value from `generate_tdi_table_meta`
+            'store_dir' : string
+                TDI store the table was written to / loaded from
+            'tile_idx' : tuple of 3 ints
+                Index of the table's tile in the store
             'binmap_meta' : OrderedDict
                 Return value from `generate_binmap_meta`
 
     """
     assert isdir(tables_dir)
+    if num_jobs > 1 or merge_partials:
+        if partials_dir is None:
+            raise ValueError('`partials_dir` must be specified if using jobs')
+        if not merge_partials and not 0 <= job_idx < num_jobs:
+            raise ValueError('Must specify `job_idx` in [0, {})'.format(num_jobs))
+        recompute_table = True
+        if layer_partials_dir is not None:
+            raise ValueError('`layer_partials_dir` cannot be used with jobs')
     if dom_tables_hash is None:
         dom_tables_hash = 'none'
         r_max = POL_TABLE_RMAX
@@ -258,28 +898,46 @@ def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
     print('Generated/loaded TDI Cart table will have shape:', xyz_shape)
     print('')
 
-    geom = np.load(geom_fpath)
+    if gcd is not None:
+        gcd_info = extract_gcd(gcd)
+        geom = gcd_info['geo']
+        rde = gcd_info['rde']
+        operational = np.isfinite(rde) & (rde > 0)
+    elif geom_fpath is not None:
+        geom = np.load(geom_fpath)
+        operational = np.ones(shape=geom.shape[:2], dtype=bool)
+    else:
+        raise ValueError('Either `geom_fpath` or `gcd` must be specified')
 
     depth_indices = np.atleast_1d(np.arange(60)[depths])
     string_indices = np.atleast_1d(np.arange(87)[strings]) - 1
     string_indices = string_indices[string_indices >= 0]
 
     subdet_doms = {'ic': [], 'dc': []}
+    subdet_dom_masks = {'ic': [], 'dc': []}
     dc_strings = list(range(79, 86))
     for string_idx in string_indices:
         dom_coords = geom[string_idx:string_idx+1, depths, :]
+        dom_mask = operational[string_idx:string_idx+1, depths]
         if string_idx in dc_strings:
             subdet_doms['dc'].append(dom_coords)
+            subdet_dom_masks['dc'].append(dom_mask)
         else:
             subdet_doms['ic'].append(dom_coords)
-    for subdet in subdet_doms:
+            subdet_dom_masks['ic'].append(dom_mask)
+    for subdet in list(subdet_doms.keys()):
         dom_string_list = subdet_doms[subdet]
         if not dom_string_list:
             subdet_doms.pop(subdet)
+            subdet_dom_masks.pop(subdet)
         else:
             subdet_doms[subdet] = np.concatenate(dom_string_list, axis=0)
+            subdet_dom_masks[subdet] = np.concatenate(subdet_dom_masks[subdet], axis=0)
     geom = geom[string_indices, :, :][:, depth_indices, :]
-    geom_meta = generate_geom_meta(geom)
+    operational = operational[string_indices, :][:, depth_indices]
+    # Non-operational DOMs are moved far away for hashing purposes, so that
+    # tables made with different sets of operational DOMs are distinguished
+    geom_meta = generate_geom_meta(np.where(operational[..., np.newaxis], geom, 1e6))
     print('Geom uses strings %s, depth indices %s for a total of %d DOMs'
           % (list2hrlist([i+1 for i in string_indices]),
              list2hrlist(depth_indices),
@@ -325,161 +983,144 @@ def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
     print('Generating Cartesian time- and DOM-independent (TDI) Retro table')
     print('tdi_kw:', tdi_meta['kwargs'])
 
-    names = [
-        'survival_prob',
-        'avg_photon_x',
-        'avg_photon_y',
-        'avg_photon_z'
-    ]
+    if volume_x_lims is None:
+        volume_x_lims = x_lims
+    if volume_y_lims is None:
+        volume_y_lims = y_lims
+    if volume_z_lims is None:
+        volume_z_lims = z_lims
+    store_meta = generate_tdi_store_meta(
+        tdi_meta=tdi_meta,
+        volume_x_lims=volume_x_lims,
+        volume_y_lims=volume_y_lims,
+        volume_z_lims=volume_z_lims,
+    )
+    if store_dir is None:
+        store_dir = join(
+            tables_dir, TDI_STORE_DIRNAME_PROTO.format(store_hash=store_meta['store_hash'])
+        )
+    store_bin_edges = OrderedDict()
+    for dim, lims in zip('xyz', (volume_x_lims, volume_y_lims, volume_z_lims)):
+        n_vol_bins = int(np.round((lims[1] - lims[0]) / binwidth))
+        assert np.abs(lims[0] + n_vol_bins * binwidth - lims[1]) < 1e-6
+        store_bin_edges[dim] = lims[0] + binwidth * np.arange(n_vol_bins + 1)
+    store = create_tdi_store(
+        store_dir=store_dir,
+        bin_edges=store_bin_edges,
+        tile_shape=xyz_shape,
+        quantities=TDI_QUANTITIES,
+        dtype=np.float32,
+        meta=store_meta,
+    )
+    tile_idx = store.find_tile_for_lims(x_lims, y_lims, z_lims)
+    print('TDI store: "{}", tile {}'.format(store.store_dir, tile_idx))
+    print('')
+
     if not recompute_table:
-        for name in names:
-            fpath = join(tables_dir,
-                         '%s_%s.fits' % (tdi_meta['fbasename'], name))
-            if not isfile(fpath):
-                print('  Could not find table, will (re)compute\n%s\n' % fpath)
-                recompute_table = True
-                break
+        tile_meta = store.get_tile_meta(tile_idx)
+        if tile_meta is None:
+            print('  Could not find tile in TDI store, will (re)compute\n')
+            recompute_table = True
+        elif tile_meta.get('hash') != tdi_meta['hash']:
+            print(
+                '  Tile in TDI store has hash {} but expected {}, will recompute\n'
+                .format(tile_meta.get('hash'), tdi_meta['hash'])
+            )
+            recompute_table = True
 
     if not recompute_table:
         print('  Loading (x,y,z)-binned TDI Retro table from disk')
-        for name in names:
-            fpath = join(tables_dir,
-                         tdi_meta['fbasename'] + '_' + name + '.fits')
-            with fits.open(fpath) as fits_file:
-                tmp = fits_file[0].data # pylint: disable=no-member
-            if name == 'survival_prob':
-                binned_sp = tmp
-            elif name == 'avg_photon_x':
-                binned_px = tmp
-            elif name == 'avg_photon_y':
-                binned_py = tmp
-            elif name == 'avg_photon_z':
-                binned_pz = tmp
-            del tmp
         tdi_data = OrderedDict([ # pylint: disable=redefined-outer-name
-            ('binned_sp', binned_sp),
-            ('binned_px', binned_px),
-            ('binned_py', binned_py),
-            ('binned_pz', binned_pz),
+            ('binned_sp', np.array(store.get_tile('survival_prob', tile_idx))),
+            ('binned_px', np.array(store.get_tile('avg_photon_x', tile_idx))),
+            ('binned_py', np.array(store.get_tile('avg_photon_y', tile_idx))),
+            ('binned_pz', np.array(store.get_tile('avg_photon_z', tile_idx))),
             ('ind_arrays', ind_arrays),
             ('vol_arrays', vol_arrays),
             ('tdi_meta', tdi_meta),
-            ('binmap_meta', binmap_meta)
+            ('binmap_meta', binmap_meta),
+            ('store_dir', store.store_dir),
+            ('tile_idx', tile_idx),
         ])
         return tdi_data
 
-    # Instantiate arrays for aggregation of survival probabilities and
-    # averaging photon direction per Cartesian bin. Note that these start as 1D
-    # to speed indexing operations, then are reshaped into 3D at the end.
-    binned_spv = np.zeros((nx*ny*nz), dtype=np.float64)
-    binned_px_spv = np.zeros((nx*ny*nz), dtype=np.float64)
-    binned_py_spv = np.zeros((nx*ny*nz), dtype=np.float64)
-    binned_pz_spv = np.zeros((nx*ny*nz), dtype=np.float64)
-    binned_one_minus_sp = np.ones((nx*ny*nz), dtype=np.float64)
+    layers = [
+        (subdet, rel_idx, int(depth_idx))
+        for subdet in sorted(subdet_doms.keys())
+        for rel_idx, depth_idx in enumerate(depth_indices)
+    ]
+    layer_kw = dict(
+        tables_dir=tables_dir,
+        subdet_doms=subdet_doms,
+        subdet_dom_masks=subdet_dom_masks,
+        times=times,
+        ind_arrays=ind_arrays,
+        vol_arrays=vol_arrays,
+        n_rbins=n_rbins,
+        n_costhetabins=n_costhetabins,
+        r_max=r_max,
+        x_lims=x_lims,
+        y_lims=y_lims,
+        z_lims=z_lims,
+        binwidth=binwidth,
+        oversample=oversample,
+        threads=threads,
+        xyz_shape=xyz_shape,
+        quant_effs=dict(ic=ic_dom_quant_eff, dc=dc_dom_quant_eff),
+        exponents=dict(ic=ic_exponent, dc=dc_exponent),
+    )
 
     t00 = time.time()
-    for subdet, subdet_dom_coords in subdet_doms.items():
-        print('  Subdetector:', subdet)
-        print('  -> %d strings with DOM(s) at %d depths'
-              % (len(subdet_dom_coords), len(subdet_dom_coords[0])))
-        print('')
-
-        if subdet == 'ic':
-            dom_quant_eff = ic_dom_quant_eff
-            exponent = ic_exponent
-        elif subdet == 'dc':
-            dom_quant_eff = dc_dom_quant_eff
-            exponent = dc_exponent
+    if merge_partials:
+        partials = load_tdi_partials(
+            partials_dir=partials_dir, fbasename=tdi_meta['fbasename'], num_jobs=num_jobs
+        )
+        missing = set(layers).difference(partials['layers'])
+        if missing:
+            raise ValueError('Partials do not cover layers {}'.format(sorted(missing)))
+    else:
+        if num_jobs > 1:
+            layers = layers[job_idx::num_jobs]
+        if layer_partials_dir is None:
+            partials = compute_tdi_partials(layers=layers, procs=procs, layer_kw=layer_kw)
         else:
-            raise ValueError(str(subdet))
-
-        for rel_idx, depth_idx in enumerate(depth_indices):
-            print('    Subdetector: %s, depth_idx: %d' % (subdet, depth_idx))
-            dom_coords = subdet_dom_coords[:, rel_idx, :]
-
-            t0 = time.time()
-            table_fname = (
-                'retro_nevts1000'
-                '_{subdet:s}'
-                '_DOM{depth_idx:d}'
-                '_r_cz_t_angles'
-                '.fits'.format(
-                    subdet=subdet.upper(), depth_idx=depth_idx
-                )
-            )
-            # TODO: validate that bin edges match spec we're using
-            photon_info, _ = load_t_r_theta_table(
-                fpath=join(tables_dir, table_fname),
-                depth_idx=depth_idx,
-                scale=dom_quant_eff,
-                exponent=exponent
-            )
-            t1 = time.time()
-            print('    Time to load Retro DOM table: {} s'
-                  .format(np.round(t1 - t0, 3)))
-
-            sp = photon_info.survival_prob[depth_idx].astype(np.float64)
-            plength = photon_info.length[depth_idx].astype(np.float64)
-            ptheta = photon_info.theta[depth_idx].astype(np.float64)
-            pdeltaphi = photon_info.deltaphi[depth_idx].astype(np.float64)
-
-            plength *= np.cos(pdeltaphi)
-            pz = plength * np.cos(ptheta)
-            prho = plength * np.sin(ptheta)
-
-            # Marginalize out time, computing the probability of a photon
-            # starting at any one time being detected at any other time
-            t_indep_sp = 1 - np.prod(1 - sp[times], axis=0)
-
-            mask = t_indep_sp != 0
-            scale = 1 / sp.sum(axis=0)[mask]
-
-            t_indep_pz = np.zeros_like(t_indep_sp)
-            t_indep_prho = np.zeros_like(t_indep_sp)
-
-            t_indep_pz[mask] = (
-                (pz[times] * sp[times]).sum(axis=0)[mask] * scale
-            )
-            t_indep_prho[mask] = (
-                (prho[times] * sp[times]).sum(axis=0)[mask] * scale
+            partials = update_tdi_layer_partials(
+                layers=layers,
+                layer_kw=layer_kw,
+                layer_partials_dir=expand(layer_partials_dir),
+                common_signature=hash_items([
+                    ('tables_dir', expand(tables_dir)),
+                    ('binmap_hash', binmap_meta['hash']),
+                    ('times_str', times_str),
+                    ('lims', np.array([x_lims, y_lims, z_lims], dtype=np.float64)),
+                    ('binwidth', binwidth),
+                    ('oversample', oversample),
+                ]),
+                procs=procs,
             )
 
-            t2 = time.time()
-            print("    Time to reduce Retro DOM table's time dimension: {} s"
-                  .format(np.round(t2 - t1, 3)))
-
-            shift_and_bin(
-                ind_arrays=ind_arrays,
-                vol_arrays=vol_arrays,
-                dom_coords=dom_coords,
-                survival_prob=t_indep_sp,
-                prho=t_indep_prho,
-                pz=t_indep_pz,
-                nr=n_rbins,
-                ntheta=n_costhetabins,
-                r_max=r_max,
-                binned_spv=binned_spv,
-                binned_px_spv=binned_px_spv,
-                binned_py_spv=binned_py_spv,
-                binned_pz_spv=binned_pz_spv,
-                binned_one_minus_sp=binned_one_minus_sp,
-                x_min=x_lims[0],
-                y_min=y_lims[0],
-                z_min=z_lims[0],
-                x_max=x_lims[1],
-                y_max=y_lims[1],
-                z_max=z_lims[1],
-                binwidth=binwidth,
-                oversample=oversample,
-                anisotropy=None
+        if num_jobs > 1:
+            fpath = save_tdi_partials(
+                partials=partials,
+                partials_dir=partials_dir,
+                fbasename=tdi_meta['fbasename'],
+                job_idx=job_idx,
+                num_jobs=num_jobs,
             )
-            print('    %d surv probs are exactly 1'
-                  % np.sum(binned_one_minus_sp == 0))
-            t3 = time.time()
-            print('    Time to shift and bin: {} s'
-                  .format(np.round(t3 - t2, 3)))
-            print('')
+            print('Saved partial accumulators to "{}"; run with --merge-partials'
+                  ' once all {} jobs are done'.format(fpath, num_jobs))
+            return None
+
+    binned_spv = partials['binned_spv']
+    binned_px_spv = partials['binned_px_spv']
+    binned_py_spv = partials['binned_py_spv']
+    binned_pz_spv = partials['binned_pz_spv']
+    binned_one_minus_sp = np.where(
+        partials['binned_num_sp_one'] > 0, 0, np.exp(partials['binned_log_one_minus_sp'])
+    )
+    del partials
 
+    t3 = time.time()
     print('Total time to shift and bin: {} s'.format(np.round(t3 - t00, 3)))
     print('')
 
@@ -503,23 +1144,17 @@ def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
     print('Time to normalize histograms: {} s'.format(np.round(t4 - t3, 3)))
     print('')
 
-    arrays_names = [
-        (binned_sp, 'survival_prob'),
-        (binned_px, 'avg_photon_x'),
-        (binned_py, 'avg_photon_y'),
-        (binned_pz, 'avg_photon_z')
-    ]
-    for array, name in arrays_names:
-        fname = '%s_%s.fits' % (tdi_meta['fbasename'], name)
-        fpath = join(tables_dir, fname)
-        hdulist = fits.HDUList([
-            fits.PrimaryHDU(array.astype(np.float32)),
-            fits.ImageHDU(xyz_shape),
-            fits.ImageHDU(np.array([x_lims, y_lims, z_lims])),
-            fits.ImageHDU(geom)
-        ])
-        print('Saving %s to file\n%s\n' % (name, fpath))
-        hdulist.writeto(fpath, clobber=True)  # pylint: disable=unexpected-keyword-arg
+    print('Writing tile {} to TDI store "{}"\n'.format(tile_idx, store.store_dir))
+    store.write_tile(
+        tile_idx=tile_idx,
+        arrays=OrderedDict([
+            ('survival_prob', binned_sp),
+            ('avg_photon_x', binned_px),
+            ('avg_photon_y', binned_py),
+            ('avg_photon_z', binned_pz),
+        ]),
+        tile_meta=tdi_meta,
+    )
     t5 = time.time()
     print('Time to save tables to disk: {} s'.format(np.round(t5 - t4, 3)))
     print('')
@@ -534,7 +1169,9 @@ def generate_tdi_table(tables_dir, geom_fpath, dom_tables_hash, n_phibins,
         ('ind_arrays', ind_arrays),
         ('vol_arrays', vol_arrays),
         ('tdi_meta', tdi_meta),
-        ('binmap_meta', binmap_meta)
+        ('binmap_meta', binmap_meta),
+        ('store_dir', store.store_dir),
+        ('tile_idx', tile_idx),
     ])
     return tdi_data
 
@@ -547,8 +1184,20 @@ def parse_args(description=__doc__):
         help='Path to eirectory containing Retro tables'
     )
     parser.add_argument(
-        '--geom-fpath', required=True,
-        help='Path to geometry NPY file'
+        '--geom-fpath', default=None,
+        help='Path to geometry NPY file; required if --gcd is not specified'
+    )
+    parser.add_argument(
+        '--gcd', default=None,
+        help='''GCD file (i3 or extracted pkl) from which to take DOM
+        positions and operational status (DOMs with zero or non-finite RDE
+        are excluded)'''
+    )
+    parser.add_argument(
+        '--layer-partials-dir', default=None,
+        help='''Store per-(subdet, depth) partial accumulators here and reuse
+        them in subsequent runs, recomputing only layers whose DOMs changed
+        (e.g. when running with a new --gcd)'''
     )
     parser.add_argument(
         '--dom-tables-hash', default=None,
@@ -606,6 +1255,26 @@ def parse_args(description=__doc__):
         '--z-lims', nargs=2, type=float, required=True,
         help='''Limits of the produced table in the z-direction (meters)'''
     )
+    parser.add_argument(
+        '--volume-x-lims', nargs=2, type=float, default=None,
+        help='''Limits in the x-direction of the full volume of the TDI store
+        that the produced table is a tile of (meters); defaults to --x-lims'''
+    )
+    parser.add_argument(
+        '--volume-y-lims', nargs=2, type=float, default=None,
+        help='''Limits in the y-direction of the full volume of the TDI store
+        (meters); defaults to --y-lims'''
+    )
+    parser.add_argument(
+        '--volume-z-lims', nargs=2, type=float, default=None,
+        help='''Limits in the z-direction of the full volume of the TDI store
+        (meters); defaults to --z-lims'''
+    )
+    parser.add_argument(
+        '--store-dir', default=None,
+        help='''TDI store directory; defaults to a directory within
+        --tables-dir named after the hash of the store's parameters'''
+    )
     parser.add_argument(
         '--binwidth', type=float, required=True,
         help='''Binwidth in x, y, and z directions (meters). Must divide each
@@ -679,6 +1348,35 @@ def parse_args(description=__doc__):
         help='''Recompute the Retro time- and DOM-independent (TDI) table even
         if the corresponding files exist; these files will be overwritten.'''
     )
+    parser.add_argument(
+        '--procs', type=int, default=1,
+        help='''Number of processes among which to split the (subdet, depth)
+        layers of DOMs'''
+    )
+    parser.add_argument(
+        '--threads', type=int, default=1,
+        help='''Number of threads among which to split each layer's DOMs when
+        shifting and binning; 1 uses the serial implementation and values <= 0
+        use all cores'''
+    )
+    parser.add_argument(
+        '--num-jobs', type=int, default=1,
+        help='''Split the work among this many jobs (e.g. on a cluster); each
+        job must be run with a distinct --job-idx, followed by a final run
+        with --merge-partials'''
+    )
+    parser.add_argument(
+        '--job-idx', type=int, default=None,
+    )
+    parser.add_argument(
+        '--partials-dir', default=None,
+        help='''Directory in which jobs store their partial accumulators'''
+    )
+    parser.add_argument(
+        '--merge-partials', action='store_true',
+        help='''Combine the partial accumulators from all --num-jobs jobs and
+        write the TDI table'''
+    )
 
     kwargs = vars(parser.parse_args())
 
@@ -13,6 +13,7 @@ __all__ = [
     'StepSpacing',
     'LLHChoice',
     'MACHINE_EPS',
+    'LOOKUP_TRACE_FIELDS',
     'MAX_RAD_SQ',
     'SCALE_FACTOR_MINIMIZER',
     'PEGLEG_SPACING',
@@ -52,6 +53,7 @@ if __name__ == '__main__' and __package__ is None:
 from retro import DFLT_NUMBA_JIT_KWARGS, numba_jit
 from retro.const import SPEED_OF_LIGHT_M_PER_NS, SRC_OMNI, SRC_CKV_BETA1
 from retro.utils.geom import generate_digitizer
+from retro.tables.sparse_tdi import generate_sparse_tdi_lookup
 from retro.hypo.discrete_cascade_kernels import SCALING_CASCADE_ENERGY
 
 
@@ -73,6 +75,16 @@ class StepSpacing(enum.IntEnum):
 
 MACHINE_EPS = 1e-10
 
+LOOKUP_TRACE_FIELDS = (
+    'table_idx',
+    'r_bin_idx',
+    'costheta_bin_idx',
+    't_bin_idx',
+    'costhetadir_bin_idx',
+    'deltaphidir_bin_idx',
+)
+"""Columns of the `lookup_trace` filled by `generate_pexp_and_llh_functions`"""
+
 MAX_RAD_SQ = 500**2
 """Maximum radius to consider, squared (units of m^2)"""
 
@@ -104,10 +116,28 @@ USE_JITTER = True
 """Whether to use a crude jitter implementation"""
 
 
+def _stack_tables(tables):
+    """Stack tables into a single array like `np.stack`, except that tables
+    which are `retro.tables.chunked_tables.ChunkedArrayReader`s are
+    decompressed directly into the stacked array"""
+    if not any(hasattr(table, 'to_array') for table in tables):
+        return np.stack(tables, axis=0)
+    first = tables[0]
+    stacked = np.empty(shape=(len(tables),) + tuple(first.shape), dtype=first.dtype)
+    for table_idx, table in enumerate(tables):
+        if hasattr(table, 'to_array'):
+            table.to_array(out=stacked[table_idx])
+            table.close()
+        else:
+            stacked[table_idx] = table
+    return stacked
+
+
 def generate_pexp_and_llh_functions(
     dom_tables,
     tdi_tables=None,
     tdi_metas=None,
+    lookup_trace=None,
 ):
     """Generate a numba-compiled function for computing expected photon counts
     at a DOM, where the table's binning info is used to pre-compute various
@@ -120,7 +150,10 @@ def generate_pexp_and_llh_functions(
         time-independent)
 
     tdi_tables : sequence of 1 or 2 arrays, optional
-        Time- and DOM-independent tables.
+        Time- and DOM-independent tables. Alternatively, a single sparse TDI
+        table (the tuple of arrays returned by
+        `retro.tables.sparse_tdi.load_sparse_tdi`), which replaces both the
+        finely- and coarsely-binned tables.
 
     tdi_metas : sequence of 1 or 2 mappings, optional
         If provided, sequence must contain two mappings where the first
@@ -131,7 +164,20 @@ def generate_pexp_and_llh_functions(
         and "phidir"; values of these are arrays of the bin edges in each of
         these dimensions. "costhetadir" must span [-1, 1] (inclusive) and
         "phidir" must span [-pi, pi] inclusive). All edges must be strictly
-        monotonic and increasing.
+        monotonic and increasing. For a sparse TDI table, the single mapping
+        must also contain "sparse" = True and the keys written by
+        `retro.tables.sparse_tdi.build_sparse_tdi`.
+
+    lookup_trace : tuple of two arrays, optional
+        If provided, the returned functions do not look up the time-dependent
+        tables but instead record the lookups they would have performed. The
+        first array must be an integer array of shape (max_trace_len,
+        len(LOOKUP_TRACE_FIELDS)) that is filled with one row per directional
+        lookup (directionality-averaged lookups are not recorded) and the
+        second a shape-(1,) int64 array holding the number of lookups
+        performed so far (which can exceed `max_trace_len`, in which case the
+        lookups beyond the first `max_trace_len` are not recorded). Every
+        lookup returns 1. Time-independent tables are used as normal.
 
     Returns
     -------
@@ -171,7 +217,7 @@ def generate_pexp_and_llh_functions(
         meta['table_binning'][key] = dom_tables.table_meta[key]
 
     meta['tdi'] = tdi_metas
-    if len(tdi_tables) == 1:
+    if len(tdi_tables) == 1 and not (tdi_metas and tdi_metas[0].get('sparse', False)):
         tdi_tables = (tdi_tables[0], tdi_tables[0])
 
     # NOTE: For now, we only support absolute value of deltaphidir (which
@@ -212,9 +258,39 @@ def generate_pexp_and_llh_functions(
     )
 
     num_tdi_tables = len(tdi_metas)
+    tdi_is_sparse = num_tdi_tables > 0 and bool(tdi_metas[0].get('sparse', False))
     if num_tdi_tables == 0:
         # Numba needs an object that it can determine type of
         tdi_tables = 0
+
+    elif tdi_is_sparse:
+        if num_tdi_tables != 1:
+            raise ValueError(
+                'A sparse TDI table replaces all other TDI tables; got {}'
+                ' tables'.format(num_tdi_tables)
+            )
+        # Sparse table is passed as the tuple of its arrays
+        tdi_tables = tuple(tdi_tables[0])
+        sparse_tdi_lookup = generate_sparse_tdi_lookup(tdi_metas[0])
+        digitize_tdi_costhetadir = generate_digitizer(
+            tdi_metas[0]['bin_edges']['costhetadir'], clip=True
+        )
+        digitize_tdi_phidir = generate_digitizer(
+            tdi_metas[0]['bin_edges']['phidir'], clip=True
+        )
+
+        @numba_jit(**DFLT_NUMBA_JIT_KWARGS)
+        def tdi_lookup(tdi_tables, x, y, z, costhetadir, phidir):
+            """Look up sparse TDI table; 0 outside its volume"""
+            return sparse_tdi_lookup(
+                tdi_tables,
+                x,
+                y,
+                z,
+                digitize_tdi_costhetadir(costhetadir),
+                digitize_tdi_phidir(phidir),
+            )
+
     else:
         x_edges = tdi_metas[0]['bin_edges']['x']
         y_edges = tdi_metas[0]['bin_edges']['y']
@@ -258,6 +334,36 @@ def generate_pexp_and_llh_functions(
             tdi_metas[idx]['bin_edges']['phidir'], clip=True
         )
 
+        @numba_jit(**DFLT_NUMBA_JIT_KWARGS)
+        def tdi_lookup(tdi_tables, x, y, z, costhetadir, phidir):
+            """Look up finely-binned TDI table if it contains (x, y, z), else
+            coarsely-binned table; 0 outside both"""
+            if (
+                tdi0_xmin <= x <= tdi0_xmax
+                and tdi0_ymin <= y <= tdi0_ymax
+                and tdi0_zmin <= z <= tdi0_zmax
+            ):
+                return tdi_tables[0][
+                    digitize_tdi0_x(x),
+                    digitize_tdi0_y(y),
+                    digitize_tdi0_z(z),
+                    digitize_tdi0_costhetadir(costhetadir),
+                    digitize_tdi0_phidir(phidir),
+                ]
+            if num_tdi_tables >= 2 and (
+                tdi1_xmin <= x <= tdi1_xmax
+                and tdi1_ymin <= y <= tdi1_ymax
+                and tdi1_zmin <= z <= tdi1_zmax
+            ):
+                return tdi_tables[1][
+                    digitize_tdi1_x(x),
+                    digitize_tdi1_y(y),
+                    digitize_tdi1_z(z),
+                    digitize_tdi1_costhetadir(costhetadir),
+                    digitize_tdi1_phidir(phidir),
+                ]
+            return 0.
+
     dom_tables_ = dom_tables
 
     dom_tables = dom_tables_.tables
@@ -267,22 +373,29 @@ def generate_pexp_and_llh_functions(
     t_indep_dom_table_norms = dom_tables_.t_indep_table_norms
     t_is_residual_time = dom_tables_.t_is_residual_time
 
-    if not isinstance(dom_tables, np.ndarray):
-        dom_tables = np.stack(dom_tables, axis=0)
+    if lookup_trace is not None:
+        # Functions are passed the trace in place of the tables, so don't
+        # load the tables into memory
+        dom_tables = tuple(lookup_trace)
+        meta['lookup_trace'] = True
+    elif not isinstance(dom_tables, np.ndarray):
+        dom_tables = _stack_tables(dom_tables)
         print('dom_tables.shape:', dom_tables.shape)
     if not isinstance(dom_table_norms, np.ndarray):
         dom_table_norms = np.stack(dom_table_norms, axis=0)
         print('dom_table_norms.shape:', dom_table_norms.shape)
     if not isinstance(t_indep_dom_tables, np.ndarray):
-        t_indep_dom_tables = np.stack(t_indep_dom_tables, axis=0)
+        t_indep_dom_tables = _stack_tables(t_indep_dom_tables)
         print('t_indep_dom_tables.shape:', t_indep_dom_tables.shape)
     if not isinstance(t_indep_dom_table_norms, np.ndarray):
         t_indep_dom_table_norms = np.stack(t_indep_dom_table_norms, axis=0)
         print('t_indep_dom_table_norms.shape:', t_indep_dom_table_norms.shape)
 
-    dom_tables.flags.writeable = False
+    if lookup_trace is None:
+        dom_tables.flags.writeable = False
     dom_table_norms.flags.writeable = False
-    dom_tables_template_library.flags.writeable = False
+    if dom_tables_template_library is not None:
+        dom_tables_template_library.flags.writeable = False
     t_indep_dom_tables.flags.writeable = False
     t_indep_dom_table_norms.flags.writeable = False
 
@@ -299,7 +412,32 @@ def generate_pexp_and_llh_functions(
     num_jitter_time_offsets = len(jitter_dt)
 
     # Indexing functions for table types omni / directional lookups
-    if tbl_is_templ_compr:
+    if lookup_trace is not None:
+        @numba_jit(**DFLT_NUMBA_JIT_KWARGS)
+        def table_lookup_mean(
+            tables, table_idx, r_bin_idx, costheta_bin_idx, t_bin_idx
+        ): # pylint: disable=missing-docstring, unused-argument
+            return 1.
+
+        @numba_jit(**DFLT_NUMBA_JIT_KWARGS)
+        def table_lookup(
+            tables, table_idx, r_bin_idx, costheta_bin_idx, t_bin_idx,
+            costhetadir_bin_idx, deltaphidir_bin_idx
+        ): # pylint: disable=missing-docstring
+            trace = tables[0]
+            trace_len = tables[1]
+            row = trace_len[0]
+            if row < trace.shape[0]:
+                trace[row, 0] = table_idx
+                trace[row, 1] = r_bin_idx
+                trace[row, 2] = costheta_bin_idx
+                trace[row, 3] = t_bin_idx
+                trace[row, 4] = costhetadir_bin_idx
+                trace[row, 5] = deltaphidir_bin_idx
+            trace_len[0] = row + 1
+            return 1.
+
+    elif tbl_is_templ_compr:
         @numba_jit(**DFLT_NUMBA_JIT_KWARGS)
         def table_lookup_mean(
             tables, table_idx, r_bin_idx, costheta_bin_idx, t_bin_idx
@@ -625,32 +763,14 @@ def generate_pexp_and_llh_functions(
                 src_opposite_dir_costheta = -src['dir_costheta']
                 src_opposite_dir_phi = ((src['dir_phi'] + 2*np.pi) % (2*np.pi)) - np.pi
 
-                if (
-                    tdi0_xmin <= src['x'] <= tdi0_xmax
-                    and tdi0_ymin <= src['y'] <= tdi0_ymax
-                    and tdi0_zmin <= src['z'] <= tdi0_zmax
-                ):
-                    t_indep_exp += 0.45 * src['photons'] * tdi_tables[0][
-                        digitize_tdi0_x(src['x']),
-                        digitize_tdi0_y(src['y']),
-                        digitize_tdi0_z(src['z']),
-                        digitize_tdi0_costhetadir(src_opposite_dir_costheta),
-                        digitize_tdi0_phidir(src_opposite_dir_phi),
-                    ]
-                elif num_tdi_tables >= 2 and (
-                    tdi1_xmin <= src['x'] <= tdi1_xmax
-                    and tdi1_ymin <= src['y'] <= tdi1_ymax
-                    and tdi1_zmin <= src['z'] <= tdi1_zmax
-                ):
-                    t_indep_exp += 0.45 * src['photons'] * tdi_tables[1][
-                        digitize_tdi1_x(src['x']),
-                        digitize_tdi1_y(src['y']),
-                        digitize_tdi1_z(src['z']),
-                        digitize_tdi1_costhetadir(src_opposite_dir_costheta),
-                        digitize_tdi1_phidir(src_opposite_dir_phi),
-                    ]
-                else:
-                    continue
+                t_indep_exp += 0.45 * src['photons'] * tdi_lookup(
+                    tdi_tables,
+                    src['x'],
+                    src['y'],
+                    src['z'],
+                    src_opposite_dir_costheta,
+                    src_opposite_dir_phi,
+                )
 
             # -- Time-dependent photon-det expectation for each hit DOM -- #
 
@@ -8,7 +8,7 @@ Convert deltaphidir to absdeltaphidir
 
 from __future__ import absolute_import, division, print_function
 
-__all__ = ["deltaphidir_to_absdeltaphidir", "main"]
+__all__ = ["get_absdeltaphidir_binning", "deltaphidir_to_absdeltaphidir", "main"]
 
 __author__ = "J.L. Lanfranchi"
 
@@ -36,37 +36,30 @@ if __name__ == "__main__" and __package__ is None:
     RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
     if RETRO_DIR not in sys.path:
         sys.path.append(RETRO_DIR)
+from retro.tables.chunked_reduce import (
+    DFLT_CHUNK_NBYTES, AxisLinearMap, Product, reduce_table, save_binning
+)
 from retro.utils.misc import expand, mkdir
 
 
-def deltaphidir_to_absdeltaphidir(input_file, output_file):
-    """
+def get_absdeltaphidir_binning(input_binning, dim_name="deltaphidir"):
+    """Binning after folding deltaphidir into abs(deltaphidir), and the
+    linear map taking input deltaphidir bins to output bins.
+
     Parameters
     ----------
-    input_file : str
-        Path to input file (table)
+    input_binning : structured numpy.ndarray
+    dim_name : str, optional
 
-    output_file : str
-        Path to output file (table)
+    Returns
+    -------
+    output_binning : structured numpy.ndarray
+    dim_num : int
+        Axis of `dim_name` in the table
+    matrix : shape (n_output_bins, n_input_bins) array
+        Fraction of each input bin falling in each output bin
 
     """
-    dim_name = "deltaphidir"
-
-    input_file = expand(input_file)
-    output_file = expand(output_file)
-
-    input_dir = dirname(input_file)
-    output_dir = dirname(output_file)
-
-    if abspath(output_dir) == abspath(input_dir):
-        raise ValueError("Will not allow output dir to be same as input dir")
-
-    if not isdir(output_dir):
-        mkdir(output_dir)
-
-    input_table = np.load(input_file, mmap_mode="r")
-    input_binning = np.load(join(input_dir, "binning.npy"))
-
     dim_num = list(input_binning.dtype.names).index(dim_name)
 
     output_dtype_spec = []
@@ -96,10 +89,10 @@ def deltaphidir_to_absdeltaphidir(input_file, output_file):
 
     output_binning = np.array(tuple(output_bin_edges), dtype=output_dtype_spec)
 
-    output_shape = tuple(dim_spec[2][0] - 1 for dim_spec in output_binning.dtype.descr)
-    output_table = np.zeros(shape=output_shape, dtype=np.float64)
-
-    mapping = []
+    matrix = np.zeros(
+        shape=(len(output_binning[dim_name]) - 1, len(input_binning[dim_name]) - 1),
+        dtype=np.float64,
+    )
 
     for input_bin_idx, (input_le, input_ue) in enumerate(
         zip(input_binning[dim_name][:-1], input_binning[dim_name][1:])
@@ -109,8 +102,6 @@ def deltaphidir_to_absdeltaphidir(input_file, output_file):
         for output_bin_idx, (output_le, output_ue) in enumerate(
             zip(output_binning[dim_name][:-1], output_binning[dim_name][1:])
         ):
-            overlap_fract = 0.
-
             for sign in [-1, +1]:
                 if sign > 0:
                     actual_output_le = output_le
@@ -131,35 +122,58 @@ def deltaphidir_to_absdeltaphidir(input_file, output_file):
 
                 overlap_fract = np.diff(input_clipped_rel_edges)[0] / input_wid
                 if overlap_fract > 0:
-                    dupe_idx = None
-                    for idx, (obi, ibi, ofr) in enumerate(mapping):
-                        if obi == output_bin_idx and ibi == input_bin_idx:
-                            dupe_idx = idx
-                            overlap_fract += ofr
-                    entry = (output_bin_idx, input_bin_idx, overlap_fract)
-                    if dupe_idx is None:
-                        mapping.append(entry)
-                    else:
-                        mapping[dupe_idx] = entry
-
-    output_slicer = [slice(None) for _ in output_binning.dtype.names]
-    input_slicer = [slice(None) for _ in input_binning.dtype.names]
-
-    for output_bin_idx, input_bin_idx, overlap_fract in mapping:
-        output_slicer[dim_num] = output_bin_idx
-        input_slicer[dim_num] = input_bin_idx
-        output_table[output_slicer] += overlap_fract * input_table[input_slicer]
+                    matrix[output_bin_idx, input_bin_idx] += overlap_fract
 
-    # Save the binning to the output directory
-    np.save(join(output_dir, "binning.npy"), output_binning)
+    return output_binning, dim_num, matrix
 
-    # Legacy way of storing bin edges: store each dim individually
-    for d_name in output_binning.dtype.names:
-        bin_edges_fpath = join(output_dir, "{}_bin_edges.npy".format(d_name))
-        np.save(bin_edges_fpath, output_binning[d_name])
 
-    # Save the table
-    np.save(output_file, output_table)
+def deltaphidir_to_absdeltaphidir(input_file, output_file, chunk_nbytes=DFLT_CHUNK_NBYTES):
+    """
+    Parameters
+    ----------
+    input_file : str
+        Path to input file (table)
+
+    output_file : str
+        Path to output file (table)
+
+    chunk_nbytes : int, optional
+        Approximate size of blocks of the input table processed at a time; see
+        `retro.tables.chunked_reduce.reduce_table`
+
+    """
+    input_file = expand(input_file)
+    output_file = expand(output_file)
+
+    input_dir = dirname(input_file)
+    output_dir = dirname(output_file)
+
+    if abspath(output_dir) == abspath(input_dir):
+        raise ValueError("Will not allow output dir to be same as input dir")
+
+    if not isdir(output_dir):
+        mkdir(output_dir)
+
+    input_table = np.load(input_file, mmap_mode="r")
+    input_binning = np.load(join(input_dir, "binning.npy"))
+
+    output_binning, dim_num, matrix = get_absdeltaphidir_binning(input_binning)
+
+    # Save the binning to the output directory
+    save_binning(output_dir, output_binning)
+
+    # Rebin block by block into the memory-mapped output table
+    reduce_table(
+        table=input_table,
+        products={
+            "table": Product(
+                steps=[AxisLinearMap(dim_num, matrix)],
+                fpath=output_file,
+                dtype=np.float64,
+            )
+        },
+        chunk_nbytes=chunk_nbytes,
+    )
 
 
 def main(description=__doc__):
@@ -167,6 +181,10 @@ def main(description=__doc__):
     parser = ArgumentParser(description=description)
     parser.add_argument("--input-file", required=True, help="Input table")
     parser.add_argument("--output-file", required=True, help="Output file")
+    parser.add_argument(
+        "--chunk-nbytes", type=int, default=DFLT_CHUNK_NBYTES,
+        help="Approximate size of blocks of the input table processed at a time",
+    )
     args = parser.parse_args()
     kwargs = vars(args)
     deltaphidir_to_absdeltaphidir(**kwargs)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position
+
+"""
+Prefetch the regions of memory-mapped single-DOM tables that an event's
+likelihood evaluations are going to touch, so that the first evaluations do not
+incur page faults one at a time.
+
+Regions are found from the DOMs' positions and a spatial (x, y, z) extent
+that the event's light sources are expected to lie within (the bounding box of
+the event's hit DOMs, enlarged by a margin): only those r-bins of each table are
+prefetched that lie within the range of distances between any of the table's
+DOMs and that volume. Pages are requested via ``madvise(MADV_WILLNEED)`` where
+available (Python >= 3.8 on Linux/BSD/macOS) and otherwise touched, in a
+background thread.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'PAGE_SIZE',
+    'DFLT_PREFETCH_MARGIN',
+    'get_hit_doms_extent',
+    'get_r_bin_ranges',
+    'prefetch_array',
+    'TablePrefetcher',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from collections import OrderedDict
+import mmap
+from os.path import abspath, dirname
+import sys
+import threading
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+
+
+PAGE_SIZE = mmap.PAGESIZE
+
+MADV_WILLNEED = getattr(mmap, 'MADV_WILLNEED', None)
+
+
+DFLT_PREFETCH_MARGIN = 200.
+"""Default distance (m) by which the bounding box of an event's hit DOMs is
+enlarged in each direction to find the volume its light sources (and hence the
+hypotheses evaluated in reconstructing it) lie within"""
+
+
+def get_hit_doms_extent(event_dom_info):
+    """Get the spatial extent of the DOMs that were hit in an event.
+
+    Parameters
+    ----------
+    event_dom_info : array of dtype EVT_DOM_INFO_T
+
+    Returns
+    -------
+    extent : tuple of three (low, high) tuples or None
+        Extent in (x, y, z); None if no DOM was hit
+
+    """
+    hit_doms = event_dom_info[event_dom_info['total_observed_charge'] > 0]
+    if len(hit_doms) == 0:
+        return None
+    return tuple(
+        (float(np.min(hit_doms[dim])), float(np.max(hit_doms[dim])))
+        for dim in ('x', 'y', 'z')
+    )
+
+
+def get_r_bin_ranges(event_dom_info, r_bin_edges, extent=None, margin=0.):
+    """Find the range of r-bins of each table that can be accessed by sources
+    located within `extent`.
+
+    Parameters
+    ----------
+    event_dom_info : array of dtype EVT_DOM_INFO_T
+    r_bin_edges : 1D array
+    extent : tuple of three (low, high) tuples, optional
+        Extent in (x, y, z); if not specified, all r-bins are used
+    margin : float >= 0, optional
+        Enlarge `extent` by this much in each direction (e.g. to account for
+        light sources some distance away from the hit DOMs)
+
+    Returns
+    -------
+    r_bin_ranges : OrderedDict
+        Keys are table indices and values are (start, stop) r-bin slices
+
+    """
+    num_r_bins = len(r_bin_edges) - 1
+    table_indices = event_dom_info['table_idx'].astype(np.int64)
+
+    if extent is None:
+        starts = np.zeros_like(table_indices)
+        stops = np.full_like(table_indices, num_r_bins)
+    else:
+        low = np.array([e[0] for e in extent], dtype=np.float64) - margin
+        high = np.array([e[1] for e in extent], dtype=np.float64) + margin
+        pos = np.stack(
+            [event_dom_info[dim].astype(np.float64) for dim in ('x', 'y', 'z')],
+            axis=1,
+        )
+        nearest = np.clip(pos, low, high)
+        farthest = np.where(pos - low > high - pos, low, high)
+        r_min = np.sqrt(np.sum((pos - nearest)**2, axis=1))
+        r_max = np.sqrt(np.sum((pos - farthest)**2, axis=1))
+        starts = np.clip(
+            np.searchsorted(r_bin_edges, r_min, side='right') - 1, 0, num_r_bins
+        )
+        stops = np.clip(np.searchsorted(r_bin_edges, r_max, side='right'), 0, num_r_bins)
+
+    r_bin_ranges = OrderedDict()
+    for table_idx, start, stop in zip(table_indices, starts, stops):
+        if stop <= start:
+            continue
+        if table_idx in r_bin_ranges:
+            prev_start, prev_stop = r_bin_ranges[table_idx]
+            start, stop = min(start, prev_start), max(stop, prev_stop)
+        r_bin_ranges[table_idx] = (int(start), int(stop))
+
+    return r_bin_ranges
+
+
+def prefetch_array(array):
+    """Ask the OS to read the pages backing a (contiguous) memory-mapped array.
+
+    Arrays that are not memory mapped are left alone.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+
+    """
+    mm = getattr(array, '_mmap', None)
+    if mm is None or array.nbytes == 0:
+        return
+
+    if MADV_WILLNEED is not None and array.flags.c_contiguous:
+        mm_start = np.frombuffer(mm, dtype=np.uint8).__array_interface__['data'][0]
+        start = array.__array_interface__['data'][0] - mm_start
+        aligned_start = start - start % PAGE_SIZE
+        mm.madvise(MADV_WILLNEED, aligned_start, start - aligned_start + array.nbytes)
+    else:
+        # Read one byte per page
+        flat = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+        np.sum(flat[::PAGE_SIZE])
+
+
+class TablePrefetcher(object):
+    """Prefetch regions of memory-mapped tables in a background thread.
+
+    Safe to share among threads reconstructing events concurrently (see
+    `retro.reco.Reco.reco_frames`): a prefetch only abandons the prefetch
+    previously issued by the same thread, so concurrently reconstructed events
+    are prefetched concurrently.
+
+    Parameters
+    ----------
+    dom_tables : Retro5DTables
+    margin : float >= 0, optional
+        See `get_r_bin_ranges`
+
+    """
+    def __init__(self, dom_tables, margin=DFLT_PREFETCH_MARGIN):
+        self.dom_tables = dom_tables
+        self.margin = margin
+        self._prefetches = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, event_dom_info, extent=None, block=False):
+        """Prefetch the table regions an event will touch. Any prefetch
+        issued by the calling thread that is still in progress is abandoned.
+
+        Parameters
+        ----------
+        event_dom_info : array of dtype EVT_DOM_INFO_T
+        extent : tuple of three (low, high) tuples, optional
+            See `get_r_bin_ranges`
+        block : bool, optional
+            Wait for the prefetch to complete before returning
+
+        """
+        self.cancel()
+
+        dom_tables = self.dom_tables
+        r_bin_ranges = get_r_bin_ranges(
+            event_dom_info=event_dom_info,
+            r_bin_edges=dom_tables.table_meta['r_bin_edges'],
+            extent=extent,
+            margin=self.margin,
+        )
+        use_t_indep = len(dom_tables.t_indep_tables) > 0
+        regions = []
+        for table_idx, (start, stop) in r_bin_ranges.items():
+            regions.append(dom_tables.tables[table_idx][start:stop])
+            if use_t_indep:
+                regions.append(dom_tables.t_indep_tables[table_idx][start:stop])
+
+        stop_event = threading.Event()
+        thread = threading.Thread(
+            target=self._prefetch_regions,
+            args=(regions, stop_event),
+            name='retro-table-prefetch',
+        )
+        thread.daemon = True
+        with self._lock:
+            self._prefetches[threading.current_thread().ident] = (thread, stop_event)
+        thread.start()
+        if block:
+            thread.join()
+
+    def cancel(self, all_threads=False):
+        """Stop the prefetch issued by the calling thread (or, if
+        `all_threads`, by any thread) and wait for it to exit"""
+        with self._lock:
+            if all_threads:
+                prefetches = list(self._prefetches.values())
+                self._prefetches.clear()
+            else:
+                prefetch = self._prefetches.pop(threading.current_thread().ident, None)
+                prefetches = [] if prefetch is None else [prefetch]
+        for thread, stop_event in prefetches:
+            stop_event.set()
+            thread.join()
+
+    @staticmethod
+    def _prefetch_regions(regions, stop_event):
+        for region in regions:
+            if stop_event.is_set():
+                return
+            prefetch_array(region)
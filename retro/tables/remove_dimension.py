@@ -8,7 +8,7 @@ Remove a dimension from a table.
 
 from __future__ import absolute_import, division, print_function
 
-__all__ = ["remove_dimension", "main"]
+__all__ = ["get_removed_dim_binning", "remove_dimension", "main"]
 
 __author__ = "J.L. Lanfranchi"
 
@@ -27,8 +27,7 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 from argparse import ArgumentParser
-from os import remove
-from os.path import abspath, dirname, isdir, isfile, join
+from os.path import abspath, dirname, isdir, join
 import sys
 
 import numpy as np
@@ -37,10 +36,45 @@ if __name__ == "__main__" and __package__ is None:
     RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
     if RETRO_DIR not in sys.path:
         sys.path.append(RETRO_DIR)
+from retro.tables.chunked_reduce import (
+    DFLT_CHUNK_NBYTES, Product, SumAxis, reduce_table, save_binning
+)
 from retro.utils.misc import expand, mkdir
 
 
-def remove_dimension(input_file, output_file, dim_name):
+def get_removed_dim_binning(input_binning, dim_name):
+    """Binning after removing a dimension.
+
+    Parameters
+    ----------
+    input_binning : structured numpy.ndarray
+    dim_name : str
+
+    Returns
+    -------
+    output_binning : structured numpy.ndarray
+    dim_num : int
+        Axis of the removed dimension in the input table
+
+    """
+    names = list(input_binning.dtype.names)
+    if dim_name not in names:
+        raise ValueError(
+            'Dimension "{}" not in binning dimensions {}'.format(dim_name, names)
+        )
+    dim_num = names.index(dim_name)
+    # Copy fields individually (rather than indexing with a list of field
+    # names) so the output has no padding where the removed field was
+    output_binning = np.empty(
+        shape=input_binning.shape,
+        dtype=[(n, input_binning.dtype.fields[n][0]) for n in names if n != dim_name],
+    )
+    for name in output_binning.dtype.names:
+        output_binning[name] = input_binning[name]
+    return output_binning, dim_num
+
+
+def remove_dimension(input_file, output_file, dim_name, chunk_nbytes=DFLT_CHUNK_NBYTES):
     """
     Parameters
     ----------
@@ -53,6 +87,10 @@ def remove_dimension(input_file, output_file, dim_name):
     dim_name : str
         Dimension to remove from the intput table
 
+    chunk_nbytes : int, optional
+        Approximate size of blocks of the input table processed at a time; see
+        `retro.tables.chunked_reduce.reduce_table`
+
     """
     input_file = expand(input_file)
     output_file = expand(output_file)
@@ -69,37 +107,22 @@ def remove_dimension(input_file, output_file, dim_name):
     input_table = np.load(input_file, mmap_mode="r")
     input_binning = np.load(join(input_dir, "binning.npy"))
 
-    dim_num = [i for i, n in enumerate(input_binning.dtype.names) if n == dim_name][0]
-    output_binning = input_binning[
-        [n for n in input_binning.dtype.names if n != dim_name]
-    ]
-
-    # Save the binning to the output directory
-    np.save(join(output_dir, "binning.npy"), output_binning)
-
-    # Legacy way of storing bin edges: store each dim individually
-    for d_name in output_binning.dtype.names:
-        bin_edges_fpath = join(output_dir, "{}_bin_edges.npy".format(d_name))
-        np.save(bin_edges_fpath, output_binning[d_name])
-
-    # If we find the removed dimension's bin edges in output dir, remove that file
-    bin_edges_fpath = join(output_dir, "{}_bin_edges.npy".format(dim_name))
-    if isfile(bin_edges_fpath):
-        remove(bin_edges_fpath)
-
-    output_shape = tuple(n for i, n in enumerate(input_table.shape) if i != dim_num)
-    output_table = np.empty(shape=output_shape, dtype=input_table.dtype)
-    #output_table = np.memmap(
-    #    output_file, dtype=input_table.dtype, mode="w+", shape=output_shape
-    #)
-
-    # Perform the summation over the dimension to be removed
-
-    # Note that setting dtype to float64 causes accumulator to be double
-    # precision, even if output table is not
-    input_table.sum(axis=dim_num, dtype=np.float64, out=output_table)
-
-    np.save(output_file, output_table)
+    output_binning, dim_num = get_removed_dim_binning(input_binning, dim_name)
+
+    # Save the binning to the output directory (removing the removed
+    # dimension's legacy bin edges file if found there)
+    save_binning(output_dir, output_binning, removed_dims=[dim_name])
+
+    # Perform the summation over the dimension to be removed, block by block
+    # into the memory-mapped output (accumulating in double precision even if
+    # output table is not)
+    reduce_table(
+        table=input_table,
+        products={
+            "table": Product(steps=[SumAxis(dim_num)], fpath=output_file, dtype=None)
+        },
+        chunk_nbytes=chunk_nbytes,
+    )
 
 
 def main(description=__doc__):
@@ -110,6 +133,10 @@ def main(description=__doc__):
     parser.add_argument(
         "--dim-name", required=True, help="Dimension to be removed from the input file"
     )
+    parser.add_argument(
+        "--chunk-nbytes", type=int, default=DFLT_CHUNK_NBYTES,
+        help="Approximate size of blocks of the input table processed at a time",
+    )
     args = parser.parse_args()
     kwargs = vars(args)
     remove_dimension(**kwargs)
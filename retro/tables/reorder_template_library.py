@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position, too-many-locals
+
+"""
+Reorder the template library of template-compressed Cherenkov tables such that
+templates that are accessed most often--and those that are accessed in close
+succession--are stored close to one another, and rewrite the template maps to
+match.
+
+Access patterns are measured by tracing the (time-dependent) table lookups that
+`retro.tables.pexp_5d` performs for hypotheses sampled around the hits of a
+sample of events. The same trace is replayed against the original and the
+reordered library to report lookup throughput before and after reordering.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'sample_sources',
+    'generate_access_tracer',
+    'get_template_indices',
+    'get_template_order',
+    'reorder_templates',
+    'benchmark_lookups',
+    'write_reordered_tables',
+    'main',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import math
+from os import listdir, remove, symlink
+from os.path import abspath, basename, dirname, isfile, join
+import sys
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy import sparse
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro import DFLT_NUMBA_JIT_KWARGS, init_obj, numba_jit
+from retro.hypo.discrete_cascade_kernels import point_ckv_cascade
+from retro.hypo.discrete_muon_kernels import pegleg_muon
+from retro.reco import get_event_dom_and_hit_info
+from retro.tables.pexp_5d import LOOKUP_TRACE_FIELDS, generate_pexp_and_llh_functions
+from retro.utils.misc import expand, mkdir
+
+
+def sample_sources(event_dom_info, event_hit_info, rand, xy_spread=50.,
+                   z_spread=30., max_dt=1000., max_track_segments=50):
+    """Sample a hypothesis (cascade plus track) roughly consistent with an
+    event, mimicking the exploratory phase of a minimizer.
+
+    The vertex is drawn uniformly within (`xy_spread`, `xy_spread`,
+    `z_spread`) meters of the charge-weighted mean position of the hit DOMs,
+    the vertex time up to `max_dt` ns before the earliest hit, and the
+    direction uniformly on the sphere.
+
+    Parameters
+    ----------
+    event_dom_info : array of dtype EVT_DOM_INFO_T
+    event_hit_info : array of dtype EVT_HIT_INFO_T
+    rand : numpy.random.RandomState
+    xy_spread, z_spread, max_dt : float, optional
+    max_track_segments : int, optional
+
+    Returns
+    -------
+    sources : array of dtype SRC_T
+
+    """
+    charge = event_hit_info['charge'].astype(np.float64)
+    dom_idx = event_hit_info['event_dom_idx']
+    weights = charge / np.sum(charge)
+    center = [
+        np.sum(weights * event_dom_info[dim][dom_idx]) for dim in ('x', 'y', 'z')
+    ]
+
+    vertex = dict(
+        time=np.min(event_hit_info['time']) - rand.uniform(0, max_dt),
+        x=center[0] + rand.uniform(-xy_spread, xy_spread),
+        y=center[1] + rand.uniform(-xy_spread, xy_spread),
+        z=center[2] + rand.uniform(-z_spread, z_spread),
+    )
+    azimuth = rand.uniform(0, 2*np.pi)
+    zenith = math.acos(rand.uniform(-1, 1))
+
+    cascade_sources = point_ckv_cascade(
+        cascade_energy=rand.uniform(1, 30),
+        cascade_azimuth=azimuth,
+        cascade_zenith=zenith,
+        **vertex
+    )
+    track_sources = pegleg_muon(
+        track_azimuth=azimuth,
+        track_zenith=zenith,
+        dt=3.,
+        n_segments=rand.randint(0, max_track_segments + 1),
+        **vertex
+    )
+    return np.concatenate([cascade_sources, track_sources])
+
+
+def generate_access_tracer(dom_tables, max_trace_len, tdi_tables=None,
+                           tdi_metas=None):
+    """Generate a function that records the (time-dependent) directional
+    table lookups `retro.tables.pexp_5d` performs for a set of sources.
+
+    The lookups are recorded by the `pexp` function that
+    `generate_pexp_and_llh_functions` returns when passed `lookup_trace`, so
+    the trace follows exactly the binning, jitter, and loop order used in
+    reconstructions.
+
+    Parameters
+    ----------
+    dom_tables : Retro5DTables
+    max_trace_len : int > 0
+    tdi_tables, tdi_metas : optional
+        Passed to `generate_pexp_and_llh_functions`; the order of lookups
+        depends on whether TDI tables are used
+
+    Returns
+    -------
+    record_accesses : callable
+        ``trace_len = record_accesses(sources, event_dom_info,
+        event_hit_info)`` records the lookups for `sources` and returns the
+        total number of lookups performed so far (which can exceed
+        `max_trace_len`)
+    trace : shape (max_trace_len, len(LOOKUP_TRACE_FIELDS)) array of ints
+        Filled in by `record_accesses`
+
+    """
+    trace = np.empty(shape=(max_trace_len, len(LOOKUP_TRACE_FIELDS)), dtype=np.int32)
+    trace_len = np.zeros(shape=1, dtype=np.int64)
+    pexp, _, _ = generate_pexp_and_llh_functions(
+        dom_tables=dom_tables,
+        tdi_tables=tdi_tables,
+        tdi_metas=tdi_metas,
+        lookup_trace=(trace, trace_len),
+    )
+
+    def record_accesses(sources, event_dom_info, event_hit_info):
+        """Record table lookups; see `generate_access_tracer`"""
+        hit_exp = np.zeros(shape=len(event_hit_info), dtype=np.float64)
+        pexp(
+            sources=sources,
+            sources_start=0,
+            sources_stop=len(sources),
+            event_dom_info=event_dom_info,
+            event_hit_info=event_hit_info,
+            hit_exp=hit_exp,
+        )
+        return int(trace_len[0])
+
+    return record_accesses, trace
+
+
+def get_template_indices(tables, trace):
+    """Look up the template index of each entry in a lookup trace, reading
+    one template map at a time.
+
+    Parameters
+    ----------
+    tables : sequence of template maps or array of stacked template maps
+    trace : array as filled by function returned by `generate_access_tracer`
+
+    Returns
+    -------
+    template_indices : shape (len(trace),) array of ints
+
+    """
+    template_indices = np.empty(shape=len(trace), dtype=np.int64)
+    for table_idx in np.unique(trace[:, 0]):
+        mask = trace[:, 0] == table_idx
+        table_trace = trace[mask]
+        template_indices[mask] = tables[table_idx]['index'][
+            table_trace[:, 1], table_trace[:, 2], table_trace[:, 3]
+        ]
+    return template_indices
+
+
+def get_template_order(template_indices, num_templates):
+    """Order templates by access frequency and co-occurrence.
+
+    Starting from the most frequently accessed template, greedily append the
+    not-yet-placed template that most often directly follows or precedes the
+    last-placed template in `template_indices`; if there is none, continue with
+    the most frequently accessed template not yet placed. Templates that are
+    never accessed end up at the end, in their original order.
+
+    Parameters
+    ----------
+    template_indices : 1D array of ints
+        Sequence of template indices in the order they were accessed
+    num_templates : int
+
+    Returns
+    -------
+    order : shape (num_templates,) array of ints
+        ``reordered_library = template_library[order]``
+
+    """
+    template_indices = np.asarray(template_indices, dtype=np.int64)
+    counts = np.bincount(template_indices, minlength=num_templates)
+
+    prev_idx = template_indices[:-1]
+    next_idx = template_indices[1:]
+    mask = prev_idx != next_idx
+    transitions = sparse.coo_matrix(
+        (np.ones(np.count_nonzero(mask)), (prev_idx[mask], next_idx[mask])),
+        shape=(num_templates, num_templates),
+    ).tocsr()
+    transitions = (transitions + transitions.T).tocsr()
+
+    by_frequency = np.argsort(-counts, kind='mergesort')
+    placed = np.zeros(shape=num_templates, dtype=bool)
+    order = np.empty(shape=num_templates, dtype=np.int64)
+    freq_ptr = 0
+    current = -1
+    for order_idx in range(num_templates):
+        nxt = -1
+        if current >= 0:
+            row_start, row_stop = transitions.indptr[current:current + 2]
+            neighbors = transitions.indices[row_start:row_stop]
+            weights = transitions.data[row_start:row_stop]
+            unplaced = ~placed[neighbors]
+            if np.any(unplaced):
+                neighbors = neighbors[unplaced]
+                weights = weights[unplaced]
+                nxt = neighbors[np.lexsort((-counts[neighbors], -weights))[0]]
+        if nxt < 0:
+            while placed[by_frequency[freq_ptr]]:
+                freq_ptr += 1
+            nxt = by_frequency[freq_ptr]
+        order[order_idx] = nxt
+        placed[nxt] = True
+        current = nxt if counts[nxt] > 0 else -1
+
+    return order
+
+
+def reorder_templates(template_maps, template_library, order):
+    """Apply a template ordering to a library and template map(s).
+
+    Parameters
+    ----------
+    template_maps : array with fields "index" and "weight"
+    template_library : shape (n_templates, n_costhetadir, n_deltaphidir) array
+    order : shape (n_templates,) array of ints
+
+    Returns
+    -------
+    new_template_maps : array like `template_maps`
+    new_template_library : array like `template_library`
+
+    """
+    new_index_of_old = _invert_order(order)
+    new_template_maps = np.array(template_maps, copy=True)
+    new_template_maps['index'] = new_index_of_old[template_maps['index']]
+    return new_template_maps, np.ascontiguousarray(template_library[order])
+
+
+def _invert_order(order):
+    """Get the new index of each template given `order`"""
+    new_index_of_old = np.empty_like(order)
+    new_index_of_old[order] = np.arange(len(order))
+    return new_index_of_old
+
+
+def _stack_template_maps(tables, fpath, order=None):
+    """Stack template maps into a memory-mapped file, one map at a time,
+    optionally renumbering the templates according to `order`"""
+    stacked = open_memmap(
+        fpath,
+        mode='w+',
+        dtype=tables[0].dtype,
+        shape=(len(tables),) + tables[0].shape,
+    )
+    new_index_of_old = None if order is None else _invert_order(order)
+    for table_idx, template_map in enumerate(tables):
+        stacked[table_idx] = template_map
+        if new_index_of_old is not None:
+            stacked[table_idx]['index'] = new_index_of_old[template_map['index']]
+    stacked.flush()
+    return stacked
+
+
+@numba_jit(**DFLT_NUMBA_JIT_KWARGS)
+def _replay_lookups(tables, template_library, trace):
+    """Perform the lookups in `trace`, as `pexp_5d` does for
+    template-compressed tables"""
+    total = 0.
+    for i in range(trace.shape[0]):
+        templ = tables[trace[i, 0]][trace[i, 1], trace[i, 2], trace[i, 3]]
+        total += templ['weight'] * template_library[templ['index'], trace[i, 4], trace[i, 5]]
+    return total
+
+
+def benchmark_lookups(tables, template_library, trace, repeats=5):
+    """Time replaying the lookups in `trace`.
+
+    Parameters
+    ----------
+    tables : array of stacked template maps
+    template_library : array
+    trace : array as filled by function returned by `generate_access_tracer`
+    repeats : int > 0
+
+    Returns
+    -------
+    lookups_per_sec : float
+        Best throughput over `repeats` replays
+    total : float
+        Sum over all looked-up values (should not depend on template order)
+
+    """
+    total = _replay_lookups(tables, template_library, trace[:1])
+    best_time = np.inf
+    for _ in range(repeats):
+        t0 = time.time()
+        total = _replay_lookups(tables, template_library, trace)
+        best_time = min(best_time, time.time() - t0)
+    return len(trace) / max(best_time, 1e-9), total
+
+
+def write_reordered_tables(dom_tables, order, outdir):
+    """Write reordered template library and rewritten template maps.
+
+    Each table directory is mirrored within `outdir`; the template map file is
+    rewritten and all other files are symlinked to the originals.
+
+    Parameters
+    ----------
+    dom_tables : Retro5DTables
+    order : shape (n_templates,) array of ints
+    outdir : string
+
+    """
+    outdir = expand(outdir)
+    mkdir(outdir)
+
+    new_library = None
+    for fpath in dom_tables.table_fpaths:
+        if isfile(fpath):
+            src_dir, map_fname = dirname(fpath), basename(fpath)
+        else:
+            src_dir, map_fname = fpath, dom_tables.table_name + '.npy'
+        dst_dir = join(outdir, basename(src_dir))
+        if dst_dir == src_dir:
+            raise ValueError('Will not overwrite source tables in "{}"'.format(src_dir))
+        mkdir(dst_dir)
+
+        template_maps, new_library = reorder_templates(
+            template_maps=np.load(join(src_dir, map_fname), mmap_mode='r'),
+            template_library=dom_tables.template_library,
+            order=order,
+        )
+        np.save(join(dst_dir, map_fname), template_maps)
+
+        for fname in listdir(src_dir):
+            if fname == map_fname:
+                continue
+            symlink(join(src_dir, fname), join(dst_dir, fname))
+
+    np.save(join(outdir, 'ckv_dir_templates.npy'), new_library)
+    np.save(join(outdir, 'template_order.npy'), order)
+    print('Wrote reordered template library and maps to "{}"'.format(outdir))
+
+
+def main(description=__doc__):
+    """Script interface"""
+    parser = ArgumentParser(description=description)
+    parser.add_argument(
+        '--outdir', required=True,
+        help='''Directory in which to write the reordered template library and
+        template maps'''
+    )
+    parser.add_argument(
+        '--hypos-per-event', type=int, default=100,
+        help='''Number of hypotheses to sample per event'''
+    )
+    parser.add_argument(
+        '--max-trace-len', type=int, default=int(1e8),
+        help='''Maximum number of table lookups to record'''
+    )
+    parser.add_argument(
+        '--benchmark-repeats', type=int, default=5,
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+    )
+    split_kwargs = init_obj.parse_args(
+        dom_tables=True, tdi_tables=True, events=True, parser=parser
+    )
+    kwargs = split_kwargs['other_kw']
+    dom_tables_kw = split_kwargs['dom_tables_kw']
+    tdi_tables_kw = split_kwargs['tdi_tables_kw']
+    events_kw = split_kwargs['events_kw']
+
+    if dom_tables_kw['dom_tables_kind'] != 'ckv_templ_compr':
+        raise ValueError('Only "ckv_templ_compr" tables have a template library')
+    if events_kw['hits'] is None:
+        raise ValueError('Must specify --hits')
+
+    outdir = expand(kwargs['outdir'])
+    mkdir(outdir)
+
+    dom_tables = init_obj.setup_dom_tables(**dom_tables_kw)
+    tdi_tables, tdi_metas = init_obj.setup_tdi_tables(**tdi_tables_kw)
+    record_accesses, trace = generate_access_tracer(
+        dom_tables=dom_tables,
+        max_trace_len=kwargs['max_trace_len'],
+        tdi_tables=tdi_tables,
+        tdi_metas=tdi_metas,
+    )
+
+    rand = np.random.RandomState(kwargs['seed'])
+    trace_len = 0
+    num_events = 0
+    for event in init_obj.get_events(**events_kw):
+        if len(event['hits']) == 0:
+            continue
+        event_dom_info, event_hit_info = get_event_dom_and_hit_info(
+            event=event, dom_tables=dom_tables
+        )
+        num_events += 1
+        for _ in range(kwargs['hypos_per_event']):
+            sources = sample_sources(event_dom_info, event_hit_info, rand)
+            trace_len = record_accesses(sources, event_dom_info, event_hit_info)
+        if trace_len >= len(trace):
+            break
+    trace = trace[:trace_len]
+    print('Recorded {} lookups from {} events'.format(len(trace), num_events))
+
+    tables = dom_tables.tables
+    template_library = dom_tables.template_library
+    num_templates = template_library.shape[0]
+
+    template_indices = get_template_indices(tables, trace)
+    num_used = len(np.unique(template_indices))
+    print('{} of {} templates accessed'.format(num_used, num_templates))
+
+    order = get_template_order(template_indices, num_templates)
+    new_library = np.ascontiguousarray(template_library[order])
+
+    # Replay needs all maps in one array; build it on disk one map at a time
+    # rather than loading all maps into memory
+    stacked_fpaths = OrderedDict([
+        ('original', join(outdir, '.benchmark_maps_original.npy')),
+        ('reordered', join(outdir, '.benchmark_maps_reordered.npy')),
+    ])
+    results = OrderedDict()
+    try:
+        for label, lib in [('original', template_library),
+                           ('reordered', new_library)]:
+            if label == 'original' and isinstance(tables, np.ndarray):
+                tbls = tables
+            else:
+                tbls = _stack_template_maps(
+                    tables=tables,
+                    fpath=stacked_fpaths[label],
+                    order=order if label == 'reordered' else None,
+                )
+            results[label] = benchmark_lookups(
+                tbls, lib, trace, repeats=kwargs['benchmark_repeats']
+            )
+            del tbls
+            print('{:>9s}: {:.3e} lookups/s'.format(label, results[label][0]))
+    finally:
+        for fpath in stacked_fpaths.values():
+            if isfile(fpath):
+                remove(fpath)
+    print('speedup: {:.3f}'.format(results['reordered'][0] / results['original'][0]))
+    assert np.isclose(results['original'][1], results['reordered'][1]), \
+            'reordered lookups do not reproduce original values'
+
+    write_reordered_tables(dom_tables=dom_tables, order=order, outdir=outdir)
+
+
+if __name__ == '__main__':
+    main()
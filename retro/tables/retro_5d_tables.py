@@ -33,7 +33,8 @@ limitations under the License.'''
 
 from collections import OrderedDict
 from copy import deepcopy
-from os.path import abspath, dirname
+from functools import partial
+from os.path import abspath, dirname, isdir, join
 import sys
 
 import numpy as np
@@ -49,6 +50,10 @@ from retro.const import (
 )
 from retro.i3info.angsens_model import load_angsens_model
 from retro.retro_types import DOMINFO_T
+from retro.tables.table_cache import (
+    get_norm_cache_key, load_norm_entry, load_tables_entry, store_norm_entry,
+    store_tables_entry
+)
 #from retro.tables.pexp_5d import generate_pexp_and_llh_functions
 from retro.utils.geom import spherical_volume
 from retro.utils.misc import expand
@@ -145,6 +150,19 @@ class Retro5DTables(object):
     use_sd_indices : sequence of int, optional
         Only use a subset of DOMs. If not specified, all in-ice DOMs are used.
 
+    table_cache_dir : string, optional
+        If specified, table norms are looked up in (and stored to) this
+        content-addressed cache, and the `load_tables_from_cache` and
+        `store_tables_in_cache` methods can be used; see
+        `retro.tables.table_cache`
+
+    chunked : bool, optional
+        Whether tables are stored in the chunked, compressed format written by
+        `retro.tables.chunked_tables` (only applies to `load_table`). Except
+        for template-compressed tables, `tables` and `t_indep_tables` then
+        hold `retro.tables.chunked_tables.ChunkedArrayReader`s, which are
+        decompressed when the likelihood functions are generated.
+
     """
     def __init__(
         self,
@@ -159,6 +177,8 @@ class Retro5DTables(object):
         ckv_sigma_deg=None,
         template_library=None,
         use_sd_indices=ALL_STRS_DOMS,
+        table_cache_dir=None,
+        chunked=False,
     ):
         # TODO: change that this is hard-coded in retro CLSim branch and make it
         # metadata that gets passed through the entire table-generation chain.
@@ -213,10 +233,22 @@ class Retro5DTables(object):
             self.t_indep_table_name = 't_indep_ckv_table'
             self.table_name = 'ckv_table'
 
+        self.chunked = chunked
+        if chunked:
+            from retro.tables.chunked_tables import load_chunked_table
+            # Defer decompressing uncompressed tables until the likelihood
+            # functions are generated (see `retro.tables.pexp_5d`); template
+            # maps are small and are validated as soon as they are loaded
+            self.table_loader_func = partial(
+                load_chunked_table, lazy=not self.tbl_is_templ_compr
+            )
+
         assert len(geom.shape) == 3
         self.num_phi_samples = num_phi_samples
         self.ckv_sigma_deg = ckv_sigma_deg
         self.norm_version = norm_version
+        self.table_cache_dir = table_cache_dir
+        self.norm_cache_keys = []
 
         zero_mask = rde == 0
         nan_mask = np.isnan(rde)
@@ -264,6 +296,7 @@ class Retro5DTables(object):
             )
 
         self.tables = []
+        self.table_fpaths = []
         self.t_indep_tables = []
         self.table_norms = []
         self.t_indep_table_norms = []
@@ -289,8 +322,19 @@ class Retro5DTables(object):
         )
 
         self.is_stacked = None
+        self.stacked_tables_meta_fpath = None
+        self.stacked_t_indep_tables_fpath = None
         self.t_is_residual_time = None
 
+        # Optional coarsely-binned counterpart (itself a Retro5DTables object
+        # with identical `sd_idx_table_indexer`) for use in the early,
+        # exploratory phase of a minimizer; see `init_obj.setup_dom_tables`
+        self.coarse_tables = None
+
+        # Optional `retro.tables.prefetch.TablePrefetcher` for memory-mapped
+        # tables; see `init_obj.setup_dom_tables`
+        self.prefetcher = None
+
     def load_stacked_tables(
         self,
         stacked_tables_meta_fpath,
@@ -310,7 +354,9 @@ class Retro5DTables(object):
         t_indep_mmap_mode = 'r' if mmap_t_indep else None
 
         self.table_meta = load_pickle(stacked_tables_meta_fpath)
+        self.stacked_tables_meta_fpath = stacked_tables_meta_fpath
         self.tables = np.load(stacked_tables_fpath, mmap_mode=tables_mmap_mode)
+        self.table_fpaths = [stacked_tables_fpath]
         self.tables.setflags(write=False, align=True, uic=False)
         num_tables = self.tables.shape[0]
 
@@ -321,6 +367,7 @@ class Retro5DTables(object):
             mmap_mode=t_indep_mmap_mode
         )
         self.t_indep_tables.setflags(write=False, align=True, uic=False)
+        self.stacked_t_indep_tables_fpath = stacked_t_indep_tables_fpath
         assert self.t_indep_tables.shape[0] == num_tables
 
         self.sd_idx_table_indexer = deepcopy(self.table_meta['sd_idx_table_indexer'])
@@ -333,15 +380,13 @@ class Retro5DTables(object):
         # is scaled such that the effective number of photons used to generate
         # the table is one (to avoid different norms across the tables if
         # different number of photons was used originally to create each).
-        self.table_norm, self.t_indep_table_norm = get_table_norm(
-            avg_angsens=self.avg_angsens,
-            quantum_efficiency=1,
-            norm_version=self.norm_version,
-            **{k: self.table_meta[k] for k in TABLE_NORM_KEYS}
+        self.table_norm, self.t_indep_table_norm, norm_cache_key = self._get_table_norm(
+            {k: self.table_meta[k] for k in TABLE_NORM_KEYS}
         )
 
         self.table_norms = [self.table_norm] * num_tables
         self.t_indep_table_norms = [self.t_indep_table_norm] * num_tables
+        self.norm_cache_keys = [norm_cache_key]
 
         self.is_stacked = True
 
@@ -401,15 +446,14 @@ class Retro5DTables(object):
         else:
             assert bool(table['t_is_residual_time']) == self.t_is_residual_time
 
-        table_norm, t_indep_table_norm = get_table_norm(
-            avg_angsens=self.avg_angsens,
-            quantum_efficiency=1,
-            norm_version=self.norm_version,
-            **{k: table[k] for k in TABLE_NORM_KEYS}
+        table_norm, t_indep_table_norm, norm_cache_key = self._get_table_norm(
+            {k: table[k] for k in TABLE_NORM_KEYS}
         )
 
         self.tables.append(table[self.table_name])
+        self.table_fpaths.append(expand(fpath))
         self.table_norms.append(table_norm)
+        self.norm_cache_keys.append(norm_cache_key)
         self.n_photons_per_table.append(table['n_photons'])
         # DEBUG:
         #print('n_photons: {:.2e}, avg norm: {:.2e}\n'.format(
@@ -427,6 +471,209 @@ class Retro5DTables(object):
 
         self.loaded_sd_indices = np.where(self.sd_idx_table_indexer >= 0)[0]
 
+    def _get_table_norm(self, norm_kwargs):
+        """Get table norm and t-indep table norm, from the table cache if
+        possible.
+
+        Parameters
+        ----------
+        norm_kwargs : mapping
+            Must contain all of `TABLE_NORM_KEYS`
+
+        Returns
+        -------
+        table_norm, t_indep_table_norm : array
+        norm_cache_key : string or None
+            None if not using a table cache
+
+        """
+        if self.table_cache_dir is None:
+            table_norm, t_indep_table_norm = get_table_norm(
+                avg_angsens=self.avg_angsens,
+                quantum_efficiency=1,
+                norm_version=self.norm_version,
+                **norm_kwargs
+            )
+            return table_norm, t_indep_table_norm, None
+
+        key = get_norm_cache_key(
+            norm_kwargs=norm_kwargs,
+            norm_version=self.norm_version,
+            angsens_model=self.angsens_model,
+        )
+        entry = load_norm_entry(self.table_cache_dir, key)
+        if entry is None:
+            table_norm, t_indep_table_norm = get_table_norm(
+                avg_angsens=self.avg_angsens,
+                quantum_efficiency=1,
+                norm_version=self.norm_version,
+                **norm_kwargs
+            )
+            store_norm_entry(
+                cache_dir=self.table_cache_dir,
+                key=key,
+                norm_kwargs=norm_kwargs,
+                norm_version=self.norm_version,
+                angsens_model=self.angsens_model,
+                table_norm=table_norm,
+                t_indep_table_norm=t_indep_table_norm,
+            )
+        else:
+            table_norm, t_indep_table_norm = entry['table_norm'], entry['t_indep_table_norm']
+        return table_norm, t_indep_table_norm, key
+
+    def _table_array_fpaths(self, fpath):
+        """Paths to the table and t-indep table .npy files loaded from
+        `fpath` (a table directory, or a stacked table file)"""
+        if not isdir(fpath):
+            return fpath, None
+        return (
+            join(fpath, self.table_name + '.npy'),
+            join(fpath, self.t_indep_table_name + '.npy'),
+        )
+
+    def store_tables_in_cache(self, cache_key):
+        """Record the loaded tables in the table cache such that
+        `load_tables_from_cache` can reload them without computing norms or
+        reading table metadata (except for the small metadata file of stacked
+        tables, which is reloaded so that all of its keys are available).
+
+        Parameters
+        ----------
+        cache_key : string
+            E.g. as returned by `retro.tables.table_cache.get_tables_cache_key`
+
+        """
+        if self.table_cache_dir is None:
+            raise ValueError('No `table_cache_dir` specified')
+        if not self.tbl_is_ckv or self.chunked:
+            raise NotImplementedError('Can only cache (non-chunked) ckv tables')
+
+        manifest = OrderedDict()
+        manifest['table_kind'] = self.table_kind
+        manifest['is_stacked'] = bool(self.is_stacked)
+        manifest['t_is_residual_time'] = bool(self.t_is_residual_time)
+        manifest['compute_t_indep_exp'] = bool(self.compute_t_indep_exp)
+        manifest['n_photons_per_table'] = [float(n) for n in self.n_photons_per_table]
+        manifest['norm_cache_keys'] = list(self.norm_cache_keys)
+        manifest['table_fpaths'] = list(self.table_fpaths)
+        fpaths = [self._table_array_fpaths(f)[0] for f in self.table_fpaths]
+        if self.is_stacked:
+            t_indep_fpaths = [self.stacked_t_indep_tables_fpath]
+            # The stacked tables' metadata (which can contain more than is
+            # needed to compute norms) is reloaded from this file
+            manifest['stacked_tables_meta_fpath'] = self.stacked_tables_meta_fpath
+            fpaths.append(self.stacked_tables_meta_fpath)
+        else:
+            t_indep_fpaths = [self._table_array_fpaths(f)[1] for f in self.table_fpaths]
+        manifest['t_indep_table_fpaths'] = t_indep_fpaths
+
+        store_tables_entry(
+            cache_dir=self.table_cache_dir,
+            key=cache_key,
+            sd_idx_table_indexer=self.sd_idx_table_indexer,
+            manifest=manifest,
+            fpaths=fpaths,
+        )
+
+    def load_tables_from_cache(self, cache_key, mmap):
+        """Load tables recorded in the table cache by `store_tables_in_cache`.
+
+        Parameters
+        ----------
+        cache_key : string
+        mmap : bool
+
+        Returns
+        -------
+        success : bool
+            False if there is no valid cache entry for `cache_key` (in which
+            case nothing is loaded)
+
+        """
+        if self.table_cache_dir is None or not self.tbl_is_ckv or self.chunked:
+            return False
+        assert self.is_stacked is None, 'tables already loaded'
+
+        entry = load_tables_entry(self.table_cache_dir, cache_key)
+        if entry is None or entry['table_kind'] != self.table_kind:
+            return False
+        if entry['is_stacked'] and 'stacked_tables_meta_fpath' not in entry:
+            # Written before stacked tables' metadata was recorded
+            return False
+        norm_entries = OrderedDict()
+        for key in entry['norm_cache_keys']:
+            if key not in norm_entries:
+                norm_entries[key] = load_norm_entry(self.table_cache_dir, key)
+                if norm_entries[key] is None:
+                    return False
+
+        # Replicate memory mapping behavior of `load_stacked_tables` (as
+        # called by `init_obj.setup_dom_tables`) and of the table loader funcs
+        if entry['is_stacked']:
+            mmap_mode = None
+            t_indep_mmap_mode = 'r' if mmap else None
+        else:
+            mmap_mode = 'r' if mmap else None
+            t_indep_mmap_mode = 'r' if mmap and self.tbl_is_templ_compr else None
+
+        tables = []
+        for fpath in entry['table_fpaths']:
+            table = np.load(self._table_array_fpaths(fpath)[0], mmap_mode=mmap_mode)
+            table.setflags(write=False, align=True, uic=False)
+            tables.append(table)
+        t_indep_tables = []
+        if self.compute_t_indep_exp or entry['is_stacked']:
+            for fpath in entry['t_indep_table_fpaths']:
+                t_indep_table = np.load(fpath, mmap_mode=t_indep_mmap_mode)
+                t_indep_table.setflags(write=False, align=True, uic=False)
+                t_indep_tables.append(t_indep_table)
+
+        norm_entry = norm_entries[entry['norm_cache_keys'][-1]]
+        if entry['is_stacked']:
+            table_meta = load_pickle(entry['stacked_tables_meta_fpath'])
+        else:
+            table_meta = OrderedDict()
+            binning = OrderedDict()
+            for key in TABLE_NORM_KEYS:
+                table_meta[key] = norm_entry[key]
+                if 'bin_edges' in key:
+                    binning[key] = norm_entry[key]
+            table_meta['binning'] = binning
+            table_meta['t_is_residual_time'] = entry['t_is_residual_time']
+
+        self.is_stacked = entry['is_stacked']
+        self.table_meta = table_meta
+        self.t_is_residual_time = entry['t_is_residual_time']
+        self.table_fpaths = list(entry['table_fpaths'])
+        self.norm_cache_keys = list(entry['norm_cache_keys'])
+        self.n_photons_per_table = list(entry['n_photons_per_table'])
+        self.sd_idx_table_indexer = entry['sd_idx_table_indexer']
+
+        if self.is_stacked:
+            self.stacked_tables_meta_fpath = entry['stacked_tables_meta_fpath']
+            self.stacked_t_indep_tables_fpath = entry['t_indep_table_fpaths'][0]
+            self.tables = tables[0]
+            num_tables = self.tables.shape[0]
+            self.sd_idx_table_indexer.setflags(write=False, align=True, uic=False)
+            self.table_norm = norm_entry['table_norm']
+            self.t_indep_table_norm = norm_entry['t_indep_table_norm']
+            self.table_norms = [self.table_norm] * num_tables
+            self.t_indep_table_norms = [self.t_indep_table_norm] * num_tables
+            self.t_indep_tables = t_indep_tables[0]
+        else:
+            self.tables = tables
+            self.table_norms = [norm_entries[k]['table_norm'] for k in self.norm_cache_keys]
+            if self.compute_t_indep_exp:
+                self.t_indep_tables = t_indep_tables
+                self.t_indep_table_norms = [
+                    norm_entries[k]['t_indep_table_norm'] for k in self.norm_cache_keys
+                ]
+
+        self.loaded_sd_indices = np.where(self.sd_idx_table_indexer >= 0)[0]
+
+        return True
+
 
 def get_table_norm(
     n_photons,
@@ -2,6 +2,13 @@
 Fast `shift_and_bin` function: Shift (r, theta) retro tables (i.e., (t, r,
 theta) tables with time marginalized out) to each DOM location and aggregate
 their quantities (with appropriate weighting) in (x, y, z) retro tables.
+
+`shift_and_bin_parallel` does the same, splitting the DOMs among OpenMP
+threads (if the extension is compiled with OpenMP support).
+
+Run `test_shift_and_bin_parallel` (e.g., ``python -c "from
+retro.tables.shift_and_bin import test_shift_and_bin_parallel as t; t()"``)
+to check that both agree.
 """
 
 
@@ -26,10 +33,191 @@ cimport cython
 import numpy as np
 cimport numpy as np
 
+from multiprocessing import cpu_count
+
+from cython.parallel cimport prange
 from libc.stdlib cimport free, malloc
 from libc.math cimport abs, ceil, round, sqrt
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.nonecheck(False)
+cdef int _shift_and_bin_dom(double dom_x,
+                             double dom_y,
+                             double dom_z,
+                             unsigned int **ind_array_ptrs,
+                             double **vol_array_ptrs,
+                             int[:] num_cart_bins_in_pol_bin,
+                             double[:, :] survival_prob,
+                             double[:, :] prho,
+                             double[:, :] pz,
+                             int nr,
+                             int ntheta,
+                             double r_max,
+                             double *binned_spv,
+                             double *binned_px_spv,
+                             double *binned_py_spv,
+                             double *binned_pz_spv,
+                             double *binned_one_minus_sp,
+                             double *dom_binned_vol,
+                             double *dom_binned_spv,
+                             double x_min,
+                             double x_max,
+                             double y_min,
+                             double y_max,
+                             double z_min,
+                             double z_max,
+                             unsigned int nx,
+                             unsigned int ny,
+                             unsigned int nz,
+                             double os_bw,
+                             int oversample) nogil:
+    """Shift and bin the (r, theta) table for a single DOM; see
+    `shift_and_bin` for details. `dom_binned_vol` and `dom_binned_spv` are
+    scratch arrays of length nx*ny*nz. Always returns 0 (an int rather than
+    void return type avoids exception checks that require the GIL)."""
+    cdef:
+        double inv_os_bw = 1.0 / os_bw
+        double half_os_bw = os_bw / 2.0
+
+        int dom_x_os_idx, dom_y_os_idx, dom_z_os_idx
+        int x_os_idx, y_os_idx, z_os_idx
+        double bin_pos_rho_norm
+
+        double vol, prho_, px_, py_, pz_
+        double px_unnormed, py_unnormed, pz_unnormed
+        double px_firstquad, py_firstquad
+        double sp, spv
+
+        unsigned int ntheta_in_quad = <unsigned int>ceil(<double>ntheta / 2.0)
+        unsigned int flat_pol_idx, r_idx, theta_idx, theta_idx_
+        int x_idx, y_idx, z_idx
+        int ix
+        int hemisphere, quadrant
+
+        double bv
+        unsigned int flat_cart_ix
+        int ix0
+
+    # Quick-and-dirty check to see if we can circumvent this DOM
+    # altogether if the polar binning falls outside the binned volume
+    # (This is not precise: won't exclude DOMs that do overlap, but
+    # this _might_ include DOMs that have no overlap--in which case the
+    # result will not be wrong, it'll just take more time to compute
+    # the fact that there's no overlap.)
+    if dom_x + r_max <= x_min or dom_x - r_max >= x_max:
+        return 0
+    if dom_y + r_max <= y_min or dom_y - r_max >= y_max:
+        return 0
+    if dom_z + r_max <= z_min or dom_z - r_max >= z_max:
+        return 0
+
+    dom_x_os_idx = <int>round((dom_x - x_min) * inv_os_bw)
+    dom_y_os_idx = <int>round((dom_y - y_min) * inv_os_bw)
+    dom_z_os_idx = <int>round((dom_z - z_min) * inv_os_bw)
+
+    for flat_cart_ix in range(nx*ny*nz):
+        dom_binned_vol[flat_cart_ix] = 0.0
+        dom_binned_spv[flat_cart_ix] = 0.0
+
+    for r_idx in range(nr):
+        for theta_idx in range(ntheta_in_quad):
+            flat_pol_idx = theta_idx + r_idx*ntheta_in_quad
+
+            for ix in range(num_cart_bins_in_pol_bin[flat_pol_idx]):
+                vol = <double>vol_array_ptrs[flat_pol_idx][ix]
+                #assert 0 <= vol <= 1e5
+                ix0 = ix * 3
+                x_os_idx = <int>ind_array_ptrs[flat_pol_idx][ix0]
+                y_os_idx = <int>ind_array_ptrs[flat_pol_idx][ix0 + 1]
+                z_os_idx = <int>ind_array_ptrs[flat_pol_idx][ix0 + 2]
+
+                # Azimuth angle is detrmined by (x, y) bin center since
+                # we assume azimuthal symmetry
+                px_unnormed = <double>x_os_idx * os_bw + half_os_bw
+                py_unnormed = <double>y_os_idx * os_bw + half_os_bw
+                bin_pos_rho_norm = 1.0 / sqrt(px_unnormed*px_unnormed + py_unnormed*py_unnormed)
+                px_unnormed = px_unnormed * bin_pos_rho_norm
+                py_unnormed = py_unnormed * bin_pos_rho_norm
+
+                for hemisphere in range(2):
+                    if hemisphere == 0:
+                        z_idx = (z_os_idx + dom_z_os_idx) // oversample
+                        theta_idx_ = theta_idx
+                    else:
+                        z_idx = (-1 - z_os_idx + dom_z_os_idx) // oversample
+                        theta_idx_ = ntheta - 1 - theta_idx
+
+                    if z_idx < 0 or z_idx >= nz:
+                        continue
+
+                    sp = survival_prob[r_idx, theta_idx_]
+                    #assert 0 <= sp <= 1
+                    spv = sp * vol
+                    prho_ = prho[r_idx, theta_idx_]
+                    pz_ = pz[r_idx, theta_idx_]
+
+                    px_firstquad = px_unnormed * prho_
+                    py_firstquad = py_unnormed * prho_
+
+                    for quadrant in range(4):
+                        if quadrant == 0:
+                            x_idx = (x_os_idx + dom_x_os_idx) // oversample
+                            y_idx = (y_os_idx + dom_y_os_idx) // oversample
+                            px_ = px_firstquad
+                            py_ = py_firstquad
+
+                        # x -> +y, y -> -x
+                        elif quadrant == 1:
+                            x_idx = (-1 - y_os_idx + dom_x_os_idx) // oversample
+                            y_idx = (x_os_idx + dom_y_os_idx) // oversample
+                            px_ = -py_firstquad
+                            py_ = px_firstquad
+
+                        # x -> -x, y -> -y
+                        elif quadrant == 2:
+                            x_idx = (-1 - x_os_idx + dom_x_os_idx) // oversample
+                            y_idx = (-1 - y_os_idx + dom_y_os_idx) // oversample
+                            px_ = -px_firstquad
+                            py_ = -py_firstquad
+
+                        # x -> -y, y -> x
+                        elif quadrant == 3:
+                            x_idx = (y_os_idx + dom_x_os_idx) // oversample
+                            y_idx = (-1 - x_os_idx + dom_y_os_idx) // oversample
+                            px_ = py_firstquad
+                            py_ = -px_firstquad
+
+                        if x_idx < 0 or x_idx >= nx or y_idx < 0 or y_idx >= ny:
+                            continue
+
+                        # Compute base index
+                        flat_cart_ix = (x_idx * ny*nz) + (y_idx * nz) + z_idx
+                        dom_binned_vol[flat_cart_ix] += vol
+                        dom_binned_spv[flat_cart_ix] += spv
+                        binned_spv[flat_cart_ix] += spv
+                        binned_px_spv[flat_cart_ix] += px_ * spv
+                        binned_py_spv[flat_cart_ix] += py_ * spv
+                        binned_pz_spv[flat_cart_ix] += pz_ * spv
+
+    # Normalize the weighted sum of survival probabilities for this DOM and
+    # then include it in the overall survival probability via probabilistic
+    # "or" statement:
+    #     P(A) or P(B) = 1 - (1 - P(A)) * (1 - P(B))
+    # though we stop at just the two factors on the right and more
+    # probabilities can be easily combined before being subtracted form one
+    # to yield the overall probability.
+    for flat_cart_ix in range(nx*ny*nz):
+        bv = dom_binned_vol[flat_cart_ix]
+        if bv == 0:
+            continue
+        binned_one_minus_sp[flat_cart_ix] *= 1.0 - dom_binned_spv[flat_cart_ix] / bv
+
+    return 0
+
+
 @cython.embedsignature(True)
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -44,11 +232,11 @@ def shift_and_bin(list ind_arrays,
                   int nr,
                   int ntheta,
                   double r_max,
-                  double[:] binned_spv,
-                  double[:] binned_px_spv,
-                  double[:] binned_py_spv,
-                  double[:] binned_pz_spv,
-                  double[:] binned_one_minus_sp,
+                  double[::1] binned_spv,
+                  double[::1] binned_px_spv,
+                  double[::1] binned_py_spv,
+                  double[::1] binned_pz_spv,
+                  double[::1] binned_one_minus_sp,
                   double x_min,
                   double x_max,
                   double y_min,
@@ -204,184 +392,358 @@ def shift_and_bin(list ind_arrays,
         unsigned int num_first_octant_pol_bins = len(vol_arrays)
 
         double os_bw = binwidth / <double>oversample
-        double inv_os_bw = 1.0 / os_bw
-
-        double half_os_bw = os_bw / 2.0
 
         unsigned int nx = <unsigned int>round((x_max - x_min) / binwidth)
         unsigned int ny = <unsigned int>round((y_max - y_min) / binwidth)
         unsigned int nz = <unsigned int>round((z_max - z_min) / binwidth)
 
-        double dom_x, dom_y, dom_z
-        int dom_x_os_idx, dom_y_os_idx, dom_z_os_idx
-        int x_os_idx, y_os_idx, z_os_idx
-        double bin_pos_rho_norm
-
-        double vol, prho_, px_, py_, pz_
-        double px_unnormed, py_unnormed, pz_unnormed
-        double px_firstquad, py_firstquad
-        double sp, spv
-
-        unsigned int ntheta_in_quad = <unsigned int>ceil(<double>ntheta / 2.0)
-        unsigned int flat_pol_idx, r_idx, theta_idx, theta_idx_
-        int x_idx, y_idx, z_idx
         int ix
         int[:] num_cart_bins_in_pol_bin = np.empty(num_first_octant_pol_bins, dtype=np.int32)
-        int hemisphere, quadrant
 
-        double[:] dom_binned_vol = np.empty((nx*ny*nz), dtype=np.float64)
-        double[:] dom_binned_spv = np.empty((nx*ny*nz), dtype=np.float64)
-        double bv
-        unsigned int flat_cart_ix
+        double[::1] dom_binned_vol = np.empty((nx*ny*nz), dtype=np.float64)
+        double[::1] dom_binned_spv = np.empty((nx*ny*nz), dtype=np.float64)
 
         int dom_idx
         int num_doms = <int>dom_coords.shape[0]
-        int ix0
 
-        np.ndarray[unsigned int, ndim=2] ind_array
-        np.ndarray[double, ndim=1] vol_array
         unsigned int **ind_array_ptrs = <unsigned int**>malloc(num_first_octant_pol_bins * sizeof(unsigned int*))
         double **vol_array_ptrs = <double**>malloc(num_first_octant_pol_bins * sizeof(double*))
 
     try:
-        # Enforce < 1 micrometer accumulated error for binning
-        assert abs(x_min + nx * binwidth - x_max) < 1e-6
-        assert abs(y_min + ny * binwidth - y_max) < 1e-6
-        assert abs(z_min + nz * binwidth - z_max) < 1e-6
-
-        assert num_first_octant_pol_bins == nr * ntheta / 2
-
-        for array, name in [(binned_spv, 'binned_spv'),
-                            (binned_px_spv, 'binned_px_spv'),
-                            (binned_py_spv, 'binned_py_spv'),
-                            (binned_pz_spv, 'binned_pz_spv'),
-                            (binned_one_minus_sp, 'binned_one_minus_sp')]:
-            assert array.shape[0] == nx*ny*nz
-
-        for ix in range(num_first_octant_pol_bins):
-            num_cart_bins_in_pol_bin[ix] = vol_arrays[ix].shape[0]
-            ind_array = ind_arrays[ix]
-            vol_array = vol_arrays[ix]
-            ind_array_ptrs[ix] = <unsigned int*>ind_array.data
-            vol_array_ptrs[ix] = <double*>vol_array.data
+        _check_and_get_ptrs(
+            ind_arrays=ind_arrays,
+            vol_arrays=vol_arrays,
+            nr=nr,
+            ntheta=ntheta,
+            accumulators=[binned_spv, binned_px_spv, binned_py_spv, binned_pz_spv, binned_one_minus_sp],
+            x_min=x_min,
+            x_max=x_max,
+            y_min=y_min,
+            y_max=y_max,
+            z_min=z_min,
+            z_max=z_max,
+            binwidth=binwidth,
+            num_cart_bins_in_pol_bin=num_cart_bins_in_pol_bin,
+            ind_array_ptrs=<size_t>ind_array_ptrs,
+            vol_array_ptrs=<size_t>vol_array_ptrs,
+        )
 
         for dom_idx in range(num_doms):
-            dom_x = dom_coords[dom_idx, 0]
-            dom_y = dom_coords[dom_idx, 1]
-            dom_z = dom_coords[dom_idx, 2]
-
-            # Quick-and-dirty check to see if we can circumvent this DOM
-            # altogether if the polar binning falls outside the binned volume
-            # (This is not precise: won't exclude DOMs that do overlap, but
-            # this _might_ include DOMs that have no overlap--in which case the
-            # result will not be wrong, it'll just take more time to compute
-            # the fact that there's no overlap.)
-            if dom_x + r_max <= x_min or dom_x - r_max >= x_max:
-                continue
-            if dom_y + r_max <= y_min or dom_y - r_max >= y_max:
-                continue
-            if dom_z + r_max <= z_min or dom_z - r_max >= z_max:
-                continue
-
-            dom_x_os_idx = <int>round((dom_x - x_min) * inv_os_bw)
-            dom_y_os_idx = <int>round((dom_y - y_min) * inv_os_bw)
-            dom_z_os_idx = <int>round((dom_z - z_min) * inv_os_bw)
-
-            dom_binned_vol[:] = 0.0
-            dom_binned_spv[:] = 0.0
-
-            for r_idx in range(nr):
-                for theta_idx in range(ntheta_in_quad):
-                    flat_pol_idx = theta_idx + r_idx*ntheta_in_quad
-
-                    for ix in range(num_cart_bins_in_pol_bin[flat_pol_idx]):
-                        vol = <double>vol_array_ptrs[flat_pol_idx][ix]
-                        #assert 0 <= vol <= 1e5
-                        ix0 = ix * 3
-                        x_os_idx = <int>ind_array_ptrs[flat_pol_idx][ix0]
-                        y_os_idx = <int>ind_array_ptrs[flat_pol_idx][ix0 + 1]
-                        z_os_idx = <int>ind_array_ptrs[flat_pol_idx][ix0 + 2]
-
-                        # Azimuth angle is detrmined by (x, y) bin center since
-                        # we assume azimuthal symmetry
-                        px_unnormed = <double>x_os_idx * os_bw + half_os_bw
-                        py_unnormed = <double>y_os_idx * os_bw + half_os_bw
-                        bin_pos_rho_norm = 1.0 / sqrt(px_unnormed*px_unnormed + py_unnormed*py_unnormed)
-                        px_unnormed = px_unnormed * bin_pos_rho_norm
-                        py_unnormed = py_unnormed * bin_pos_rho_norm
-
-                        for hemisphere in range(2):
-                            if hemisphere == 0:
-                                z_idx = (z_os_idx + dom_z_os_idx) // oversample
-                                theta_idx_ = theta_idx
-                            else:
-                                z_idx = (-1 - z_os_idx + dom_z_os_idx) // oversample
-                                theta_idx_ = ntheta - 1 - theta_idx
-
-                            if z_idx < 0 or z_idx >= nz:
-                                continue
-
-                            sp = survival_prob[r_idx, theta_idx_]
-                            #assert 0 <= sp <= 1
-                            spv = sp * vol
-                            prho_ = prho[r_idx, theta_idx_]
-                            pz_ = pz[r_idx, theta_idx_]
-
-                            px_firstquad = px_unnormed * prho_
-                            py_firstquad = py_unnormed * prho_
-
-                            for quadrant in range(4):
-                                if quadrant == 0:
-                                    x_idx = (x_os_idx + dom_x_os_idx) // oversample
-                                    y_idx = (y_os_idx + dom_y_os_idx) // oversample
-                                    px_ = px_firstquad
-                                    py_ = py_firstquad
-
-                                # x -> +y, y -> -x
-                                elif quadrant == 1:
-                                    x_idx = (-1 - y_os_idx + dom_x_os_idx) // oversample
-                                    y_idx = (x_os_idx + dom_y_os_idx) // oversample
-                                    px_ = -py_firstquad
-                                    py_ = px_firstquad
-
-                                # x -> -x, y -> -y
-                                elif quadrant == 2:
-                                    x_idx = (-1 - x_os_idx + dom_x_os_idx) // oversample
-                                    y_idx = (-1 - y_os_idx + dom_y_os_idx) // oversample
-                                    px_ = -px_firstquad
-                                    py_ = -py_firstquad
-
-                                # x -> -y, y -> x
-                                elif quadrant == 3:
-                                    x_idx = (y_os_idx + dom_x_os_idx) // oversample
-                                    y_idx = (-1 - x_os_idx + dom_y_os_idx) // oversample
-                                    px_ = py_firstquad
-                                    py_ = -px_firstquad
-
-                                if x_idx < 0 or x_idx >= nx or y_idx < 0 or y_idx >= ny:
-                                    continue
-
-                                # Compute base index; can use directly on typed memoryviews
-                                flat_cart_ix = (x_idx * ny*nz) + (y_idx * nz) + z_idx
-                                dom_binned_vol[flat_cart_ix] += vol
-                                dom_binned_spv[flat_cart_ix] += spv
-                                binned_spv[flat_cart_ix] += spv
-                                binned_px_spv[flat_cart_ix] += px_ * spv
-                                binned_py_spv[flat_cart_ix] += py_ * spv
-                                binned_pz_spv[flat_cart_ix] += pz_ * spv
-
-            # Normalize the weighted sum of survival probabilities for this DOM and
-            # then include it in the overall survival probability via probabilistic
-            # "or" statement:
-            #     P(A) or P(B) = 1 - (1 - P(A)) * (1 - P(B))
-            # though we stop at just the two factors on the right and more
-            # probabilities can be easily combined before being subtracted form one
-            # to yield the overall probability.
-            for flat_cart_ix in range(nx*ny*nz):
-                bv = dom_binned_vol[flat_cart_ix]
-                if bv == 0:
-                    continue
-                binned_one_minus_sp[flat_cart_ix] *= 1.0 - dom_binned_spv[flat_cart_ix] / bv
+            _shift_and_bin_dom(
+                dom_coords[dom_idx, 0],
+                dom_coords[dom_idx, 1],
+                dom_coords[dom_idx, 2],
+                ind_array_ptrs,
+                vol_array_ptrs,
+                num_cart_bins_in_pol_bin,
+                survival_prob,
+                prho,
+                pz,
+                nr,
+                ntheta,
+                r_max,
+                &binned_spv[0],
+                &binned_px_spv[0],
+                &binned_py_spv[0],
+                &binned_pz_spv[0],
+                &binned_one_minus_sp[0],
+                &dom_binned_vol[0],
+                &dom_binned_spv[0],
+                x_min,
+                x_max,
+                y_min,
+                y_max,
+                z_min,
+                z_max,
+                nx,
+                ny,
+                nz,
+                os_bw,
+                oversample,
+            )
+    finally:
+        free(ind_array_ptrs)
+        free(vol_array_ptrs)
+
+
+@cython.embedsignature(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.nonecheck(False)
+def shift_and_bin_parallel(list ind_arrays,
+                           list vol_arrays,
+                           np.ndarray[double, ndim=2] dom_coords,
+                           double[:, :] survival_prob,
+                           double[:, :] prho,
+                           double[:, :] pz,
+                           int nr,
+                           int ntheta,
+                           double r_max,
+                           double[::1] binned_spv,
+                           double[::1] binned_px_spv,
+                           double[::1] binned_py_spv,
+                           double[::1] binned_pz_spv,
+                           double[::1] binned_one_minus_sp,
+                           double x_min,
+                           double x_max,
+                           double y_min,
+                           double y_max,
+                           double z_min,
+                           double z_max,
+                           double binwidth,
+                           int oversample,
+                           anisotropy,
+                           int num_threads=0):
+    r"""Multi-threaded version of `shift_and_bin`; see that function for
+    details on all but the last parameter.
+
+    DOMs are split into `num_threads` contiguous blocks, each of which is
+    binned by one thread into its own set of accumulators. The per-thread
+    accumulators are then combined with the input accumulators in thread
+    order, so results do not depend on thread scheduling; they agree with
+    those of `shift_and_bin` to within floating-point round-off (and exactly
+    if `num_threads` is 1 and the input accumulators are freshly
+    initialized).
+
+    Note that memory usage is that of seven (nx*ny*nz,) float64 arrays per
+    thread.
+
+    Parameters
+    ----------
+    num_threads : int, optional
+        Number of threads to use; values <= 0 use `multiprocessing.cpu_count`.
+        No more threads than DOMs are used.
+
+    """
+    assert binwidth > 0
+    assert oversample >= 1
+    assert anisotropy is None
+
+    cdef:
+        unsigned int num_first_octant_pol_bins = len(vol_arrays)
+
+        double os_bw = binwidth / <double>oversample
+
+        unsigned int nx = <unsigned int>round((x_max - x_min) / binwidth)
+        unsigned int ny = <unsigned int>round((y_max - y_min) / binwidth)
+        unsigned int nz = <unsigned int>round((z_max - z_min) / binwidth)
+        Py_ssize_t num_cart_bins = nx*ny*nz
+
+        int[:] num_cart_bins_in_pol_bin = np.empty(num_first_octant_pol_bins, dtype=np.int32)
+
+        double[:, :] dom_xyz = dom_coords
+        int num_doms = <int>dom_coords.shape[0]
+        int dom_idx, thread_idx
+        Py_ssize_t flat_cart_ix
+
+        double[:, ::1] local_spv, local_px_spv, local_py_spv, local_pz_spv
+        double[:, ::1] local_one_minus_sp, local_dom_binned_vol, local_dom_binned_spv
+
+        unsigned int **ind_array_ptrs = <unsigned int**>malloc(num_first_octant_pol_bins * sizeof(unsigned int*))
+        double **vol_array_ptrs = <double**>malloc(num_first_octant_pol_bins * sizeof(double*))
+
+    if num_threads <= 0:
+        num_threads = cpu_count()
+    num_threads = max(1, min(num_threads, num_doms))
+
+    try:
+        _check_and_get_ptrs(
+            ind_arrays=ind_arrays,
+            vol_arrays=vol_arrays,
+            nr=nr,
+            ntheta=ntheta,
+            accumulators=[binned_spv, binned_px_spv, binned_py_spv, binned_pz_spv, binned_one_minus_sp],
+            x_min=x_min,
+            x_max=x_max,
+            y_min=y_min,
+            y_max=y_max,
+            z_min=z_min,
+            z_max=z_max,
+            binwidth=binwidth,
+            num_cart_bins_in_pol_bin=num_cart_bins_in_pol_bin,
+            ind_array_ptrs=<size_t>ind_array_ptrs,
+            vol_array_ptrs=<size_t>vol_array_ptrs,
+        )
+        if num_doms == 0:
+            return
+
+        shape = (num_threads, num_cart_bins)
+        local_spv = np.zeros(shape, dtype=np.float64)
+        local_px_spv = np.zeros(shape, dtype=np.float64)
+        local_py_spv = np.zeros(shape, dtype=np.float64)
+        local_pz_spv = np.zeros(shape, dtype=np.float64)
+        local_one_minus_sp = np.ones(shape, dtype=np.float64)
+        local_dom_binned_vol = np.empty(shape, dtype=np.float64)
+        local_dom_binned_spv = np.empty(shape, dtype=np.float64)
+
+        for thread_idx in prange(num_threads, nogil=True, schedule='static', chunksize=1,
+                                 num_threads=num_threads):
+            for dom_idx in range(thread_idx * num_doms // num_threads,
+                                 (thread_idx + 1) * num_doms // num_threads):
+                _shift_and_bin_dom(
+                    dom_xyz[dom_idx, 0],
+                    dom_xyz[dom_idx, 1],
+                    dom_xyz[dom_idx, 2],
+                    ind_array_ptrs,
+                    vol_array_ptrs,
+                    num_cart_bins_in_pol_bin,
+                    survival_prob,
+                    prho,
+                    pz,
+                    nr,
+                    ntheta,
+                    r_max,
+                    &local_spv[thread_idx, 0],
+                    &local_px_spv[thread_idx, 0],
+                    &local_py_spv[thread_idx, 0],
+                    &local_pz_spv[thread_idx, 0],
+                    &local_one_minus_sp[thread_idx, 0],
+                    &local_dom_binned_vol[thread_idx, 0],
+                    &local_dom_binned_spv[thread_idx, 0],
+                    x_min,
+                    x_max,
+                    y_min,
+                    y_max,
+                    z_min,
+                    z_max,
+                    nx,
+                    ny,
+                    nz,
+                    os_bw,
+                    oversample,
+                )
+
+        # Reduce; each Cartesian bin combines threads' values in thread order
+        for flat_cart_ix in prange(num_cart_bins, nogil=True, schedule='static',
+                                   num_threads=num_threads):
+            for thread_idx in range(num_threads):
+                binned_spv[flat_cart_ix] += local_spv[thread_idx, flat_cart_ix]
+                binned_px_spv[flat_cart_ix] += local_px_spv[thread_idx, flat_cart_ix]
+                binned_py_spv[flat_cart_ix] += local_py_spv[thread_idx, flat_cart_ix]
+                binned_pz_spv[flat_cart_ix] += local_pz_spv[thread_idx, flat_cart_ix]
+                binned_one_minus_sp[flat_cart_ix] *= local_one_minus_sp[thread_idx, flat_cart_ix]
     finally:
         free(ind_array_ptrs)
         free(vol_array_ptrs)
+
+
+def _check_and_get_ptrs(list ind_arrays,
+                        list vol_arrays,
+                        int nr,
+                        int ntheta,
+                        list accumulators,
+                        double x_min,
+                        double x_max,
+                        double y_min,
+                        double y_max,
+                        double z_min,
+                        double z_max,
+                        double binwidth,
+                        int[:] num_cart_bins_in_pol_bin,
+                        size_t ind_array_ptrs,
+                        size_t vol_array_ptrs):
+    """Validate arguments common to `shift_and_bin` and
+    `shift_and_bin_parallel` and fill in the number of Cartesian bins in each
+    polar bin and pointers to the data of `ind_arrays` and `vol_arrays`"""
+    cdef:
+        unsigned int num_first_octant_pol_bins = len(vol_arrays)
+        unsigned int nx = <unsigned int>round((x_max - x_min) / binwidth)
+        unsigned int ny = <unsigned int>round((y_max - y_min) / binwidth)
+        unsigned int nz = <unsigned int>round((z_max - z_min) / binwidth)
+        unsigned int ix
+        unsigned int **ind_ptrs = <unsigned int**>ind_array_ptrs
+        double **vol_ptrs = <double**>vol_array_ptrs
+        np.ndarray[unsigned int, ndim=2] ind_array
+        np.ndarray[double, ndim=1] vol_array
+        double[::1] accumulator
+
+    # Enforce < 1 micrometer accumulated error for binning
+    assert abs(x_min + nx * binwidth - x_max) < 1e-6
+    assert abs(y_min + ny * binwidth - y_max) < 1e-6
+    assert abs(z_min + nz * binwidth - z_max) < 1e-6
+
+    assert num_first_octant_pol_bins == nr * ntheta / 2
+
+    for accumulator in accumulators:
+        assert accumulator.shape[0] == nx*ny*nz
+
+    for ix in range(num_first_octant_pol_bins):
+        num_cart_bins_in_pol_bin[ix] = vol_arrays[ix].shape[0]
+        ind_array = ind_arrays[ix]
+        vol_array = vol_arrays[ix]
+        ind_ptrs[ix] = <unsigned int*>ind_array.data
+        vol_ptrs[ix] = <double*>vol_array.data
+
+
+def test_shift_and_bin_parallel():
+    """Unit test that `shift_and_bin_parallel` reproduces `shift_and_bin`
+    (exactly for one thread, and to within round-off for more), using random
+    polar-to-Cartesian bin mappings and DOMs in and around the volume."""
+    rand = np.random.RandomState(0)
+    nr, ntheta, oversample = 5, 6, 2
+    binwidth = 1.0
+    x_min, x_max, y_min, y_max, z_min, z_max = -4.0, 4.0, -3.0, 5.0, -6.0, 2.0
+    r_max = 6.0
+    nx = int(round((x_max - x_min) / binwidth))
+    ny = int(round((y_max - y_min) / binwidth))
+    nz = int(round((z_max - z_min) / binwidth))
+
+    ind_arrays = []
+    vol_arrays = []
+    for _ in range(nr * ntheta // 2):
+        num_cart_bins = rand.randint(0, 20)
+        ind_arrays.append(
+            rand.randint(0, int(r_max) * oversample, size=(num_cart_bins, 3)).astype(np.uint32)
+        )
+        vol_arrays.append(rand.uniform(0, 1, size=num_cart_bins))
+
+    survival_prob = rand.uniform(0, 1, size=(nr, ntheta))
+    prho = rand.uniform(-1, 1, size=(nr, ntheta))
+    pz = rand.uniform(-1, 1, size=(nr, ntheta))
+    dom_coords = rand.uniform(-12, 12, size=(23, 3))
+
+    kwargs = dict(
+        ind_arrays=ind_arrays,
+        vol_arrays=vol_arrays,
+        dom_coords=dom_coords,
+        survival_prob=survival_prob,
+        prho=prho,
+        pz=pz,
+        nr=nr,
+        ntheta=ntheta,
+        r_max=r_max,
+        x_min=x_min,
+        x_max=x_max,
+        y_min=y_min,
+        y_max=y_max,
+        z_min=z_min,
+        z_max=z_max,
+        binwidth=binwidth,
+        oversample=oversample,
+        anisotropy=None,
+    )
+
+    def get_accumulators():
+        accumulators = dict(
+            (name, np.zeros(nx * ny * nz, dtype=np.float64))
+            for name in ['binned_spv', 'binned_px_spv', 'binned_py_spv', 'binned_pz_spv']
+        )
+        accumulators['binned_one_minus_sp'] = np.ones(nx * ny * nz, dtype=np.float64)
+        return accumulators
+
+    ref = get_accumulators()
+    shift_and_bin(**dict(kwargs, **ref))
+    assert np.count_nonzero(ref['binned_spv']) > 0
+    assert np.count_nonzero(ref['binned_one_minus_sp'] != 1) > 0
+
+    for num_threads in [1, 2, 3, 8, 100]:
+        test = get_accumulators()
+        shift_and_bin_parallel(num_threads=num_threads, **dict(kwargs, **test))
+        for name, ref_vals in ref.items():
+            if num_threads == 1:
+                assert np.array_equal(test[name], ref_vals), (num_threads, name)
+            else:
+                assert np.allclose(test[name], ref_vals, rtol=1e-12, atol=1e-12), (num_threads, name)
+
+    print('<< PASS : test_shift_and_bin_parallel >>')
@@ -0,0 +1,758 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position, too-many-locals
+
+"""
+Adaptive block-sparse (octree) representation of (Cherenkov) TDI tables.
+
+The spatial volume is covered by a grid with the (x, y, z) binning of the
+finest input TDI table, which is divided into cubic blocks of `block_size`
+bins on a side. Each block is the root of an octree whose nodes are either
+
+* empty: all values (for all directions) are within tolerance of zero;
+* leaves: values are stored on a grid downsampled by a power of two (from a
+  single average value per direction for the whole node up to full
+  resolution), the coarsest that reproduces all of the node's values to
+  within tolerance; or
+* internal: split into eight child nodes, if that takes less storage than the
+  best leaf.
+
+Directional (costhetadir, phidir) dimensions are not compressed. Where the
+fine table does not reach but a coarser table does (as for the two-level
+fine/coarse TDI scheme used by `pexp_5d`), the coarse table is resampled
+onto the fine grid, so a single sparse table replaces both.
+
+Tables are stored in a directory with one .npy file per array (which can be
+memory mapped) and a json file with the metadata.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'SPARSE_TDI_META_FNAME',
+    'SPARSE_TDI_ARRAY_NAMES',
+    'NODE_EMPTY',
+    'NODE_LEAF',
+    'NODE_INTERNAL',
+    'is_sparse_tdi',
+    'build_sparse_tdi',
+    'save_sparse_tdi',
+    'load_sparse_tdi',
+    'generate_sparse_tdi_lookup',
+    'check_sparse_tdi',
+    'test_sparse_tdi',
+    'parse_args',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from argparse import ArgumentParser
+from collections import OrderedDict, deque
+import json
+from os.path import abspath, dirname, isfile, join
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+import time
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro import DFLT_NUMBA_JIT_KWARGS, numba_jit
+from retro.utils.geom import generate_digitizer
+from retro.utils.misc import expand, mkdir
+
+
+SPARSE_TDI_META_FNAME = 'sparse_tdi_meta.json'
+
+SPARSE_TDI_ARRAY_NAMES = [
+    'block_nodes',
+    'node_kind',
+    'node_level',
+    'node_shift',
+    'node_offset',
+    'values',
+]
+"""Arrays making up a sparse TDI table, in the order they are passed (as a
+tuple) to the lookup function:
+
+* block_nodes : (nbx, nby, nbz) int32, root node of each block
+* node_kind : (n_nodes,) int8, one of NODE_EMPTY, NODE_LEAF, NODE_INTERNAL
+* node_level : (n_nodes,) int8, log2 of a node's side length in bins
+* node_shift : (n_nodes,) int8, log2 of a leaf's downsampling factor
+* node_offset : (n_nodes,) int64, index into `values` of a leaf's data or
+  index of the first of an internal node's eight (contiguous) children
+* values : (n_values,) float32, leaves' data, each C-ordered with shape
+  (side, side, side, n_costhetadir, n_phidir)
+"""
+
+NODE_EMPTY = 0
+NODE_LEAF = 1
+NODE_INTERNAL = 2
+
+SPATIAL_DIMS = ('x', 'y', 'z')
+DIR_DIMS = ('costhetadir', 'phidir')
+
+
+def is_sparse_tdi(path):
+    """Whether `path` is a directory containing a sparse TDI table"""
+    return isfile(join(expand(path), SPARSE_TDI_META_FNAME))
+
+
+def _block_means(cube, shift):
+    """Average (ignoring NaNs) groups of 2**shift bins in each spatial
+    dimension of `cube`; groups that are all NaN yield 0"""
+    factor = 1 << shift
+    side = cube.shape[0] // factor
+    grouped = cube.reshape(
+        (side, factor, side, factor, side, factor) + cube.shape[3:]
+    )
+    valid = ~np.isnan(grouped)
+    sums = np.where(valid, grouped, 0).sum(axis=(1, 3, 5))
+    counts = valid.sum(axis=(1, 3, 5))
+    return sums / np.maximum(counts, 1)
+
+
+def _max_abs_err(cube, coarse, shift):
+    """Max abs difference (ignoring NaNs) between `cube` and `coarse`
+    upsampled by 2**shift"""
+    factor = 1 << shift
+    side = coarse.shape[0]
+    grouped = cube.reshape(
+        (side, factor, side, factor, side, factor) + cube.shape[3:]
+    )
+    err = np.abs(
+        grouped - coarse[:, np.newaxis, :, np.newaxis, :, np.newaxis, ...]
+    )
+    return np.nanmax(err) if np.any(~np.isnan(err)) else 0.
+
+
+def _build_node(cube, level, min_level, tol):
+    """Recursively build the octree node for `cube`, a shape
+    (2**level, 2**level, 2**level, n_ctdir, n_phidir) array (NaN outside the
+    volume).
+
+    Returns
+    -------
+    node : dict
+    num_values : int
+        Number of values stored by the node and its descendants
+    max_err : float
+
+    """
+    if not np.any(np.abs(cube) > tol):
+        err = float(np.nanmax(np.abs(cube))) if np.any(~np.isnan(cube)) else 0.
+        return dict(kind=NODE_EMPTY, level=level), 0, err
+
+    # Coarsest leaf within tolerance
+    for shift in range(level, -1, -1):
+        coarse = _block_means(cube, shift)
+        err = _max_abs_err(cube, coarse, shift)
+        if err <= tol:
+            break
+    leaf = dict(kind=NODE_LEAF, level=level, shift=shift, data=coarse)
+    leaf_size = coarse.size
+
+    if shift == level or level <= min_level:
+        return leaf, leaf_size, err
+
+    half = 1 << (level - 1)
+    children = []
+    children_size = 0
+    children_err = 0.
+    for x0 in (0, half):
+        for y0 in (0, half):
+            for z0 in (0, half):
+                child, size, child_err = _build_node(
+                    cube=cube[x0:x0+half, y0:y0+half, z0:z0+half],
+                    level=level - 1,
+                    min_level=min_level,
+                    tol=tol,
+                )
+                children.append(child)
+                children_size += size
+                children_err = max(children_err, child_err)
+
+    if children_size < leaf_size:
+        return dict(kind=NODE_INTERNAL, level=level, children=children), \
+            children_size, children_err
+    return leaf, leaf_size, err
+
+
+def _sample_dense_tables(tdi_tables, tdi_metas, x, y, z):
+    """Values of the dense TDI tables at points (x, y, z) for all directions,
+    taking the first table containing each point (as `pexp_5d` does); 0 where
+    no table contains a point.
+
+    Returns
+    -------
+    values : shape (n_points, n_ctdir, n_phidir) array
+
+    """
+    dir_shape = tdi_tables[0].shape[3:]
+    values = np.zeros((len(x),) + dir_shape, dtype=np.float64)
+    remaining = np.ones(len(x), dtype=bool)
+    for table, meta in zip(tdi_tables, tdi_metas):
+        edges = [meta['bin_edges'][dim] for dim in SPATIAL_DIMS]
+        inside = remaining.copy()
+        for coord, dim_edges in zip((x, y, z), edges):
+            inside &= (coord >= dim_edges[0]) & (coord <= dim_edges[-1])
+        if not np.any(inside):
+            continue
+        indices = tuple(
+            np.clip(np.searchsorted(dim_edges, coord[inside], side='right') - 1,
+                    0, len(dim_edges) - 2)
+            for coord, dim_edges in zip((x, y, z), edges)
+        )
+        values[inside] = table[indices]
+        remaining &= ~inside
+    return values
+
+
+def build_sparse_tdi(tdi_tables, tdi_metas, rtol=1e-3, atol=None, block_size=16,
+                     min_block_size=2):
+    """Build a block-sparse (octree) representation of TDI table(s).
+
+    Parameters
+    ----------
+    tdi_tables : sequence of 1 or more arrays
+        Dense (x, y, z, costhetadir, phidir) TDI tables, finest first (as
+        returned by `retro.init_obj.setup_tdi_tables`)
+    tdi_metas : sequence of mappings
+        Corresponding metadata, each with "bin_edges" for all five dimensions;
+        directional binning must be identical for all tables, and the first
+        table's spatial binning must be regular
+    rtol : float >= 0, optional
+        Tolerance relative to the largest value in the tables; ignored if
+        `atol` is specified
+    atol : float >= 0, optional
+        Absolute tolerance: every value (at fine-grid resolution) is
+        reproduced to within this
+    block_size : int, optional
+        Side length of octree root blocks, in bins; power of 2
+    min_block_size : int, optional
+        Side length of the smallest octree nodes, in bins; power of 2
+
+    Returns
+    -------
+    arrays : OrderedDict
+        Keys are `SPARSE_TDI_ARRAY_NAMES`
+    meta : OrderedDict
+        Binning, tolerance, and compression / error statistics
+
+    """
+    t0 = time.time()
+    block_level = int(np.round(np.log2(block_size)))
+    min_level = int(np.round(np.log2(min_block_size)))
+    if 1 << block_level != block_size or 1 << min_level != min_block_size:
+        raise ValueError('`block_size` and `min_block_size` must be powers of 2')
+    if not 0 <= min_level <= block_level:
+        raise ValueError('Must have 1 <= `min_block_size` <= `block_size`')
+
+    fine_edges = tdi_metas[0]['bin_edges']
+    for meta in tdi_metas[1:]:
+        for dim in DIR_DIMS:
+            if not np.allclose(meta['bin_edges'][dim], fine_edges[dim]):
+                raise NotImplementedError(
+                    'TDI tables with differing directional binning'
+                )
+
+    if atol is None:
+        table_max = max(float(np.max(np.abs(table))) for table in tdi_tables)
+        tol = rtol * table_max
+    else:
+        tol = float(atol)
+
+    # Fine grid: first table's binning, extended to cover all tables
+    bin_edges = OrderedDict()
+    for dim in SPATIAL_DIMS:
+        edges = np.asarray(fine_edges[dim], dtype=np.float64)
+        widths = np.diff(edges)
+        if not np.allclose(widths, widths[0]):
+            raise NotImplementedError(
+                'Finest TDI table must have regular spatial binning'
+            )
+        binwidth = widths[0]
+        lower = min(meta['bin_edges'][dim][0] for meta in tdi_metas)
+        upper = max(meta['bin_edges'][dim][-1] for meta in tdi_metas)
+        n_below = int(np.ceil((edges[0] - lower) / binwidth - 1e-6))
+        n_above = int(np.ceil((upper - edges[-1]) / binwidth - 1e-6))
+        n_bins = len(widths) + n_below + n_above
+        bin_edges[dim] = edges[0] + binwidth * np.arange(-n_below, n_bins - n_below + 1)
+    for dim in DIR_DIMS:
+        bin_edges[dim] = np.asarray(fine_edges[dim], dtype=np.float64)
+
+    shape = tuple(len(bin_edges[dim]) - 1 for dim in SPATIAL_DIMS)
+    dir_shape = tuple(len(bin_edges[dim]) - 1 for dim in DIR_DIMS)
+    blocks_shape = tuple(int(np.ceil(n / block_size)) for n in shape)
+    centers = [0.5 * (bin_edges[dim][:-1] + bin_edges[dim][1:]) for dim in SPATIAL_DIMS]
+
+    roots = []
+    max_err = 0.
+    for block_idx in np.ndindex(*blocks_shape):
+        # Centers of the block's bins; bins beyond the grid are NaN
+        block_centers = []
+        for dim_idx, bidx in enumerate(block_idx):
+            dim_centers = np.full(block_size, np.nan)
+            start = bidx * block_size
+            stop = min(start + block_size, shape[dim_idx])
+            dim_centers[:stop - start] = centers[dim_idx][start:stop]
+            block_centers.append(dim_centers)
+        bx, by, bz = np.meshgrid(*block_centers, indexing='ij')
+        pad = np.isnan(bx) | np.isnan(by) | np.isnan(bz)
+        cube = np.full((block_size,)*3 + dir_shape, np.nan)
+        cube[~pad] = _sample_dense_tables(
+            tdi_tables, tdi_metas, bx[~pad], by[~pad], bz[~pad]
+        )
+        root, _, err = _build_node(cube=cube, level=block_level, min_level=min_level, tol=tol)
+        roots.append(root)
+        max_err = max(max_err, err)
+
+    # Flatten trees breadth-first so each internal node's children are
+    # contiguous
+    node_kind, node_level, node_shift, node_offset = [], [], [], []
+    values = []
+    num_values = 0
+    queue = deque()
+
+    def _add(node):
+        node_kind.append(node['kind'])
+        node_level.append(node['level'])
+        node_shift.append(node.get('shift', 0))
+        node_offset.append(0)
+        queue.append((len(node_kind) - 1, node))
+
+    for root in roots:
+        _add(root)
+    while queue:
+        node_idx, node = queue.popleft()
+        if node['kind'] == NODE_LEAF:
+            node_offset[node_idx] = num_values
+            values.append(node['data'].astype(np.float32).ravel())
+            num_values += node['data'].size
+        elif node['kind'] == NODE_INTERNAL:
+            node_offset[node_idx] = len(node_kind)
+            for child in node['children']:
+                _add(child)
+
+    arrays = OrderedDict([
+        ('block_nodes', np.arange(len(roots), dtype=np.int32).reshape(blocks_shape)),
+        ('node_kind', np.array(node_kind, dtype=np.int8)),
+        ('node_level', np.array(node_level, dtype=np.int8)),
+        ('node_shift', np.array(node_shift, dtype=np.int8)),
+        ('node_offset', np.array(node_offset, dtype=np.int64)),
+        ('values', np.concatenate(values) if values else np.zeros(0, dtype=np.float32)),
+    ])
+
+    dense_nbytes = int(sum(table.nbytes for table in tdi_tables))
+    sparse_nbytes = int(sum(array.nbytes for array in arrays.values()))
+    node_kind = arrays['node_kind']
+    meta = OrderedDict([
+        ('sparse', True),
+        ('bin_edges', bin_edges),
+        ('block_size', block_size),
+        ('min_block_size', min_block_size),
+        ('tol', tol),
+        ('max_abs_err', float(max_err)),
+        ('num_empty_nodes', int(np.sum(node_kind == NODE_EMPTY))),
+        ('num_leaf_nodes', int(np.sum(node_kind == NODE_LEAF))),
+        ('num_internal_nodes', int(np.sum(node_kind == NODE_INTERNAL))),
+        ('dense_nbytes', dense_nbytes),
+        ('sparse_nbytes', sparse_nbytes),
+        ('source_metas', [
+            OrderedDict((k, v) for k, v in m.items() if k != 'bin_edges')
+            for m in tdi_metas
+        ]),
+    ])
+
+    print('Built sparse TDI table in {:.1f} s: {:.1f} MiB (dense: {:.1f} MiB,'
+          ' {:.1f}x smaller); max abs error {:.3e} (tolerance {:.3e})'.format(
+              time.time() - t0, sparse_nbytes / 2**20, dense_nbytes / 2**20,
+              dense_nbytes / max(1, sparse_nbytes), max_err, tol))
+    print('Each source photon changes the TDI expected charge (and hence the'
+          ' LLH) by at most 0.45 * {:.3e} relative to the resampled dense'
+          ' tables'.format(max_err))
+
+    return arrays, meta
+
+
+def save_sparse_tdi(outdir, arrays, meta):
+    """Save a sparse TDI table (as returned by `build_sparse_tdi`)"""
+    outdir = expand(outdir)
+    mkdir(outdir)
+    for name in SPARSE_TDI_ARRAY_NAMES:
+        np.save(join(outdir, name + '.npy'), arrays[name])
+    json_meta = OrderedDict(meta)
+    json_meta['bin_edges'] = OrderedDict(
+        (dim, np.asarray(edges).tolist()) for dim, edges in meta['bin_edges'].items()
+    )
+    with open(join(outdir, SPARSE_TDI_META_FNAME), 'w') as fobj:
+        json.dump(json_meta, fobj, indent=2, default=str)
+
+
+def load_sparse_tdi(sparse_dir, mmap=False):
+    """Load a sparse TDI table.
+
+    Parameters
+    ----------
+    sparse_dir : string
+    mmap : bool, optional
+
+    Returns
+    -------
+    arrays : tuple
+        Arrays in the order of `SPARSE_TDI_ARRAY_NAMES`
+    meta : OrderedDict
+
+    """
+    sparse_dir = expand(sparse_dir)
+    with open(join(sparse_dir, SPARSE_TDI_META_FNAME), 'r') as fobj:
+        meta = json.load(fobj, object_pairs_hook=OrderedDict)
+    meta['bin_edges'] = OrderedDict(
+        (dim, np.array(edges, dtype=np.float64)) for dim, edges in meta['bin_edges'].items()
+    )
+    mmap_mode = 'r' if mmap else None
+    arrays = tuple(
+        np.load(join(sparse_dir, name + '.npy'), mmap_mode=mmap_mode)
+        for name in SPARSE_TDI_ARRAY_NAMES
+    )
+    return arrays, meta
+
+
+def generate_sparse_tdi_lookup(meta):
+    """Generate a numba-compiled lookup function for a sparse TDI table.
+
+    Parameters
+    ----------
+    meta : mapping
+        As returned by `load_sparse_tdi`
+
+    Returns
+    -------
+    sparse_tdi_lookup : callable
+        Call as ``sparse_tdi_lookup(arrays, x, y, z, costhetadir_bin_idx,
+        phidir_bin_idx)`` where `arrays` is the tuple of arrays returned by
+        `load_sparse_tdi`; returns 0 for points outside the table's volume
+
+    """
+    bin_edges = meta['bin_edges']
+    x_min, x_max = bin_edges['x'][[0, -1]]
+    y_min, y_max = bin_edges['y'][[0, -1]]
+    z_min, z_max = bin_edges['z'][[0, -1]]
+    digitize_x = generate_digitizer(bin_edges['x'], clip=True)
+    digitize_y = generate_digitizer(bin_edges['y'], clip=True)
+    digitize_z = generate_digitizer(bin_edges['z'], clip=True)
+    block_size = int(meta['block_size'])
+    n_phidir = len(bin_edges['phidir']) - 1
+    n_dir = (len(bin_edges['costhetadir']) - 1) * n_phidir
+
+    @numba_jit(**DFLT_NUMBA_JIT_KWARGS)
+    def sparse_tdi_lookup(arrays, x, y, z, costhetadir_bin_idx, phidir_bin_idx):
+        """Look up sparse TDI table value at (x, y, z) for a direction bin"""
+        if not (
+                x_min <= x <= x_max
+                and y_min <= y <= y_max
+                and z_min <= z <= z_max
+        ):
+            return 0.
+
+        block_nodes = arrays[0]
+        node_kind = arrays[1]
+        node_level = arrays[2]
+        node_shift = arrays[3]
+        node_offset = arrays[4]
+        values = arrays[5]
+
+        x_idx = digitize_x(x)
+        y_idx = digitize_y(y)
+        z_idx = digitize_z(z)
+        bx = x_idx // block_size
+        by = y_idx // block_size
+        bz = z_idx // block_size
+        lx = x_idx - bx * block_size
+        ly = y_idx - by * block_size
+        lz = z_idx - bz * block_size
+
+        node = block_nodes[bx, by, bz]
+        while node_kind[node] == NODE_INTERNAL:
+            half = 1 << (node_level[node] - 1)
+            child = 0
+            if lx >= half:
+                child += 4
+                lx -= half
+            if ly >= half:
+                child += 2
+                ly -= half
+            if lz >= half:
+                child += 1
+                lz -= half
+            node = node_offset[node] + child
+
+        if node_kind[node] == NODE_EMPTY:
+            return 0.
+
+        shift = node_shift[node]
+        side = 1 << (node_level[node] - shift)
+        cx = lx >> shift
+        cy = ly >> shift
+        cz = lz >> shift
+        return values[
+            node_offset[node]
+            + ((cx * side + cy) * side + cz) * n_dir
+            + costhetadir_bin_idx * n_phidir
+            + phidir_bin_idx
+        ]
+
+    return sparse_tdi_lookup
+
+
+def check_sparse_tdi(arrays, meta, tdi_tables, tdi_metas, num_samples=100000, seed=0):
+    """Compare sparse TDI lookups against the dense (two-level) lookups at
+    random points within the sparse table's volume and random directions.
+
+    Parameters
+    ----------
+    arrays : tuple
+    meta : mapping
+    tdi_tables, tdi_metas : sequences
+        Dense tables the sparse table was built from
+    num_samples : int, optional
+    seed : int, optional
+
+    Returns
+    -------
+    stats : OrderedDict
+        Max and mean absolute differences, and max difference relative to
+        the largest dense value
+
+    """
+    rand = np.random.RandomState(seed)
+    bin_edges = meta['bin_edges']
+    points = [
+        rand.uniform(bin_edges[dim][0], bin_edges[dim][-1], num_samples)
+        for dim in SPATIAL_DIMS
+    ]
+    n_ctdir = len(bin_edges['costhetadir']) - 1
+    n_phidir = len(bin_edges['phidir']) - 1
+    ctdir_idx = rand.randint(0, n_ctdir, num_samples)
+    phidir_idx = rand.randint(0, n_phidir, num_samples)
+
+    dense = _sample_dense_tables(tdi_tables, tdi_metas, *points)
+    dense = dense[np.arange(num_samples), ctdir_idx, phidir_idx]
+
+    lookup = generate_sparse_tdi_lookup(meta)
+    sparse = np.empty(num_samples, dtype=np.float64)
+    for i in range(num_samples):
+        sparse[i] = lookup(
+            arrays, points[0][i], points[1][i], points[2][i], ctdir_idx[i], phidir_idx[i]
+        )
+
+    abs_diff = np.abs(sparse - dense)
+    stats = OrderedDict([
+        ('num_samples', num_samples),
+        ('max_abs_diff', float(np.max(abs_diff))),
+        ('mean_abs_diff', float(np.mean(abs_diff))),
+        ('max_diff_rel_to_max', float(np.max(abs_diff) / max(np.max(np.abs(dense)), 1e-300))),
+    ])
+    print('Sparse vs. dense TDI lookups at {} random points: max |diff| = {:.3e},'
+          ' mean |diff| = {:.3e}, max |diff| / max = {:.3e}'.format(
+              num_samples, stats['max_abs_diff'], stats['mean_abs_diff'],
+              stats['max_diff_rel_to_max']))
+    return stats
+
+
+def _random_dense_tdi_tables(rand):
+    """Fine and coarse dense TDI tables: a smooth blob that falls to zero
+    (leaving empty regions), with noise in one corner (which only
+    full-resolution leaves reproduce)"""
+    dir_edges = OrderedDict([
+        ('costhetadir', np.linspace(-1, 1, 4)),
+        ('phidir', np.linspace(-np.pi, np.pi, 5)),
+    ])
+    tdi_tables, tdi_metas = [], []
+    for spatial_edges in [
+            [np.linspace(-50, 50, 13), np.linspace(-40, 40, 11), np.linspace(-30, 25, 8)],
+            [np.linspace(-100, 100, 6), np.linspace(-90, 90, 4), np.linspace(-60, 80, 5)],
+    ]:
+        bin_edges = OrderedDict(zip(SPATIAL_DIMS, spatial_edges))
+        bin_edges.update(dir_edges)
+        x, y, z = np.meshgrid(
+            *[0.5 * (edges[:-1] + edges[1:]) for edges in spatial_edges],
+            indexing='ij'
+        )
+        r = np.sqrt(x**2 + y**2 + z**2)
+        blob = np.clip(1 - r / 60, 0, None)
+        dir_weights = rand.uniform(0.5, 1, size=(len(dir_edges['costhetadir']) - 1,
+                                                  len(dir_edges['phidir']) - 1))
+        table = blob[..., np.newaxis, np.newaxis] * dir_weights
+        noisy = (x > 20) & (y > 20)
+        table[noisy] += rand.uniform(0, 0.5, size=table[noisy].shape)
+        tdi_tables.append(table.astype(np.float32))
+        tdi_metas.append(OrderedDict([('bin_edges', bin_edges)]))
+    return tdi_tables, tdi_metas
+
+
+def _reference_dense_tdi_lookup(tdi_tables, tdi_metas, x, y, z, costhetadir_bin_idx,
+                                phidir_bin_idx):
+    """Look up value of the first dense table containing (x, y, z) by
+    indexing it directly; 0 outside all tables"""
+    for table, meta in zip(tdi_tables, tdi_metas):
+        indices = []
+        for coord, dim in zip((x, y, z), SPATIAL_DIMS):
+            edges = meta['bin_edges'][dim]
+            if not edges[0] <= coord <= edges[-1]:
+                break
+            indices.append(min(int(np.sum(edges <= coord)) - 1, len(edges) - 2))
+        else:
+            return table[tuple(indices) + (costhetadir_bin_idx, phidir_bin_idx)]
+    return 0.
+
+
+def test_sparse_tdi():
+    """Unit tests for functions `build_sparse_tdi`, `save_sparse_tdi`,
+    `load_sparse_tdi`, and `generate_sparse_tdi_lookup`."""
+    rand = np.random.RandomState(0)
+    tdi_tables, tdi_metas = _random_dense_tdi_tables(rand)
+    table_max = max(np.max(table) for table in tdi_tables)
+    num_samples = 2000
+
+    tmpdir = mkdtemp(suffix='test_sparse_tdi')
+    try:
+        for num_tables, kwargs in [
+                (1, dict(atol=0, block_size=4, min_block_size=1)),
+                (1, dict(rtol=1e-2, block_size=8, min_block_size=2)),
+                (2, dict(atol=0, block_size=8, min_block_size=1)),
+                (2, dict(atol=0.02, block_size=4, min_block_size=2)),
+                (2, dict(rtol=0.1, block_size=16, min_block_size=4)),
+        ]:
+            arrays, meta = build_sparse_tdi(
+                tdi_tables=tdi_tables[:num_tables],
+                tdi_metas=tdi_metas[:num_tables],
+                **kwargs
+            )
+            tol = kwargs['atol'] if 'atol' in kwargs else kwargs['rtol'] * table_max
+            assert np.isclose(meta['tol'], tol)
+            assert meta['max_abs_err'] <= tol
+            assert meta['num_empty_nodes'] > 0 and meta['num_leaf_nodes'] > 0
+
+            outdir = join(tmpdir, 'sparse')
+            save_sparse_tdi(outdir=outdir, arrays=arrays, meta=meta)
+            assert is_sparse_tdi(outdir)
+            for mmap in [False, True]:
+                loaded_arrays, loaded_meta = load_sparse_tdi(outdir, mmap=mmap)
+                for name, array in zip(SPARSE_TDI_ARRAY_NAMES, loaded_arrays):
+                    assert np.array_equal(array, arrays[name]), name
+                lookup = generate_sparse_tdi_lookup(loaded_meta)
+
+                # Sample (extended) fine-grid bin centers, where every value is
+                # guaranteed to be reproduced to within tolerance
+                bin_edges = loaded_meta['bin_edges']
+                centers = [0.5 * (bin_edges[d][:-1] + bin_edges[d][1:]) for d in SPATIAL_DIMS]
+                n_ctdir = len(bin_edges['costhetadir']) - 1
+                n_phidir = len(bin_edges['phidir']) - 1
+                for _ in range(num_samples):
+                    x, y, z = [dim_centers[rand.randint(len(dim_centers))]
+                               for dim_centers in centers]
+                    ctdir_idx = rand.randint(n_ctdir)
+                    phidir_idx = rand.randint(n_phidir)
+                    ref = _reference_dense_tdi_lookup(
+                        tdi_tables[:num_tables], tdi_metas[:num_tables], x, y, z,
+                        ctdir_idx, phidir_idx
+                    )
+                    test = lookup(loaded_arrays, x, y, z, ctdir_idx, phidir_idx)
+                    assert abs(test - ref) <= tol + 1e-6 * abs(ref), \
+                        (kwargs, (x, y, z), test, ref)
+
+                # Outside the volume
+                for dim_idx in range(3):
+                    point = [dim_centers[0] for dim_centers in centers]
+                    point[dim_idx] = bin_edges[SPATIAL_DIMS[dim_idx]][-1] + 1
+                    assert lookup(loaded_arrays, *(point + [0, 0])) == 0
+
+                del loaded_arrays
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+    print('<< PASS : test_sparse_tdi >>')
+
+
+def parse_args(description=__doc__):
+    """Parse command line arguments"""
+    parser = ArgumentParser(description=description)
+    parser.add_argument(
+        '--tdi', action='append', required=True,
+        help='''Dense TDI table(s) as accepted by
+        retro.init_obj.setup_tdi_tables; repeat --tdi to specify multiple
+        tables (finely-binned tables BEFORE coarsely-binned tables)'''
+    )
+    parser.add_argument(
+        '--outdir', required=True,
+        help='''Directory in which to store the sparse TDI table'''
+    )
+    parser.add_argument(
+        '--rtol', type=float, default=1e-3,
+        help='''Tolerance relative to the largest table value'''
+    )
+    parser.add_argument(
+        '--atol', type=float, default=None,
+        help='''Absolute tolerance (overrides --rtol)'''
+    )
+    parser.add_argument(
+        '--block-size', type=int, default=16,
+        help='''Side length of octree root blocks, in bins (power of 2)'''
+    )
+    parser.add_argument(
+        '--min-block-size', type=int, default=2,
+        help='''Side length of smallest octree nodes, in bins (power of 2)'''
+    )
+    parser.add_argument(
+        '--num-check-samples', type=int, default=100000,
+        help='''Compare sparse and dense lookups at this many random points'''
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Script interface to `build_sparse_tdi`, `save_sparse_tdi`, and
+    `check_sparse_tdi`"""
+    from retro.init_obj import setup_tdi_tables
+    args = parse_args()
+    tdi_tables, tdi_metas = setup_tdi_tables(tdi=args.tdi, mmap=True)
+    arrays, meta = build_sparse_tdi(
+        tdi_tables=tdi_tables,
+        tdi_metas=tdi_metas,
+        rtol=args.rtol,
+        atol=args.atol,
+        block_size=args.block_size,
+        min_block_size=args.min_block_size,
+    )
+    if args.num_check_samples > 0:
+        meta['check'] = check_sparse_tdi(
+            arrays=tuple(arrays[name] for name in SPARSE_TDI_ARRAY_NAMES),
+            meta=meta,
+            tdi_tables=tdi_tables,
+            tdi_metas=tdi_metas,
+            num_samples=args.num_check_samples,
+        )
+    save_sparse_tdi(outdir=args.outdir, arrays=arrays, meta=meta)
+    print('Saved sparse TDI table to "{}"'.format(expand(args.outdir)))
+
+
+if __name__ == '__main__':
+    main()
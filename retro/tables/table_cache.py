@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position
+
+"""
+Content-addressed cache for table norms and table-set metadata.
+
+Two kinds of entries live in a table cache directory:
+
+* Norm entries, at ``<cache_dir>/norm_<key>/``, keyed by a hash of the table
+  binning, the other quantities the norm depends on (`TABLE_NORM_KEYS`),
+  `norm_version`, and the angular sensitivity model. Each holds the
+  precomputed table norm and t-indep table norm plus the binning, all as .npy
+  files (which can be memory mapped), and a small json file with the scalar
+  quantities. Many single-DOM tables share binning and photon counts, so they
+  share a single norm entry.
+
+* Table-set entries, at ``<cache_dir>/tables_<key>/``, keyed by a hash of the
+  table kind, table location, norm version, angular sensitivity model, and the
+  set of DOMs to load. Each holds the `sd_idx_table_indexer` (as .npy) and a
+  json manifest listing the table files loaded, the norm entry each uses, and
+  the modification times of the table files at the time the entry was
+  written (so modified tables invalidate the entry).
+
+Entries are written to a temporary directory which is then renamed, so
+concurrent writers cannot produce partial entries.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'TABLE_CACHE_VERSION',
+    'NORM_ENTRY_PREFIX',
+    'TABLES_ENTRY_PREFIX',
+    'hash_items',
+    'get_norm_cache_key',
+    'get_tables_cache_key',
+    'load_norm_entry',
+    'store_norm_entry',
+    'load_tables_entry',
+    'store_tables_entry',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from collections import OrderedDict
+import hashlib
+import json
+from os import getpid, rename
+from os.path import abspath, dirname, getmtime, isdir, isfile, join
+from shutil import rmtree
+import sys
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro.utils.misc import expand, mkdir
+
+
+TABLE_CACHE_VERSION = 1
+"""Increment when the layout or contents of cache entries change"""
+
+NORM_ENTRY_PREFIX = 'norm_'
+TABLES_ENTRY_PREFIX = 'tables_'
+
+
+def hash_items(items):
+    """Hash a sequence of (name, value) pairs in a manner that does not depend
+    on the Python version (unlike hashing pickled objects).
+
+    Parameters
+    ----------
+    items : sequence of (string, value) pairs
+        Values can be strings, bools, numbers, None, or numpy arrays
+        (numeric arrays are hashed as float64)
+
+    Returns
+    -------
+    hash_val : string
+        Hex digest
+
+    """
+    hasher = hashlib.sha1()
+    for name, val in items:
+        hasher.update(name.encode('utf-8'))
+        if isinstance(val, np.ndarray):
+            val = np.ascontiguousarray(val, dtype=np.float64)
+            hasher.update(str(val.shape).encode('utf-8'))
+            hasher.update(val.tobytes())
+        else:
+            if isinstance(val, (float, np.floating)):
+                val = repr(float(val))
+            elif isinstance(val, (bool, np.bool_)):
+                val = str(bool(val))
+            elif isinstance(val, (int, np.integer)):
+                val = str(int(val))
+            hasher.update(str(val).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def get_norm_cache_key(norm_kwargs, norm_version, angsens_model):
+    """Cache key for a table norm.
+
+    Parameters
+    ----------
+    norm_kwargs : mapping
+        Must contain all of `TABLE_NORM_KEYS`
+    norm_version : string
+    angsens_model : string
+
+    Returns
+    -------
+    key : string
+
+    """
+    from retro.tables.retro_5d_tables import TABLE_NORM_KEYS
+    items = [
+        ('cache_version', TABLE_CACHE_VERSION),
+        ('norm_version', norm_version),
+        ('angsens_model', angsens_model),
+    ]
+    for key in TABLE_NORM_KEYS:
+        val = norm_kwargs[key]
+        if 'bin_edges' in key:
+            val = np.asarray(val)
+        items.append((key, val))
+    return hash_items(items)
+
+
+def get_tables_cache_key(table_kind, tables_location, norm_version,
+                         angsens_model, sd_indices, compute_t_indep_exp):
+    """Cache key for a set of loaded tables.
+
+    Parameters
+    ----------
+    table_kind : string
+    tables_location : string
+        Filename prototype or directory the tables were loaded from
+    norm_version : string
+    angsens_model : string
+    sd_indices : array of ints
+        DOMs for which tables are loaded (i.e., operational DOMs in use)
+    compute_t_indep_exp : bool
+
+    Returns
+    -------
+    key : string
+
+    """
+    return hash_items([
+        ('cache_version', TABLE_CACHE_VERSION),
+        ('table_kind', table_kind),
+        ('tables_location', expand(tables_location)),
+        ('norm_version', norm_version),
+        ('angsens_model', angsens_model),
+        ('sd_indices', np.asarray(sorted(sd_indices))),
+        ('compute_t_indep_exp', compute_t_indep_exp),
+    ])
+
+
+def _write_entry(entry_dir, arrays, meta):
+    """Write arrays (as .npy) and `meta` (as meta.json) to a temp dir, then
+    move it into place as `entry_dir`. An existing entry with identical
+    `meta` is kept; any other (e.g. stale) entry is replaced."""
+    if isdir(entry_dir) and _read_meta(entry_dir) == json.loads(json.dumps(meta)):
+        return
+    tmp_dir = '{}.tmp{}'.format(entry_dir, getpid())
+    mkdir(tmp_dir)
+    for key, val in arrays.items():
+        np.save(join(tmp_dir, key + '.npy'), val)
+    with open(join(tmp_dir, 'meta.json'), 'w') as fobj:
+        json.dump(meta, fobj, indent=2)
+
+    # A directory can't be renamed over a non-empty one, so move the old
+    # entry aside first; readers meanwhile just see no entry (a cache miss)
+    old_dir = '{}.old{}'.format(entry_dir, getpid())
+    try:
+        rename(entry_dir, old_dir)
+    except OSError:
+        # No old entry (or another process moved it aside)
+        old_dir = None
+    try:
+        rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process beat us to it
+        if not isdir(entry_dir):
+            raise
+        rmtree(tmp_dir)
+    if old_dir is not None:
+        rmtree(old_dir, ignore_errors=True)
+
+
+def _read_meta(entry_dir):
+    """Read meta.json from `entry_dir`, or return None if missing or from a
+    different cache version"""
+    fpath = join(entry_dir, 'meta.json')
+    if not isfile(fpath):
+        return None
+    with open(fpath, 'r') as fobj:
+        meta = json.load(fobj, object_pairs_hook=OrderedDict)
+    if meta.get('cache_version') != TABLE_CACHE_VERSION:
+        return None
+    return meta
+
+
+def load_norm_entry(cache_dir, key, mmap=True):
+    """Load a cached norm entry.
+
+    Parameters
+    ----------
+    cache_dir : string
+    key : string
+    mmap : bool, optional
+
+    Returns
+    -------
+    entry : OrderedDict or None
+        None if no (valid) entry exists; otherwise, contains "table_norm",
+        "t_indep_table_norm", and all of `TABLE_NORM_KEYS`
+
+    """
+    entry_dir = join(expand(cache_dir), NORM_ENTRY_PREFIX + key)
+    meta = _read_meta(entry_dir)
+    if meta is None:
+        return None
+    mmap_mode = 'r' if mmap else None
+    entry = OrderedDict()
+    for name in meta['arrays']:
+        entry[name] = np.load(join(entry_dir, name + '.npy'), mmap_mode=mmap_mode)
+    entry.update(meta['scalars'])
+    return entry
+
+
+def store_norm_entry(cache_dir, key, norm_kwargs, norm_version, angsens_model,
+                     table_norm, t_indep_table_norm):
+    """Store a norm entry (no-op if an identical one already exists).
+
+    Parameters
+    ----------
+    cache_dir, key : string
+    norm_kwargs : mapping
+        Must contain all of `TABLE_NORM_KEYS`
+    norm_version, angsens_model : string
+    table_norm, t_indep_table_norm : array
+
+    """
+    from retro.tables.retro_5d_tables import TABLE_NORM_KEYS
+    arrays = OrderedDict()
+    arrays['table_norm'] = np.asarray(table_norm)
+    arrays['t_indep_table_norm'] = np.asarray(t_indep_table_norm)
+    scalars = OrderedDict()
+    for name in TABLE_NORM_KEYS:
+        if 'bin_edges' in name:
+            arrays[name] = np.asarray(norm_kwargs[name])
+        else:
+            scalars[name] = float(norm_kwargs[name])
+    meta = OrderedDict([
+        ('cache_version', TABLE_CACHE_VERSION),
+        ('norm_version', norm_version),
+        ('angsens_model', angsens_model),
+        ('arrays', list(arrays.keys())),
+        ('scalars', scalars),
+    ])
+    cache_dir = expand(cache_dir)
+    mkdir(cache_dir)
+    _write_entry(join(cache_dir, NORM_ENTRY_PREFIX + key), arrays, meta)
+
+
+def load_tables_entry(cache_dir, key):
+    """Load a cached table-set entry, checking that none of the table files
+    have been modified since the entry was written.
+
+    Parameters
+    ----------
+    cache_dir, key : string
+
+    Returns
+    -------
+    entry : OrderedDict or None
+        None if no (valid, up-to-date) entry exists; otherwise, contains
+        "sd_idx_table_indexer" and the items of the manifest written by
+        `store_tables_entry`
+
+    """
+    entry_dir = join(expand(cache_dir), TABLES_ENTRY_PREFIX + key)
+    meta = _read_meta(entry_dir)
+    if meta is None:
+        return None
+    for fpath, mtime in meta['mtimes'].items():
+        if not isfile(fpath) or getmtime(fpath) != mtime:
+            return None
+    entry = OrderedDict(meta)
+    entry['sd_idx_table_indexer'] = np.load(join(entry_dir, 'sd_idx_table_indexer.npy'))
+    return entry
+
+
+def store_tables_entry(cache_dir, key, sd_idx_table_indexer, manifest, fpaths):
+    """Store a table-set entry, replacing any stale one (no-op if an
+    up-to-date one already exists).
+
+    Parameters
+    ----------
+    cache_dir, key : string
+    sd_idx_table_indexer : array
+    manifest : mapping
+        JSON-serializable description of the loaded tables
+    fpaths : sequence of strings
+        Files whose modification invalidates the entry
+
+    """
+    meta = OrderedDict([('cache_version', TABLE_CACHE_VERSION)])
+    meta.update(manifest)
+    meta['mtimes'] = OrderedDict((fpath, getmtime(fpath)) for fpath in fpaths)
+    cache_dir = expand(cache_dir)
+    mkdir(cache_dir)
+    _write_entry(
+        join(cache_dir, TABLES_ENTRY_PREFIX + key),
+        OrderedDict([('sd_idx_table_indexer', np.asarray(sd_idx_table_indexer))]),
+        meta,
+    )
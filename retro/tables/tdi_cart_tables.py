@@ -10,6 +10,8 @@ from __future__ import absolute_import, division, print_function
 __all__ = [
     'TDI_TABLE_FNAME_PROTO',
     'TDI_TABLE_FNAME_RE',
+    'TDI_STORE_DIRNAME_PROTO',
+    'TDI_QUANTITIES',
     'TDICartTable'
 ]
 
@@ -28,9 +30,8 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.'''
 
-from copy import deepcopy
-from glob import glob
-from os.path import abspath, basename, dirname, isdir, join
+from collections import OrderedDict
+from os.path import abspath, dirname, isdir, join
 import re
 import sys
 from time import time
@@ -43,9 +44,8 @@ if __name__ == '__main__' and __package__ is None:
     if RETRO_DIR not in sys.path:
         sys.path.append(RETRO_DIR)
 from retro.tables.pexp_xyz import pexp_xyz
-from retro.utils.misc import (
-    expand, force_little_endian, generate_anisotropy_str, hrlist2list
-)
+from retro.tables.tdi_store import TDIStore, is_tdi_store
+from retro.utils.misc import expand, hrlist2list
 
 
 TDI_TABLE_FNAME_PROTO = [
@@ -94,6 +94,18 @@ TDI_TABLE_FNAME_RE = re.compile(
 """Time- and DOM-independent (TDI) table file names can be found / interpreted
 using this regex"""
 
+TDI_STORE_DIRNAME_PROTO = 'retro_tdi_store_{store_hash:s}'
+"""Name of the TDI store directory into which tiles generated with identical
+parameters (other than their limits) are written"""
+
+TDI_QUANTITIES = [
+    'survival_prob',
+    'avg_photon_x',
+    'avg_photon_y',
+    'avg_photon_z',
+]
+"""Quantities stored for each TDI table"""
+
 
 # TODO: convert to using exponent rather than scale (scale will be applied via
 # dom_quant_eff when generating the TDI table in the first place; at this
@@ -104,18 +116,18 @@ class TDICartTable(object):
     """Load and use information from a time- and DOM-independent Cartesian
     (x, y, z)-binned Retro table.
 
-    The parameters used to generate the table are passed at instantiation of
-    this class to determine which table(s) to load when a table is requested
-    (multiple "tables" are loaded if a single table is generated from multiple
-    smaller tiles meant to be stitched together).
+    The table is read from a TDI store (see `retro.tables.tdi_store`) into
+    which the tiles making up the table were written by `generate_tdi_table`.
 
     Parameters
     ----------
     tables_dir : string
+        Directory containing the store or, if `store_hash` is None, the store
+        directory itself
 
-    proto_tile_hash : string
-        Hash value used to locate files in the `tables_dir` which contain tiles
-        relevant to the table being loaded.
+    store_hash : string, optional
+        Hash identifying the store within `tables_dir` (see
+        `TDI_STORE_DIRNAME_PROTO`)
 
     scale : float from 0 to 1, optional
         Scale factor by which to multiply the detection probabilities in the
@@ -131,20 +143,33 @@ class TDICartTable(object):
         directionality is not to be used, the corresponding tables will not be
         loaded, resulting in ~1/4 the memory footprint.
 
+    mmap : bool, optional
+        Memory map the tables rather than reading them into memory
+
     """
-    def __init__(self, tables_dir, proto_tile_hash, subvol=None, scale=1,
-                 use_directionality=True):
+    def __init__(self, tables_dir, store_hash=None, subvol=None, scale=1,
+                 use_directionality=True, mmap=True):
         # Translation and validation of args
         tables_dir = expand(tables_dir)
         assert isdir(tables_dir)
         assert isinstance(use_directionality, bool)
-        assert isinstance(proto_tile_hash, string_types)
         assert scale > 0
 
+        if store_hash is None:
+            store_dir = tables_dir
+        else:
+            assert isinstance(store_hash, string_types)
+            store_dir = join(
+                tables_dir, TDI_STORE_DIRNAME_PROTO.format(store_hash=store_hash)
+            )
+        if not is_tdi_store(store_dir):
+            raise ValueError('Could not find a TDI store at "{}"'.format(store_dir))
+
         self.tables_dir = tables_dir
+        self.store_dir = store_dir
         self.use_directionality = use_directionality
-        self.proto_tile_hash = proto_tile_hash
         self.scale = scale
+        self.mmap = mmap
 
         self.survival_prob = None
         self.avg_photon_x = None
@@ -159,284 +184,92 @@ class TDICartTable(object):
 
         self.tables_meta = None
 
-        proto_table_fpath = glob(join(
-            expand(self.tables_dir),
-            'retro_tdi_table_%s_*survival_prob.fits' % self.proto_tile_hash
-        ))
-        if not proto_table_fpath:
-            raise ValueError('Could not find the prototypical table.')
-        proto_table_fpath = proto_table_fpath[0]
-        proto_meta = self.get_table_metadata(proto_table_fpath)
-        if not proto_meta:
-            raise ValueError('Could not figure out metadata from\n%s'
-                             % proto_table_fpath)
-        self.proto_meta = proto_meta
-
-        # Some "universal" metadata can be gotten from the proto table
-        self.binmap_hash = proto_meta['binmap_hash']
-        self.geom_hash = proto_meta['geom_hash']
-        self.dom_tables_hash = proto_meta['dom_tables_hash']
-        self.time_indices = proto_meta['time_indices']
-        self.times_str = proto_meta['times_str']
-        self.x_tile_width = proto_meta['x_width']
-        self.y_tile_width = proto_meta['y_width']
-        self.z_tile_width = proto_meta['z_width']
-        self.binwidth = proto_meta['binwidth']
-        self.anisotropy = proto_meta['anisotropy']
-
-        if subvol is not None:
-            raise NotImplementedError()
-            sv_x0, sv_x1 = subvol[0][0], subvol[0][1]
-            sv_y0, sv_y1 = subvol[1][0], subvol[1][1]
-            sv_z0, sv_z1 = subvol[2][0], subvol[2][1]
-            assert sv_x1 - sv_x0 >= self.binwidth
-            assert sv_y1 - sv_y0 >= self.binwidth
-            assert sv_z1 - sv_z0 >= self.binwidth
-            sv_x0_idx = (sv_x0 - proto_meta['x_min']) / self.binwidth
-            sv_y0_idx = (sv_y0 - proto_meta['y_min']) / self.binwidth
-            sv_z0_idx = (sv_z0 - proto_meta['z_min']) / self.binwidth
-            assert abs(np.round(sv_x0_idx) - sv_x0_idx) * self.binwidth < 1e-6
-            assert abs(np.round(sv_y0_idx) - sv_y0_idx) * self.binwidth < 1e-6
-            assert abs(np.round(sv_z0_idx) - sv_z0_idx) * self.binwidth < 1e-6
-            sv_x1_idx = (sv_x1 - proto_meta['x_min']) / self.binwidth
-            sv_y1_idx = (sv_y1 - proto_meta['y_min']) / self.binwidth
-            sv_z1_idx = (sv_z1 - proto_meta['z_min']) / self.binwidth
-            assert abs(np.round(sv_x1_idx) - sv_x1_idx) * self.binwidth < 1e-6
-            assert abs(np.round(sv_y1_idx) - sv_y1_idx) * self.binwidth < 1e-6
-            assert abs(np.round(sv_z1_idx) - sv_z1_idx) * self.binwidth < 1e-6
+        self.store = TDIStore(store_dir, mmap=mmap)
+        store_meta = self.store.meta
+
+        # "Universal" metadata is common to all tiles in the store
+        self.store_hash = store_meta['store_hash']
+        self.binmap_hash = store_meta['binmap_hash']
+        self.geom_hash = store_meta['geom_hash']
+        self.dom_tables_hash = store_meta['dom_tables_hash']
+        self.times_str = store_meta['times_str']
+        if self.times_str == 'all':
+            self.time_indices = slice(None)
+        else:
+            self.time_indices = hrlist2list(self.times_str)
+        self.binwidth = store_meta['binwidth']
+        self.anisotropy = store_meta['anisotropy']
+        self.x_tile_width, self.y_tile_width, self.z_tile_width = (
+            nt * self.binwidth for nt in self.store.tile_shape
+        )
+
+        if subvol is None:
+            self.subvol_slices = (slice(None),) * 3
+        else:
+            subvol_slices = []
+            for dim, (sv0, sv1) in zip('xyz', subvol):
+                edges = self.store.bin_edges[dim]
+                assert sv1 - sv0 >= self.binwidth
+                idx0 = (sv0 - edges[0]) / self.binwidth
+                idx1 = (sv1 - edges[0]) / self.binwidth
+                assert abs(np.round(idx0) - idx0) * self.binwidth < 1e-6
+                assert abs(np.round(idx1) - idx1) * self.binwidth < 1e-6
+                idx0, idx1 = int(np.round(idx0)), int(np.round(idx1))
+                assert 0 <= idx0 < idx1 <= len(edges) - 1
+                subvol_slices.append(slice(idx0, idx1))
+            self.subvol_slices = tuple(subvol_slices)
         self.subvol = subvol
 
         self.tables_loaded = False
         self.load_tables()
 
-    @staticmethod
-    def get_table_metadata(fpath):
-        """Interpret a Retro TDI table filename or path, returning the critical
-        parameters used in generating that table.
-
-        Parameters
-        ----------
-        fpath : string
-            Path to the file or simply the filename
-
-        Returns
-        -------
-        info : None or dict
-            None is returned if the file name/path does not match the format
-            for a TDI table.
-
-        """
-        fname = basename(fpath)
-        match = TDI_TABLE_FNAME_RE[-1].match(fname)
-        if match is None:
-            return None
-        meta = match.groupdict()
-        for key, value in meta.items():
-            if key.endswith('min') or key.endswith('max') or key == 'binwidth':
-                meta[key] = float(meta[key])
-            elif key == 'n_phibins':
-                meta[key] = int(meta[key])
-            elif key.endswith('scale'):
-                meta[key] = float(meta[key])
-            elif key.endswith('hash'):
-                if value.lower() == 'none':
-                    meta[key] = None
-            elif key == 'times_str':
-                if value == 'all':
-                    meta['time_indices'] = slice(None)
-                else:
-                    meta['time_indices'] = hrlist2list(value)
-            elif key == 'anisotropy':
-                if value.lower() == 'none':
-                    meta[key] = None
-                # TODO: implement any other anisotropy spec xlation here
-        meta['x_width'] = meta['x_max'] - meta['x_min']
-        meta['y_width'] = meta['y_max'] - meta['y_min']
-        meta['z_width'] = meta['z_max'] - meta['z_min']
-        return meta
-
     def load_tables(self, force_reload=False):
-        """Load all tables that match the `proto_tile_hash`; if multiple tables
-        match, then stitch these together into one large TDI table."""
+        """Get the (memory-mapped, unless `mmap` is False) tables from the
+        store, which must have all of its tiles written."""
         if self.tables_loaded and not force_reload:
             return
-        from astropy.io import fits
 
         t0 = time()
 
-        x_ref = self.proto_meta['x_min']
-        y_ref = self.proto_meta['y_min']
-        z_ref = self.proto_meta['z_min']
-
-        must_match = [
-            'binmap_hash', 'geom_hash', 'dom_tables_hash', 'time_indices',
-            'binwidth', 'anisotropy',
-            # For simplicity, assume all tiles have equal widths. If there's a
-            # compelling reason to use something more complicated, we could
-            # implement it... but I see no reason to do so now
-            'x_width', 'y_width', 'z_width'
-        ]
-
-        # Work with "survival_prob" table filepaths, which generalizes to all
-        # table filepaths (so long as they exist)
-        fpaths = glob(join(
-            expand(self.tables_dir),
-            'retro_tdi_table_*survival_prob.fits'
-        ))
-
-        lowermost_corner = np.array([np.inf]*3)
-        uppermost_corner = np.array([-np.inf]*3)
-        to_load_meta = {}
-        for fpath in fpaths:
-            meta = self.get_table_metadata(fpath)
-            if meta is None:
-                continue
-
-            is_match = True
-            for key in must_match:
-                if meta[key] != self.proto_meta[key]:
-                    is_match = False
-
-            if not is_match:
-                continue
-
-            # Make sure that the corner falls on the reference grid (within
-            # micrometer precision)
-            x_float_idx = (meta['x_min'] - x_ref) / self.x_tile_width
-            y_float_idx = (meta['y_min'] - y_ref) / self.y_tile_width
-            z_float_idx = (meta['z_min'] - z_ref) / self.x_tile_width
-            indices_widths = (
-                [x_float_idx, y_float_idx, z_float_idx],
-                [self.x_tile_width, self.y_tile_width, self.z_tile_width]
-            )
-            for float_idx, tile_width in zip(indices_widths):
-                if abs(np.round(float_idx) - float_idx) * tile_width >= 1e-6:
-                    continue
-
-            # Extend the limits of the tiled volume to include this tile
-            lower_corner = [meta['x_min'], meta['y_min'], meta['z_min']]
-            upper_corner = [meta['x_max'], meta['y_max'], meta['z_max']]
-            lowermost_corner = np.min([lowermost_corner, lower_corner], axis=0)
-            uppermost_corner = np.max([uppermost_corner, upper_corner], axis=0)
-
-            # Store the metadata by relative tile index
-            rel_idx = tuple(int(np.round(i))
-                            for i in (x_float_idx, y_float_idx, z_float_idx))
-            to_load_meta[rel_idx] = meta
-
-        x_min, y_min, z_min = lowermost_corner
-        x_max, y_max, z_max = uppermost_corner
-
-        # Figure out how many tiles we _should_ have
-        nx_tiles = int(np.round((x_max - x_min) / self.x_tile_width))
-        ny_tiles = int(np.round((y_max - y_min) / self.y_tile_width))
-        nz_tiles = int(np.round((z_max - z_min) / self.z_tile_width))
-        n_tiles = nx_tiles * ny_tiles * nz_tiles
-        if len(to_load_meta) < n_tiles:
-            raise ValueError('Not enough tiles found! Cannot fill the extents'
-                             ' of the outermost extents of the volume defined'
-                             ' by the tiles found.')
-        elif len(to_load_meta) > n_tiles:
-            print(self.proto_meta['tdi_hash'])
-            print('x:', self.proto_meta['x_min'], self.proto_meta['x_max'],
-                  self.proto_meta['x_width'])
-            print('y:', self.proto_meta['y_min'], self.proto_meta['y_max'],
-                  self.proto_meta['y_width'])
-            print('z:', self.proto_meta['z_min'], self.proto_meta['z_max'],
-                  self.proto_meta['z_width'])
-            print('')
-            for v in to_load_meta.values():
-                print(v['tdi_hash'])
-                print('x:', v['x_min'], v['x_max'], v['x_width'])
-                print('y:', v['y_min'], v['y_max'], v['y_width'])
-                print('z:', v['z_min'], v['z_max'], v['z_width'])
-                print('')
+        store = self.store
+        tiles_written = store.tiles_written
+        if len(tiles_written) < store.num_tiles:
             raise ValueError(
-                'WTF? How did we get here? to_load_meta = %d, n_tiles = %d'
-                % (len(to_load_meta), n_tiles)
+                'Not enough tiles found! Only {} of {} tiles of the TDI store'
+                ' "{}" have been written.'
+                .format(len(tiles_written), store.num_tiles, store.store_dir)
             )
 
-        # Figure out how many bins in each dimension fill the volume
-        nx = int(np.round(nx_tiles * self.x_tile_width / self.binwidth))
-        ny = int(np.round(ny_tiles * self.y_tile_width / self.binwidth))
-        nz = int(np.round(nz_tiles * self.z_tile_width / self.binwidth))
+        survival_prob = store.get_array('survival_prob')[self.subvol_slices]
+        if self.scale != 1:
+            survival_prob = (1 - (1 - survival_prob)**self.scale).astype(np.float32)
 
-        # Number of bins per dimension in the tile
-        nx_per_tile = int(np.round(self.x_tile_width / self.binwidth))
-        ny_per_tile = int(np.round(self.y_tile_width / self.binwidth))
-        nz_per_tile = int(np.round(self.z_tile_width / self.binwidth))
-
-        # Create empty arrays to fill
-        survival_prob = np.empty((nx, ny, nz), dtype=np.float32)
         if self.use_directionality:
-            avg_photon_x = np.empty((nx, ny, nz), dtype=np.float32)
-            avg_photon_y = np.empty((nx, ny, nz), dtype=np.float32)
-            avg_photon_z = np.empty((nx, ny, nz), dtype=np.float32)
+            avg_photon_x = store.get_array('avg_photon_x')[self.subvol_slices]
+            avg_photon_y = store.get_array('avg_photon_y')[self.subvol_slices]
+            avg_photon_z = store.get_array('avg_photon_z')[self.subvol_slices]
         else:
             avg_photon_x, avg_photon_y, avg_photon_z = None, None, None
 
-        anisotropy_str = generate_anisotropy_str(self.anisotropy)
-
-        tables_meta = {} #[[[None]*nz_tiles]*ny_tiles]*nx_tiles
-        for meta in to_load_meta.values():
-            tile_x_idx = int(np.round(
-                (meta['x_min'] - x_min) / self.x_tile_width
-            ))
-            tile_y_idx = int(np.round(
-                (meta['y_min'] - y_min) / self.y_tile_width
-            ))
-            tile_z_idx = int(np.round(
-                (meta['z_min'] - z_min) / self.z_tile_width
-            ))
-
-            x0_idx = int(np.round((meta['x_min'] - x_min) / self.binwidth))
-            y0_idx = int(np.round((meta['y_min'] - y_min) / self.binwidth))
-            z0_idx = int(np.round((meta['z_min'] - z_min) / self.binwidth))
-
-            bin_idx_range = (slice(x0_idx, x0_idx + nx_per_tile),
-                             slice(y0_idx, y0_idx + ny_per_tile),
-                             slice(z0_idx, z0_idx + nz_per_tile))
-
-            kwargs = deepcopy(meta)
-            kwargs.pop('table_name')
-
-            to_fill = [('survival_prob', survival_prob)]
-            if self.use_directionality:
-                to_fill.extend([
-                    ('avg_photon_x', avg_photon_x),
-                    ('avg_photon_y', avg_photon_y),
-                    ('avg_photon_z', avg_photon_z)
-                ])
-
-            for table_name, table in to_fill:
-                fpath = join(
-                    self.tables_dir,
-                    TDI_TABLE_FNAME_PROTO[-1].format(
-                        table_name=table_name, anisotropy_str=anisotropy_str,
-                        **kwargs
-                    ).lower()
-                )
-
-                with fits.open(fpath) as fits_table:
-                    data = force_little_endian(fits_table[0].data) # pylint: disable=no-member
-
-                if self.scale != 1 and table_name == 'survival_prob':
-                    data = 1 - (1 - data)**self.scale
-
-                table[bin_idx_range] = data
-
-            tables_meta[(tile_x_idx, tile_y_idx, tile_z_idx)] = meta
+        mins, maxs = [], []
+        for dim, slc in zip('xyz', self.subvol_slices):
+            edges = store.bin_edges[dim][slc.start:None if slc.stop is None else slc.stop + 1]
+            mins.append(edges[0])
+            maxs.append(edges[-1])
+
+        tables_meta = OrderedDict(
+            (tile_idx, store.get_tile_meta(tile_idx)) for tile_idx in tiles_written
+        )
 
         # Since we have made it to the end successfully, it is now safe to
         # store the above-computed info to the object for later use
-        self.nx, self.ny, self.nz = nx, ny, nz
-        self.nx_tiles = nx_tiles
-        self.ny_tiles = ny_tiles
-        self.nz_tiles = nz_tiles
+        self.nx, self.ny, self.nz = survival_prob.shape
+        self.nx_tiles, self.ny_tiles, self.nz_tiles = store.tile_grid_shape
+        self.nx_per_tile, self.ny_per_tile, self.nz_per_tile = store.tile_shape
         self.n_bins = self.nx * self.ny * self.nz
-        self.n_tiles = self.nx_tiles * self.ny_tiles * self.nz_tiles
-        self.x_min, self.y_min, self.z_min = x_min, y_min, z_min
-        self.x_max, self.y_max, self.z_max = x_max, y_max, z_max
+        self.n_tiles = store.num_tiles
+        self.x_min, self.y_min, self.z_min = mins
+        self.x_max, self.y_max, self.z_max = maxs
 
         self.survival_prob = survival_prob
         self.avg_photon_x = avg_photon_x
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position
+
+"""
+Tiled, memory-mappable on-disk store for time- and DOM-independent (TDI)
+tables.
+
+A store is a directory containing
+
+* ``tdi_store.json``: header with the bin edges of every dimension, the tile
+  shape, the quantities stored, and free-form metadata (hashes, ice model,
+  etc.)
+* one ``<quantity>.npy`` file per quantity, each holding a single contiguous
+  array spanning the full volume of the store (so it can be loaded with
+  ``np.load(..., mmap_mode='r')`` or, using the dtype, shape, and offset in
+  the header, with ``np.memmap``)
+* ``tiles/tile_<i>_<j>_<k>.json`` marker files recording which (x, y, z)
+  tiles have been written and per-tile metadata
+
+Since every tile is written in place into the full-volume arrays, the arrays
+are always "stitched": nothing has to be assembled at load time, tiles are
+just slices of the arrays, and pages are only read from disk when touched.
+Tiles can be written by independent processes (e.g. cluster jobs), as each
+writes only its own region of the arrays and its own marker file. A store is
+built in a temporary directory and renamed into place, so it appears to other
+processes only once complete, and changes to the header are made while holding
+an exclusive lock on ``tdi_store.lock``.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'TDI_STORE_VERSION',
+    'TDI_STORE_HEADER_FNAME',
+    'is_tdi_store',
+    'create_tdi_store',
+    'TDIStore',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import errno
+import fcntl
+from glob import glob
+import json
+from os import getpid, rename
+from os.path import abspath, basename, dirname, isfile, join
+import re
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+
+import numpy as np
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro.utils.misc import expand, mkdir
+
+
+TDI_STORE_VERSION = 1
+"""Increment when the layout of a store changes"""
+
+TDI_STORE_HEADER_FNAME = 'tdi_store.json'
+
+TDI_STORE_LOCK_FNAME = 'tdi_store.lock'
+
+TILES_DIRNAME = 'tiles'
+
+TILE_FNAME_PROTO = 'tile_{:d}_{:d}_{:d}.json'
+
+TILE_FNAME_RE = re.compile(r'^tile_(\d+)_(\d+)_(\d+)\.json$')
+
+SPATIAL_DIMS = ('x', 'y', 'z')
+
+
+def _write_json(fpath, obj):
+    """Write `obj` to `fpath` via a temporary file so readers never see a
+    partially-written file"""
+    tmp_fpath = '{}.tmp{}'.format(fpath, getpid())
+    with open(tmp_fpath, 'w') as fobj:
+        json.dump(obj, fobj, indent=2)
+    rename(tmp_fpath, fpath)
+
+
+def _read_json(fpath):
+    with open(fpath, 'r') as fobj:
+        return json.load(fobj, object_pairs_hook=OrderedDict)
+
+
+@contextmanager
+def _header_lock(store_dir):
+    """Hold an exclusive lock on a store's header (blocking until available)
+    for the duration of the context"""
+    with open(join(store_dir, TDI_STORE_LOCK_FNAME), 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def is_tdi_store(path):
+    """Whether `path` is a TDI store directory"""
+    return isfile(join(expand(path), TDI_STORE_HEADER_FNAME))
+
+
+def create_tdi_store(store_dir, bin_edges, tile_shape, quantities,
+                     dtype=np.float32, fill_value=0, meta=None):
+    """Create a TDI store, allocating the (full-volume) array of each quantity
+    on disk. If a store already exists at `store_dir`, it is opened instead
+    after checking that it is compatible with the arguments (including, if
+    `meta` has a "store_hash", that the store's is the same).
+
+    Parameters
+    ----------
+    store_dir : string
+    bin_edges : mapping
+        Must have "x", "y", and "z" as its first three keys; any further keys
+        (e.g. "costhetadir" and "phidir") specify further dimensions of the
+        arrays, which are not tiled
+    tile_shape : sequence of 3 ints
+        Number of (x, y, z) bins in each tile; bins at the upper edges of the
+        volume can make for smaller tiles
+    quantities : sequence of strings
+        Name of each array to store, e.g. "survival_prob"
+    dtype : numpy dtype, optional
+    fill_value : scalar, optional
+        Initial value of arrays' elements
+    meta : mapping, optional
+        JSON-serializable metadata, e.g. hashes of the inputs to the table
+
+    Returns
+    -------
+    store : TDIStore
+        Opened writable
+
+    """
+    store_dir = expand(store_dir)
+    bin_edges = OrderedDict(
+        (dim, np.asarray(edges, dtype=np.float64)) for dim, edges in bin_edges.items()
+    )
+    if tuple(bin_edges.keys())[:3] != SPATIAL_DIMS:
+        raise ValueError('First three dims of `bin_edges` must be "x", "y", and "z"')
+    shape = tuple(len(edges) - 1 for edges in bin_edges.values())
+    tile_shape = tuple(int(n) for n in tile_shape)
+    if len(tile_shape) != 3 or min(tile_shape) < 1:
+        raise ValueError('`tile_shape` must be three ints >= 1')
+    dtype = np.dtype(dtype)
+
+    if not is_tdi_store(store_dir):
+        created = _build_tdi_store(
+            store_dir=store_dir,
+            bin_edges=bin_edges,
+            tile_shape=tile_shape,
+            quantities=quantities,
+            dtype=dtype,
+            fill_value=fill_value,
+            meta=meta,
+        )
+        if created:
+            return TDIStore(store_dir, mmap=True, writable=True)
+
+    # Store existed already (or was created by another process meanwhile)
+    store = TDIStore(store_dir, mmap=True, writable=True)
+    if (
+        store.shape != shape
+        or store.tile_shape != tile_shape
+        or store.dtype != dtype
+        or not all(
+            np.array_equal(store.bin_edges[d], bin_edges[d]) for d in bin_edges
+        )
+    ):
+        raise ValueError(
+            'Existing TDI store at "{}" is incompatible'.format(store_dir)
+        )
+    if (
+        meta is not None
+        and 'store_hash' in meta
+        and store.meta.get('store_hash') != meta['store_hash']
+    ):
+        raise ValueError(
+            'Existing TDI store at "{}" has store_hash {} but {} was specified;'
+            ' it was generated with different settings'.format(
+                store_dir, store.meta.get('store_hash'), meta['store_hash']
+            )
+        )
+    for quantity in quantities:
+        if quantity not in store.quantities:
+            store.add_quantity(quantity, fill_value=fill_value)
+    return store
+
+
+def _build_tdi_store(store_dir, bin_edges, tile_shape, quantities, dtype,
+                     fill_value, meta):
+    """Build a new store in a temporary directory next to `store_dir` and
+    rename it into place.
+
+    Returns
+    -------
+    created : bool
+        False if another process created a store at `store_dir` first
+
+    """
+    shape = tuple(len(edges) - 1 for edges in bin_edges.values())
+    parent_dir = dirname(store_dir)
+    mkdir(parent_dir)
+    tmp_dir = mkdtemp(prefix='.tmp', suffix='.' + basename(store_dir), dir=parent_dir)
+    try:
+        mkdir(join(tmp_dir, TILES_DIRNAME))
+        header = OrderedDict([
+            ('version', TDI_STORE_VERSION),
+            ('dtype', dtype.str),
+            ('shape', list(shape)),
+            ('tile_shape', list(tile_shape)),
+            ('bin_edges', OrderedDict((d, e.tolist()) for d, e in bin_edges.items())),
+            ('quantities', OrderedDict()),
+            ('meta', OrderedDict() if meta is None else meta),
+        ])
+        for quantity in quantities:
+            header['quantities'][quantity] = _create_array(
+                store_dir=tmp_dir,
+                quantity=quantity,
+                dtype=dtype,
+                shape=shape,
+                fill_value=fill_value,
+            )
+        _write_json(join(tmp_dir, TDI_STORE_HEADER_FNAME), header)
+
+        try:
+            rename(tmp_dir, store_dir)
+        except OSError as err:
+            if err.errno not in (errno.EEXIST, errno.ENOTEMPTY) or not is_tdi_store(store_dir):
+                raise
+            return False
+        return True
+
+    finally:
+        rmtree(tmp_dir, ignore_errors=True)
+
+
+def _create_array(store_dir, quantity, dtype, shape, fill_value):
+    """Allocate a quantity's .npy file and return its header entry"""
+    fname = quantity + '.npy'
+    array = np.lib.format.open_memmap(
+        join(store_dir, fname), mode='w+', dtype=dtype, shape=shape
+    )
+    if fill_value != 0:
+        array[...] = fill_value
+    array.flush()
+    entry = OrderedDict([('fname', fname), ('offset', int(array.offset))])
+    del array
+    return entry
+
+
+class TDIStore(object):
+    """Tiled TDI table store; see module docstring for layout.
+
+    Parameters
+    ----------
+    store_dir : string
+    mmap : bool, optional
+        Memory map arrays (otherwise, arrays are read into memory in their
+        entirety when first accessed)
+    writable : bool, optional
+        Open arrays for reading and writing (requires `mmap`)
+
+    """
+    def __init__(self, store_dir, mmap=True, writable=False):
+        if writable and not mmap:
+            raise ValueError('`writable` requires `mmap`')
+
+        self.store_dir = expand(store_dir)
+        self.mmap = mmap
+        self.writable = writable
+
+        header = _read_json(join(self.store_dir, TDI_STORE_HEADER_FNAME))
+        if header['version'] != TDI_STORE_VERSION:
+            raise ValueError(
+                'TDI store version {} is not supported (expected {})'
+                .format(header['version'], TDI_STORE_VERSION)
+            )
+        self.header = header
+        self.dtype = np.dtype(header['dtype'])
+        self.shape = tuple(header['shape'])
+        self.tile_shape = tuple(header['tile_shape'])
+        self.bin_edges = OrderedDict(
+            (dim, np.array(edges, dtype=np.float64))
+            for dim, edges in header['bin_edges'].items()
+        )
+        self.meta = header['meta']
+        self.tile_grid_shape = tuple(
+            int(np.ceil(n / nt)) for n, nt in zip(self.shape[:3], self.tile_shape)
+        )
+        self.num_tiles = int(np.prod(self.tile_grid_shape))
+
+        self._arrays = {}
+
+    @property
+    def quantities(self):
+        """Names of the quantities in the store"""
+        return list(self.header['quantities'].keys())
+
+    def add_quantity(self, quantity, fill_value=0):
+        """Allocate a new quantity's array and add it to the header"""
+        if not self.writable:
+            raise ValueError('Store not opened writable')
+        if quantity in self.header['quantities']:
+            raise ValueError('Quantity "{}" already exists'.format(quantity))
+        with _header_lock(self.store_dir):
+            header = self._reload_header()
+            # Another process may have added the quantity since this store
+            # was opened, in which case its array is used as-is
+            if quantity not in header['quantities']:
+                header['quantities'][quantity] = _create_array(
+                    store_dir=self.store_dir,
+                    quantity=quantity,
+                    dtype=self.dtype,
+                    shape=self.shape,
+                    fill_value=fill_value,
+                )
+                _write_json(join(self.store_dir, TDI_STORE_HEADER_FNAME), header)
+
+    def update_meta(self, meta):
+        """Update the store's metadata with the (JSON-serializable) items in
+        `meta`"""
+        if not self.writable:
+            raise ValueError('Store not opened writable')
+        with _header_lock(self.store_dir):
+            header = self._reload_header()
+            header['meta'].update(meta)
+            _write_json(join(self.store_dir, TDI_STORE_HEADER_FNAME), header)
+
+    def _reload_header(self):
+        """Re-read the header (which other processes may have changed) from
+        disk; call only while holding the header lock"""
+        self.header = _read_json(join(self.store_dir, TDI_STORE_HEADER_FNAME))
+        self.meta = self.header['meta']
+        return self.header
+
+    def get_array(self, quantity):
+        """Get the full-volume array of a quantity.
+
+        Parameters
+        ----------
+        quantity : string
+
+        Returns
+        -------
+        array : numpy.ndarray or numpy.memmap
+
+        """
+        if quantity not in self._arrays:
+            if quantity not in self.header['quantities']:
+                raise KeyError(
+                    'No quantity "{}" in TDI store "{}"; quantities are {}'
+                    .format(quantity, self.store_dir, self.quantities)
+                )
+            fpath = join(self.store_dir, self.header['quantities'][quantity]['fname'])
+            if self.writable:
+                mmap_mode = 'r+'
+            elif self.mmap:
+                mmap_mode = 'r'
+            else:
+                mmap_mode = None
+            self._arrays[quantity] = np.load(fpath, mmap_mode=mmap_mode)
+        return self._arrays[quantity]
+
+    def tile_slices(self, tile_idx):
+        """(x, y, z) slices into the full-volume arrays covered by a tile"""
+        tile_idx = self._check_tile_idx(tile_idx)
+        return tuple(
+            slice(i * nt, min((i + 1) * nt, n))
+            for i, nt, n in zip(tile_idx, self.tile_shape, self.shape)
+        )
+
+    def tile_bin_edges(self, tile_idx):
+        """Bin edges of a tile, formatted like `bin_edges`"""
+        slices = self.tile_slices(tile_idx)
+        edges = OrderedDict(self.bin_edges)
+        for dim, slc in zip(SPATIAL_DIMS, slices):
+            edges[dim] = edges[dim][slc.start:slc.stop + 1]
+        return edges
+
+    def find_tile(self, x, y, z):
+        """Index of the tile containing the point (x, y, z), or None if it is
+        outside the volume"""
+        tile_idx = []
+        for dim, coord, nt in zip(SPATIAL_DIMS, (x, y, z), self.tile_shape):
+            edges = self.bin_edges[dim]
+            if not edges[0] <= coord < edges[-1]:
+                return None
+            tile_idx.append(int((np.searchsorted(edges, coord, side='right') - 1) // nt))
+        return tuple(tile_idx)
+
+    def find_tile_for_lims(self, x_lims, y_lims, z_lims):
+        """Index of the tile exactly spanning the given (x, y, z) limits.
+
+        Raises
+        ------
+        ValueError
+            If the limits do not coincide with the edges of a tile
+
+        """
+        tile_idx = []
+        for dim, lims, nt in zip(SPATIAL_DIMS, (x_lims, y_lims, z_lims), self.tile_shape):
+            edges = self.bin_edges[dim]
+            start = int(np.argmin(np.abs(edges - lims[0])))
+            stop = int(np.argmin(np.abs(edges - lims[1])))
+            if (
+                abs(edges[start] - lims[0]) > 1e-6
+                or abs(edges[stop] - lims[1]) > 1e-6
+                or start % nt != 0
+                or stop != min(start + nt, len(edges) - 1)
+            ):
+                raise ValueError(
+                    '{}-limits {} do not match a tile of the store'.format(dim, lims)
+                )
+            tile_idx.append(start // nt)
+        return tuple(tile_idx)
+
+    def get_tile(self, quantity, tile_idx):
+        """Get a view of a tile's region of a quantity's array"""
+        return self.get_array(quantity)[self.tile_slices(tile_idx)]
+
+    def write_tile(self, tile_idx, arrays, tile_meta=None, accumulate=False):
+        """Write (or add) arrays into a tile's region and mark the tile as
+        written.
+
+        Parameters
+        ----------
+        tile_idx : sequence of 3 ints
+        arrays : mapping
+            Keys are quantities and values are arrays broadcastable to the
+            tile's region
+        tile_meta : mapping, optional
+            JSON-serializable metadata to record for the tile
+        accumulate : bool, optional
+            Add to the existing values instead of overwriting them
+
+        """
+        if not self.writable:
+            raise ValueError('Store not opened writable')
+        slices = self.tile_slices(tile_idx)
+        for quantity, values in arrays.items():
+            array = self.get_array(quantity)
+            if accumulate:
+                array[slices] += values
+            else:
+                array[slices] = values
+            array.flush()
+        self.mark_tile_written(tile_idx, tile_meta=tile_meta)
+
+    def mark_tile_written(self, tile_idx, tile_meta=None):
+        """Record that a tile's region has been written (e.g. if it was
+        written directly via `get_array`)"""
+        tile_idx = self._check_tile_idx(tile_idx)
+        _write_json(
+            join(self.store_dir, TILES_DIRNAME, TILE_FNAME_PROTO.format(*tile_idx)),
+            OrderedDict() if tile_meta is None else tile_meta,
+        )
+
+    def get_tile_meta(self, tile_idx):
+        """Metadata recorded for a tile, or None if it has not been written"""
+        tile_idx = self._check_tile_idx(tile_idx)
+        fpath = join(self.store_dir, TILES_DIRNAME, TILE_FNAME_PROTO.format(*tile_idx))
+        if not isfile(fpath):
+            return None
+        return _read_json(fpath)
+
+    @property
+    def tiles_written(self):
+        """Sorted list of indices of the tiles that have been written"""
+        tile_indices = []
+        for fpath in glob(join(self.store_dir, TILES_DIRNAME, 'tile_*.json')):
+            match = TILE_FNAME_RE.match(basename(fpath))
+            if match is not None:
+                tile_indices.append(tuple(int(i) for i in match.groups()))
+        return sorted(tile_indices)
+
+    @property
+    def complete(self):
+        """Whether all tiles have been written"""
+        return len(self.tiles_written) == self.num_tiles
+
+    def _check_tile_idx(self, tile_idx):
+        tile_idx = tuple(int(i) for i in tile_idx)
+        if len(tile_idx) != 3 or not all(
+                0 <= i < n for i, n in zip(tile_idx, self.tile_grid_shape)
+        ):
+            raise ValueError(
+                'Invalid tile index {}; tile grid has shape {}'
+                .format(tile_idx, self.tile_grid_shape)
+            )
+        return tile_idx
@@ -0,0 +1,794 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=wrong-import-position, too-many-locals
+
+"""
+Template-compress Cherenkov tables out of core.
+
+Every (r, costheta, t) bin of a Cherenkov table holds a directionality map over
+(costhetadir, deltaphidir). Template compression replaces each map by its
+total (the "weight") and the index of the best-matching normalized map from a
+library of templates shared by all tables. The library is found by clustering
+the well-populated maps (at least `min_photons` photons) of all tables in a
+PCA-reduced space, and summing the maps assigned to each cluster.
+
+All steps stream the (memory-mapped) tables in blocks sized to fit within a
+memory budget:
+
+1. fit an incremental PCA to the normalized maps of all tables;
+2. fit mini-batch k-means to the PCA-reduced maps (for one or more passes);
+3. sum the (unnormalized) maps assigned to each cluster into templates, which
+   are normalized, sorted by total (largest first), and saved to
+   "ckv_dir_templates.npy";
+4. assign each bin of each table the template with smallest chi-squared
+   distance to its normalized map, saving "ckv_template_map.npy" and
+   "template_chi2s.npy" in the table's directory. Blocks of bins are compared
+   against all templates at once (see `find_best_templates`), in parallel.
+
+This replaces the `table_compression/step1...step6` scripts. Requires
+scikit-learn.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__all__ = [
+    'TEMPLATE_MAP_T',
+    'DFLT_MAX_MEMORY',
+    'DFLT_MIN_PHOTONS',
+    'get_table_fpaths',
+    'iter_dir_maps',
+    'iter_dir_map_batches',
+    'fit_pca',
+    'fit_kmeans',
+    'sum_templates',
+    'get_chi2_lower_bounds',
+    'find_best_templates',
+    'assign_templates',
+    'test_find_best_templates',
+    'compress_tables',
+    'parse_args',
+    'main',
+]
+
+__author__ = 'P. Eller, J.L. Lanfranchi'
+__license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.'''
+
+from argparse import ArgumentParser
+from glob import glob
+from multiprocessing.pool import ThreadPool
+from os.path import abspath, dirname, isdir, isfile, join
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+import time
+
+import numpy as np
+from six import string_types
+from six.moves import cPickle as pickle
+
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro import DFLT_NUMBA_JIT_KWARGS, numba_jit
+from retro.tables.chunked_reduce import iter_lead_blocks
+from retro.utils.misc import expand, mkdir, nsort_key_func
+
+
+TEMPLATE_MAP_T = np.dtype([('index', np.uint16), ('weight', np.float32)])
+"""Entries of "ckv_template_map.npy": template index and total of the map"""
+
+DFLT_MAX_MEMORY = 2**30
+"""Default memory budget, in bytes"""
+
+DFLT_MIN_PHOTONS = 1000.
+"""Maps with fewer photons are too noisy to contribute to the library"""
+
+TEMPLATES_FNAME = 'ckv_dir_templates.npy'
+MODELS_FNAME = 'template_compression_models.pkl'
+
+
+def get_table_fpaths(tables):
+    """Find the "ckv_table.npy" files of tables.
+
+    Parameters
+    ----------
+    tables : string or iterable thereof
+        Each is glob-expanded and may be a table's directory or its
+        "ckv_table.npy" file
+
+    Returns
+    -------
+    table_fpaths : list of strings
+
+    """
+    if isinstance(tables, string_types):
+        tables = [tables]
+    table_fpaths = []
+    for pattern in tables:
+        for path in sorted(glob(expand(pattern)), key=nsort_key_func):
+            if isdir(path):
+                path = join(path, 'ckv_table.npy')
+            if isfile(path):
+                table_fpaths.append(path)
+    if not table_fpaths:
+        raise ValueError('Found no Cherenkov tables given {}'.format(tables))
+    return table_fpaths
+
+
+def _get_chunk_nbytes(max_memory):
+    """Size of table blocks to read at a time; leaves room for the
+    double-precision copies and batches made from each block"""
+    return max(1, max_memory // 8)
+
+
+def iter_dir_maps(table_fpath, max_memory=DFLT_MAX_MEMORY):
+    """Iterate over blocks of the directionality maps of a table.
+
+    Parameters
+    ----------
+    table_fpath : string
+        Path to "ckv_table.npy" (memory mapped)
+    max_memory : int, optional
+
+    Yields
+    ------
+    lead_slices : tuple of three slices
+        Block of (r, costheta, t) bins
+    maps : shape (n_bins_in_block, n_costhetadir * n_deltaphidir) array
+        Unnormalized maps
+    totals : shape (n_bins_in_block,) float64 array
+        Sum of each map
+
+    """
+    table = np.load(table_fpath, mmap_mode='r')
+    if table.ndim != 5:
+        raise ValueError('Expected 5D table, got shape {}'.format(table.shape))
+    n_dir = table.shape[3] * table.shape[4]
+    for lead_slices in iter_lead_blocks(
+            shape=table.shape,
+            num_lead_axes=3,
+            itemsize=table.dtype.itemsize,
+            chunk_nbytes=_get_chunk_nbytes(max_memory),
+    ):
+        maps = np.asarray(table[lead_slices]).reshape(-1, n_dir)
+        totals = maps.sum(axis=1, dtype=np.float64)
+        yield lead_slices, maps, totals
+
+
+def iter_dir_map_batches(table_fpaths, batch_rows, min_photons=DFLT_MIN_PHOTONS,
+                         max_memory=DFLT_MAX_MEMORY):
+    """Iterate over batches of the well-populated directionality maps of all
+    tables.
+
+    All batches have between `batch_rows` and 2 * `batch_rows` rows, except
+    if there are fewer than `batch_rows` maps in total.
+
+    Parameters
+    ----------
+    table_fpaths : sequence of strings
+    batch_rows : int > 0
+    min_photons : float, optional
+    max_memory : int, optional
+
+    Yields
+    ------
+    maps : shape (n_rows, n_dir) float64 array
+        Unnormalized maps
+    totals : shape (n_rows,) float64 array
+
+    """
+    buffered_maps = []
+    buffered_totals = []
+    num_buffered = 0
+    for table_fpath in table_fpaths:
+        for _, maps, totals in iter_dir_maps(table_fpath, max_memory=max_memory):
+            mask = totals >= min_photons
+            if not np.any(mask):
+                continue
+            buffered_maps.append(maps[mask].astype(np.float64))
+            buffered_totals.append(totals[mask])
+            num_buffered += buffered_totals[-1].size
+
+            if num_buffered < 2 * batch_rows:
+                continue
+            maps = np.concatenate(buffered_maps)
+            totals = np.concatenate(buffered_totals)
+            while totals.size >= 2 * batch_rows:
+                yield maps[:batch_rows], totals[:batch_rows]
+                maps = maps[batch_rows:]
+                totals = totals[batch_rows:]
+            buffered_maps = [maps]
+            buffered_totals = [totals]
+            num_buffered = totals.size
+
+    if num_buffered > 0:
+        yield np.concatenate(buffered_maps), np.concatenate(buffered_totals)
+
+
+def _get_batch_rows(table_fpaths, max_memory, min_rows):
+    """Rows per batch such that (two) batches fit in the memory budget"""
+    table = np.load(table_fpaths[0], mmap_mode='r')
+    row_nbytes = 8 * table.shape[3] * table.shape[4]
+    batch_rows = max_memory // (8 * row_nbytes)
+    if batch_rows < min_rows:
+        raise ValueError(
+            'Memory budget of {} bytes is too small for batches of {} maps;'
+            ' need at least {} bytes'.format(max_memory, min_rows, 8 * row_nbytes * min_rows)
+        )
+    return batch_rows
+
+
+def fit_pca(table_fpaths, n_components, batch_rows, min_photons=DFLT_MIN_PHOTONS,
+            max_memory=DFLT_MAX_MEMORY):
+    """Fit incremental PCA to the normalized, well-populated directionality
+    maps of all tables.
+
+    Returns
+    -------
+    pca : sklearn.decomposition.IncrementalPCA
+
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    pca = IncrementalPCA(n_components=n_components)
+    num_maps = 0
+    for maps, totals in iter_dir_map_batches(
+            table_fpaths, batch_rows=batch_rows, min_photons=min_photons,
+            max_memory=max_memory
+    ):
+        pca.partial_fit(maps / totals[:, np.newaxis])
+        num_maps += totals.size
+    print('Fit PCA with {} components to {} maps'.format(n_components, num_maps))
+    return pca
+
+
+def fit_kmeans(table_fpaths, pca, n_clusters, batch_rows, epochs=1,
+               min_photons=DFLT_MIN_PHOTONS, max_memory=DFLT_MAX_MEMORY,
+               random_state=0):
+    """Fit mini-batch k-means to the PCA-reduced normalized, well-populated
+    directionality maps of all tables.
+
+    Returns
+    -------
+    kmeans : sklearn.cluster.MiniBatchKMeans
+
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        batch_size=batch_rows,
+        compute_labels=False,
+        random_state=random_state,
+    )
+    for epoch in range(epochs):
+        for maps, totals in iter_dir_map_batches(
+                table_fpaths, batch_rows=batch_rows, min_photons=min_photons,
+                max_memory=max_memory
+        ):
+            kmeans.partial_fit(pca.transform(maps / totals[:, np.newaxis]))
+        print('Fit k-means with {} clusters, pass {}/{}'.format(n_clusters, epoch + 1, epochs))
+    return kmeans
+
+
+def sum_templates(table_fpaths, pca, kmeans, batch_rows, min_photons=DFLT_MIN_PHOTONS,
+                  max_memory=DFLT_MAX_MEMORY):
+    """Sum the (unnormalized) maps in each k-means cluster into templates.
+
+    Templates are normalized, empty templates are replaced by flat ones, and
+    templates are sorted by their totals (largest first).
+
+    Returns
+    -------
+    templates : shape (n_clusters, n_costhetadir, n_deltaphidir) array
+
+    """
+    dir_shape = np.load(table_fpaths[0], mmap_mode='r').shape[3:]
+    n_clusters = kmeans.cluster_centers_.shape[0]
+    templates = np.zeros((n_clusters, dir_shape[0] * dir_shape[1]), dtype=np.float64)
+    for maps, totals in iter_dir_map_batches(
+            table_fpaths, batch_rows=batch_rows, min_photons=min_photons,
+            max_memory=max_memory
+    ):
+        labels = kmeans.predict(pca.transform(maps / totals[:, np.newaxis]))
+        np.add.at(templates, labels, maps)
+
+    n_templates = templates.sum(axis=1)
+    empty = n_templates <= 0
+    if np.any(empty):
+        print('{} templates are zero - substituting with flat templates'
+              .format(np.count_nonzero(empty)))
+        templates[empty] = 1
+    templates /= templates.sum(axis=1)[:, np.newaxis]
+
+    # Largest first
+    sorted_indices = np.argsort(n_templates)[::-1]
+    return templates[sorted_indices].reshape((n_clusters,) + dir_shape)
+
+
+def get_chi2_lower_bounds(normed_maps, templates):
+    """Lower bounds on the chi-squared distances between each normalized map
+    and each template, computed for all pairs at once by matrix operations.
+
+    For non-negative `a` and `b`, each term of the chi-squared distance
+    satisfies ``(a - b)**2 / (a + b) >= (a - b)**2 / (max(a) + max(b))``, so
+    the distance is bounded by the squared Euclidean distance (computed via
+    the expanded square ``|a|**2 + |b|**2 - 2 a.b``) divided by
+    ``max(a) + max(b)``.
+
+    Parameters
+    ----------
+    normed_maps : shape (n_maps, n_dir) array
+    templates : shape (n_templates, n_dir) array
+
+    Returns
+    -------
+    lower_bounds : shape (n_maps, n_templates) float64 array
+
+    """
+    maps = normed_maps.astype(np.float64)
+    tmpls = templates.astype(np.float64)
+    maps_sq = np.einsum('ij,ij->i', maps, maps)
+    tmpls_sq = np.einsum('ij,ij->i', tmpls, tmpls)
+
+    lower_bounds = np.dot(maps, tmpls.T)
+    lower_bounds *= -2
+    lower_bounds += maps_sq[:, np.newaxis]
+    lower_bounds += tmpls_sq[np.newaxis, :]
+    # Absorb rounding errors of the expanded square (which can even make it
+    # negative for nearly identical maps and templates)
+    lower_bounds -= 1e-12 * (maps_sq[:, np.newaxis] + tmpls_sq[np.newaxis, :])
+    np.maximum(lower_bounds, 0, out=lower_bounds)
+
+    denoms = maps.max(axis=1)[:, np.newaxis] + tmpls.max(axis=1)[np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lower_bounds /= denoms
+    lower_bounds[denoms == 0] = 0
+    return lower_bounds
+
+
+@numba_jit(**DFLT_NUMBA_JIT_KWARGS)
+def _find_best_templates(normed_maps, templates, lower_bounds, order, slack, indices,
+                         chi2s):
+    """Find index of template with minimum chi-squared distance to each
+    normalized map, visiting templates in order of increasing lower bound and
+    stopping once the lower bound (inflated by `slack` to cover float32
+    rounding of the chi-squared sums) exceeds the best distance found. Ties go
+    to the smallest template index."""
+    n_templates, n_dir = templates.shape
+    for map_idx in range(normed_maps.shape[0]):
+        best_idx = n_templates
+        best_chi2 = np.float32(np.inf)
+        for order_idx in range(n_templates):
+            template_idx = order[map_idx, order_idx]
+            if lower_bounds[map_idx, template_idx] > slack * best_chi2:
+                break
+            chi2 = np.float32(0)
+            for dir_idx in range(n_dir):
+                a = normed_maps[map_idx, dir_idx]
+                b = templates[template_idx, dir_idx]
+                tot = a + b
+                if tot == 0:
+                    continue
+                chi2 += (a - b)**2 / tot
+            if chi2 < best_chi2 or (chi2 == best_chi2 and template_idx < best_idx):
+                best_chi2 = chi2
+                best_idx = template_idx
+        indices[map_idx] = best_idx
+        chi2s[map_idx] = best_chi2
+
+
+def find_best_templates(block, templates):
+    """Find the template with smallest chi-squared distance to the normalized
+    directionality map of each bin in a block of a table.
+
+    Distances are computed in single precision exactly as the original
+    (GPU) `table_compression/step6_assign_indices.py` did, but only for
+    templates not ruled out by `get_chi2_lower_bounds`, so results are
+    identical. Bins with empty maps get index 0 and chi2 0.
+
+    Parameters
+    ----------
+    block : shape (..., n_costhetadir, n_deltaphidir) array
+    templates : shape (n_templates, n_costhetadir * n_deltaphidir) float32 array
+
+    Returns
+    -------
+    indices : shape block.shape[:-2] int64 array
+    chi2s : shape block.shape[:-2] float32 array
+    totals : shape block.shape[:-2] float32 array
+        Sum of each map
+
+    """
+    block = np.asarray(block, dtype=np.float32)
+    lead_shape = block.shape[:-2]
+    totals = np.sum(block, axis=(-2, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normed_maps = np.nan_to_num(block / totals[..., np.newaxis, np.newaxis])
+    normed_maps = normed_maps.reshape(-1, templates.shape[1])
+    flat_totals = totals.reshape(-1)
+
+    indices = np.zeros(flat_totals.size, dtype=np.int64)
+    chi2s = np.zeros(flat_totals.size, dtype=np.float32)
+    nonempty = np.flatnonzero(flat_totals != 0)
+    if nonempty.size > 0:
+        normed_maps = np.ascontiguousarray(normed_maps[nonempty])
+        lower_bounds = get_chi2_lower_bounds(normed_maps, templates)
+        order = np.argsort(lower_bounds, axis=1)
+        # Relative error of a float32 sum of n_dir terms is below n_dir * eps
+        slack = 1 + 4 * templates.shape[1] * np.finfo(np.float32).eps
+        sub_indices = np.empty(nonempty.size, dtype=np.int64)
+        sub_chi2s = np.empty(nonempty.size, dtype=np.float32)
+        _find_best_templates(
+            normed_maps, templates, lower_bounds, order, slack, sub_indices, sub_chi2s
+        )
+        indices[nonempty] = sub_indices
+        chi2s[nonempty] = sub_chi2s
+
+    return indices.reshape(lead_shape), chi2s.reshape(lead_shape), totals
+
+
+def assign_templates(table_fpath, templates, outdir=None, max_memory=DFLT_MAX_MEMORY,
+                     threads=1):
+    """Assign each (r, costheta, t) bin of a table its best-matching template,
+    saving "ckv_template_map.npy" and "template_chi2s.npy".
+
+    Blocks of bins are processed in parallel by `threads` threads (the
+    matrix operations and the compiled chi-squared loop release the GIL).
+
+    Parameters
+    ----------
+    table_fpath : string
+    templates : shape (n_templates, n_costhetadir, n_deltaphidir) array
+    outdir : string, optional
+        Defaults to the table's directory
+    max_memory : int, optional
+        Memory budget shared by all threads
+    threads : int, optional
+
+    Returns
+    -------
+    template_map : memory-mapped array of dtype TEMPLATE_MAP_T
+    chi2s : memory-mapped float32 array
+
+    """
+    if templates.shape[0] > np.iinfo(TEMPLATE_MAP_T['index']).max + 1:
+        raise ValueError('Too many templates ({}) for template map index dtype {}'.format(
+            templates.shape[0], TEMPLATE_MAP_T['index']))
+    if outdir is None:
+        outdir = dirname(table_fpath)
+    outdir = expand(outdir)
+    mkdir(outdir)
+
+    flat_templates = np.ascontiguousarray(
+        templates.reshape(templates.shape[0], -1), dtype=np.float32
+    )
+    n_templates, n_dir = flat_templates.shape
+    table = np.load(table_fpath, mmap_mode='r')
+    if table.ndim != 5:
+        raise ValueError('Expected 5D table, got shape {}'.format(table.shape))
+    if table.shape[3] * table.shape[4] != n_dir:
+        raise ValueError('Table directionality maps of shape {} do not match templates'
+                         ' of shape {}'.format(table.shape[3:], templates.shape[1:]))
+
+    template_map = np.lib.format.open_memmap(
+        join(outdir, 'ckv_template_map.npy'), mode='w+', dtype=TEMPLATE_MAP_T,
+        shape=table.shape[:3]
+    )
+    chi2s = np.lib.format.open_memmap(
+        join(outdir, 'template_chi2s.npy'), mode='w+', dtype=np.float32,
+        shape=table.shape[:3]
+    )
+
+    # Per map: float32 block, normalized and float64 copies, and the float64
+    # lower bounds and int64 ordering over all templates
+    row_nbytes = (table.dtype.itemsize + 4 + 8) * n_dir + 16 * n_templates
+    block_rows = max(1, max_memory // (threads * row_nbytes))
+
+    def process_block(lead_slices):
+        """Assign templates to bins in one block"""
+        return (lead_slices,) + find_best_templates(table[lead_slices], flat_templates)
+
+    blocks = iter_lead_blocks(
+        shape=table.shape,
+        num_lead_axes=3,
+        itemsize=1,
+        chunk_nbytes=block_rows * n_dir,
+    )
+    pool = None
+    if threads > 1:
+        pool = ThreadPool(threads)
+        results = pool.imap_unordered(process_block, blocks)
+    else:
+        results = (process_block(lead_slices) for lead_slices in blocks)
+
+    try:
+        for lead_slices, indices, block_chi2s, totals in results:
+            template_map['index'][lead_slices] = indices
+            template_map['weight'][lead_slices] = totals
+            chi2s[lead_slices] = block_chi2s
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    template_map.flush()
+    chi2s.flush()
+    return template_map, chi2s
+
+
+def _brute_force_best_templates(normed_maps, templates):
+    """Index of and float32 chi-squared distance to the best template for
+    each normalized map, computing the distances to all templates"""
+    chi2s = np.zeros((normed_maps.shape[0], templates.shape[0]), dtype=np.float32)
+    for dir_idx in range(templates.shape[1]):
+        a = normed_maps[:, dir_idx][:, np.newaxis]
+        b = templates[:, dir_idx][np.newaxis, :]
+        tot = a + b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = (a - b)**2 / tot
+        terms[tot == 0] = 0
+        chi2s += terms
+    indices = np.argmin(chi2s, axis=1)
+    return indices, chi2s[np.arange(len(indices)), indices]
+
+
+def test_find_best_templates():
+    """Unit tests for functions `find_best_templates` and `assign_templates`."""
+    rand = np.random.RandomState(seed=0)
+    dir_shape = (5, 6)
+    n_dir = dir_shape[0] * dir_shape[1]
+
+    n_templates = 60
+    templates = rand.exponential(size=(n_templates, n_dir))
+    templates[rand.rand(*templates.shape) < 0.2] = 0
+    # Nearly flat templates, to which the lower bounds on the chi2 distances
+    # of nearly flat maps are tightest (within the `slack` of rounding errors)
+    n_flat = 10
+    templates[:n_flat] = 1 + 1e-6 * rand.randint(-3, 4, size=(n_flat, n_dir))
+    templates /= templates.sum(axis=1)[:, np.newaxis]
+    templates = templates.astype(np.float32)
+
+    # Exact duplicates of templates that sum to exactly 1 in single
+    # precision, such that maps that are power-of-2 multiples of them
+    # normalize to exactly the template. Such maps have chi2 = 0 to both
+    # templates, and ties go to the smallest index
+    sums = templates.reshape((-1,) + dir_shape).sum(axis=(-2, -1))
+    exact = np.flatnonzero(sums == 1)
+    num_dups = min(len(exact), n_templates // 3)
+    originals = exact[:num_dups]
+    duplicates = n_templates - 1 - np.arange(num_dups)
+    assert num_dups >= 5 and np.all(originals < duplicates)
+    templates[duplicates] = templates[originals]
+
+    lead_shape = (6, 7, 8)
+    n_maps = int(np.prod(lead_shape))
+    maps = rand.exponential(size=(n_maps, n_dir)) * rand.uniform(1, 1e4, size=(n_maps, 1))
+    maps[rand.rand(*maps.shape) < 0.3] = 0
+    template_idx = rand.randint(0, templates.shape[0], size=n_maps)
+    # Maps identical to a template (up to their totals), which includes the
+    # duplicated templates, ...
+    identical = np.arange(0, n_maps, 5)
+    maps[identical] = (
+        templates[template_idx[identical]] * rand.uniform(1, 1e4, size=(len(identical), 1))
+    )
+    tie_maps = 5 * np.arange(num_dups)
+    maps[tie_maps] = templates[duplicates] * 2.**rand.randint(-5, 20, size=(num_dups, 1))
+    # ... nearly identical to a template, ...
+    near = np.arange(1, n_maps, 5)
+    maps[near] = (
+        templates[template_idx[near]] * (1 + 1e-6 * rand.randn(len(near), n_dir))
+    )
+    # ... close to two templates at once, ...
+    between = np.arange(2, n_maps, 5)
+    maps[between] = (
+        templates[template_idx[between]] + templates[template_idx[between] - 1]
+    ) * (1 + 1e-6 * rand.randn(len(between), n_dir))
+    # ... nearly flat, ...
+    flat = np.arange(4, n_maps, 10)
+    maps[flat] = (
+        (1 + 1e-6 * rand.randint(-3, 4, size=(len(flat), n_dir)))
+        * rand.uniform(1, 1e4, size=(len(flat), 1))
+    )
+    # ... and empty
+    maps[3::5] = 0
+    maps[4::25] = 0
+    block = maps.reshape(lead_shape + dir_shape).astype(np.float32)
+
+    totals_ref = block.sum(axis=(-2, -1))
+    nonempty = totals_ref.reshape(-1) != 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normed_maps = np.nan_to_num(block / totals_ref[..., np.newaxis, np.newaxis])
+    indices_ref = np.zeros(n_maps, dtype=np.int64)
+    chi2s_ref = np.zeros(n_maps, dtype=np.float32)
+    indices_ref[nonempty], chi2s_ref[nonempty] = _brute_force_best_templates(
+        normed_maps.reshape(n_maps, n_dir)[nonempty], templates
+    )
+    indices_ref = indices_ref.reshape(lead_shape)
+    chi2s_ref = chi2s_ref.reshape(lead_shape)
+    assert np.all(chi2s_ref.flat[tie_maps] == 0)
+    assert np.array_equal(indices_ref.flat[tie_maps], originals)
+
+    indices, chi2s, totals = find_best_templates(block, templates)
+    assert np.array_equal(indices, indices_ref), np.count_nonzero(indices != indices_ref)
+    assert np.array_equal(chi2s, chi2s_ref)
+    assert np.array_equal(totals, totals_ref)
+
+    tmpdir = mkdtemp(suffix='test_find_best_templates')
+    try:
+        table_fpath = join(tmpdir, 'ckv_table.npy')
+        np.save(table_fpath, block)
+        for threads, max_memory in [(1, DFLT_MAX_MEMORY), (3, 20000)]:
+            template_map, chi2s = assign_templates(
+                table_fpath,
+                templates=templates.reshape((-1,) + dir_shape),
+                max_memory=max_memory,
+                threads=threads,
+            )
+            assert np.array_equal(template_map['index'], indices_ref)
+            assert np.array_equal(template_map['weight'], totals_ref)
+            assert np.array_equal(chi2s, chi2s_ref)
+            del template_map, chi2s
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+    print('<< PASS : test_find_best_templates >>')
+
+
+def compress_tables(
+        tables,
+        outdir,
+        n_components=100,
+        n_clusters=4000,
+        kmeans_epochs=1,
+        min_photons=DFLT_MIN_PHOTONS,
+        max_memory=DFLT_MAX_MEMORY,
+        random_state=0,
+        overwrite=False,
+        threads=1,
+):
+    """Build a template library from Cherenkov tables and template-compress
+    them; see module docstring.
+
+    Parameters
+    ----------
+    tables : string or iterable thereof
+        Table directories or "ckv_table.npy" files (glob-expanded)
+    outdir : string
+        Directory in which to save "ckv_dir_templates.npy" (and the fitted
+        PCA and k-means models)
+    n_components : int, optional
+        Number of PCA components
+    n_clusters : int, optional
+        Number of templates
+    kmeans_epochs : int, optional
+        Number of passes over all tables for fitting k-means
+    min_photons : float, optional
+        Only maps with at least this many photons are used to build templates
+    max_memory : int, optional
+        Memory budget, in bytes, for table blocks and batches
+    random_state : int, optional
+    overwrite : bool, optional
+        Overwrite existing template library; otherwise, an existing library
+        is reused and only template assignment is performed
+    threads : int, optional
+        Number of threads for assigning templates
+
+    Returns
+    -------
+    templates : array
+
+    """
+    t0 = time.time()
+    table_fpaths = get_table_fpaths(tables)
+    outdir = expand(outdir)
+    mkdir(outdir)
+    templates_fpath = join(outdir, TEMPLATES_FNAME)
+
+    if isfile(templates_fpath) and not overwrite:
+        print('Using existing template library "{}"'.format(templates_fpath))
+        templates = np.load(templates_fpath)
+    else:
+        batch_rows = _get_batch_rows(
+            table_fpaths, max_memory=max_memory, min_rows=max(n_components, n_clusters)
+        )
+        kw = dict(
+            table_fpaths=table_fpaths,
+            batch_rows=batch_rows,
+            min_photons=min_photons,
+            max_memory=max_memory,
+        )
+        pca = fit_pca(n_components=n_components, **kw)
+        kmeans = fit_kmeans(
+            pca=pca, n_clusters=n_clusters, epochs=kmeans_epochs,
+            random_state=random_state, **kw
+        )
+        with open(join(outdir, MODELS_FNAME), 'wb') as fobj:
+            pickle.dump(dict(pca=pca, kmeans=kmeans), fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        templates = sum_templates(pca=pca, kmeans=kmeans, **kw)
+        np.save(templates_fpath, templates)
+        print('Saved {} templates to "{}"'.format(templates.shape[0], templates_fpath))
+
+    for table_fpath in table_fpaths:
+        if isfile(join(dirname(table_fpath), 'ckv_template_map.npy')) and not overwrite:
+            print('Template map exists, not overwriting: "{}"'.format(dirname(table_fpath)))
+            continue
+        assign_templates(
+            table_fpath, templates=templates, max_memory=max_memory, threads=threads
+        )
+        print('Assigned templates for "{}"'.format(table_fpath))
+
+    print('Template compression took {:.1f} s'.format(time.time() - t0))
+    return templates
+
+
+def parse_args(description=__doc__):
+    """Parse command line arguments"""
+    parser = ArgumentParser(description=description)
+    parser.add_argument(
+        '--tables', nargs='+', required=True,
+        help='''Cherenkov table directories or "ckv_table.npy" files; glob
+        expressions are expanded'''
+    )
+    parser.add_argument(
+        '--outdir', required=True,
+        help='''Directory in which to save the template library'''
+    )
+    parser.add_argument(
+        '--n-components', type=int, default=100,
+        help='''Number of PCA components'''
+    )
+    parser.add_argument(
+        '--n-clusters', type=int, default=4000,
+        help='''Number of templates'''
+    )
+    parser.add_argument(
+        '--kmeans-epochs', type=int, default=1,
+        help='''Number of passes over all tables when fitting k-means'''
+    )
+    parser.add_argument(
+        '--min-photons', type=float, default=DFLT_MIN_PHOTONS,
+        help='''Only maps with at least this many photons are used to build
+        templates'''
+    )
+    parser.add_argument(
+        '--max-memory-mib', type=float, default=DFLT_MAX_MEMORY / 2**20,
+        help='''Memory budget (MiB) for table blocks and batches'''
+    )
+    parser.add_argument(
+        '--random-state', type=int, default=0,
+    )
+    parser.add_argument(
+        '--threads', type=int, default=1,
+        help='''Number of threads for assigning templates to table bins'''
+    )
+    parser.add_argument(
+        '--overwrite', action='store_true',
+        help='''Rebuild the template library and template maps if they
+        exist'''
+    )
+    kwargs = vars(parser.parse_args())
+    kwargs['max_memory'] = int(kwargs.pop('max_memory_mib') * 2**20)
+    return kwargs
+
+
+def main():
+    """Script interface to `compress_tables`"""
+    compress_tables(**parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -16,7 +16,12 @@ mapping.
 from __future__ import absolute_import, division, print_function
 
 __all__ = [
+    'CONE_OPERATOR_FNAME_PROTO',
+    'DFLT_CHUNK_NBYTES',
     'get_cone_map',
+    'get_cone_operator',
+    'apply_cone_operator',
+    'test_cone_operator',
     'convolve_table',
     'survival_prob_from_smeared_cone',
     'survival_prob_from_cone',
@@ -38,15 +43,30 @@ See the License for the specific language governing permissions and
 limitations under the License.'''
 
 import math
+from os import getpid, rename
+from os.path import abspath, dirname, isfile, join
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
 
 from numba import jit, njit, prange
 import numpy as np
 
+if __name__ == '__main__' and __package__ is None:
+    RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
+    if RETRO_DIR not in sys.path:
+        sys.path.append(RETRO_DIR)
+from retro.utils.misc import expand, hash_obj, mkdir
+
 
 FLOAT_T = np.float64
 PI = FLOAT_T(np.pi)
 TWO_PI = FLOAT_T(2*np.pi)
 
+CONE_OPERATOR_FNAME_PROTO = 'cone_operator_{hash:s}.npz'
+
+DFLT_CHUNK_NBYTES = 2**28
+
 
 # NOTE: dithering the ckv angle appears to do non-representative things to the
 # resulting table. Smearing can be done on resulting table if that makes more
@@ -251,7 +271,344 @@ def get_cone_map(
     return costheta_indices, phi_indices, weights
 
 
+@njit(nogil=True, cache=True)
+def _get_dir_bin_cone_map(
+    cos_ckv,
+    sin_ckv,
+    num_cone_samples,
+    oversample,
+    costhetadir_idx,
+    phidir_idx,
+    n_costhetadir,
+    n_phidir,
+    costhetadir_min,
+    costhetadir_max,
+    phidir_min,
+    phidir_max,
+):
+    """Cone map for Cherenkov emitters in one output (costhetadir, phidir)
+    bin, averaged over `oversample`^2 emitter directions within the bin; see
+    `get_cone_map` for the returned values"""
+    costhetadir_bw = (costhetadir_max - costhetadir_min) / n_costhetadir
+    phidir_bw = (phidir_max - phidir_min) / n_phidir
+
+    costhetadir_samp_step = costhetadir_bw / oversample
+    phidir_samp_step = phidir_bw / oversample
+
+    costhetadir_min_samp = costhetadir_min + 0.5 * costhetadir_samp_step
+    phidir_min_samp = phidir_min + 0.5 * phidir_samp_step
+
+    samples_shape = (oversample, oversample)
+
+    # Cosine and sine of thetadir
+    costhetadir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
+    sinthetadir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
+
+    # Cosine and sine of phidir
+    cosphidir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
+    sinphidir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
+
+    costhetadir0 = costhetadir_min_samp + costhetadir_idx*costhetadir_bw
+    phidir0 = phidir_min_samp + phidir_idx*phidir_bw
+
+    for costhetadir_subidx in range(oversample):
+        costhetadir_samp = costhetadir0 + costhetadir_subidx * costhetadir_samp_step
+        sinthetadir_samp = math.sin(math.acos(costhetadir_samp))
+
+        for phidir_subidx in range(oversample):
+            phidir_samp = phidir0 + phidir_subidx * phidir_samp_step
+            cosphidir_samp = math.cos(phidir_samp)
+            sinphidir_samp = math.sin(phidir_samp)
+
+            costhetadir_samples[costhetadir_subidx, phidir_subidx] = costhetadir_samp
+            sinthetadir_samples[costhetadir_subidx, phidir_subidx] = sinthetadir_samp
+            cosphidir_samples[costhetadir_subidx, phidir_subidx] = cosphidir_samp
+            sinphidir_samples[costhetadir_subidx, phidir_subidx] = sinphidir_samp
+
+    return get_cone_map(
+        ckv_costheta=cos_ckv,
+        ckv_sintheta=sin_ckv,
+        num_phi=num_cone_samples,
+        axis_costheta=costhetadir_samples,
+        axis_sintheta=sinthetadir_samples,
+        axis_cosphi=cosphidir_samples,
+        axis_sinphi=sinphidir_samples,
+        num_costheta_bins=n_costhetadir,
+        num_phi_bins=n_phidir,
+        costheta_min=costhetadir_min,
+        costheta_max=costhetadir_max,
+        phi_min=phidir_min,
+        phi_max=phidir_max,
+    )
+
+
+def get_cone_operator(
+    cos_ckv,
+    num_cone_samples,
+    oversample,
+    n_costhetadir,
+    n_phidir,
+    costhetadir_min,
+    costhetadir_max,
+    phidir_min,
+    phidir_max,
+    cache_dir=None,
+):
+    """Get the sparse (n_dir x n_dir) linear operator, n_dir = n_costhetadir *
+    n_phidir, that maps directional survival probabilities to those for
+    Cherenkov emitters (see `convolve_table` for parameter definitions).
+
+    The operator depends only on the Cherenkov angle and the directional
+    binning (not on table contents), so it can be computed once and applied to
+    any number of tables.
+
+    Parameters
+    ----------
+    cos_ckv, num_cone_samples, oversample
+    n_costhetadir, n_phidir : int > 0
+    costhetadir_min, costhetadir_max, phidir_min, phidir_max
+    cache_dir : string, optional
+        If specified, load the operator from a file in this directory if it
+        exists, otherwise compute it and save it there
+
+    Returns
+    -------
+    indptr : shape (n_dir + 1,) int64 array
+    indices : int64 array
+    weights : float64 array
+        Operator in compressed sparse row (CSR) format: row `i` (the flattened
+        output bin index) has input-bin indices
+        ``indices[indptr[i]:indptr[i+1]]`` with corresponding weights
+
+    """
+    params = (
+        float(cos_ckv),
+        int(num_cone_samples),
+        int(oversample),
+        int(n_costhetadir),
+        int(n_phidir),
+        float(costhetadir_min),
+        float(costhetadir_max),
+        float(phidir_min),
+        float(phidir_max),
+    )
+
+    cache_fpath = None
+    if cache_dir is not None:
+        cache_dir = expand(cache_dir)
+        cache_fpath = join(
+            cache_dir,
+            CONE_OPERATOR_FNAME_PROTO.format(hash=hash_obj(params, fmt='hex')),
+        )
+        if isfile(cache_fpath):
+            with np.load(cache_fpath) as npz:
+                return npz['indptr'], npz['indices'], npz['weights']
+
+    cos_ckv = FLOAT_T(cos_ckv)
+    sin_ckv = math.sin(math.acos(cos_ckv))
+
+    n_dir = n_costhetadir * n_phidir
+    indptr = np.zeros(n_dir + 1, dtype=np.int64)
+    all_indices = []
+    all_weights = []
+    for costhetadir_idx in range(n_costhetadir):
+        for phidir_idx in range(n_phidir):
+            ctdir_idxs, phidir_idxs, weights = _get_dir_bin_cone_map(
+                cos_ckv,
+                sin_ckv,
+                num_cone_samples,
+                oversample,
+                costhetadir_idx,
+                phidir_idx,
+                n_costhetadir,
+                n_phidir,
+                FLOAT_T(costhetadir_min),
+                FLOAT_T(costhetadir_max),
+                FLOAT_T(phidir_min),
+                FLOAT_T(phidir_max),
+            )
+            dir_idx = costhetadir_idx * n_phidir + phidir_idx
+            indptr[dir_idx + 1] = indptr[dir_idx] + len(weights)
+            all_indices.append(ctdir_idxs * n_phidir + phidir_idxs)
+            all_weights.append(weights)
+
+    indices = np.concatenate(all_indices).astype(np.int64)
+    weights = np.concatenate(all_weights).astype(np.float64)
+
+    if cache_fpath is not None:
+        mkdir(cache_dir)
+        tmp_fpath = '{}.{}.tmp'.format(cache_fpath, getpid())
+        with open(tmp_fpath, 'wb') as fobj:
+            np.savez(
+                fobj,
+                indptr=indptr,
+                indices=indices,
+                weights=weights,
+                params=np.array(params, dtype=np.float64),
+            )
+        rename(tmp_fpath, cache_fpath)
+
+    return indptr, indices, weights
+
+
 @njit(parallel=True, nogil=True, cache=True)
+def apply_cone_operator(src, dst, indptr, indices, weights):
+    """Apply a cone operator (see `get_cone_operator`) to each row of `src`,
+    storing results in `dst`: ``dst = src . operator^T``.
+
+    Parameters
+    ----------
+    src : shape (n_rows, n_dir) array
+    dst : shape (n_rows, n_dir) array
+    indptr, indices, weights : arrays
+
+    """
+    n_rows, n_dir = src.shape
+    for row_idx in prange(n_rows): # pylint: disable=not-an-iterable
+        for dir_idx in range(n_dir):
+            # Weights account for normalization
+            total = 0.0
+            for i in range(indptr[dir_idx], indptr[dir_idx + 1]):
+                total += weights[i] * src[row_idx, indices[i]]
+            dst[row_idx, dir_idx] = total
+
+
+def _reference_cone_operator(
+    cos_ckv,
+    num_cone_samples,
+    oversample,
+    n_costhetadir,
+    n_phidir,
+    costhetadir_min,
+    costhetadir_max,
+    phidir_min,
+    phidir_max,
+):
+    """Dense cone operator, computed by explicitly rotating the sampled cone
+    directions to each emitter direction (sampled `oversample`^2 times within
+    each bin)"""
+    sin_ckv = math.sin(math.acos(cos_ckv))
+    abs_phidir = phidir_min == 0 and phidir_max == np.pi
+    ctbw = (costhetadir_max - costhetadir_min) / n_costhetadir
+    phibw = (phidir_max - phidir_min) / n_phidir
+    cone_phi = 2*np.pi / num_cone_samples * np.arange(num_cone_samples)
+
+    n_dir = n_costhetadir * n_phidir
+    operator = np.zeros((n_dir, n_dir))
+    for costhetadir_idx in range(n_costhetadir):
+        for phidir_idx in range(n_phidir):
+            dir_idx = costhetadir_idx * n_phidir + phidir_idx
+            for costhetadir_subidx in range(oversample):
+                costhetadir = (
+                    costhetadir_min + (costhetadir_idx + (costhetadir_subidx + 0.5) / oversample)
+                    * ctbw
+                )
+                thetadir = math.acos(costhetadir)
+                for phidir_subidx in range(oversample):
+                    phidir = (
+                        phidir_min + (phidir_idx + (phidir_subidx + 0.5) / oversample) * phibw
+                    )
+                    # Emitter direction and two unit vectors perpendicular to it
+                    axis = np.array([
+                        math.sin(thetadir) * math.cos(phidir),
+                        math.sin(thetadir) * math.sin(phidir),
+                        math.cos(thetadir),
+                    ])
+                    theta_hat = np.array([
+                        math.cos(thetadir) * math.cos(phidir),
+                        math.cos(thetadir) * math.sin(phidir),
+                        -math.sin(thetadir),
+                    ])
+                    phi_hat = np.array([-math.sin(phidir), math.cos(phidir), 0.])
+                    cone_dirs = (
+                        cos_ckv * axis[np.newaxis, :]
+                        + sin_ckv * (
+                            np.cos(cone_phi)[:, np.newaxis] * theta_hat[np.newaxis, :]
+                            + np.sin(cone_phi)[:, np.newaxis] * phi_hat[np.newaxis, :]
+                        )
+                    )
+                    q_phi = np.arctan2(cone_dirs[:, 1], cone_dirs[:, 0])
+                    if abs_phidir:
+                        q_phi = np.abs(q_phi)
+                    ct_bins = np.clip(
+                        ((cone_dirs[:, 2] - costhetadir_min) / ctbw).astype(int),
+                        0, n_costhetadir - 1
+                    )
+                    phi_bins = np.clip(
+                        ((q_phi - phidir_min) / phibw).astype(int), 0, n_phidir - 1
+                    )
+                    np.add.at(operator[dir_idx], ct_bins * n_phidir + phi_bins, 1)
+            operator[dir_idx] /= num_cone_samples * oversample**2
+    return operator
+
+
+def test_cone_operator():
+    """Unit tests for functions `get_cone_operator`, `apply_cone_operator`, and
+    `convolve_table`."""
+    rand = np.random.RandomState(0)
+    kw = dict(
+        cos_ckv=1/1.33,
+        num_cone_samples=37,
+        oversample=3,
+        n_costhetadir=7,
+        # Odd `n_phidir` would put directions opposite the emitters' (in
+        # azimuth) exactly on bin edges, where rounding decides the bin
+        n_phidir=8,
+        costhetadir_min=-1.,
+        costhetadir_max=1.,
+    )
+    n_dir = kw['n_costhetadir'] * kw['n_phidir']
+
+    tmpdir = mkdtemp(suffix='test_cone_operator')
+    try:
+        for phidir_min, phidir_max in [(0., np.pi), (-np.pi, np.pi)]:
+            kw['phidir_min'], kw['phidir_max'] = phidir_min, phidir_max
+            ref_operator = _reference_cone_operator(**kw)
+            assert np.allclose(ref_operator.sum(axis=1), 1)
+
+            for cache_dir in [None, tmpdir, tmpdir]:
+                indptr, indices, weights = get_cone_operator(cache_dir=cache_dir, **kw)
+                assert len(indptr) == n_dir + 1 and indptr[-1] == len(indices) == len(weights)
+                operator = np.zeros((n_dir, n_dir))
+                for dir_idx in range(n_dir):
+                    row = slice(indptr[dir_idx], indptr[dir_idx + 1])
+                    # Each input bin appears at most once per output bin
+                    assert len(np.unique(indices[row])) == len(indices[row])
+                    operator[dir_idx, indices[row]] = weights[row]
+                assert np.allclose(operator, ref_operator, rtol=0, atol=1e-12), \
+                        np.max(np.abs(operator - ref_operator))
+
+            src = rand.rand(5, 4, kw['n_costhetadir'], kw['n_phidir'])
+            ref_dst = np.dot(src.reshape(-1, n_dir), ref_operator.T).reshape(src.shape)
+
+            dst = np.empty_like(src)
+            apply_cone_operator(
+                src.reshape(-1, n_dir), dst.reshape(-1, n_dir), indptr, indices, weights
+            )
+            assert np.allclose(dst, ref_dst, rtol=1e-12, atol=0)
+
+            for chunk_size in [None, 1, 7]:
+                dst = np.empty_like(src)
+                convolve_table(
+                    src=src,
+                    dst=dst,
+                    cos_ckv=kw['cos_ckv'],
+                    num_cone_samples=kw['num_cone_samples'],
+                    oversample=kw['oversample'],
+                    costhetadir_min=kw['costhetadir_min'],
+                    costhetadir_max=kw['costhetadir_max'],
+                    phidir_min=phidir_min,
+                    phidir_max=phidir_max,
+                    cache_dir=tmpdir,
+                    chunk_size=chunk_size,
+                )
+                assert np.allclose(dst, ref_dst, rtol=1e-12, atol=0)
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+    print('<< PASS : test_cone_operator >>')
+
+
 def convolve_table(
     src,
     dst,
@@ -262,15 +619,19 @@ def convolve_table(
     costhetadir_max,
     phidir_min,
     phidir_max,
+    cache_dir=None,
+    chunk_size=None,
 ):
     """
     Parameters
     ----------
     src : shape (..., n_costhetadir, n_phidir) arrays
         Source array; at least 2 dimensions, where second-to-last dimension
-        must be costhetadir and last dimension must be phidir
+        must be costhetadir and last dimension must be phidir. Can be memory
+        mapped.
 
     dst : same shape as `src`
+        Can be memory mapped.
 
     cos_ckv : float
         Cosine of Cherenkov angle
@@ -290,6 +651,13 @@ def convolve_table(
     phidir_min, phidir_max : floats with phidir_max - phidir_min == 2*pi
         Lower and upper edges of phidir binning
 
+    cache_dir : string, optional
+        Directory in which to cache the cone operator; see `get_cone_operator`
+
+    chunk_size : int > 0, optional
+        Number of non-directional bins to process at a time; if not specified,
+        chunks of approximately `DFLT_CHUNK_NBYTES` of `src` are used
+
     """
     assert src.ndim >= 2
     assert dst.shape == src.shape
@@ -301,83 +669,35 @@ def convolve_table(
     assert -1 <= costhetadir_min <= 1
     assert np.abs((phidir_max - phidir_min) - 2*np.pi) < 1e5
 
-    sin_ckv = math.sin(math.acos(cos_ckv))
-
     n_costhetadir = src.shape[-2]
     n_phidir = src.shape[-1]
-
-    src_flat = src.reshape(-1, n_costhetadir, n_phidir)
-    dst_flat = dst.reshape(-1, n_costhetadir, n_phidir)
-
+    n_dir = n_costhetadir * n_phidir
+
+    indptr, indices, weights = get_cone_operator(
+        cos_ckv=cos_ckv,
+        num_cone_samples=num_cone_samples,
+        oversample=oversample,
+        n_costhetadir=n_costhetadir,
+        n_phidir=n_phidir,
+        costhetadir_min=costhetadir_min,
+        costhetadir_max=costhetadir_max,
+        phidir_min=phidir_min,
+        phidir_max=phidir_max,
+        cache_dir=cache_dir,
+    )
+
+    src_flat = src.reshape(-1, n_dir)
+    dst_flat = dst.reshape(-1, n_dir)
     n_nondir_bins = src_flat.shape[0]
 
-    costhetadir_bw = (costhetadir_max - costhetadir_min) / n_costhetadir
-    phidir_bw = (phidir_max - phidir_min) / n_phidir
-
-    costhetadir_samp_step = costhetadir_bw / oversample
-    phidir_samp_step = phidir_bw / oversample
+    if chunk_size is None:
+        chunk_size = max(1, DFLT_CHUNK_NBYTES // (n_dir * src.itemsize))
 
-    costhetadir_min_samp = costhetadir_min + 0.5 * costhetadir_samp_step
-    phidir_min_samp = phidir_min + 0.5 * phidir_samp_step
-
-    samples_shape = (oversample, oversample)
-
-    # Cosine and sine of thetadir
-    costhetadir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
-    sinthetadir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
-
-    # Cosine and sine of phidir
-    cosphidir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
-    sinphidir_samples = np.empty(shape=samples_shape, dtype=FLOAT_T)
-
-    for costhetadir_idx in range(n_costhetadir):
-        costhetadir0 = costhetadir_min_samp + costhetadir_idx*costhetadir_bw
-
-        for phidir_idx in range(n_phidir):
-            phidir0 = phidir_min_samp + phidir_idx*phidir_bw
-
-            for costhetadir_subidx in prange(oversample): # pylint: disable=not-an-iterable
-                costhetadir_samp = costhetadir0 + costhetadir_subidx * costhetadir_samp_step
-                sinthetadir_samp = math.sin(math.acos(costhetadir_samp))
-
-                for phidir_subidx in range(oversample):
-                    phidir_samp = phidir0 + phidir_subidx * phidir_samp_step
-                    cosphidir_samp = math.cos(phidir_samp)
-                    sinphidir_samp = math.sin(phidir_samp)
-
-                    costhetadir_samples[costhetadir_subidx, phidir_subidx] = costhetadir_samp
-                    sinthetadir_samples[costhetadir_subidx, phidir_subidx] = sinthetadir_samp
-                    cosphidir_samples[costhetadir_subidx, phidir_subidx] = cosphidir_samp
-                    sinphidir_samples[costhetadir_subidx, phidir_subidx] = sinphidir_samp
-
-            ctdir_idxs, phidir_idxs, weights = get_cone_map(
-                ckv_costheta=cos_ckv,
-                ckv_sintheta=sin_ckv,
-                num_phi=num_cone_samples,
-                axis_costheta=costhetadir_samples,
-                axis_sintheta=sinthetadir_samples,
-                axis_cosphi=cosphidir_samples,
-                axis_sinphi=sinphidir_samples,
-                num_costheta_bins=n_costhetadir,
-                num_phi_bins=n_phidir,
-                costheta_min=costhetadir_min,
-                costheta_max=costhetadir_max,
-                phi_min=phidir_min,
-                phi_max=phidir_max,
-            )
-
-            n_map = len(weights)
-
-            for nondir_idx in prange(n_nondir_bins): # pylint: disable=not-an-iterable
-                # Apply the weights to the corresponding entries
-                # (note that weights account for normalization)
-                total = 0.0
-                for i in range(n_map):
-                    total += weights[i] * src_flat[nondir_idx, ctdir_idxs[i], phidir_idxs[i]]
-
-                dst_flat[nondir_idx, costhetadir_idx, phidir_idx] = total
-
-            #wstderr('({}, {}) '.format(costhetadir_idx, phidir_idx))
+    for start in range(0, n_nondir_bins, chunk_size):
+        stop = min(start + chunk_size, n_nondir_bins)
+        apply_cone_operator(
+            src_flat[start:stop], dst_flat[start:stop], indptr, indices, weights
+        )
 
 
 @jit(parallel=False, nogil=False, cache=True)
@@ -601,3 +921,7 @@ def survival_prob_from_cone(
     survival_prob = survival_prob / FLOAT_T(counts_total)
 
     return survival_prob, bin_indices, counts
+
+
+if __name__ == '__main__':
+    test_cone_operator()
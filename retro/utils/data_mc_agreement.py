@@ -49,7 +49,7 @@ if __name__ == "__main__" and __package__ is None:
     RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
     if RETRO_DIR not in sys.path:
         sys.path.append(RETRO_DIR)
-from retro import load_pickle
+from retro.i3processing.flat_pulses import load_pulses_lists
 from retro.retro_types import PULSE_T
 from retro.utils.misc import expand, mkdir, nsort_key_func, wstderr
 
@@ -504,7 +504,7 @@ def process_dir(
         if np.count_nonzero(mask_vals) == 0:
             return stats
 
-    pulses = load_pickle(join(dirpath, "pulses", "{}.pkl".format(PULSE_SERIES_NAME)))
+    pulses = load_pulses_lists(dirpath, PULSE_SERIES_NAME)
 
     for mask_val, event_pulses, weight in zip(mask_vals, pulses, weights):
         if not mask_val:
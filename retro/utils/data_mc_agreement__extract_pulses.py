@@ -27,7 +27,7 @@ if __name__ == "__main__" and __package__ is None:
     RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
     if RETRO_DIR not in sys.path:
         sys.path.append(RETRO_DIR)
-from retro import load_pickle
+from retro.i3processing.flat_pulses import load_pulses_lists
 from retro.retro_types import NEUTRINOS, PULSE_T
 from retro.utils.misc import expand, mkdir, nsort_key_func
 
@@ -203,7 +203,7 @@ def process_events_dir(events_dirpath, pulse_series):
         dom_idx0 = 0
         pulses_idx0 = 0
 
-        pulses = load_pickle(join(events_dirpath, "pulses", "{}.pkl".format(pulse_series)))
+        pulses = load_pulses_lists(events_dirpath, pulse_series)
         linefit_dc = np.load(join(events_dirpath, "recos", "LineFit_DC.npy"))
 
         for rel_idx, valid_idx in enumerate(valid_event_indices):
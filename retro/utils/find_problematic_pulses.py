@@ -21,7 +21,7 @@ if __name__ == "__main__" and __package__ is None:
     RETRO_DIR = dirname(dirname(dirname(abspath(__file__))))
     if RETRO_DIR not in sys.path:
         sys.path.append(RETRO_DIR)
-from retro import load_pickle
+from retro.i3processing.flat_pulses import load_pulses_lists
 from retro.utils.misc import expand, nsort_key_func
 
 
@@ -69,12 +69,9 @@ def find_problematic_pulses(indir, pulse_series):
         # If any one of the named pulse series are missing or bad, record
         # the path and move on without checking the other pulse series
         for ps_name in pulse_series:
-            pulses_fpath = join(dirpath, "pulses", ps_name + ".pkl")
-            if not isfile(pulses_fpath):
-                print(dirpath)
-                break
             try:
-                pulses = load_pickle(pulses_fpath)
+                # Flat pulses if found, else legacy .pkl; missing is an error
+                pulses = load_pulses_lists(dirpath, ps_name)
                 if len(pulses) > 0 and "flags" not in pulses[0][0][1].dtype.names:
                     print(dirpath)
                     break
@@ -6,6 +6,13 @@ Installation script for the Retro project
 
 from __future__ import absolute_import
 
+from distutils.ccompiler import new_compiler
+from distutils.errors import CompileError, LinkError
+from distutils.sysconfig import customize_compiler
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
 from setuptools import setup, Extension, find_packages
 
 from Cython.Build import cythonize
@@ -13,6 +20,36 @@ import numpy as np
 import versioneer
 
 
+def get_openmp_flags():
+    """Compiler/linker flags enabling OpenMP if the compiler supports
+    "-fopenmp" (e.g., Apple clang does not), otherwise none (in which case
+    OpenMP-parallel loops run in a single thread)"""
+    flags = ['-fopenmp']
+    tmp_dir = mkdtemp()
+    try:
+        src_fpath = join(tmp_dir, 'test_openmp.c')
+        with open(src_fpath, 'w') as fobj:
+            fobj.write(
+                '#include <omp.h>\n'
+                'int main(void) { return omp_get_max_threads() < 1; }\n'
+            )
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        objects = compiler.compile(
+            [src_fpath], output_dir=tmp_dir, extra_postargs=flags
+        )
+        compiler.link_executable(
+            objects, join(tmp_dir, 'test_openmp'), extra_postargs=flags
+        )
+    except (CompileError, LinkError):
+        return []
+    finally:
+        rmtree(tmp_dir, ignore_errors=True)
+    return flags
+
+
+OPENMP_FLAGS = get_openmp_flags()
+
 EXT_MODULES = [
     Extension(
         'retro.tables.sphbin2cartbin',
@@ -21,6 +58,8 @@ EXT_MODULES = [
     Extension(
         'retro.tables.shift_and_bin',
         ['retro/tables/shift_and_bin.pyx'],
+        extra_compile_args=OPENMP_FLAGS,
+        extra_link_args=OPENMP_FLAGS,
     )
 ]
 